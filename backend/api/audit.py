@@ -0,0 +1,277 @@
+"""
+Access Audit
+Buffers access log events and writes them in anchored batches
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import List, Optional
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+
+class AuditBuffer:
+    """
+    In-process buffer of AccessLog rows
+
+    Events are kept in memory and written with one bulk_create and one
+    anchor transaction when AUDIT_BUFFER_SIZE events are waiting or the
+    oldest has waited AUDIT_FLUSH_INTERVAL seconds (checked after each
+    request, never while recording), and at process exit. Each row's
+    blockchain_tx_id is '<tx id>#<index in batch>'. A crashed worker loses
+    at most one interval of events.
+
+    While anchoring fails the events stay buffered, and beyond
+    AUDIT_BUFFER_MAX the oldest are spilled to JSON lines files in
+    AUDIT_SPILL_DIR, which the next successful flush of any worker
+    claims and writes. Anchored events that cannot be inserted are
+    spilled with their tx ids and written later without anchoring again.
+    """
+
+    def __init__(self, size: Optional[int] = None, interval: Optional[float] = None,
+                 max_events: Optional[int] = None, spill_dir: Optional[str] = None):
+        self.size = size or settings.AUDIT_BUFFER_SIZE
+        self.interval = settings.AUDIT_FLUSH_INTERVAL if interval is None else interval
+        self.max_events = max_events or settings.AUDIT_BUFFER_MAX
+        self.spill_dir = spill_dir or settings.AUDIT_SPILL_DIR
+        self._events = []
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def record(self, accessor_did: str, patient_id, resource_type: str, resource_id, action: str,
+               consent_id=None, request=None) -> None:
+        """
+        Buffer one access event
+
+        Never raises: an audit failure must not fail the request that was
+        audited. Writing is left to flush_if_due.
+
+        Args:
+            accessor_did: DID of the caller
+            patient_id: Patient whose data was accessed
+            resource_type: FHIR resource type
+            resource_id: Resource id
+            action: 'read', 'create', 'update' or 'delete'
+            consent_id: Consent the access relied on (None for the patient)
+            request: Request, for the client address and user agent
+        """
+        from fhir.models import AccessLog
+
+        try:
+            event = AccessLog(
+                id=uuid.uuid4(),
+                accessor_did=accessor_did,
+                patient_id=patient_id,
+                resource_type=resource_type,
+                resource_id=resource_id,
+                action=action,
+                consent_id=consent_id,
+                accessed_at=timezone.now(),
+                ip_address=request.META.get('REMOTE_ADDR') if request else None,
+                user_agent=request.META.get('HTTP_USER_AGENT') if request else None,
+            )
+            self._buffer([event])
+        except Exception:
+            logger.exception(f"Error buffering {action} access event for {resource_type}/{resource_id}")
+
+    def _buffer(self, events: list, front: bool = False) -> None:
+        """Add events to the buffer, spilling the oldest beyond max_events to disk"""
+        with self._lock:
+            if front:
+                self._events[:0] = events
+            else:
+                self._events.extend(events)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            overflow = len(self._events) - self.max_events
+            spilled = []
+            if overflow > 0:
+                spilled, self._events = self._events[:overflow], self._events[overflow:]
+        if spilled:
+            self._spill(spilled)
+
+    def _spill(self, events: list) -> None:
+        """Write events to a new spill file (written aside, then renamed into place)"""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f'audit-{os.getpid()}-{uuid.uuid4().hex}.jsonl')
+        try:
+            with open(path + '.tmp', 'w') as spill:
+                for event in events:
+                    spill.write(json.dumps(_spill_row(event)) + '\n')
+            os.replace(path + '.tmp', path)
+            logger.warning(f"Spilled {len(events)} access log events to {path}")
+        except OSError:
+            logger.exception(f"Error spilling {len(events)} access log events; they are lost")
+
+    def _claim_spilled(self) -> List:
+        """Take the spill files no other worker has claimed and load their events"""
+        from fhir.models import AccessLog
+
+        events = []
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, 'audit-*.jsonl'))):
+            claimed = f'{path}.{os.getpid()}.claimed'
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # Claimed by another worker
+            with open(claimed) as spill:
+                for line in spill:
+                    row = json.loads(line)
+                    row['accessed_at'] = parse_datetime(row['accessed_at'])
+                    events.append(AccessLog(**row))
+            os.remove(claimed)
+        return events
+
+    def flush_if_due(self) -> int:
+        """Flush when the buffer is full or its oldest event is too old"""
+        if not self._events:
+            return 0
+        if len(self._events) >= self.size or time.monotonic() - self._oldest >= self.interval:
+            return self.flush()
+        return 0
+
+    def flush(self) -> int:
+        """
+        Write and anchor all buffered events
+
+        Returns:
+            Number of events written
+        """
+        from blockchain import get_cardano_client, get_hash_manager
+
+        with self._lock:
+            events, self._events, self._oldest = self._events, [], None
+        if os.path.isdir(self.spill_dir):
+            events = self._claim_spilled() + events
+        if not events:
+            return 0
+
+        # Spilled after an earlier insert failure: anchored already
+        pending = [event for event in events if not event.blockchain_tx_id]
+        if pending:
+            hash_manager = get_hash_manager()
+            hashes = [hash_manager.generate_hash(_event_data(event)) for event in pending]
+            try:
+                tx_id = get_cardano_client().submit_access_batch(
+                    merkle_root=hash_manager.merkle_root(hashes),
+                    count=len(pending),
+                    actions=dict(Counter(event.action for event in pending)),
+                )
+            except Exception as e:
+                # Keep the events for the next flush rather than lose them
+                logger.error(f"Error anchoring {len(pending)} access log events, will retry: {e}")
+                self._buffer(events, front=True)
+                raise
+
+            for position, event in enumerate(pending):
+                event.blockchain_tx_id = f"{tx_id}#{position}"
+            logger.info(f"Anchored {len(pending)} access log events in {tx_id}")
+
+        written = self._write(events)
+        logger.info(f"Wrote {written} of {len(events)} access log events")
+        return written
+
+    def _write(self, events: list) -> int:
+        """
+        Insert anchored events
+
+        If the batch insert fails, events are inserted one by one and those
+        that still fail (e.g. their patient was deleted meanwhile, or the
+        database is down) are spilled with their tx ids for a later flush.
+
+        Returns:
+            Number of events inserted
+        """
+        from fhir.models import AccessLog
+
+        try:
+            with transaction.atomic():
+                AccessLog.objects.bulk_create(events)
+            return len(events)
+        except Exception as e:
+            logger.error(f"Error writing {len(events)} anchored access log events, retrying one by one: {e}")
+
+        failed = []
+        for position, event in enumerate(events):
+            try:
+                with transaction.atomic():
+                    event.save(force_insert=True)
+            except IntegrityError:
+                failed.append(event)
+            except Exception:
+                logger.exception("Error writing access log events")
+                failed.extend(events[position:])
+                break
+        if failed:
+            self._spill(failed)
+        return len(events) - len(failed)
+
+
+def _spill_row(event) -> dict:
+    return {
+        'id': str(event.id),
+        'accessor_did': event.accessor_did,
+        'patient_id': str(event.patient_id),
+        'resource_type': event.resource_type,
+        'resource_id': str(event.resource_id),
+        'action': event.action,
+        'consent_id': str(event.consent_id) if event.consent_id else None,
+        'accessed_at': event.accessed_at.isoformat(),
+        'ip_address': event.ip_address,
+        'user_agent': event.user_agent,
+        'blockchain_tx_id': event.blockchain_tx_id,
+    }
+
+
+def _event_data(event) -> dict:
+    return {
+        'id': str(event.id),
+        'accessorDID': event.accessor_did,
+        'patientId': str(event.patient_id),
+        'resourceType': event.resource_type,
+        'resourceId': str(event.resource_id),
+        'action': event.action,
+        'accessedAt': event.accessed_at.isoformat(),
+    }
+
+
+# Singleton instance
+_audit_buffer = None
+
+
+def get_audit_buffer() -> AuditBuffer:
+    """Get singleton AuditBuffer instance"""
+    global _audit_buffer
+    if _audit_buffer is None:
+        _audit_buffer = AuditBuffer()
+        atexit.register(_flush_at_exit)
+    return _audit_buffer
+
+
+def _flush_at_exit() -> None:
+    try:
+        _audit_buffer.flush()
+    except Exception:
+        logger.exception("Error writing access log events at exit")
+
+
+def flush_due_audit_events() -> None:
+    """Flush the buffer if it is due, logging rather than raising errors"""
+    if _audit_buffer is not None:
+        try:
+            _audit_buffer.flush_if_due()
+        except Exception:
+            logger.exception("Error writing access log events")
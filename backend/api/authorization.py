@@ -0,0 +1,168 @@
+"""
+Record Authorization
+Fetches a FHIR record, its patient and the caller's consent in one query
+"""
+import logging
+import time
+import uuid
+from typing import NamedTuple, Optional
+from django.contrib.postgres.aggregates import JSONBAgg
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import JSONObject
+from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import PermissionDenied
+
+from fhir.consent_decisions import ConsentDecision, decision_from_grants, get_consent_service
+from fhir.consent_scope import compile_scope
+from fhir.models import ConsentRecord
+
+logger = logging.getLogger(__name__)
+
+# Resource types providers may search across all the patients who consented
+# to them, e.g. an Encounter census by period-overlaps
+CROSS_PATIENT_SEARCHES = frozenset({'Encounter'})
+
+
+class AuthorizedRecord(NamedTuple):
+    """A record the caller may read"""
+    instance: object
+    patient: object
+    consent_id: Optional[uuid.UUID]  # None when the patient reads their own record
+
+
+def with_consent_grants(queryset, accessor_did: str, patient_field: str = 'patient'):
+    """
+    Annotate each record with the caller's active consents for its patient
+
+    Adds 'consent_grants': a JSON array of {id, expires_at, scope} for the
+    accessor's direct, care team and organization consents, latest expiry
+    first, computed by a correlated subquery in the same statement.
+    patient_field=None annotates Patient rows themselves.
+    """
+    grants = (
+        ConsentRecord.objects.active()
+        .filter(patient_id=OuterRef(f'{patient_field}_id' if patient_field else 'id'))
+        .granted_to(practitioner_did=accessor_did)
+        .values('patient_id')
+        .annotate(grants=JSONBAgg(
+            JSONObject(id='id', expires_at='expires_at', scope='scope'),
+            ordering=F('expires_at').desc(),
+        ))
+        .values('grants')
+    )
+    if patient_field:
+        queryset = queryset.select_related(patient_field)
+    return queryset.annotate(consent_grants=Subquery(grants))
+
+
+def consent_decision(grants) -> ConsentDecision:
+    """Build a ConsentDecision from a 'consent_grants' annotation"""
+    consent_service = get_consent_service()
+    rows = [
+        (uuid.UUID(grant['id']), parse_datetime(grant['expires_at']), grant['scope'])
+        for grant in grants or []
+    ]
+    return decision_from_grants(rows, time.time(), consent_service.ttl, consent_service.NEGATIVE_TTL)
+
+
+class CompartmentSearch(NamedTuple):
+    """A search limited to one patient's records the caller may see"""
+    queryset: object
+    patient_id: object  # None for a search across consenting patients
+    consent_id: Optional[uuid.UUID]  # None when the patient searches their own records
+    decision: Optional[ConsentDecision] = None  # None when the patient searches their own records
+
+
+def consented_records(queryset, accessor_did: str):
+    """
+    Limit records of any patient to those the accessor's consents cover
+
+    Consents whose scope covers the whole resource type select their
+    patients with a granted_to subquery, like the Patient search. The few
+    narrower consents are compiled here and add their own patient and
+    scope filter.
+    """
+    resource_type = queryset.model.__name__
+    consents = ConsentRecord.objects.active().granted_to(practitioner_did=accessor_did)
+    whole_type = (
+        Q(scope=[]) | Q(scope__contains=['all']) | Q(scope__contains=['*'])
+        | Q(scope__contains=[resource_type])
+    )
+    covered = Q(patient_id__in=Subquery(consents.filter(whole_type).values('patient_id')))
+    for patient_id, scope in consents.exclude(whole_type).values_list('patient_id', 'scope'):
+        scope_q = compile_scope(scope).as_q(resource_type)
+        if scope_q is not None:
+            covered |= Q(patient_id=patient_id) & scope_q
+    return queryset.filter(covered)
+
+
+def restrict_to_patient(queryset, user, params) -> CompartmentSearch:
+    """
+    Limit a search over clinical records to what the caller may see
+
+    Patients search their own records. Providers name exactly one patient
+    (patient or subject) and only see what that patient's consent covers;
+    searches of a type in CROSS_PATIENT_SEARCHES that name no patient
+    cover every consenting patient instead (see consented_records).
+
+    Raises:
+        ValueError: If a provider does not name exactly one patient
+        PermissionDenied: Without an active consent
+    """
+    if user.is_patient:
+        return CompartmentSearch(queryset.filter(patient_id=user.entity_id), user.entity_id, None)
+
+    patient_ids = [p for name in ('patient', 'subject') for p in params.getlist(name)]
+    if not patient_ids and queryset.model.__name__ in CROSS_PATIENT_SEARCHES:
+        return CompartmentSearch(consented_records(queryset, user.did), None, None)
+    if len(patient_ids) != 1 or ',' in patient_ids[0]:
+        raise ValueError('Provider searches must name exactly one patient')
+    patient_id = patient_ids[0].rpartition('/')[2]
+
+    decision = get_consent_service().check(patient_id, user.did)
+    if not decision.allowed:
+        raise PermissionDenied('No active consent')
+    return CompartmentSearch(decision.filter(queryset), patient_id, decision.consent_id, decision)
+
+
+class AuthorizedRecordMixin:
+    """
+    Consent-checked record lookup for FHIR resource viewsets
+
+    For models with a 'patient' foreign key, or for Patient itself with
+    patient_field = None. get_authorized_object loads the record, its
+    patient and the caller's consents with one SQL statement, then checks
+    consent and scope in memory. Any active consent covers the Patient
+    resource; scopes apply to clinical records.
+    """
+
+    patient_field = 'patient'
+
+    def get_authorized_object(self) -> AuthorizedRecord:
+        """
+        Fetch the record addressed by the URL if the caller may read it
+
+        Raises:
+            Http404: If the record does not exist
+            PermissionDenied: If there is no active consent or the record is out of scope
+        """
+        accessor_did = self.request.user.did
+        queryset = with_consent_grants(
+            self.filter_queryset(self.get_queryset()), accessor_did, self.patient_field
+        )
+
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        instance = get_object_or_404(queryset, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        patient = getattr(instance, self.patient_field) if self.patient_field else instance
+
+        if accessor_did == patient.did:
+            return AuthorizedRecord(instance, patient, None)
+
+        decision = consent_decision(instance.consent_grants)
+        if not decision.allowed:
+            raise PermissionDenied('No active consent for accessing this record')
+        if self.patient_field and not decision.allows(instance):
+            raise PermissionDenied('Record is outside the scope of the active consent')
+
+        return AuthorizedRecord(instance, patient, decision.consent_id)
@@ -0,0 +1,55 @@
+"""
+Conditional Requests
+ETags derived from record hashes, for If-None-Match reads and If-Match updates
+"""
+from typing import Optional, Set
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'Resource has changed since it was read (If-Match)'
+    default_code = 'precondition_failed'
+
+
+def etag(version_id: str) -> str:
+    """
+    ETag for a record version
+
+    Weak, as FHIR uses: the same version renders differently as JSON and
+    FHIR JSON. The version id is the record's blockchain_hash, which
+    changes exactly when the hashed content does.
+    """
+    return f'W/"{version_id}"'
+
+
+def _etag_values(header: Optional[str]) -> Set[str]:
+    """Version ids listed in an If-Match / If-None-Match header ('*' kept as is)"""
+    values = set()
+    for value in (header or '').split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        value = value.strip('"')
+        if value:
+            values.add(value)
+    return values
+
+
+def not_modified(request, version_id: str) -> bool:
+    """True if If-None-Match names the current version (or '*')"""
+    values = _etag_values(request.headers.get('If-None-Match'))
+    return '*' in values or version_id in values
+
+
+def check_if_match(request, version_id: str) -> None:
+    """
+    Enforce If-Match, when sent
+
+    Raises:
+        PreconditionFailed: If the header names other versions only
+    """
+    values = _etag_values(request.headers.get('If-Match'))
+    if values and '*' not in values and version_id not in values:
+        raise PreconditionFailed()
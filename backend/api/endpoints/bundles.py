@@ -0,0 +1,51 @@
+"""
+FHIR Bundle API Endpoints
+Accepts transaction and batch Bundles of clinical records
+"""
+import logging
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+
+from api.idempotency import idempotent
+from fhir import bundles
+
+logger = logging.getLogger(__name__)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@idempotent
+def process_bundle(request):
+    """
+    Store a FHIR Bundle of type transaction or batch
+    
+    Entries are created in one database transaction and anchored on
+    Cardano as a single Merkle root, or left for flush_anchors with
+    FHIR_DEFER_ANCHORING. Returns a transaction-response or
+    batch-response Bundle with one response per entry; entries identical
+    to stored records are answered '200 OK' with them. Retries may send
+    an Idempotency-Key to get the original response back. Only providers
+    may submit Bundles, as with other creates.
+    """
+    if not request.user.is_provider:
+        return Response({
+            'error': 'Only providers can submit bundles of clinical records'
+        }, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        result = bundles.process_bundle(request.data, request.user.did)
+        
+        return Response(result.bundle, status=status.HTTP_200_OK)
+        
+    except bundles.BundleError as e:
+        return Response({
+            'error': str(e),
+            'issues': [{'entry': index, 'diagnostics': message} for index, message in e.issues],
+        }, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        logger.error(f"Error processing bundle: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
@@ -3,18 +3,70 @@ Consent Management API Endpoints
 Handles patient consent for data access via smart contracts
 """
 import logging
+import uuid
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
 
-from fhir.models import Patient, Practitioner, ConsentRecord
-from identity import DIDAuthentication
+from api.pagination import cached_count, count_version, filter_cache_key, page_limit, paginate_keyset
+from fhir.models import CareTeam, ConsentRecord, Organization
+from fhir.consent_grants import ConsentGrant, grant_consents, revoke_consents
+from identity import DIDAuthentication, get_did_directory
 
 logger = logging.getLogger(__name__)
 
+CONSENT_STATUSES = {choice for choice, _ in ConsentRecord._meta.get_field('status').choices}
+
+# Consent list element -> (values() column, render)
+CONSENT_LIST_ELEMENTS = {
+    'id': ('id', str),
+    'patient_did': ('patient__did', None),
+    'provider_did': ('practitioner__did', None),
+    'care_team_id': ('care_team_id', lambda value: str(value) if value else None),
+    'organization_id': ('organization_id', lambda value: str(value) if value else None),
+    'status': ('status', None),
+    'granted_at': ('granted_at', lambda value: value.isoformat()),
+    'expires_at': ('expires_at', lambda value: value.isoformat()),
+    'scope': ('scope', None),
+    'smart_contract_address': ('smart_contract_address', None),
+}
+
+# Left out of _summary=true: the scope JSON and contract address
+CONSENT_SUMMARY_ELEMENTS = tuple(e for e in CONSENT_LIST_ELEMENTS if e not in ('scope', 'smart_contract_address'))
+
+
+def _consent_list_elements(params):
+    """Elements requested by _summary / _elements (all by default)"""
+    summary = params.get('_summary')
+    requested = [name for value in params.getlist('_elements') for name in value.split(',') if name]
+    if summary and requested:
+        raise ValueError('_summary and _elements cannot be combined')
+    if summary == 'true':
+        return CONSENT_SUMMARY_ELEMENTS
+    if summary not in (None, 'false', 'data'):
+        raise ValueError(f'Invalid _summary: {summary}')
+    if not requested:
+        return tuple(CONSENT_LIST_ELEMENTS)
+    
+    unknown = sorted(set(requested) - set(CONSENT_LIST_ELEMENTS))
+    if unknown:
+        raise ValueError(f"Unknown elements: {', '.join(unknown)}")
+    return tuple(e for e in CONSENT_LIST_ELEMENTS if e == 'id' or e in requested)
+
+
+def _consent_item(row, elements):
+    item = {}
+    for element in elements:
+        column, render = CONSENT_LIST_ELEMENTS[element]
+        item[element] = render(row[column]) if render else row[column]
+    return item
+
 
 class ConsentViewSet(viewsets.ModelViewSet):
     """
@@ -24,67 +76,135 @@ class ConsentViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     authentication_classes = [DIDAuthentication]
     
+    def _parse_grants(self, items):
+        """
+        Resolve grant requests to ConsentGrants
+        
+        Each item names exactly one grantee: provider_did, care_team_id or
+        organization_id. Optional: scope (default ['all']) and
+        duration_hours (default 72).
+        
+        Raises:
+            NotFound: If a grantee does not exist or is inactive
+            ValueError: If an item is malformed
+        """
+        now = timezone.now()
+        grantees = []
+        team_ids, organization_ids = set(), set()
+        
+        for item in items:
+            if not isinstance(item, dict):
+                raise ValueError('Each grant must be an object')
+            named = [key for key in ('provider_did', 'care_team_id', 'organization_id') if item.get(key)]
+            if len(named) != 1:
+                raise ValueError('Each grant needs exactly one of provider_did, care_team_id or organization_id')
+            
+            if named[0] == 'provider_did':
+                provider_entry = get_did_directory().lookup(item['provider_did'])
+                if not provider_entry or provider_entry.role != 'provider':
+                    raise NotFound('Provider not found')
+                grantees.append(('practitioner', provider_entry.entity_id))
+            elif named[0] == 'care_team_id':
+                team_id = uuid.UUID(str(item['care_team_id']))
+                team_ids.add(team_id)
+                grantees.append(('care_team', team_id))
+            else:
+                organization_id = uuid.UUID(str(item['organization_id']))
+                organization_ids.add(organization_id)
+                grantees.append(('organization', organization_id))
+        
+        # One query per group type, however many grants
+        if team_ids - set(CareTeam.objects.filter(id__in=team_ids, status='active').values_list('id', flat=True)):
+            raise NotFound('Care team not found')
+        if organization_ids - set(Organization.objects.filter(id__in=organization_ids, active=True)
+                                  .values_list('id', flat=True)):
+            raise NotFound('Organization not found')
+        
+        return [
+            ConsentGrant(
+                grantee_type=grantee_type,
+                grantee_id=grantee_id,
+                scope=item.get('scope', ['all']),  # Default: all records
+                expires_at=now + timedelta(hours=item.get('duration_hours', 72)),  # Default 72 hours
+            )
+            for item, (grantee_type, grantee_id) in zip(items, grantees)
+        ]
+    
+    @staticmethod
+    def _consent_summary(consent):
+        return {
+            'consent_id': str(consent.id),
+            'status': consent.status,
+            'grantee_type': consent.grantee_type,
+            'grantee_id': str(consent.grantee_id),
+            'expires_at': consent.expires_at.isoformat(),
+            'smart_contract_address': consent.smart_contract_address,
+            'consent_tx_id': consent.consent_tx_id,
+            'scope': consent.scope,
+        }
+    
     @action(detail=False, methods=['post'])
     def grant(self, request):
         """
-        Grant consent to a provider
+        Grant consent to a provider, care team or organization
         Deploys Plutus smart contract on Cardano
         """
         try:
-            data = request.data
-            
             # Get patient (must be the requester)
-            patient_did = request.user.did
-            patient = Patient.objects.get(did=patient_did)
-            
-            # Get provider
-            provider_did = data['provider_did']
-            provider = Practitioner.objects.get(did=provider_did)
-            
-            # Parse expiration
-            duration_hours = data.get('duration_hours', 72)  # Default 72 hours
-            expires_at = timezone.now() + timedelta(hours=duration_hours)
-            
-            # Scope (what records can be accessed)
-            scope = data.get('scope', ['all'])  # Default: all records
-            
-            # TODO: Deploy Plutus consent smart contract
-            # For now, create mock contract address and transaction
-            contract_address = f"addr_test1_consent_{patient.id}_{provider.id}"
-            consent_tx_id = f"consent_tx_{patient_did[:8]}_{provider_did[:8]}"
-            
-            # Create consent record
-            consent = ConsentRecord.objects.create(
-                patient=patient,
-                practitioner=provider,
-                status='active',
-                scope=scope,
-                expires_at=expires_at,
-                smart_contract_address=contract_address,
-                consent_tx_id=consent_tx_id,
-            )
+            if request.user.role != 'patient':
+                return Response({
+                    'error': 'Patient not found'
+                }, status=status.HTTP_404_NOT_FOUND)
             
-            logger.info(f"Granted consent: {patient_did} -> {provider_did}")
+            grants = self._parse_grants([request.data])
+            consents, _ = grant_consents(request.user.entity_id, request.user.did, grants)
             
-            return Response({
-                'consent_id': str(consent.id),
-                'status': 'active',
-                'expires_at': expires_at.isoformat(),
-                'smart_contract_address': contract_address,
-                'consent_tx_id': consent_tx_id,
-                'scope': scope,
-            }, status=status.HTTP_201_CREATED)
+            return Response(self._consent_summary(consents[0]), status=status.HTTP_201_CREATED)
             
-        except Patient.DoesNotExist:
+        except NotFound as e:
             return Response({
-                'error': 'Patient not found'
+                'error': str(e.detail)
             }, status=status.HTTP_404_NOT_FOUND)
-        except Practitioner.DoesNotExist:
+        except Exception as e:
+            logger.error(f"Error granting consent: {e}")
             return Response({
-                'error': 'Provider not found'
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=False, methods=['post'])
+    def bulk_grant(self, request):
+        """
+        Grant several consents in one transaction with one anchoring event
+        
+        Body: {"grants": [{"care_team_id": ...}, {"provider_did": ..., "scope": [...]}, ...]}
+        """
+        try:
+            if request.user.role != 'patient':
+                return Response({
+                    'error': 'Patient not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+            
+            items = request.data.get('grants')
+            if not isinstance(items, list) or not items:
+                raise ValueError('grants must be a non-empty list')
+            if len(items) > settings.CONSENT_BULK_MAX:
+                raise ValueError(f'At most {settings.CONSENT_BULK_MAX} grants per request')
+            
+            grants = self._parse_grants(items)
+            consents, tx_id = grant_consents(request.user.entity_id, request.user.did, grants)
+            
+            return Response({
+                'anchor_tx_id': tx_id,
+                'count': len(consents),
+                'consents': [self._consent_summary(c) for c in consents],
+            }, status=status.HTTP_201_CREATED)
+            
+        except NotFound as e:
+            return Response({
+                'error': str(e.detail)
             }, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
-            logger.error(f"Error granting consent: {e}")
+            logger.error(f"Error granting consents: {e}")
             return Response({
                 'error': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
@@ -99,24 +219,22 @@ class ConsentViewSet(viewsets.ModelViewSet):
             consent = self.get_object()
             
             # Verify requester is the patient
-            if request.user.did != consent.patient.did:
+            if request.user.role != 'patient' or request.user.entity_id != consent.patient_id:
                 return Response({
                     'error': 'Only the patient can revoke consent'
                 }, status=status.HTTP_403_FORBIDDEN)
             
-            # Update consent status
-            consent.status = 'revoked'
-            consent.revoked_at = timezone.now()
-            consent.save()
+            revoked_ids, tx_id = revoke_consents(request.user.entity_id, request.user.did, [consent.id])
+            if not revoked_ids:
+                raise ValueError(f'Consent is already {consent.status}')
             
-            # TODO: Update smart contract on blockchain
-            
-            logger.info(f"Revoked consent: {consent.id}")
+            consent.refresh_from_db(fields=['status', 'revoked_at'])
             
             return Response({
                 'consent_id': str(consent.id),
                 'status': 'revoked',
                 'revoked_at': consent.revoked_at.isoformat(),
+                'revoke_tx_id': tx_id,
             })
             
         except Exception as e:
@@ -125,52 +243,121 @@ class ConsentViewSet(viewsets.ModelViewSet):
                 'error': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['post'])
+    def bulk_revoke(self, request):
+        """
+        Revoke several of the patient's consents in one transaction
+        
+        Body: {"consent_ids": [...]}. Ids that are not the caller's active
+        or pending consents are reported as not revoked.
+        """
+        try:
+            if request.user.role != 'patient':
+                return Response({
+                    'error': 'Only the patient can revoke consent'
+                }, status=status.HTTP_403_FORBIDDEN)
+            
+            consent_ids = request.data.get('consent_ids')
+            if not isinstance(consent_ids, list) or not consent_ids:
+                raise ValueError('consent_ids must be a non-empty list')
+            if len(consent_ids) > settings.CONSENT_BULK_MAX:
+                raise ValueError(f'At most {settings.CONSENT_BULK_MAX} consents per request')
+            consent_ids = {uuid.UUID(str(consent_id)) for consent_id in consent_ids}
+            
+            revoked_ids, tx_id = revoke_consents(request.user.entity_id, request.user.did, consent_ids)
+            
+            return Response({
+                'revoke_tx_id': tx_id,
+                'revoked': [str(consent_id) for consent_id in revoked_ids],
+                'not_revoked': sorted(str(consent_id) for consent_id in consent_ids - set(revoked_ids)),
+            })
+            
+        except Exception as e:
+            logger.error(f"Error revoking consents: {e}")
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+    
     @action(detail=False, methods=['get'])
     def active(self, request):
         """
-        Get all active consents for the authenticated user
+        List consents for the authenticated user
+        
+        Query parameters:
+            role: 'patient' or 'provider' (must match the caller's role)
+            status: 'active' (default), 'expired', 'revoked', 'pending' or 'all'
+            expires_after, expires_before: ISO 8601 expiry window
+            limit: Page size
+            cursor: next_cursor from the previous page
+            _summary: 'true' leaves out scope and smart_contract_address
+            _elements: Comma-separated fields to return (id is always included)
+        
+        Results are ordered by (expires_at, id) and paginated by keyset.
+        Only the columns (and DID joins) of the returned fields are read.
         """
         try:
-            user_did = request.user.did
-            
-            # Check if user is patient or provider
-            try:
-                patient = Patient.objects.get(did=user_did)
-                consents = ConsentRecord.objects.filter(
-                    patient=patient,
-                    status='active',
-                    expires_at__gt=timezone.now()
-                )
-                role = 'patient'
-            except Patient.DoesNotExist:
-                try:
-                    provider = Practitioner.objects.get(did=user_did)
-                    consents = ConsentRecord.objects.filter(
-                        practitioner=provider,
-                        status='active',
-                        expires_at__gt=timezone.now()
-                    )
-                    role = 'provider'
-                except Practitioner.DoesNotExist:
-                    return Response({
-                        'error': 'User not found as patient or provider'
-                    }, status=status.HTTP_404_NOT_FOUND)
+            user = request.user
+            params = request.query_params
+            
+            # Role and entity id come from the DID directory at authentication
+            role = params.get('role', user.role)
+            if user.role not in ('patient', 'provider'):
+                return Response({
+                    'error': 'User not found as patient or provider'
+                }, status=status.HTTP_404_NOT_FOUND)
+            if role != user.role:
+                return Response({
+                    'error': f'Authenticated DID is not a {role}'
+                }, status=status.HTTP_403_FORBIDDEN)
+            
+            consent_status = params.get('status', 'active')
+            if consent_status == 'active':
+                consents = ConsentRecord.objects.active()
+            elif consent_status == 'all':
+                consents = ConsentRecord.objects.all()
+            elif consent_status in CONSENT_STATUSES:
+                consents = ConsentRecord.objects.filter(status=consent_status)
+            else:
+                raise ValueError(f'Invalid status: {consent_status}')
+            
+            if role == 'patient':
+                consents = consents.filter(patient_id=user.entity_id)
+            else:
+                # Includes grants to the provider's care teams and organizations
+                consents = consents.granted_to(practitioner_id=user.entity_id)
+            
+            filters = {'role': role, 'status': consent_status}
+            for param, lookup in (('expires_after', 'expires_at__gte'), ('expires_before', 'expires_at__lt')):
+                if params.get(param):
+                    value = parse_datetime(params[param])
+                    if value is None:
+                        raise ValueError(f'Invalid {param}: {params[param]}')
+                    consents = consents.filter(**{lookup: value})
+                    filters[param] = value.isoformat()
+            
+            elements = _consent_list_elements(params)
+            
+            # Patient and provider DIDs are joined into the same query
+            columns = {CONSENT_LIST_ELEMENTS[e][0] for e in elements} | {'id', 'expires_at'}
+            page = paginate_keyset(
+                consents,
+                ordering=('expires_at', 'id'),
+                cursor=params.get('cursor'),
+                limit=page_limit(request),
+                values=tuple(sorted(columns)),
+            )
+            
+            count_scope = f'consents:{role}:{user.entity_id}'
+            count = cached_count(
+                consents,
+                filter_cache_key(f'{count_scope}:{count_version(count_scope)}', filters),
+            )
             
             return Response({
                 'role': role,
-                'count': consents.count(),
-                'consents': [
-                    {
-                        'id': str(c.id),
-                        'patient_did': c.patient.did,
-                        'provider_did': c.practitioner.did,
-                        'granted_at': c.granted_at.isoformat(),
-                        'expires_at': c.expires_at.isoformat(),
-                        'scope': c.scope,
-                        'smart_contract_address': c.smart_contract_address,
-                    }
-                    for c in consents
-                ]
+                'count': count,
+                'next_cursor': page.next_cursor,
+                'consents': [_consent_item(c, elements) for c in page.results]
             })
             
         except Exception as e:
@@ -0,0 +1,198 @@
+"""
+Patient $everything API Endpoint
+Streams a patient's chart as one Bundle with a fixed number of queries
+"""
+import json
+import logging
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+
+from api.audit import get_audit_buffer
+from api.pagination import keyset_page, keyset_queryset, page_limit
+from api.renderers import FHIRJSONRenderer
+from fhir.consent_decisions import get_consent_service
+from fhir.mapping import consent_to_fhir, parse_instant, patient_to_fhir, to_fhir
+from fhir.models import Observation, Patient
+
+logger = logging.getLogger(__name__)
+
+# Resource type -> (Patient related name, keyset ordering), in Bundle order
+EVERYTHING_TYPES = {
+    'Observation': ('observations', ('-effective_datetime', '-id')),
+    'DiagnosticReport': ('diagnostic_reports', ('-effective_datetime', '-id')),
+    'MedicationRequest': ('medication_requests', ('-authored_on', '-id')),
+    'Encounter': ('encounters', ('-period_start', '-id')),
+    'Consent': ('consents', ('expires_at', 'id')),
+}
+
+
+def _parse_cursors(values):
+    """'Type:cursor' values -> {type: cursor}"""
+    cursors = {}
+    for value in values:
+        resource_type, sep, cursor = value.partition(':')
+        if not sep or resource_type not in EVERYTHING_TYPES:
+            raise ValueError(f'Invalid cursor: {value}')
+        cursors[resource_type] = cursor
+    return cursors
+
+
+def load_everything(patient_id, resource_types, limit, cursors=None, since=None,
+                    scope=None, accessor_did=None):
+    """
+    Load a patient and one page of each resource type
+    
+    Every type is fetched by its own Prefetch query, sliced to limit + 1
+    rows after the type's cursor, so the number of queries depends only on
+    the types requested. Report results come with one more query.
+    
+    Args:
+        patient_id: Patient id
+        resource_types: Types from EVERYTHING_TYPES to include
+        limit: Page size per type
+        cursors: {type: cursor} to continue from
+        since: Only resources updated at or after this time
+        scope: CompiledScope restricting clinical types (None for the patient)
+        accessor_did: Provider DID; Consents are limited to theirs when scoped
+    
+    Returns:
+        (Patient or None, {type: KeysetPage})
+    """
+    cursors = cursors or {}
+    prefetches = []
+    for resource_type in resource_types:
+        related_name, ordering = EVERYTHING_TYPES[resource_type]
+        queryset = Patient._meta.get_field(related_name).related_model.objects.all()
+        
+        if resource_type == 'Consent':
+            queryset = queryset.active()
+            if scope is not None:
+                queryset = queryset.granted_to(practitioner_did=accessor_did)
+        elif scope is not None:
+            queryset = scope.filter(queryset)
+        if resource_type == 'DiagnosticReport':
+            queryset = queryset.prefetch_related(Prefetch('result', queryset=Observation.objects.only('id')))
+        if since:
+            queryset = queryset.filter(updated_at__gte=since)
+        
+        queryset = keyset_queryset(queryset, ordering, cursors.get(resource_type))
+        prefetches.append(Prefetch(related_name, queryset=queryset[:limit + 1], to_attr=f'{related_name}_page'))
+    
+    patient = Patient.objects.prefetch_related(*prefetches).filter(id=patient_id).first()
+    if patient is None:
+        return None, {}
+    
+    pages = {}
+    for resource_type in resource_types:
+        related_name, ordering = EVERYTHING_TYPES[resource_type]
+        pages[resource_type] = keyset_page(getattr(patient, f'{related_name}_page'), ordering, limit)
+    return patient, pages
+
+
+def _entries(patient, pages, include_patient=True):
+    """Bundle entries, serialized as the response is written"""
+    if include_patient:
+        yield {'fullUrl': f'urn:uuid:{patient.id}', 'resource': patient_to_fhir(patient)}
+    for resource_type, page in pages.items():
+        serialize = consent_to_fhir if resource_type == 'Consent' else to_fhir
+        for instance in page.results:
+            yield {'fullUrl': f'urn:uuid:{instance.id}', 'resource': serialize(instance)}
+
+
+def _stream_bundle(links, entries):
+    """Write the Bundle incrementally, one entry at a time"""
+    yield '{"resourceType":"Bundle","type":"searchset","link":' + json.dumps(links) + ',"entry":['
+    for i, entry in enumerate(entries):
+        yield (',' if i else '') + json.dumps(entry, cls=DjangoJSONEncoder)
+    yield ']}'
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, FHIRJSONRenderer])
+def patient_everything(request, patient_id):
+    """
+    Patient/$everything: the patient and their Observations,
+    DiagnosticReports, MedicationRequests, Encounters and active Consents
+    
+    Query parameters:
+        _type: Comma-separated subset of the types above
+        _since: Only resources updated at or after this instant
+        _count: Page size per resource type
+        cursor: 'Type:cursor' values from the next link, one per type
+    
+    The chart takes the same number of queries however large it is (see
+    load_everything). Providers only receive what the patient's consent
+    covers and the consents granted to them.
+    """
+    try:
+        user = request.user
+        params = request.query_params
+        
+        # Check consent; providers only see records within its scope
+        scope = None
+        consent_id = None
+        if not (user.role == 'patient' and str(user.entity_id) == str(patient_id)):
+            decision = get_consent_service().check(patient_id, user.did)
+            if not decision.allowed:
+                return Response({
+                    'error': 'No active consent'
+                }, status=status.HTTP_403_FORBIDDEN)
+            scope = decision.scope
+            consent_id = decision.consent_id
+        
+        resource_types = [t for t in params.get('_type', '').split(',') if t] or list(EVERYTHING_TYPES)
+        unknown = set(resource_types) - set(EVERYTHING_TYPES)
+        if unknown:
+            raise ValueError(f"Unsupported _type: {', '.join(sorted(unknown))}")
+        
+        cursors = _parse_cursors(params.getlist('cursor'))
+        if cursors:
+            # Later pages continue only the types that had more rows
+            resource_types = [t for t in resource_types if t in cursors]
+        since = parse_instant(params.get('_since'))
+        limit = page_limit(request, param='_count')
+        
+        patient, pages = load_everything(
+            patient_id, resource_types, limit, cursors=cursors, since=since,
+            scope=scope, accessor_did=user.did,
+        )
+        if patient is None:
+            return Response({
+                'error': 'Patient not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        base = request.build_absolute_uri(request.path)
+        next_cursors = [
+            f'{resource_type}:{page.next_cursor}'
+            for resource_type, page in pages.items() if page.next_cursor
+        ]
+        
+        links = [{'relation': 'self', 'url': request.build_absolute_uri()}]
+        if next_cursors:
+            next_params = params.copy()
+            next_params.setlist('cursor', next_cursors)
+            links.append({'relation': 'next', 'url': f"{base}?{next_params.urlencode()}"})
+        
+        # Log chart access (buffered, written and anchored in batches)
+        get_audit_buffer().record(
+            user.did, patient.id, 'Patient', patient.id, 'read',
+            consent_id=consent_id, request=request,
+        )
+        
+        return StreamingHttpResponse(
+            _stream_bundle(links, _entries(patient, pages, include_patient=not cursors)),
+            content_type='application/fhir+json'
+        )
+        
+    except Exception as e:
+        logger.error(f"Error assembling patient chart: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
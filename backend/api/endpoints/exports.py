@@ -0,0 +1,208 @@
+"""
+FHIR Bulk Data Export API Endpoints
+Asynchronous $export kick-off, status polling and file download
+"""
+import logging
+import os
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from django.conf import settings
+from django.http import FileResponse
+from django.urls import reverse
+
+from api.renderers import FHIRJSONRenderer, NDJSONRenderer
+from fhir.exports import create_export_job, delete_export_files, export_dir
+from fhir.mapping import parse_instant
+from fhir.models import CareTeam, CareTeamMember, ExportJob, Organization, PractitionerRole
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = {'application/fhir+ndjson', 'application/ndjson', 'ndjson'}
+
+
+def _kick_off(request, level, group_id=None):
+    """
+    Validate $export parameters and queue the job
+    
+    Query parameters:
+        _type: Comma-separated resource types (default: all)
+        _since: Only resources updated at or after this instant
+        _outputFormat: NDJSON (the default and only format)
+        redact: Comma-separated elements to strip, e.g. 'Patient.telecom,note'
+    """
+    try:
+        params = request.query_params
+        
+        if 'respond-async' not in request.headers.get('Prefer', ''):
+            raise ValueError('$export requires the Prefer: respond-async header')
+        if params.get('_outputFormat', 'ndjson') not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported _outputFormat: {params['_outputFormat']}")
+        
+        since = parse_instant(params.get('_since'))
+        resource_types = [t for t in params.get('_type', '').split(',') if t]
+        redact = [e for e in params.get('redact', '').split(',') if e]
+        
+        job = create_export_job(
+            requester_did=request.user.did,
+            level=level,
+            request_url=request.build_absolute_uri(),
+            resource_types=resource_types,
+            since=since,
+            group_id=group_id,
+            redact=redact,
+        )
+        
+        logger.info(f"Queued {level} export {job.id} for {request.user.did}")
+        
+        return Response(status=status.HTTP_202_ACCEPTED, headers={
+            'Content-Location': request.build_absolute_uri(reverse('export-status', args=[job.id])),
+        })
+        
+    except Exception as e:
+        logger.error(f"Error starting export: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, FHIRJSONRenderer])
+def export_system(request):
+    """
+    System-level $export of every patient's data
+    Restricted to the DIDs in FHIR_EXPORT_SYSTEM_DIDS (e.g. public health reporting)
+    """
+    if request.user.did not in settings.FHIR_EXPORT_SYSTEM_DIDS:
+        return Response({
+            'error': 'Not authorized for system-level export'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    return _kick_off(request, 'system')
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, FHIRJSONRenderer])
+def export_patients(request):
+    """
+    Patient-level $export
+    A patient exports their own record; a provider exports every patient
+    with an active consent to them, within each consent's scope
+    """
+    if request.user.role not in ('patient', 'provider'):
+        return Response({
+            'error': 'User not found as patient or provider'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    return _kick_off(request, 'patient')
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, FHIRJSONRenderer])
+def export_group(request, group_id):
+    """
+    Group-level $export for a care team or organization
+    Covers patients with an active consent to the group; the caller must be
+    an active member
+    """
+    user = request.user
+    
+    if CareTeam.objects.filter(id=group_id).exists():
+        is_member = user.role == 'provider' and CareTeamMember.objects.filter(
+            care_team_id=group_id, practitioner_id=user.entity_id, active=True, care_team__status='active'
+        ).exists()
+    elif Organization.objects.filter(id=group_id).exists():
+        is_member = user.role == 'provider' and PractitionerRole.objects.filter(
+            organization_id=group_id, practitioner_id=user.entity_id, active=True, organization__active=True
+        ).exists()
+    else:
+        return Response({
+            'error': 'Group not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    if not is_member:
+        return Response({
+            'error': 'Only active group members can export the group'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    return _kick_off(request, 'group', group_id)
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, FHIRJSONRenderer])
+def export_status(request, job_id):
+    """
+    Poll (GET) or cancel (DELETE) an export
+    
+    GET returns 202 with X-Progress while the job runs and the completion
+    manifest once it is done. DELETE cancels the job and removes its files.
+    """
+    job = ExportJob.objects.filter(id=job_id, requester_did=request.user.did).first()
+    if job is None or job.status == 'cancelled':
+        return Response({
+            'error': 'Export not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    if request.method == 'DELETE':
+        ExportJob.objects.filter(id=job.id).update(status='cancelled')
+        if job.status != 'in-progress':
+            # A running worker removes its own files when it sees the cancellation
+            delete_export_files(job.id)
+        return Response(status=status.HTTP_202_ACCEPTED)
+    
+    if job.status in ('queued', 'in-progress'):
+        return Response(status=status.HTTP_202_ACCEPTED, headers={
+            'X-Progress': job.progress or job.status,
+            'Retry-After': '10',
+        })
+    
+    if job.status == 'failed':
+        return Response({
+            'resourceType': 'OperationOutcome',
+            'issue': [{'severity': 'error', 'code': 'exception', 'diagnostics': job.error}],
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    return Response({
+        'transactionTime': job.transaction_time.isoformat(),
+        'request': job.request_url,
+        'requiresAccessToken': True,
+        'output': [
+            {
+                'type': output['type'],
+                'url': request.build_absolute_uri(reverse('export-file', args=[job.id, output['file']])),
+                'count': output['count'],
+            }
+            for output in job.output
+        ],
+        'error': [],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, NDJSONRenderer])
+def export_file(request, job_id, file_name):
+    """
+    Download one NDJSON output file
+    Served gzip-compressed with Content-Encoding: gzip
+    """
+    job = ExportJob.objects.filter(id=job_id, requester_did=request.user.did, status='completed').first()
+    
+    # Only names listed in the manifest, never arbitrary paths
+    if job is None or file_name not in {output['file'] for output in job.output}:
+        return Response({
+            'error': 'File not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    response = FileResponse(
+        open(os.path.join(export_dir(job.id), file_name), 'rb'),
+        content_type='application/fhir+ndjson',
+    )
+    response['Content-Encoding'] = 'gzip'
+    return response
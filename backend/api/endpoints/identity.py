@@ -7,6 +7,7 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from django.conf import settings
 
 from fhir.models import Patient, Practitioner
 from identity import get_did_manager, DIDAuthentication
@@ -126,6 +127,52 @@ def resolve_did(request):
         }, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def resolve_dids_batch(request):
+    """
+    Resolve many DIDs in one call
+    
+    Body: {"dids": ["did:prism:...", ...]} (at most DID_RESOLVE_BATCH_MAX)
+    Returns a map keyed by DID with either the document or an error.
+    """
+    try:
+        dids = request.data.get('dids')
+        
+        if not isinstance(dids, list) or not dids:
+            return Response({
+                'error': 'dids must be a non-empty list'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if len(dids) > settings.DID_RESOLVE_BATCH_MAX:
+            return Response({
+                'error': f'At most {settings.DID_RESOLVE_BATCH_MAX} DIDs per request'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if not all(isinstance(did, str) for did in dids):
+            return Response({
+                'error': 'dids must be strings'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        did_manager = get_did_manager()
+        documents, errors = did_manager.resolve_dids(dids)
+        
+        results = {did: {'did_document': doc} for did, doc in documents.items()}
+        results.update({did: {'error': message} for did, message in errors.items()})
+        
+        return Response({
+            'resolved': len(documents),
+            'failed': len(errors),
+            'results': results,
+        })
+        
+    except Exception as e:
+        logger.error(f"Error resolving DID batch: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_profile(request):
@@ -133,34 +180,31 @@ def get_profile(request):
     Get profile for authenticated DID
     """
     try:
-        user_did = request.user.did
-        
-        # Try to find as patient
-        try:
-            patient = Patient.objects.get(did=user_did)
-            return Response({
-                'type': 'patient',
-                'id': str(patient.id),
-                'did': patient.did,
-                'name': patient.name,
-                'gender': patient.gender,
-                'birth_date': patient.birth_date,
-            })
-        except Patient.DoesNotExist:
-            pass
-        
-        # Try to find as provider
-        try:
-            provider = Practitioner.objects.get(did=user_did)
-            return Response({
-                'type': 'provider',
-                'id': str(provider.id),
-                'did': provider.did,
-                'name': provider.name,
-                'qualification': provider.qualification,
-            })
-        except Practitioner.DoesNotExist:
-            pass
+        user = request.user
+        
+        # Role and entity id come from the DID directory at authentication
+        if user.role == 'patient':
+            patient = Patient.objects.filter(pk=user.entity_id).first()
+            if patient:
+                return Response({
+                    'type': 'patient',
+                    'id': str(patient.id),
+                    'did': patient.did,
+                    'name': patient.name,
+                    'gender': patient.gender,
+                    'birth_date': patient.birth_date,
+                })
+        
+        elif user.role == 'provider':
+            provider = Practitioner.objects.filter(pk=user.entity_id).first()
+            if provider:
+                return Response({
+                    'type': 'provider',
+                    'id': str(provider.id),
+                    'did': provider.did,
+                    'name': provider.name,
+                    'qualification': provider.qualification,
+                })
         
         return Response({
             'error': 'Profile not found'
@@ -2,25 +2,44 @@
 Medical Records API Endpoints
 Handles CRUD operations for FHIR resources with blockchain integration
 """
+import copy
+import json
 import logging
+from functools import partial
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound, PermissionDenied
 from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from fhir.models import (
     Patient, Practitioner, Observation,
-    DiagnosticReport, MedicationRequest, Encounter,
-    ConsentRecord, AccessLog
+    DiagnosticReport, MedicationRequest, Encounter
 )
-from blockchain import get_cardano_client, get_hash_manager
+from api.audit import get_audit_buffer
+from api.authorization import AuthorizedRecordMixin
+from api.conditional import PreconditionFailed, check_if_match, etag, not_modified
+from api.idempotency import idempotent
+from api.pagination import cached_count, count_version, filter_cache_key, keyset_ordering, page_limit, paginate_keyset
+from fhir.consent_decisions import get_consent_service
+from fhir.anchoring import anchor_on_commit
+from fhir.bundles import disclosable
+from fhir.history import record_update
+from fhir.mapping import parse_instant, to_fhir
+from fhir.projection import parse_projection
+from blockchain import get_hash_manager
 from identity import DIDAuthentication
 
 logger = logging.getLogger(__name__)
 
 
-class ObservationViewSet(viewsets.ModelViewSet):
+class ObservationViewSet(AuthorizedRecordMixin, viewsets.ModelViewSet):
     """
     API endpoints for Observation resources (lab results, vitals)
     """
@@ -28,48 +47,69 @@ class ObservationViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     authentication_classes = [DIDAuthentication]
     
+    @idempotent
     def create(self, request, *args, **kwargs):
         """
         Create new observation and record hash on blockchain
+        
+        With FHIR_DEFER_ANCHORING the hash is anchored by flush_anchors
+        in a batch with other new records, and blockchain_tx_id is null
+        until then.
+        
+        An observation identical to a stored one (same content hash) is
+        not stored or anchored again: the stored one is returned with 200
+        to the patient or a provider whose consent covers it, and anyone
+        else gets 409 without learning which record it is.
+        Retries without an effective_datetime get a new one each time, so
+        they should send an Idempotency-Key instead.
         """
         try:
             # Extract data from request
             data = request.data
             
-            # Create observation instance
-            observation = Observation.objects.create(
+            observation = Observation(
                 patient_id=data['patient_id'],
                 practitioner_id=data.get('practitioner_id'),
                 status=data.get('status', 'final'),
                 code=data['code'],
                 value_quantity=data.get('value_quantity'),
-                effective_datetime=data.get('effective_datetime', timezone.now()),
+                effective_datetime=parse_instant(data.get('effective_datetime')) or timezone.now(),
             )
             
-            # Generate hash
-            hash_manager = get_hash_manager()
-            record_hash = hash_manager.generate_record_hash(observation)
-            
-            # Submit to blockchain
-            cardano_client = get_cardano_client()
-            tx_id = cardano_client.submit_record_hash(
-                record_hash=record_hash,
-                record_type='observation',
-                patient_did=observation.patient.did,
-                provider_did=observation.practitioner.did if observation.practitioner else None,
-            )
+            # Upsert on the content hash; anchored once the insert commits, or by flush_anchors
+            record_hash = get_hash_manager().generate_record_hash(observation)
+            existing = Observation.objects.filter(blockchain_hash=record_hash).first()
+            if existing is None:
+                observation.blockchain_hash = record_hash
+                try:
+                    with transaction.atomic():
+                        observation.save()
+                        anchor_on_commit([observation], request.user.did)
+                except IntegrityError:
+                    # A concurrent request stored the same observation first
+                    existing = Observation.objects.filter(blockchain_hash=record_hash).first()
+                    if existing is None:
+                        raise
             
-            # Update observation with blockchain info
-            observation.blockchain_hash = record_hash
-            observation.blockchain_tx_id = tx_id
-            observation.save()
+            if existing is not None:
+                if existing.id not in disclosable([existing], request.user.did):
+                    return Response({
+                        'error': 'Conflicts with an existing record'
+                    }, status=status.HTTP_409_CONFLICT)
+                logger.info(f"Observation {existing.id} already stored with hash {record_hash[:16]}...")
+                return Response({
+                    'id': str(existing.id),
+                    'blockchain_hash': existing.blockchain_hash,
+                    'blockchain_tx_id': existing.blockchain_tx_id,
+                    'status': 'success'
+                }, status=status.HTTP_200_OK)
             
             logger.info(f"Created observation {observation.id} with hash {record_hash[:16]}...")
             
             return Response({
                 'id': str(observation.id),
                 'blockchain_hash': record_hash,
-                'blockchain_tx_id': tx_id,
+                'blockchain_tx_id': observation.blockchain_tx_id,
                 'status': 'success'
             }, status=status.HTTP_201_CREATED)
             
@@ -82,26 +122,34 @@ class ObservationViewSet(viewsets.ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         """
         Retrieve observation with consent verification and access logging
+        
+        The ETag is the record's blockchain_hash. A matching If-None-Match
+        gets 304 Not Modified once consent is checked, without the hash
+        verification, access log or body: the caller already holds this
+        version.
+        
+        With _summary or _elements the body is the FHIR Observation cut
+        down to those elements. The whole row is still read, as the
+        integrity check hashes every content column.
         """
         try:
-            observation = self.get_object()
+            params = request.query_params
+            projection = None
+            if '_summary' in params or '_elements' in params:
+                projection = parse_projection('Observation', params)
+                if projection.count:
+                    raise ValueError('_summary=count applies to searches only')
             
-            # Verify consent
+            # Record, patient and consent in one query
+            authorized = self.get_authorized_object()
+            observation = authorized.instance
+            patient = authorized.patient
             accessor_did = request.user.did
-            patient = observation.patient
-            
-            # Check if accessor has active consent
-            active_consent = ConsentRecord.objects.filter(
-                patient=patient,
-                practitioner__did=accessor_did,
-                status='active',
-                expires_at__gt=timezone.now()
-            ).first()
+            consent_id = authorized.consent_id
             
-            if not active_consent and accessor_did != patient.did:
-                return Response({
-                    'error': 'No active consent for accessing this record'
-                }, status=status.HTTP_403_FORBIDDEN)
+            if not_modified(request, observation.blockchain_hash):
+                return Response(status=status.HTTP_304_NOT_MODIFIED,
+                                headers={'ETag': etag(observation.blockchain_hash)})
             
             # Verify hash integrity
             hash_manager = get_hash_manager()
@@ -113,33 +161,20 @@ class ObservationViewSet(viewsets.ModelViewSet):
                     'error': 'Data integrity check failed - record may have been tampered with'
                 }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
-            # Log access to blockchain
-            cardano_client = get_cardano_client()
-            access_tx_id = cardano_client.submit_access_log(
-                accessor_did=accessor_did,
-                patient_did=patient.did,
-                resource_type='Observation',
-                resource_id=str(observation.id),
-                action='read'
+            # Buffered, then written and anchored in batches
+            get_audit_buffer().record(
+                accessor_did, patient.id, 'Observation', observation.id, 'read',
+                consent_id=consent_id, request=request,
             )
             
-            # Create access log record
-            AccessLog.objects.create(
-                accessor_did=accessor_did,
-                patient=patient,
-                resource_type='Observation',
-                resource_id=observation.id,
-                action='read',
-                consent=active_consent,
-                blockchain_tx_id=access_tx_id,
-                ip_address=request.META.get('REMOTE_ADDR'),
-                user_agent=request.META.get('HTTP_USER_AGENT'),
-            )
+            if projection:
+                return Response(to_fhir(observation, projection.elements),
+                                headers={'ETag': etag(observation.blockchain_hash)})
             
             # Return observation data
             return Response({
                 'id': str(observation.id),
-                'patient_id': str(observation.patient.id),
+                'patient_id': str(patient.id),
                 'status': observation.status,
                 'code': observation.code,
                 'value_quantity': observation.value_quantity,
@@ -147,20 +182,146 @@ class ObservationViewSet(viewsets.ModelViewSet):
                 'blockchain_hash': observation.blockchain_hash,
                 'blockchain_tx_id': observation.blockchain_tx_id,
                 'hash_verified': True,
-            })
+            }, headers={'ETag': etag(observation.blockchain_hash)})
             
+        except (NotFound, PermissionDenied) as e:
+            return Response({
+                'error': str(e.detail)
+            }, status=e.status_code)
+        except Http404:
+            return Response({
+                'error': 'Observation not found'
+            }, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             logger.error(f"Error retrieving observation: {e}")
             return Response({
                 'error': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
     
+    # Fields a provider may amend with PUT / PATCH
+    UPDATABLE_FIELDS = ('status', 'code', 'value_quantity', 'effective_datetime')
+    
+    def update(self, request, *args, **kwargs):
+        """
+        Amend an observation and anchor its new hash (deferred, as for create)
+        
+        Send the ETag from the last read as If-Match: the row is only
+        written if its blockchain_hash is still that version, so two
+        providers amending the same record cannot overwrite each other
+        (the second gets 412 Precondition Failed). The replaced version
+        stays readable through Observation/<id>/_history. PATCH changes
+        only the fields given; PUT requires code.
+        """
+        try:
+            if request.user.is_patient:
+                raise PermissionDenied('Patients cannot amend clinical records')
+            
+            authorized = self.get_authorized_object()
+            observation = authorized.instance
+            current_hash = observation.blockchain_hash
+            check_if_match(request, current_hash)
+            
+            data = request.data
+            if not kwargs.get('partial') and 'code' not in data:
+                raise ValueError('code is required')
+            if 'status' in data and data['status'] not in dict(Observation._meta.get_field('status').choices):
+                raise ValueError(f"Invalid status: {data['status']}")
+            
+            changes = {field: data[field] for field in self.UPDATABLE_FIELDS if field in data}
+            if 'effective_datetime' in changes:
+                changes['effective_datetime'] = parse_instant(changes['effective_datetime'])
+            previous = copy.copy(observation)
+            for field, value in changes.items():
+                setattr(observation, field, value)
+            observation.derive_values()
+            changes.update((name, getattr(observation, name)) for name in Observation.DERIVED_FIELDS)
+            
+            record_hash = get_hash_manager().generate_record_hash(observation)
+            if record_hash == current_hash:
+                # Nothing changed; nothing to anchor
+                return Response({
+                    'id': str(observation.id),
+                    'blockchain_hash': current_hash,
+                    'blockchain_tx_id': observation.blockchain_tx_id,
+                    'status': 'success'
+                }, headers={'ETag': etag(current_hash)})
+            
+            with transaction.atomic():
+                # Compare-and-set on the version read above; the new
+                # version is written pending and anchored once it commits
+                updated = Observation.objects.filter(id=observation.id, blockchain_hash=current_hash).update(
+                    **changes,
+                    blockchain_hash=record_hash,
+                    blockchain_tx_id=None,
+                    updated_at=timezone.now(),
+                )
+                if not updated:
+                    raise PreconditionFailed()
+                amended = Observation.objects.get(id=observation.id)
+                record_update(previous, amended, request.user.did)
+                anchor_on_commit([amended], request.user.did)
+            
+            get_audit_buffer().record(
+                request.user.did, authorized.patient.id, 'Observation', observation.id, 'update',
+                consent_id=authorized.consent_id, request=request,
+            )
+            
+            logger.info(f"Updated observation {observation.id} with hash {record_hash[:16]}...")
+            
+            return Response({
+                'id': str(observation.id),
+                'blockchain_hash': record_hash,
+                'blockchain_tx_id': amended.blockchain_tx_id,
+                'status': 'success'
+            }, headers={'ETag': etag(record_hash)})
+            
+        except (NotFound, PermissionDenied, PreconditionFailed) as e:
+            return Response({
+                'error': str(e.detail)
+            }, status=e.status_code)
+        except Http404:
+            return Response({
+                'error': 'Observation not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Error updating observation: {e}")
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Columns returned by patient_observations
+    SUMMARY_FIELDS = ('id', 'code', 'status', 'effective_datetime', 'blockchain_hash')
+    
+    @staticmethod
+    def _observation_summary(obs):
+        return {
+            'id': str(obs.id),
+            'code': obs.code,
+            'status': obs.status,
+            'effective_datetime': obs.effective_datetime,
+            'blockchain_hash': obs.blockchain_hash,
+        }
+    
     @action(detail=False, methods=['get'])
     def patient_observations(self, request):
         """
-        Get all observations for a patient (requires consent)
+        Get observations for a patient (requires consent)
+        
+        Query parameters:
+            patient_id: Patient id (required)
+            _count: Page size
+            _since: ISO 8601 instant; only observations updated at or after it
+            cursor: next_cursor from the previous page
+            _format: 'ndjson' streams every matching observation, one per line
+            _summary, _elements: Return FHIR Observations with these
+                elements instead of the short summary; only their columns
+                are read. _summary=count returns just the count.
+        
+        Results are newest first, ordered by (effective_datetime, id) and
+        paginated by keyset on the (patient, effective_datetime) index.
         """
-        patient_id = request.query_params.get('patient_id')
+        params = request.query_params
+        patient_id = params.get('patient_id')
         
         if not patient_id:
             return Response({
@@ -168,38 +329,62 @@ class ObservationViewSet(viewsets.ModelViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            patient = Patient.objects.get(id=patient_id)
+            patient = Patient.objects.only('id', 'did').get(id=patient_id)
             accessor_did = request.user.did
             
-            # Check consent
+            # Get observations
+            observations = Observation.objects.filter(patient=patient)
+            filters = {}
+            
+            # Check consent; providers only see records within its scope
             if accessor_did != patient.did:
-                active_consent = ConsentRecord.objects.filter(
-                    patient=patient,
-                    practitioner__did=accessor_did,
-                    status='active',
-                    expires_at__gt=timezone.now()
-                ).first()
-                
-                if not active_consent:
+                decision = get_consent_service().check(patient.id, accessor_did)
+                if not decision.allowed:
                     return Response({
                         'error': 'No active consent'
                     }, status=status.HTTP_403_FORBIDDEN)
+                observations = decision.filter(observations)
+                filters['scope'] = decision.scope.to_json() if decision.scope else None
             
-            # Get observations
-            observations = Observation.objects.filter(patient=patient).order_by('-effective_datetime')
+            if params.get('_since'):
+                since = parse_datetime(params['_since'])
+                if since is None:
+                    raise ValueError(f"Invalid _since: {params['_since']}")
+                observations = observations.filter(updated_at__gte=since)
+                filters['since'] = since.isoformat()
+            
+            ordering = ('-effective_datetime', '-id')
+            if '_summary' in params or '_elements' in params:
+                projection = parse_projection('Observation', params)
+                observations = projection.apply(observations, extra=ordering)
+                serialize = partial(to_fhir, elements=projection.elements)
+            else:
+                projection = None
+                observations = observations.only(*self.SUMMARY_FIELDS)
+                serialize = self._observation_summary
+            
+            if params.get('_format') == 'ndjson':
+                return self._stream_ndjson(observations.order_by(*keyset_ordering(ordering, Observation)), serialize)
+            
+            count_scope = f'observations:patient:{patient.id}'
+            count = cached_count(
+                observations,
+                filter_cache_key(f'{count_scope}:{count_version(count_scope)}', filters),
+            )
+            if projection and projection.count:
+                return Response({'count': count, 'next_cursor': None, 'observations': []})
+            
+            page = paginate_keyset(
+                observations,
+                ordering=ordering,
+                cursor=params.get('cursor'),
+                limit=page_limit(request, param='_count'),
+            )
             
             return Response({
-                'count': observations.count(),
-                'observations': [
-                    {
-                        'id': str(obs.id),
-                        'code': obs.code,
-                        'status': obs.status,
-                        'effective_datetime': obs.effective_datetime,
-                        'blockchain_hash': obs.blockchain_hash,
-                    }
-                    for obs in observations
-                ]
+                'count': count,
+                'next_cursor': page.next_cursor,
+                'observations': [serialize(obs) for obs in page.results]
             })
             
         except Patient.DoesNotExist:
@@ -211,3 +396,16 @@ class ObservationViewSet(viewsets.ModelViewSet):
             return Response({
                 'error': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
+    
+    def _stream_ndjson(self, observations, serialize):
+        """
+        Stream observations as newline-delimited JSON
+        
+        Rows are read through a server-side cursor in API_STREAM_CHUNK_SIZE
+        batches, so memory stays flat however many observations match.
+        """
+        def rows():
+            for obs in observations.iterator(chunk_size=settings.API_STREAM_CHUNK_SIZE):
+                yield json.dumps(serialize(obs), cls=DjangoJSONEncoder) + '\n'
+        
+        return StreamingHttpResponse(rows(), content_type='application/fhir+ndjson')
@@ -0,0 +1,504 @@
+"""
+FHIR Resource API Endpoints
+Create, read, search and update for every FHIR resource model
+"""
+import logging
+from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch, Subquery
+from django.http import Http404
+from django.urls import reverse
+from django.utils import timezone
+
+from api.audit import get_audit_buffer
+from api.authorization import AuthorizedRecordMixin, restrict_to_patient
+from api.conditional import PreconditionFailed, check_if_match, etag, not_modified
+from api.idempotency import idempotent
+from api.pagination import page_limit, paginate_keyset
+from api.renderers import FHIRJSONRenderer
+from blockchain import get_hash_manager
+from fhir import search
+from fhir.anchoring import anchor_on_commit, anchored_models
+from fhir.bundles import CONFLICT_MESSAGE, BundleError, missing_references, process_bundle
+from fhir.history import current_version, load_history, load_version, record_update, verify_version
+from fhir.mapping import RESOURCE_MAPPERS, SERIALIZERS, UPDATE_MAPPERS, ReferenceResolver, to_fhir, version_id
+from fhir.models import ConsentRecord, Observation, Patient
+from fhir.projection import parse_projection
+from identity import DIDAuthentication
+
+logger = logging.getLogger(__name__)
+
+# Columns a PUT never writes: identity, ownership and server-managed fields
+PROTECTED_FIELDS = ('id', 'did', 'patient', 'blockchain_hash', 'blockchain_tx_id', 'created_at', 'updated_at')
+
+
+def _outcome(message: str, code: str = 'invalid') -> dict:
+    return {
+        'resourceType': 'OperationOutcome',
+        'issue': [{'severity': 'error', 'code': code, 'diagnostics': message}],
+    }
+
+
+def _searchset(request, page, full_url, projection):
+    """Wrap one page of results in a searchset Bundle with self/next links"""
+    params = request.query_params.copy()
+    params.pop('cursor', None)
+    base = request.build_absolute_uri(request.path)
+    links = [{'relation': 'self', 'url': request.build_absolute_uri()}]
+    if page.next_cursor:
+        params['cursor'] = page.next_cursor
+        links.append({'relation': 'next', 'url': f"{base}?{params.urlencode()}"})
+
+    return {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'link': links,
+        'entry': [
+            {'fullUrl': full_url(instance), 'resource': to_fhir(instance, projection.elements), 'search': {'mode': 'match'}}
+            for instance in page.results
+        ],
+    }
+
+
+def _count_only(request, queryset):
+    """_summary=count: a searchset Bundle with the total and no entries"""
+    return {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'total': queryset.count(),
+        'link': [{'relation': 'self', 'url': request.build_absolute_uri()}],
+    }
+
+
+class FHIRResourceViewSet(AuthorizedRecordMixin, viewsets.GenericViewSet):
+    """
+    FHIR REST interactions for one resource type: create, read, vread,
+    search, update and instance _history
+
+    Every request goes through the same stages: consent check (in the
+    query that loads the record), content hashing with the batch hasher,
+    anchoring (deferred to flush_anchors under FHIR_DEFER_ANCHORING),
+    buffered access logging and serialization with _summary/_elements
+    projection. Subclasses only set resource_type; see viewset_for.
+
+    Clinical records belong to a patient (patient_field = 'patient').
+    A Patient is its own compartment (patient_field = None). Practitioners
+    are directory entries any authenticated caller may read.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [DIDAuthentication]
+    renderer_classes = [JSONRenderer, FHIRJSONRenderer]
+    lookup_value_regex = '[0-9a-fA-F-]{36}'
+
+    resource_type = None
+    model = None
+    patient_field = 'patient'
+    compartment = True  # Whether records are patient data
+    anchored = True
+
+    def get_queryset(self):
+        queryset = self.model.objects.all()
+        if self.resource_type == 'DiagnosticReport':
+            queryset = queryset.prefetch_related(Prefetch('result', queryset=Observation.objects.only('id')))
+        return queryset
+
+    def _full_url(self, instance) -> str:
+        return self.request.build_absolute_uri(
+            reverse(f'fhir-{self.resource_type}-detail', args=[instance.id])
+        )
+
+    def _record(self, request, instance, action: str, consent_id=None) -> None:
+        """Buffer an access log event for patient data"""
+        if not self.compartment:
+            return
+        patient_id = instance.id if self.patient_field is None else getattr(instance, f'{self.patient_field}_id')
+        get_audit_buffer().record(
+            request.user.did, patient_id, self.resource_type, instance.id, action,
+            consent_id=consent_id, request=request,
+        )
+
+    def _restrict(self, queryset, request):
+        """
+        Limit a search to what the caller may see
+
+        Clinical records: see restrict_to_patient. Patient searches return
+        the caller, or the patients with an active consent to them.
+
+        Raises:
+            PermissionDenied: Without an active consent
+        """
+        user = request.user
+        if not self.compartment:
+            return queryset
+
+        if self.patient_field is None:
+            if user.is_patient:
+                return queryset.filter(id=user.entity_id)
+            return queryset.filter(id__in=Subquery(
+                ConsentRecord.objects.active().granted_to(practitioner_did=user.did).values('patient_id')
+            ))
+
+        return restrict_to_patient(queryset, user, request.query_params).queryset
+
+    def _load(self):
+        """Record to read or update, consent-checked; (instance, consent id)"""
+        if not self.compartment:
+            return self.get_object(), None
+        authorized = self.get_authorized_object()
+        return authorized.instance, authorized.consent_id
+
+    def list(self, request, *args, **kwargs):
+        """
+        Search: type-specific parameters (see fhir.search), _lastUpdated,
+        _count, cursor, _summary and _elements
+
+        Columns of elements left out by _summary or _elements are not read.
+        """
+        try:
+            params = request.query_params
+            projection = parse_projection(self.resource_type, params)
+            queryset = search.search(self.resource_type, params, self.get_queryset())
+            queryset = self._restrict(queryset, request)
+
+            if projection.count:
+                return Response(_count_only(request, queryset))
+
+            ordering = search.SEARCH_ORDERING[self.resource_type]
+            page = paginate_keyset(
+                projection.apply(queryset, extra=ordering),
+                ordering=ordering,
+                cursor=params.get('cursor'),
+                limit=page_limit(request, param='_count'),
+            )
+            return Response(_searchset(request, page, self._full_url, projection))
+
+        except PermissionDenied as e:
+            return Response({
+                'error': str(e.detail)
+            }, status=e.status_code)
+        except Exception as e:
+            logger.error(f"Error searching {self.resource_type}: {e}")
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Read one resource
+
+        A matching If-None-Match gets 304 once consent is checked. Anchored
+        records are re-hashed and a mismatch is reported as tampering.
+        """
+        try:
+            projection = parse_projection(self.resource_type, request.query_params)
+            if projection.count:
+                raise ValueError('_summary=count applies to searches only')
+
+            instance, consent_id = self._load()
+            version = version_id(instance)
+            if not_modified(request, version):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag(version)})
+
+            if self.anchored and get_hash_manager().generate_record_hash(instance) != instance.blockchain_hash:
+                logger.error(f"Hash mismatch for {self.resource_type} {instance.id}!")
+                return Response({
+                    'error': 'Data integrity check failed - record may have been tampered with'
+                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            self._record(request, instance, 'read', consent_id)
+            return Response(to_fhir(instance, projection.elements), headers={'ETag': etag(version)})
+
+        except (NotFound, PermissionDenied) as e:
+            return Response({
+                'error': str(e.detail)
+            }, status=e.status_code)
+        except Http404:
+            return Response({
+                'error': f'{self.resource_type} not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Error retrieving {self.resource_type}: {e}")
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        """
+        Create a clinical record from a FHIR resource
+
+        Runs the Bundle pipeline on a one-entry transaction, so validation,
+        hash upsert and (deferred) anchoring match POST /bundle/: a resource
+        identical to a stored record returns that record with 200 OK, or
+        409 if the caller's consent does not cover it.
+        Patients and practitioners are created with their DIDs through the
+        identity endpoints. Retries may send an Idempotency-Key.
+        """
+        if self.resource_type not in RESOURCE_MAPPERS:
+            return Response(_outcome(
+                f'{self.resource_type} resources are created through the identity endpoints', 'not-supported'
+            ), status=status.HTTP_405_METHOD_NOT_ALLOWED)
+        if not request.user.is_provider:
+            return Response(_outcome('Only providers can create clinical records', 'forbidden'),
+                            status=status.HTTP_403_FORBIDDEN)
+
+        resource = request.data
+        if not isinstance(resource, dict) or resource.get('resourceType') != self.resource_type:
+            return Response(_outcome(f'Expected a {self.resource_type} resource'),
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            result = process_bundle({
+                'resourceType': 'Bundle',
+                'type': 'transaction',
+                'entry': [{'resource': resource, 'request': {'method': 'POST', 'url': self.resource_type}}],
+            }, request.user.did, defer_anchoring=settings.FHIR_DEFER_ANCHORING)
+        except BundleError as e:
+            message = e.issues[0][1]
+            if message == CONFLICT_MESSAGE:
+                return Response(_outcome(message, 'duplicate'), status=status.HTTP_409_CONFLICT)
+            return Response(_outcome(message), status=status.HTTP_400_BAD_REQUEST)
+        except ValueError as e:
+            return Response(_outcome(str(e)), status=status.HTTP_400_BAD_REQUEST)
+
+        entry_response = result.bundle['entry'][0]['response']
+        created = entry_response['status'] == '201 Created'
+        instance = self.get_queryset().get(id=entry_response['location'].rpartition('/')[2])
+        self._record(request, instance, 'create' if created else 'read')
+
+        response_status = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        headers = {'Location': self._full_url(instance), 'ETag': etag(version_id(instance))}
+        if request.headers.get('Prefer') == 'return=minimal':
+            return Response(status=response_status, headers=headers)
+        return Response(to_fhir(instance), status=response_status, headers=headers)
+
+    def update(self, request, *args, **kwargs):
+        """
+        Replace a resource (PUT)
+
+        Providers amend clinical records within their consent; patients
+        and practitioners update their own resource. Send the ETag from the
+        last read as If-Match: the write is a compare-and-set on that
+        version (the content hash, or the update time for unhashed
+        resources), so concurrent updates get 412 rather than overwriting
+        each other. A record cannot be moved to another patient. Each
+        update adds a version to the resource's _history; its hash is
+        anchored only once the write commits.
+        """
+        try:
+            user = request.user
+            if self.patient_field:
+                if not user.is_provider:
+                    raise PermissionDenied('Patients cannot amend clinical records')
+            else:
+                owner_role = 'patient' if self.compartment else 'provider'
+                if user.role != owner_role or str(user.entity_id) != str(self.kwargs[self.lookup_field]):
+                    raise PermissionDenied(f'Only the {self.resource_type.lower()} can update their own resource')
+
+            instance, consent_id = self._load()
+            current = version_id(instance)
+            check_if_match(request, current)
+
+            resource = request.data
+            if not isinstance(resource, dict) or resource.get('resourceType') != self.resource_type:
+                raise ValueError(f'Expected a {self.resource_type} resource')
+            if resource.get('id') not in (None, str(instance.id)):
+                raise ValueError('Resource id does not match the URL')
+
+            mapped = UPDATE_MAPPERS[self.resource_type](resource, instance.id, ReferenceResolver({}))
+            amended = mapped.instance
+            if self.patient_field:
+                if getattr(amended, f'{self.patient_field}_id') != getattr(instance, f'{self.patient_field}_id'):
+                    raise ValueError('A record cannot be moved to another patient')
+            errors = missing_references({0: mapped})
+            if errors:
+                raise ValueError(errors[0])
+
+            changes = {
+                field.attname: getattr(amended, field.attname)
+                for field in self.model._meta.concrete_fields
+                if field.editable and field.name not in PROTECTED_FIELDS
+            }
+            changes.update((name, getattr(amended, name)) for name in getattr(self.model, 'DERIVED_FIELDS', ()))
+
+            if self.anchored:
+                record_hash = get_hash_manager().generate_record_hash(amended, related=mapped.related)
+                if record_hash == current:
+                    # Nothing changed; nothing to anchor
+                    return Response(to_fhir(instance), headers={'ETag': etag(current)})
+                # Written pending; anchored once the compare-and-set commits
+                changes.update(blockchain_hash=record_hash, blockchain_tx_id=None)
+                guard = {'blockchain_hash': current}
+            else:
+                guard = {'updated_at': instance.updated_at}
+
+            with transaction.atomic():
+                # Compare-and-set on the version read above
+                updated = self.model.objects.filter(id=instance.id, **guard).update(
+                    **changes, updated_at=timezone.now(),
+                )
+                if not updated:
+                    raise PreconditionFailed()
+                for name, ids in mapped.related.items():
+                    # Through a fresh instance: instance keeps the old results for its history entry
+                    getattr(self.model(id=instance.id), name).set(ids)
+
+                stored = self.get_queryset().get(id=instance.id)
+                record_update(instance, stored, user.did)
+                if self.anchored:
+                    anchor_on_commit([stored], user.did)
+
+            self._record(request, stored, 'update', consent_id)
+            logger.info(f"Updated {self.resource_type} {stored.id}")
+
+            return Response(to_fhir(stored), headers={'ETag': etag(version_id(stored))})
+
+        except (NotFound, PermissionDenied, PreconditionFailed) as e:
+            return Response({
+                'error': str(e.detail)
+            }, status=e.status_code)
+        except Http404:
+            return Response({
+                'error': f'{self.resource_type} not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Error updating {self.resource_type}: {e}")
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    def _history_entry(self, instance, row, content) -> dict:
+        """History Bundle entry for one version"""
+        created = row.version == 1
+        meta = {'versionId': row.version_id, 'lastUpdated': row.recorded_at.isoformat()}
+        return {
+            'fullUrl': self._full_url(instance),
+            'resource': {'resourceType': content['resourceType'], 'id': content['id'], 'meta': meta, **content},
+            'request': {'method': 'POST' if created else 'PUT', 'url': f'{self.resource_type}/{instance.id}'},
+            'response': {
+                'status': '201 Created' if created else '200 OK',
+                'etag': etag(row.version_id),
+                'lastModified': meta['lastUpdated'],
+                'blockchain_hash': row.blockchain_hash,
+                'blockchain_tx_id': row.blockchain_tx_id,
+                'hash_verified': verify_version(self.resource_type, instance.id, row, content),
+            },
+        }
+
+    @action(detail=True, methods=['get'], url_path='_history', url_name='history')
+    def history(self, request, *args, **kwargs):
+        """
+        Instance history: all versions, newest first
+
+        Each version carries the hash and anchor tx it had, and whether
+        its stored content still hashes to it. Pages of _count versions;
+        the next link's cursor is a version number.
+        """
+        try:
+            cursor = request.query_params.get('cursor')
+            before = int(cursor) if cursor else None
+            instance, consent_id = self._load()
+
+            versions = load_history(self.resource_type, instance.id, page_limit(request, param='_count'), before)
+            if not versions and before is None:
+                versions = [current_version(instance)]
+
+            links = [{'relation': 'self', 'url': request.build_absolute_uri()}]
+            oldest = versions[-1][0].version if versions else 1
+            if oldest > 1:
+                params = request.query_params.copy()
+                params['cursor'] = str(oldest)
+                links.append({'relation': 'next', 'url': f"{request.build_absolute_uri(request.path)}?{params.urlencode()}"})
+
+            self._record(request, instance, 'read', consent_id)
+            return Response({
+                'resourceType': 'Bundle',
+                'type': 'history',
+                'link': links,
+                'entry': [self._history_entry(instance, row, content) for row, content in versions],
+            })
+
+        except (NotFound, PermissionDenied) as e:
+            return Response({
+                'error': str(e.detail)
+            }, status=e.status_code)
+        except Http404:
+            return Response({
+                'error': f'{self.resource_type} not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Error reading {self.resource_type} history: {e}")
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=['get'], url_path=r'_history/(?P<vid>[^/]+)', url_name='vread')
+    def vread(self, request, vid=None, *args, **kwargs):
+        """
+        Read one version by its version id (meta.versionId / ETag value)
+
+        Hashed versions are re-hashed from their stored content and a
+        mismatch is reported as tampering.
+        """
+        try:
+            instance, consent_id = self._load()
+
+            found = load_version(self.resource_type, instance.id, vid)
+            if found is None and vid == version_id(instance):
+                found = current_version(instance)
+            if found is None:
+                return Response({
+                    'error': f'Version {vid} not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            row, content = found
+            if verify_version(self.resource_type, instance.id, row, content) is False:
+                logger.error(f"Hash mismatch for {self.resource_type} {instance.id} version {vid}!")
+                return Response({
+                    'error': 'Data integrity check failed - record may have been tampered with'
+                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            self._record(request, instance, 'read', consent_id)
+            resource = self._history_entry(instance, row, content)['resource']
+            return Response(resource, headers={'ETag': etag(row.version_id)})
+
+        except (NotFound, PermissionDenied) as e:
+            return Response({
+                'error': str(e.detail)
+            }, status=e.status_code)
+        except Http404:
+            return Response({
+                'error': f'{self.resource_type} not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Error reading {self.resource_type} version: {e}")
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+
+def viewset_for(resource_type: str):
+    """
+    FHIRResourceViewSet subclass for a resource type
+
+    Whether records belong to a patient and whether they are anchored is
+    read from the model, so every model in SERIALIZERS gets the same
+    interactions without per-type code.
+    """
+    model = SERIALIZERS[resource_type][0]
+    fields = {field.name: field for field in model._meta.concrete_fields}
+    patient_field = 'patient' if getattr(fields.get('patient'), 'related_model', None) is Patient else None
+    return type(f'{resource_type}ViewSet', (FHIRResourceViewSet,), {
+        '__doc__': f"FHIR {resource_type} interactions",
+        'resource_type': resource_type,
+        'model': model,
+        'patient_field': patient_field,
+        'compartment': model is Patient or patient_field is not None,
+        'anchored': model in anchored_models(),
+    })
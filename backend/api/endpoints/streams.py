@@ -0,0 +1,179 @@
+"""
+Device Stream API Endpoints
+Batched ingestion of remote monitoring readings and their expansion for reads
+"""
+import logging
+from django.conf import settings
+from django.http import QueryDict
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from api.audit import get_audit_buffer
+from api.authorization import restrict_to_patient
+from api.idempotency import idempotent
+from fhir.mapping import parse_instant
+from fhir.models import Observation, Patient
+from fhir.streams import ChunkSearch, ingest_readings, visible_chunks
+
+logger = logging.getLogger(__name__)
+
+# Observation search parameters that select readings
+READING_PARAMETERS = ('code', 'date', 'status', 'patient', 'subject')
+
+
+def reading_search(request) -> tuple:
+    """
+    Consent-checked ChunkSearch for the Observation search parameters of a request
+
+    Returns:
+        (ChunkSearch, api.authorization.CompartmentSearch)
+    """
+    params = request.query_params
+    criteria = QueryDict(mutable=True)
+    for name in READING_PARAMETERS:
+        if name in params:
+            criteria.setlist(name, params.getlist(name))
+    compartment = restrict_to_patient(Observation.objects.all(), request.user, params)
+    return ChunkSearch(visible_chunks(compartment), criteria), compartment
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@idempotent
+def observation_ingest(request):
+    """
+    Observation/$ingest: store a batch of readings from a monitoring device
+
+    Request body:
+        patient: 'Patient/<id>' (patients may leave it out)
+        device: Device identifier
+        code: CodeableConcept of the readings
+        unit: UCUM unit of the values
+        readings: [[dateTime, value], ...]
+
+    Readings are stored in hourly chunks, each hashed and anchored as one
+    record (see fhir.streams.ingest_readings). Resending a batch is
+    harmless, and with an Idempotency-Key it is not even decoded again.
+    Providers ingest for any patient, as with other creates; patients
+    for themselves.
+    """
+    try:
+        user = request.user
+        body = request.data
+        if not isinstance(body, dict):
+            raise ValueError('Expected a JSON object')
+
+        reference = body.get('patient')
+        if user.is_patient:
+            patient_id = user.entity_id
+            if reference and reference.rpartition('/')[2] != str(patient_id):
+                raise PermissionDenied('Patients can only ingest their own readings')
+        elif user.is_provider:
+            if not reference:
+                raise ValueError('patient is required')
+            patient_id = reference.rpartition('/')[2]
+        else:
+            raise PermissionDenied('Only patients and providers can ingest readings')
+        patient = Patient.objects.filter(id=patient_id).first()
+        if patient is None:
+            raise ValueError(f"Unknown patient: {patient_id}")
+
+        device = body.get('device')
+        if not device or not isinstance(device, str):
+            raise ValueError('device is required')
+        readings = body.get('readings')
+        if not isinstance(readings, list) or not readings:
+            raise ValueError('readings must be a non-empty list of [dateTime, value] pairs')
+        if len(readings) > settings.FHIR_STREAM_MAX_READINGS:
+            raise ValueError(f"At most {settings.FHIR_STREAM_MAX_READINGS} readings per request")
+        pairs = []
+        for reading in readings:
+            if not isinstance(reading, (list, tuple)) or len(reading) != 2:
+                raise ValueError(f"Expected [dateTime, value]: {reading!r}")
+            pairs.append((parse_instant(reading[0]), reading[1]))
+
+        chunks = ingest_readings(patient, device, body.get('code'), body.get('unit'), pairs,
+                                 user.did, defer_anchoring=settings.FHIR_DEFER_ANCHORING)
+
+        buffer = get_audit_buffer()
+        for chunk in chunks:
+            buffer.record(user.did, patient.id, 'ObservationChunk', chunk.id, 'create', request=request)
+
+        return Response({
+            'readings': len(pairs),
+            'chunks': [
+                {
+                    'id': str(chunk.id),
+                    'start': chunk.start.isoformat(),
+                    'count': chunk.count,
+                    'blockchain_hash': chunk.blockchain_hash,
+                    'blockchain_tx_id': chunk.blockchain_tx_id,
+                }
+                for chunk in chunks
+            ],
+        }, status=status.HTTP_201_CREATED)
+
+    except PermissionDenied as e:
+        return Response({
+            'error': str(e.detail)
+        }, status=e.status_code)
+    except Exception as e:
+        logger.error(f"Error ingesting device readings: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def observation_readings(request):
+    """
+    Observation/$readings: device readings in time order
+
+    Query parameters:
+        code: Observation code (required)
+        patient/subject: The patient (required for providers)
+        date, status: Further Observation search criteria
+
+    At most FHIR_STREAM_MAX_READINGS readings are returned; narrow the
+    date range for more. Values are in the canonical unit of their
+    dimension (fhir.ucum).
+    """
+    try:
+        user = request.user
+        if not request.query_params.get('code'):
+            raise ValueError('code is required')
+        chunks, compartment = reading_search(request)
+        readings = chunks.readings()
+
+        get_audit_buffer().record(
+            user.did, compartment.patient_id, 'Patient', compartment.patient_id, 'read',
+            consent_id=compartment.consent_id, request=request,
+        )
+
+        return Response({
+            'code': request.query_params.getlist('code'),
+            'total': len(readings),
+            'readings': [
+                {
+                    'time': reading['time'].isoformat(),
+                    'value': reading['value'],
+                    'unit': reading['unit'],
+                    'device': reading['device'],
+                }
+                for reading in readings
+            ],
+        })
+
+    except PermissionDenied as e:
+        return Response({
+            'error': str(e.detail)
+        }, status=e.status_code)
+    except Exception as e:
+        logger.error(f"Error reading device readings: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
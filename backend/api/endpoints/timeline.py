@@ -0,0 +1,206 @@
+"""
+Patient Timeline API Endpoint
+A patient's encounters, observations and medications merged in time order
+"""
+import heapq
+import logging
+from typing import Dict, List, NamedTuple, Optional
+from django.db.backends.postgresql.psycopg_any import DateTimeTZRange
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from api.audit import get_audit_buffer
+from api.pagination import encode_cursor, keyset_queryset, page_limit
+from fhir import search
+from fhir.consent_decisions import get_consent_service
+from fhir.mapping import to_fhir
+from fhir.models import Encounter, MedicationRequest, Observation
+
+logger = logging.getLogger(__name__)
+
+# Resource type -> (model, time field, keyset ordering, date search parameter), newest first
+TIMELINE_TYPES = {
+    'Encounter': (Encounter, 'period_start', ('-period_start', '-id'), 'date'),
+    'Observation': (Observation, 'effective_datetime', ('-effective_datetime', '-id'), 'date'),
+    'MedicationRequest': (MedicationRequest, 'authored_on', ('-authored_on', '-id'), 'authoredon'),
+}
+
+
+class TimelinePage(NamedTuple):
+    """One page of the timeline, newest first"""
+    entries: List[tuple]  # (time, resource type, instance)
+    cursors: Dict[str, str]  # Type -> cursor for the types with more entries
+    encounters: Dict[object, Encounter]  # Entry instance id -> the encounter it happened during
+
+
+def load_timeline(patient_id, resource_types, limit: int, cursors: Optional[Dict[str, str]] = None,
+                  dates=(), scope=None) -> TimelinePage:
+    """
+    Load one page of a patient's timeline
+
+    Each type is read with its own keyset query of limit + 1 rows (served
+    by its (patient, time) index), and the three newest-first streams are
+    merged with heapq.merge, so a page costs one query per type plus one
+    for the encounters its entries happened during (a GiST overlap on
+    Encounter.period), however long the history. Observations without an
+    effective time are left out.
+
+    Args:
+        patient_id: Patient id
+        resource_types: Types from TIMELINE_TYPES
+        limit: Entries per page
+        cursors: {type: cursor} to continue from ('' to start a type from the newest)
+        dates: FHIR date search values applied to each type's time
+        scope: CompiledScope restricting the types (None for the patient)
+
+    Returns:
+        TimelinePage
+    """
+    cursors = cursors or {}
+    streams = {}
+    for resource_type in resource_types:
+        model, time_field, ordering, date_param = TIMELINE_TYPES[resource_type]
+        queryset = model.objects.filter(patient_id=patient_id, **{f'{time_field}__isnull': False})
+        if scope is not None:
+            queryset = scope.filter(queryset)
+        for value in dates:
+            queryset = queryset.filter(search.SEARCH_PARAMETERS[resource_type][date_param].to_q(value))
+        queryset = keyset_queryset(queryset, ordering, cursors.get(resource_type))
+        streams[resource_type] = list(queryset[:limit + 1])
+
+    merged = heapq.merge(
+        *[
+            [(getattr(row, TIMELINE_TYPES[resource_type][1]), resource_type, row) for row in rows]
+            for resource_type, rows in streams.items()
+        ],
+        key=lambda entry: entry[0],
+        reverse=True,
+    )
+    entries = []
+    for entry in merged:
+        if len(entries) == limit:
+            break
+        entries.append(entry)
+
+    next_cursors = {}
+    for resource_type, rows in streams.items():
+        used = [row for _, entry_type, row in entries if entry_type == resource_type]
+        if len(used) == len(rows):
+            continue
+        if used:
+            ordering = TIMELINE_TYPES[resource_type][2]
+            next_cursors[resource_type] = encode_cursor([getattr(used[-1], f.lstrip('-')) for f in ordering])
+        else:
+            next_cursors[resource_type] = cursors.get(resource_type) or ''
+
+    return TimelinePage(entries, next_cursors, _encounters_of(patient_id, entries, scope))
+
+
+def _encounters_of(patient_id, entries, scope) -> Dict[object, Encounter]:
+    """Map observation and medication entries to the latest encounter whose period contains them"""
+    times = [time for time, resource_type, _ in entries if resource_type != 'Encounter']
+    if not times:
+        return {}
+    encounters = Encounter.objects.filter(
+        patient_id=patient_id, period__overlap=DateTimeTZRange(min(times), max(times), '[]'),
+    ).only('id', 'period_start', 'period_end').order_by('-period_start')
+    if scope is not None:
+        encounters = scope.filter(encounters)
+    encounters = list(encounters)
+
+    found = {}
+    for time, resource_type, instance in entries:
+        if resource_type == 'Encounter':
+            continue
+        for encounter in encounters:
+            if encounter.period_start <= time and (encounter.period_end is None or time < encounter.period_end):
+                found[instance.id] = encounter
+                break
+    return found
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def patient_timeline(request, patient_id):
+    """
+    Patient/<id>/$timeline: encounters, observations and medication
+    requests, newest first
+
+    Query parameters:
+        _type: Comma-separated subset of Encounter, Observation, MedicationRequest
+        date: FHIR date values (repeatable); Encounters match by period
+        _count: Entries per page
+        cursor: 'Type:cursor' values from the next link, one per type
+
+    Observations and medication requests carry the encounter they
+    happened during. Providers only receive what the patient's consent
+    covers.
+    """
+    try:
+        user = request.user
+        params = request.query_params
+
+        scope = None
+        consent_id = None
+        if not (user.role == 'patient' and str(user.entity_id) == str(patient_id)):
+            decision = get_consent_service().check(patient_id, user.did)
+            if not decision.allowed:
+                return Response({
+                    'error': 'No active consent'
+                }, status=status.HTTP_403_FORBIDDEN)
+            scope = decision.scope
+            consent_id = decision.consent_id
+
+        resource_types = [t for t in params.get('_type', '').split(',') if t] or list(TIMELINE_TYPES)
+        unknown = set(resource_types) - set(TIMELINE_TYPES)
+        if unknown:
+            raise ValueError(f"Unsupported _type: {', '.join(sorted(unknown))}")
+
+        cursors = {}
+        for value in params.getlist('cursor'):
+            resource_type, sep, cursor = value.partition(':')
+            if not sep or resource_type not in TIMELINE_TYPES:
+                raise ValueError(f'Invalid cursor: {value}')
+            cursors[resource_type] = cursor
+        if cursors:
+            # Later pages continue only the types that had more entries
+            resource_types = [t for t in resource_types if t in cursors]
+
+        page = load_timeline(patient_id, resource_types, page_limit(request, param='_count'),
+                             cursors=cursors, dates=params.getlist('date'), scope=scope)
+
+        links = [{'relation': 'self', 'url': request.build_absolute_uri()}]
+        if page.cursors:
+            next_params = params.copy()
+            next_params.setlist('cursor', [f'{t}:{cursor}' for t, cursor in page.cursors.items()])
+            links.append({
+                'relation': 'next',
+                'url': f"{request.build_absolute_uri(request.path)}?{next_params.urlencode()}",
+            })
+
+        get_audit_buffer().record(
+            user.did, patient_id, 'Patient', patient_id, 'read',
+            consent_id=consent_id, request=request,
+        )
+
+        entries = []
+        for time, resource_type, instance in page.entries:
+            entry = {'time': time.isoformat(), 'resource': to_fhir(instance)}
+            encounter = page.encounters.get(instance.id)
+            if encounter is not None:
+                entry['encounter'] = {'reference': f'Encounter/{encounter.id}'}
+            entries.append(entry)
+
+        return Response({
+            'patient': str(patient_id),
+            'link': links,
+            'entry': entries,
+        })
+
+    except Exception as e:
+        logger.error(f"Error building patient timeline: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,115 @@
+"""
+Observation Time Series API Endpoint
+Bucketed trends of numeric observations (vitals, glucose) for charts
+"""
+import logging
+from django.http import QueryDict
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from api.audit import get_audit_buffer
+from api.authorization import restrict_to_patient
+from fhir import search, ucum
+from fhir.streams import ChunkSearch, visible_chunks
+from fhir.timeseries import bucket_time, bucket_values, chunk_buckets, lttb, merge_buckets
+
+logger = logging.getLogger(__name__)
+
+# Observation search parameters that select the series
+SERIES_PARAMETERS = ('code', 'date', 'status', 'patient', 'subject')
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def observation_timeseries(request):
+    """
+    Observation/$timeseries: min, max, avg and last value per time bucket
+
+    Query parameters:
+        code: Observation code (required), as for Observation search
+        patient/subject: The patient (required for providers)
+        date, status: Further Observation search criteria
+        resolution: minute, hour (default), day, week or month
+        unit: Only values in this unit (any unit of its dimension)
+        points: Downsample to at most this many buckets per unit with LTTB
+
+    Values come from the numeric value_numeric column and from device
+    readings (Observation/$ingest), in the canonical unit of their
+    dimension (fhir.ucum); observations without a numeric valueQuantity
+    are left out. Each point carries its unit, and values in units that
+    do not convert into each other (glucose in mg/dL and mmol/L) form
+    separate points rather than being averaged together.
+    """
+    try:
+        user = request.user
+        params = request.query_params
+        if not params.get('code'):
+            raise ValueError('code is required')
+        resolution = params.get('resolution', 'hour')
+        points = int(params['points']) if params.get('points') else None
+        if points is not None and points < 3:
+            raise ValueError('points must be at least 3')
+
+        criteria = QueryDict(mutable=True)
+        for name in SERIES_PARAMETERS:
+            if name in params:
+                criteria.setlist(name, params.getlist(name))
+        compartment = restrict_to_patient(search.search('Observation', criteria), user, params)
+        observations = compartment.queryset
+        chunks = visible_chunks(compartment)
+        if params.get('unit'):
+            unit = ucum.canonical_unit(ucum.unit_code({'code': params['unit']}))
+            observations = observations.filter(value_unit=unit)
+            chunks = chunks.filter(unit=unit)
+
+        buckets = merge_buckets(
+            bucket_values(observations, resolution),
+            chunk_buckets(ChunkSearch(chunks, criteria), resolution),
+        )
+        total = len(buckets)
+        units = sorted({row['unit'] for row in buckets}, key=lambda unit: unit or '')
+        if points:
+            kept = []
+            for unit in units:
+                rows = [row for row in buckets if row['unit'] == unit]
+                if len(rows) > points:
+                    rows = [rows[i] for i in lttb([(row['bucket'], row['avg']) for row in rows], points)]
+                kept.extend(rows)
+            buckets = sorted(kept, key=lambda row: (row['bucket'], row['unit'] or ''))
+
+        get_audit_buffer().record(
+            user.did, compartment.patient_id, 'Patient', compartment.patient_id, 'read',
+            consent_id=compartment.consent_id, request=request,
+        )
+
+        return Response({
+            'code': params.getlist('code'),
+            'resolution': resolution,
+            'buckets': total,
+            'units': units,
+            'points': [
+                {
+                    'time': bucket_time(row['bucket']).isoformat(),
+                    'unit': row['unit'],
+                    'count': row['count'],
+                    'min': row['min'],
+                    'max': row['max'],
+                    'avg': row['avg'],
+                    'last': row['last'],
+                }
+                for row in buckets
+            ],
+        })
+
+    except PermissionDenied as e:
+        return Response({
+            'error': str(e.detail)
+        }, status=e.status_code)
+    except Exception as e:
+        logger.error(f"Error building observation time series: {e}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,146 @@
+"""
+Idempotency Keys
+Replays the stored response when a create request is retried with the same Idempotency-Key
+"""
+import functools
+import hashlib
+import json
+import logging
+from typing import Optional
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+# Response headers kept with a stored response
+REPLAYED_HEADERS = ('Location', 'ETag', 'Content-Location')
+
+
+class IdempotencyStore:
+    """
+    Short-lived responses of requests made with an Idempotency-Key
+
+    Entries live in the shared cache under the caller's DID, the method,
+    path and key. A request claims its key with an atomic add, so of two
+    concurrent requests with one key only the first runs; the entry then
+    holds the response for IDEMPOTENCY_KEY_TTL seconds.
+    """
+
+    PENDING = 'pending'
+
+    def __init__(self, ttl: int, lock_timeout: int):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+
+    def cache_key(self, did: str, method: str, path: str, key: str) -> str:
+        scope = json.dumps([did, method, path, key])
+        return 'idempotency:' + hashlib.sha256(scope.encode('utf-8')).hexdigest()
+
+    def claim(self, cache_key: str, fingerprint: str) -> Optional[dict]:
+        """
+        Claim a key for a request
+
+        Returns:
+            None if the caller now holds the key, otherwise the entry of
+            the request that does (pending, or with its response)
+        """
+        pending = {'state': self.PENDING, 'fingerprint': fingerprint}
+        for _ in range(2):
+            if cache.add(cache_key, pending, self.lock_timeout):
+                return None
+            entry = cache.get(cache_key)
+            if entry is not None:
+                return entry
+        return pending
+
+    def complete(self, cache_key: str, fingerprint: str, response: Response):
+        """Keep a response for replay"""
+        cache.set(cache_key, {
+            'state': 'done',
+            'fingerprint': fingerprint,
+            'status': response.status_code,
+            'data': response.data,
+            'headers': {name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)},
+        }, self.ttl)
+
+    def release(self, cache_key: str):
+        """Give up a claim so the request can be retried"""
+        cache.delete(cache_key)
+
+
+# Singleton instance
+_idempotency_store = None
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """Get singleton idempotency store instance"""
+    global _idempotency_store
+    if _idempotency_store is None:
+        _idempotency_store = IdempotencyStore(settings.IDEMPOTENCY_KEY_TTL, settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    return _idempotency_store
+
+
+def request_fingerprint(request) -> str:
+    """Hash of a request body, to tell a retry from a different request reusing a key"""
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def idempotent(view):
+    """
+    Honour an Idempotency-Key header on a create view (function or viewset method)
+
+    The first request with a key runs the view and its response is kept;
+    a retry with the same key and body gets that response back, marked
+    Idempotent-Replayed, without running the view again: no second row
+    and no second anchor. A retry while the first request is still
+    running gets 409 with Retry-After, and the key reused with a
+    different body 422. Server errors are not kept, so the client can
+    retry them. Requests without the header are unaffected.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, Request))
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return Response({
+                'error': 'Idempotency-Key must be at most 255 characters'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        store = get_idempotency_store()
+        cache_key = store.cache_key(request.user.did, request.method, request.path, key)
+        fingerprint = request_fingerprint(request)
+
+        entry = store.claim(cache_key, fingerprint)
+        if entry is not None:
+            if entry['fingerprint'] != fingerprint:
+                return Response({
+                    'error': 'Idempotency-Key was already used with a different request body'
+                }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if entry['state'] == store.PENDING:
+                return Response({
+                    'error': 'A request with this Idempotency-Key is still being processed'
+                }, status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+            logger.info(f"Replaying response for Idempotency-Key {key} of {request.user.did}")
+            return Response(entry['data'], status=entry['status'],
+                            headers={**entry['headers'], 'Idempotent-Replayed': 'true'})
+
+        try:
+            response = view(*args, **kwargs)
+        except Exception:
+            store.release(cache_key)
+            raise
+        if isinstance(response, Response) and response.status_code < 500:
+            store.complete(cache_key, fingerprint, response)
+        else:
+            store.release(cache_key)
+        return response
+
+    return wrapper
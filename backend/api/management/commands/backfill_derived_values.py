@@ -0,0 +1,70 @@
+# Management command to fill derived columns (observation code/value/unit, encounter period) for rows written before they existed
+from collections import defaultdict
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+
+class Command(BaseCommand):
+    help = 'Backfill derived FHIR columns (see DERIVED_FIELDS) in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per update transaction')
+        parser.add_argument('--model', action='append', help='Only this model (e.g. Encounter); repeatable')
+
+    def handle(self, *args, **options):
+        models = [
+            model for model in apps.get_app_config('fhir').get_models()
+            if hasattr(model, 'DERIVED_FIELDS')
+            and (not options['model'] or model.__name__ in options['model'])
+        ]
+        for model in models:
+            total = self.backfill(model, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Backfilled {total} {model.__name__} rows.'))
+
+    def backfill(self, model, batch_size: int) -> int:
+        """
+        Walk the table in primary key order, one short transaction per
+        batch, so it can run while the API is serving. Rows are re-derived
+        from DERIVED_FROM; the hashed content and updated_at are untouched.
+        Rows locked by a concurrent update are skipped, as that update
+        derives the values itself.
+        """
+        fields = ['id', *model.DERIVED_FROM, *model.DERIVED_FIELDS]
+        last_id = None
+        total = 0
+
+        while True:
+            with transaction.atomic():
+                rows = model.objects.order_by('id').only(*fields)
+                if last_id is not None:
+                    rows = rows.filter(id__gt=last_id)
+                batch = list(rows.select_for_update(skip_locked=True)[:batch_size])
+                if not batch:
+                    break
+
+                changed = defaultdict(list)
+                for instance in batch:
+                    current = tuple(getattr(instance, name) for name in model.DERIVED_FIELDS)
+                    instance.derive_values()
+                    derived = tuple(getattr(instance, name) for name in model.DERIVED_FIELDS)
+                    if derived != current:
+                        changed[derived].append(instance)
+
+                # One UPDATE per set of derived values shared by several rows
+                # (few for vitals and labs), one bulk UPDATE for the rest (periods)
+                single = []
+                for derived, instances in changed.items():
+                    if len(instances) == 1:
+                        single.extend(instances)
+                    else:
+                        model.objects.filter(id__in=[i.id for i in instances]).update(
+                            **dict(zip(model.DERIVED_FIELDS, derived))
+                        )
+                model.objects.bulk_update(single, list(model.DERIVED_FIELDS))
+
+            last_id = batch[-1].id
+            total += sum(len(instances) for instances in changed.values())
+
+        return total
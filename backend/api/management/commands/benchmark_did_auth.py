@@ -0,0 +1,109 @@
+# Management command to benchmark DID signature verification throughput (verifications/second per core)
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from identity import keys
+from identity.did_manager import DIDManager
+from identity.replay import ReplayGuard
+
+
+class Command(BaseCommand):
+    help = 'Benchmark single-core DID signature verification throughput for auth capacity sizing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=5000, help='Verifications per measurement')
+        parser.add_argument(
+            '--key-type',
+            choices=list(keys.SUPPORTED_KEY_TYPES) + ['all'],
+            default='all',
+            help='Key type to benchmark',
+        )
+        parser.add_argument(
+            '--replay-backend',
+            choices=['memory', 'shared_memory', 'redis'],
+            default='memory',
+            help='Replay guard backend to time (redis writes benchmark nonces to the live filter)',
+        )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        key_types = keys.SUPPORTED_KEY_TYPES if options['key_type'] == 'all' else [options['key_type']]
+
+        self.stdout.write(f'DID verification benchmark ({iterations} iterations, single thread = one core)')
+
+        for key_type in key_types:
+            did_manager = DIDManager()
+            did_info = did_manager.create_did(entity_type='benchmark', key_type=key_type)
+            did = did_info['did']
+
+            try:
+                now = int(time.time())
+                messages = [f'{now}:{i:08x}' for i in range(iterations)]
+                signatures = [keys.sign_message(key_type, did_info['private_key'], m) for m in messages]
+                message_bytes = [m.encode('utf-8') for m in messages]
+                signature_bytes = [keys.decode_signature(sig) for sig in signatures]
+
+                # Decode the public key on every verification (previous behaviour of a naive implementation)
+                start = time.perf_counter()
+                for m, sig in zip(message_bytes, signature_bytes):
+                    public_key = keys.load_public_key(key_type, did_info['public_key'])
+                    keys.verify_signature(key_type, public_key, m, sig)
+                cold = time.perf_counter() - start
+
+                # Reuse the decoded key object (pure signature math)
+                public_key = keys.load_public_key(key_type, did_info['public_key'])
+                start = time.perf_counter()
+                for m, sig in zip(message_bytes, signature_bytes):
+                    keys.verify_signature(key_type, public_key, m, sig)
+                warm = time.perf_counter() - start
+
+                # Full DIDManager path: DID document cache lookup + cached key object
+                start = time.perf_counter()
+                for m, sig in zip(messages, signatures):
+                    did_manager.verify_did_signature(did, m, sig)
+                full = time.perf_counter() - start
+
+                # Batch API
+                start = time.perf_counter()
+                results = did_manager.verify_did_signatures(list(zip([did] * iterations, messages, signatures)))
+                batch = time.perf_counter() - start
+
+                if not all(results):
+                    self.stderr.write(f'{key_type}: some signatures failed verification')
+
+                self.stdout.write(f'\n{key_type}')
+                for label, elapsed in (
+                    ('decode key per request', cold),
+                    ('cached key object', warm),
+                    ('DIDManager.verify_did_signature', full),
+                    ('DIDManager.verify_did_signatures (batch)', batch),
+                ):
+                    self.stdout.write(
+                        f'  {label:<42} {iterations / elapsed:>10,.0f} verifications/s/core'
+                        f'  ({elapsed / iterations * 1e6:.1f} us/op)'
+                    )
+            finally:
+                cache.delete(f'did_{did}')
+
+        self._benchmark_replay_guard(options['replay_backend'], iterations)
+
+        self.stdout.write(self.style.SUCCESS('\nBenchmark complete.'))
+
+    def _benchmark_replay_guard(self, backend, iterations):
+        replay_guard = ReplayGuard(backend=backend)
+        now = time.time()
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            replay_guard.check_and_record('did:prism:benchmark', f'bench-{now}-{i}', now)
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(f'\nReplay guard ({backend})')
+        self.stdout.write(
+            f'  {"check_and_record":<42} {iterations / elapsed:>10,.0f} checks/s/core'
+            f'  ({elapsed / iterations * 1e6:.1f} us/op)'
+        )
+        for key, value in replay_guard.stats(now=now).items():
+            self.stdout.write(f'  {key:<42} {value}')
@@ -0,0 +1,32 @@
+# Management command to mark lapsed consents as expired (run from cron or with --interval)
+import time
+
+from django.core.management.base import BaseCommand
+
+from fhir.consent_expiry import sweep_expired_consents
+
+
+class Command(BaseCommand):
+    help = 'Transition active consents past their expires_at to expired, in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Consents updated per transaction')
+        parser.add_argument('--max-batches', type=int, default=None, help='Stop after this many batches')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Keep running, sweeping every N seconds (0 runs once)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            count = sweep_expired_consents(
+                batch_size=options['batch_size'],
+                max_batches=options['max_batches'],
+            )
+            self.stdout.write(self.style.SUCCESS(f'Expired {count} consents.'))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+# Management command to anchor records created with deferred anchoring (run from cron or with --interval)
+import time
+
+from django.core.management.base import BaseCommand
+
+from fhir.anchoring import flush_anchors
+
+
+class Command(BaseCommand):
+    help = 'Anchor pending record hashes on Cardano in Merkle-root batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Records per anchor transaction')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Keep running, flushing every N seconds (0 flushes what is pending and exits)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            total = 0
+            while True:
+                count = flush_anchors(batch_size=options['batch_size'])
+                if not count:
+                    break
+                total += count
+            self.stdout.write(self.style.SUCCESS(f'Anchored {total} records.'))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,28 @@
+# Management command to run queued FHIR Bulk Data $export jobs (run from cron or with --interval)
+import time
+
+from django.core.management.base import BaseCommand
+
+from fhir.exports import process_export_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued $export jobs, writing gzip-compressed NDJSON files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-jobs', type=int, default=None, help='Stop after this many jobs')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Keep running, polling the queue every N seconds (0 runs once)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            count = process_export_jobs(max_jobs=options['max_jobs'])
+            self.stdout.write(self.style.SUCCESS(f'Ran {count} export jobs.'))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
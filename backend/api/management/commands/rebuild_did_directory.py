@@ -0,0 +1,12 @@
+# Management command to rebuild the DID directory from Patient and Practitioner records
+from django.core.management.base import BaseCommand
+
+from identity import get_did_directory
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the DID directory (DID -> role, entity id, status) from FHIR identity tables'
+
+    def handle(self, *args, **options):
+        count = get_did_directory().rebuild()
+        self.stdout.write(self.style.SUCCESS(f'DID directory rebuilt with {count} entries.'))
@@ -0,0 +1,224 @@
+"""
+API Pagination
+Keyset (cursor) pagination and cached counts for large listings
+"""
+import base64
+import hashlib
+import json
+import logging
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+
+class KeysetPage(NamedTuple):
+    """One page of results and the cursor for the next page (None on the last page)"""
+    results: List[Any]
+    next_cursor: Optional[str]
+
+
+def encode_cursor(values: Sequence) -> str:
+    """Encode the sort key of the last row as an opaque cursor"""
+    payload = [
+        value.isoformat() if isinstance(value, datetime) else str(value) if isinstance(value, uuid.UUID) else value
+        for value in values
+    ]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, fields: Sequence[str], model) -> list:
+    """
+    Decode a cursor produced by encode_cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError('Invalid cursor')
+
+    decoded = []
+    for field_name, value in zip(fields, values):
+        field = model._meta.get_field(field_name)
+        if value is not None and field.get_internal_type() in ('DateTimeField', 'DateField'):
+            parsed = parse_datetime(value)
+            if parsed is None:
+                raise ValueError('Invalid cursor')
+            value = parsed
+        elif value is not None and field.get_internal_type() == 'UUIDField':
+            value = uuid.UUID(value)
+        decoded.append(value)
+    return decoded
+
+
+def _after(fields: Sequence[str], values: Sequence, model=None) -> Q:
+    """
+    Row-value comparison (f1, f2, ...) > (v1, v2, ...) expanded for the ORM
+
+    Fields prefixed with '-' compare descending. Nullable fields follow the
+    PostgreSQL default of NULL sorting above every value (NULLS LAST when
+    ascending, NULLS FIRST when descending).
+    """
+    condition = Q()
+    for i in reversed(range(len(fields))):
+        name = fields[i].lstrip('-')
+        descending = fields[i].startswith('-')
+        nullable = model is not None and model._meta.get_field(name).null
+        value = values[i]
+
+        if value is None:
+            # Past a NULL: ascending has nothing further, descending has every value
+            step = Q(**{f'{name}__isnull': False}) if descending else Q(pk__in=[])
+            same = Q(**{f'{name}__isnull': True})
+        else:
+            step = Q(**{f'{name}__lt' if descending else f'{name}__gt': value})
+            if nullable and not descending:
+                step |= Q(**{f'{name}__isnull': True})
+            same = Q(**{name: value})
+
+        if i < len(fields) - 1:
+            step |= same & condition
+        condition = step
+    return condition
+
+
+def keyset_ordering(fields: Sequence[str], model) -> list:
+    """Ordering expressions with explicit NULL placement matching _after"""
+    ordering = []
+    for field in fields:
+        name = field.lstrip('-')
+        if not model._meta.get_field(name).null:
+            ordering.append(field)
+        elif field.startswith('-'):
+            ordering.append(F(name).desc(nulls_first=True))
+        else:
+            ordering.append(F(name).asc(nulls_last=True))
+    return ordering
+
+
+def page_limit(request, default: Optional[int] = None, param: str = 'limit') -> int:
+    """
+    Read the page size query parameter, bounded by API_MAX_PAGE_SIZE
+
+    Args:
+        request: DRF request
+        default: Page size if the parameter is absent (default PAGE_SIZE)
+        param: Query parameter name ('limit', or '_count' on FHIR searches)
+
+    Raises:
+        ValueError: If the page size is not a positive integer
+    """
+    default = default or settings.REST_FRAMEWORK['PAGE_SIZE']
+    try:
+        limit = int(request.query_params.get(param, default))
+    except (TypeError, ValueError):
+        raise ValueError(f'{param} must be an integer')
+    if limit <= 0:
+        raise ValueError(f'{param} must be positive')
+    return min(limit, settings.API_MAX_PAGE_SIZE)
+
+
+def keyset_queryset(queryset, ordering: Sequence[str], cursor: Optional[str]):
+    """
+    Order a queryset by a keyset and start it after a cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    names = [field.lstrip('-') for field in ordering]
+    model = queryset.model
+
+    if cursor:
+        queryset = queryset.filter(_after(ordering, decode_cursor(cursor, names, model), model))
+    return queryset.order_by(*keyset_ordering(ordering, model))
+
+
+def keyset_page(rows: List[Any], ordering: Sequence[str], limit: int) -> KeysetPage:
+    """Trim up to limit + 1 fetched rows to a page and the cursor for the next one"""
+    names = [field.lstrip('-') for field in ordering]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        key = [last[f] if isinstance(last, dict) else getattr(last, f) for f in names]
+        next_cursor = encode_cursor(key)
+
+    return KeysetPage(rows, next_cursor)
+
+
+def paginate_keyset(queryset, ordering: Sequence[str], cursor: Optional[str], limit: int,
+                    values: Optional[Sequence[str]] = None) -> KeysetPage:
+    """
+    Fetch one page ordered by a unique key, starting after a cursor
+
+    The ordering must end with a unique column (typically the primary
+    key). Each page is one indexed range scan of limit + 1 rows, however
+    deep into the listing the client is.
+
+    Args:
+        queryset: Filtered queryset
+        ordering: Sort key, e.g. ('expires_at', 'id'); prefix '-' for
+            descending. Nullable fields sort NULLs above all values.
+        cursor: Cursor from the previous page, or None for the first page
+        limit: Page size
+        values: If given, rows are returned as dicts with these fields
+
+    Returns:
+        KeysetPage
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    queryset = keyset_queryset(queryset, ordering, cursor)
+    if values is not None:
+        queryset = queryset.values(*dict.fromkeys(list(values) + [field.lstrip('-') for field in ordering]))
+
+    return keyset_page(list(queryset[:limit + 1]), ordering, limit)
+
+
+def cached_count(queryset, cache_key: str, timeout: Optional[int] = None) -> int:
+    """
+    Count rows, caching the result for API_COUNT_CACHE_TTL seconds
+
+    Callers include a version in cache_key that is bumped on writes (see
+    bump_count_versions) so counts do not lag behind the caller's own changes.
+    """
+    count = cache.get(cache_key)
+    if count is None:
+        count = queryset.count()
+        cache.set(cache_key, count, timeout or settings.API_COUNT_CACHE_TTL)
+    return count
+
+
+def count_version(scope: str) -> int:
+    """Current version for counts under a cache scope"""
+    return cache.get(f'count_version:{scope}', 0)
+
+
+def bump_count_versions(scopes) -> None:
+    """Invalidate cached counts for the given scopes"""
+    for scope in scopes:
+        key = f'count_version:{scope}'
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def filter_cache_key(prefix: str, params: Dict[str, Any]) -> str:
+    """Stable cache key for a set of filter parameters"""
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f"{prefix}:{digest}"
@@ -0,0 +1,22 @@
+"""
+API Renderers
+JSON renderers registered under the FHIR media types
+"""
+from rest_framework.renderers import JSONRenderer
+
+
+class FHIRJSONRenderer(JSONRenderer):
+    """application/fhir+json, as sent in FHIR clients' Accept headers"""
+    media_type = 'application/fhir+json'
+    format = 'fhir'
+
+
+class NDJSONRenderer(JSONRenderer):
+    """
+    application/fhir+ndjson, for NDJSON downloads
+
+    Views stream the files themselves; this renderer only lets content
+    negotiation accept the media type and renders error bodies as one line.
+    """
+    media_type = 'application/fhir+ndjson'
+    format = 'ndjson'
@@ -0,0 +1,56 @@
+"""
+API Signals
+Invalidates cached listing counts when consents and observations change,
+and flushes buffered access log events between requests
+"""
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from fhir.signals import consent_expired, consents_changed, records_created
+from .audit import flush_due_audit_events
+from .pagination import bump_count_versions
+
+
+def _consent_count_scopes(patient_id, practitioner_id):
+    # Provider counts that include care team and organization grants are
+    # left to expire with API_COUNT_CACHE_TTL
+    scopes = [f'consents:patient:{patient_id}']
+    if practitioner_id:
+        scopes.append(f'consents:provider:{practitioner_id}')
+    return scopes
+
+
+@receiver(post_save, sender='fhir.ConsentRecord')
+@receiver(post_delete, sender='fhir.ConsentRecord')
+def invalidate_consent_counts(sender, instance, **kwargs):
+    bump_count_versions(_consent_count_scopes(instance.patient_id, instance.practitioner_id))
+
+
+@receiver(consent_expired)
+@receiver(consents_changed)
+def invalidate_bulk_consent_counts(sender, consents, **kwargs):
+    scopes = set()
+    for _, patient_id, practitioner_id in consents:
+        scopes.update(_consent_count_scopes(patient_id, practitioner_id))
+    bump_count_versions(scopes)
+
+
+@receiver(post_save, sender='fhir.Observation')
+@receiver(post_delete, sender='fhir.Observation')
+def invalidate_observation_counts(sender, instance, **kwargs):
+    bump_count_versions([f'observations:patient:{instance.patient_id}'])
+
+
+@receiver(records_created)
+def invalidate_bulk_observation_counts(sender, records, **kwargs):
+    bump_count_versions({
+        f'observations:patient:{patient_id}'
+        for resource_type, _, patient_id in records
+        if resource_type == 'Observation'
+    })
+
+
+@receiver(request_finished)
+def flush_audit_events(sender, **kwargs):
+    flush_due_audit_events()
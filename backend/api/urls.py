@@ -2,21 +2,48 @@
 API URL Configuration
 """
 from django.urls import path, include
-from rest_framework.routers import DefaultRouter
-from .endpoints import records, consent, identity
+from rest_framework.routers import DefaultRouter, SimpleRouter
+from fhir.mapping import SERIALIZERS
+from .endpoints import records, consent, identity, bundles, exports, everything, resources, streams, timeline, timeseries
 
 # Create router
 router = DefaultRouter()
 router.register(r'observations', records.ObservationViewSet, basename='observation')
 router.register(r'consents', consent.ConsentViewSet, basename='consent')
 
+# FHIR REST interactions (Type, Type/<id>) for every resource type
+fhir_router = SimpleRouter(trailing_slash=False)
+for resource_type in SERIALIZERS:
+    fhir_router.register(resource_type, resources.viewset_for(resource_type), basename=f'fhir-{resource_type}')
+
 urlpatterns = [
     # Router URLs
     path('', include(router.urls)),
     
+    # FHIR Bundle (transaction/batch) endpoint
+    path('bundle/', bundles.process_bundle, name='process-bundle'),
+    
+    # FHIR operations
+    path('Patient/<uuid:patient_id>/$everything', everything.patient_everything, name='patient-everything'),
+    path('Patient/<uuid:patient_id>/$timeline', timeline.patient_timeline, name='patient-timeline'),
+    path('Observation/$timeseries', timeseries.observation_timeseries, name='observation-timeseries'),
+    path('Observation/$ingest', streams.observation_ingest, name='observation-ingest'),
+    path('Observation/$readings', streams.observation_readings, name='observation-readings'),
+    
+    # FHIR Bulk Data $export
+    path('$export', exports.export_system, name='export-system'),
+    path('Patient/$export', exports.export_patients, name='export-patients'),
+    path('Group/<uuid:group_id>/$export', exports.export_group, name='export-group'),
+    path('export/<uuid:job_id>/', exports.export_status, name='export-status'),
+    path('export/<uuid:job_id>/<str:file_name>', exports.export_file, name='export-file'),
+    
     # Identity endpoints
     path('identity/patient/create/', identity.create_patient_did, name='create-patient-did'),
     path('identity/provider/create/', identity.create_provider_did, name='create-provider-did'),
     path('identity/resolve/', identity.resolve_did, name='resolve-did'),
+    path('identity/resolve/batch/', identity.resolve_dids_batch, name='resolve-dids-batch'),
     path('identity/profile/', identity.get_profile, name='get-profile'),
+    
+    # FHIR resources (after the operations, which share their prefixes)
+    path('', include(fhir_router.urls)),
 ]
@@ -3,6 +3,7 @@ Cardano Blockchain Client
 Handles all interactions with Cardano network using PyCardano
 """
 import logging
+import uuid
 from typing import Optional, Dict, Any, List
 from pycardano import (
     Network,
@@ -164,8 +165,8 @@ class CardanoClient:
             
             logger.info(f"Logging access event to Cardano: {accessor_did} -> {resource_type}")
             
-            # Mock transaction ID
-            tx_id = f"mock_access_tx_{accessor_did[:8]}_{resource_id[:8]}"
+            # Mock transaction ID (unique per event, as a real tx hash is)
+            tx_id = f"mock_access_tx_{accessor_did[:8]}_{resource_id[:8]}_{uuid.uuid4().hex[:12]}"
             
             cache.set(f"tx_{tx_id}", metadata_dict, timeout=3600)
             
@@ -175,6 +176,138 @@ class CardanoClient:
             logger.error(f"Error submitting access log to Cardano: {e}")
             raise
     
+    def submit_record_batch(
+        self,
+        submitter_did: str,
+        merkle_root: str,
+        count: int,
+        record_types: Dict[str, int],
+    ) -> str:
+        """
+        Anchor a batch of medical record hashes in one transaction
+        
+        Args:
+            submitter_did: DID of the provider submitting the batch
+            merkle_root: Merkle root of the record hashes in the batch
+            count: Number of records in the batch
+            record_types: Records per resource type, e.g. {'Observation': 200}
+            
+        Returns:
+            Transaction ID
+        """
+        try:
+            metadata_dict = {
+                721: {
+                    "medblock_batch": {
+                        "submitterDID": submitter_did,
+                        "merkleRoot": merkle_root,
+                        "count": count,
+                        "recordTypes": record_types,
+                        "timestamp": self._get_current_timestamp(),
+                    }
+                }
+            }
+            
+            logger.info(f"Anchoring record batch of {count} from {submitter_did}")
+            
+            # Mock transaction ID
+            tx_id = f"mock_batch_tx_{merkle_root[:16]}"
+            
+            cache.set(f"tx_{tx_id}", metadata_dict, timeout=3600)
+            
+            return tx_id
+            
+        except Exception as e:
+            logger.error(f"Error anchoring record batch on Cardano: {e}")
+            raise
+    
+    def submit_access_batch(
+        self,
+        merkle_root: str,
+        count: int,
+        actions: Dict[str, int],
+    ) -> str:
+        """
+        Anchor a batch of access log events in one transaction
+        
+        Args:
+            merkle_root: Merkle root of the access event hashes
+            count: Number of events in the batch
+            actions: Events per action, e.g. {'read': 95, 'update': 5}
+            
+        Returns:
+            Transaction ID
+        """
+        try:
+            metadata_dict = {
+                721: {
+                    "medblock_access_batch": {
+                        "merkleRoot": merkle_root,
+                        "count": count,
+                        "actions": actions,
+                        "timestamp": self._get_current_timestamp(),
+                    }
+                }
+            }
+            
+            logger.info(f"Anchoring access log batch of {count}")
+            
+            # Mock transaction ID
+            tx_id = f"mock_access_batch_tx_{merkle_root[:16]}"
+            
+            cache.set(f"tx_{tx_id}", metadata_dict, timeout=3600)
+            
+            return tx_id
+            
+        except Exception as e:
+            logger.error(f"Error anchoring access log batch on Cardano: {e}")
+            raise
+    
+    def submit_consent_batch(
+        self,
+        patient_did: str,
+        action: str,
+        merkle_root: str,
+        count: int,
+    ) -> str:
+        """
+        Anchor a batch of consent grants or revocations in one transaction
+        
+        Args:
+            patient_did: DID of the patient granting or revoking
+            action: 'grant' or 'revoke'
+            merkle_root: Merkle root of the consent hashes in the batch
+            count: Number of consents in the batch
+            
+        Returns:
+            Transaction ID
+        """
+        try:
+            metadata_dict = {
+                721: {
+                    "medblock_consent": {
+                        "patientDID": patient_did,
+                        "action": action,
+                        "merkleRoot": merkle_root,
+                        "count": count,
+                        "timestamp": self._get_current_timestamp(),
+                    }
+                }
+            }
+            
+            logger.info(f"Anchoring consent {action} batch of {count} for {patient_did}")
+            
+            # Mock transaction ID
+            tx_id = f"mock_consent_tx_{merkle_root[:16]}"
+            
+            cache.set(f"tx_{tx_id}", metadata_dict, timeout=3600)
+            
+            return tx_id
+            
+        except Exception as e:
+            logger.error(f"Error anchoring consent batch on Cardano: {e}")
+            raise
+    
     def verify_transaction(self, tx_id: str) -> bool:
         """
         Verify that a transaction exists on the blockchain
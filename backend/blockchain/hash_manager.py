@@ -5,8 +5,10 @@ Generates and verifies cryptographic hashes for medical records
 import hashlib
 import json
 import logging
-from typing import Any, Dict
+from datetime import datetime, timezone as dt_timezone
+from typing import Any, Dict, List, Optional, Tuple
 from django.conf import settings
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +60,31 @@ class HashManager:
             logger.error(f"Error generating hash: {e}")
             raise
     
+    def merkle_root(self, hashes: List[str]) -> str:
+        """
+        Compute the Merkle root of a batch of record hashes
+        
+        Leaves are kept in the given order and an odd node is paired with
+        itself, so one anchored root commits to every hash in the batch.
+        
+        Args:
+            hashes: Hexadecimal leaf hashes
+            
+        Returns:
+            Hexadecimal root hash
+        """
+        if not hashes:
+            raise ValueError("Cannot compute Merkle root of an empty batch")
+        
+        digest = hashlib.sha512 if self.algorithm == 'SHA512' else hashlib.sha256
+        level = [bytes.fromhex(h) for h in hashes]
+        while len(level) > 1:
+            if len(level) % 2:
+                level.append(level[-1])
+            level = [digest(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+        
+        return level[0].hex()
+    
     def verify_hash(self, data: Dict[str, Any], expected_hash: str) -> bool:
         """
         Verify that data matches expected hash
@@ -85,12 +112,14 @@ class HashManager:
             logger.error(f"Error verifying hash: {e}")
             return False
     
-    def generate_record_hash(self, record_instance) -> str:
+    def generate_record_hash(self, record_instance, related: Optional[Dict[str, list]] = None) -> str:
         """
         Generate hash for a Django model instance
         
         Args:
             record_instance: Django model instance (Observation, DiagnosticReport, etc.)
+            related: Many-to-many ids for an instance that is not saved yet,
+                e.g. {'result': [observation ids]}
             
         Returns:
             Hash of the record
@@ -98,7 +127,7 @@ class HashManager:
         try:
             # Extract relevant fields for hashing
             # Exclude metadata fields like created_at, updated_at, blockchain_hash
-            data = self._extract_hashable_data(record_instance)
+            data = self._extract_hashable_data(record_instance, related)
             
             return self.generate_hash(data)
             
@@ -106,21 +135,50 @@ class HashManager:
             logger.error(f"Error generating record hash: {e}")
             raise
     
-    def _extract_hashable_data(self, record_instance) -> Dict[str, Any]:
+    def generate_record_hashes(self, records: List[Tuple[Any, Optional[Dict[str, list]]]]) -> List[str]:
+        """
+        Hash a batch of unsaved records without touching the database
+        
+        Args:
+            records: (instance, related many-to-many ids) pairs
+            
+        Returns:
+            Hashes in the same order
+        """
+        return [self.generate_record_hash(instance, related or {}) for instance, related in records]
+    
+    def _extract_hashable_data(self, record_instance, related: Optional[Dict[str, list]] = None) -> Dict[str, Any]:
         """
         Extract hashable data from model instance
         Excludes metadata and blockchain-specific fields
         
+        Many-to-many values are hashed as sorted id strings, taken from
+        related when given and from the database for saved instances. Datetimes are
+        normalised to UTC so an instance hashes the same before saving and
+        after being read back.
+        
         Args:
             record_instance: Django model instance
+            related: Many-to-many ids for an unsaved instance
             
         Returns:
             Dictionary of hashable fields
         """
         from django.forms.models import model_to_dict
         
+        opts = record_instance._meta
+        m2m_fields = [f.name for f in opts.many_to_many if f.editable]
+        
         # Convert model to dictionary
-        data = model_to_dict(record_instance)
+        data = model_to_dict(record_instance, exclude=m2m_fields)
+        for name in m2m_fields:
+            if related is not None:
+                ids = related.get(name, [])
+            elif record_instance._state.adding:
+                ids = []
+            else:
+                ids = getattr(record_instance, name).values_list('pk', flat=True)
+            data[name] = sorted(str(pk) for pk in ids)
         
         # Remove fields that shouldn't be hashed
         excluded_fields = {
@@ -138,7 +196,14 @@ class HashManager:
         
         # Convert UUIDs and dates to strings for JSON serialization
         for key, value in hashable_data.items():
-            if hasattr(value, 'isoformat'):
+            if isinstance(value, datetime):
+                if settings.USE_TZ and timezone.is_naive(value):
+                    # Saved naive datetimes are read back in the default time zone
+                    value = timezone.make_aware(value)
+                if timezone.is_aware(value):
+                    value = value.astimezone(dt_timezone.utc)
+                hashable_data[key] = value.isoformat()
+            elif hasattr(value, 'isoformat'):
                 hashable_data[key] = value.isoformat()
             elif hasattr(value, 'hex'):
                 hashable_data[key] = str(value)
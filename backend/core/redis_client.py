@@ -0,0 +1,33 @@
+"""
+Redis Client
+Shared low-level Redis connection for features that need more than the cache API
+(bitmaps, hashes, pub/sub)
+"""
+import logging
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Singleton instance
+_redis_client = None
+
+def get_redis_client() -> redis.Redis:
+    """
+    Get singleton Redis client
+
+    Uses the same server as the Django cache. The connection pool is created
+    lazily; connection errors surface as redis.RedisError on first command.
+    """
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            socket_timeout=1.0,
+            socket_connect_timeout=1.0,
+        )
+        logger.debug(f"Created Redis client for {settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}")
+    return _redis_client
@@ -0,0 +1,197 @@
+"""
+Record Anchoring
+Anchors record hashes on Cardano, either at write time or in deferred batches
+"""
+import logging
+from collections import Counter
+from typing import List, Optional, Tuple
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def anchored_models() -> List:
+    """FHIR models whose rows carry a required content hash and an anchor tx id"""
+    models = []
+    for model in apps.get_app_config('fhir').get_models():
+        fields = {field.name: field for field in model._meta.concrete_fields}
+        if 'blockchain_tx_id' in fields and 'blockchain_hash' in fields and not fields['blockchain_hash'].null:
+            models.append(model)
+    return models
+
+
+def anchor_records(instances: list, hashes: List[str], submitter_did: str,
+                   defer: Optional[bool] = None) -> Optional[str]:
+    """
+    Set the hashes on unsaved (or about to be updated) records and anchor them
+
+    Deferred records keep blockchain_tx_id NULL until flush_anchors
+    anchors them with other pending records in one transaction. Otherwise
+    the batch is anchored now and each record's blockchain_tx_id is
+    '<tx id>#<index in batch>'.
+
+    Args:
+        instances: Records, in batch order
+        hashes: Their content hashes
+        submitter_did: DID of the submitting provider
+        defer: Override FHIR_DEFER_ANCHORING
+
+    Returns:
+        Anchor transaction id, or None when deferred
+    """
+    from blockchain import get_cardano_client, get_hash_manager
+
+    defer = settings.FHIR_DEFER_ANCHORING if defer is None else defer
+    for instance, record_hash in zip(instances, hashes):
+        instance.blockchain_hash = record_hash
+        instance.blockchain_tx_id = None
+    if defer or not instances:
+        return None
+
+    tx_id = get_cardano_client().submit_record_batch(
+        submitter_did=submitter_did,
+        merkle_root=get_hash_manager().merkle_root(hashes),
+        count=len(instances),
+        record_types=dict(Counter(type(instance).__name__ for instance in instances)),
+    )
+    for position, instance in enumerate(instances):
+        instance.blockchain_tx_id = f"{tx_id}#{position}"
+    return tx_id
+
+
+def anchor_on_commit(instances: list, submitter_did: str, defer: Optional[bool] = None) -> None:
+    """
+    Anchor records just written pending, once their transaction commits
+
+    Call inside the transaction that inserted or updated the records,
+    with blockchain_hash set and blockchain_tx_id NULL. Nothing reaches
+    the chain if the write fails or rolls back (e.g. a unique conflict on
+    the hash, or a lost compare-and-set), so no root is anchored for rows
+    that do not exist. Rows are anchored as one batch with
+    '<tx id>#<index in batch>' set on the instances and rows, and on the
+    history version an update recorded with the same hash. If anchoring
+    fails the rows stay pending for flush_anchors; rows flush_anchors has
+    already taken, or amended again since, are skipped.
+
+    Args:
+        instances: Saved records, in batch order
+        submitter_did: DID of the submitting provider
+        defer: Override FHIR_DEFER_ANCHORING (deferred rows are left to flush_anchors)
+    """
+    from blockchain import get_cardano_client, get_hash_manager
+    from .models import ResourceVersion
+
+    defer = settings.FHIR_DEFER_ANCHORING if defer is None else defer
+    if defer or not instances:
+        return
+
+    def anchor():
+        try:
+            with transaction.atomic():
+                by_model = {}
+                for instance in instances:
+                    by_model.setdefault(type(instance), []).append(instance)
+                pending = set()
+                for model, rows in by_model.items():
+                    pending.update(
+                        model.objects.select_for_update(skip_locked=True)
+                        .filter(id__in=[row.id for row in rows], blockchain_tx_id__isnull=True)
+                        .values_list('id', 'blockchain_hash')
+                    )
+                batch = [instance for instance in instances if (instance.id, instance.blockchain_hash) in pending]
+                if not batch:
+                    return
+
+                hashes = [instance.blockchain_hash for instance in batch]
+                tx_id = get_cardano_client().submit_record_batch(
+                    submitter_did=submitter_did,
+                    merkle_root=get_hash_manager().merkle_root(hashes),
+                    count=len(batch),
+                    record_types=dict(Counter(type(instance).__name__ for instance in batch)),
+                )
+                for position, instance in enumerate(batch):
+                    instance.blockchain_tx_id = f"{tx_id}#{position}"
+                anchored = {(type(i).__name__, i.id, i.blockchain_hash): i.blockchain_tx_id for i in batch}
+                versions = []
+                for model in by_model:
+                    model.objects.bulk_update([i for i in batch if type(i) is model], ['blockchain_tx_id'])
+                    for version in ResourceVersion.objects.filter(
+                        resource_type=model.__name__, blockchain_tx_id__isnull=True,
+                        resource_id__in=[i.id for i in batch if type(i) is model],
+                    ).only('id', 'resource_type', 'resource_id', 'blockchain_hash'):
+                        key = (version.resource_type, version.resource_id, version.blockchain_hash)
+                        if key in anchored:
+                            version.blockchain_tx_id = anchored[key]
+                            versions.append(version)
+                ResourceVersion.objects.bulk_update(versions, ['blockchain_tx_id'])
+        except Exception:
+            logger.exception(f"Error anchoring {len(instances)} new records; left for flush_anchors")
+
+    transaction.on_commit(anchor)
+
+
+def _pending_sources() -> List[Tuple[object, str]]:
+    """(model, ordering field) of everything flush_anchors anchors"""
+    from .models import ResourceVersion
+
+    sources = [(model, 'updated_at') for model in anchored_models()]
+    # Versions superseded before their record was anchored
+    sources.append((ResourceVersion, 'recorded_at'))
+    return sources
+
+
+def flush_anchors(batch_size: Optional[int] = None) -> int:
+    """
+    Anchor one batch of pending records
+
+    Takes up to batch_size (default FHIR_ANCHOR_BATCH_SIZE) records and
+    history versions with no anchor tx, oldest first across all types,
+    and anchors their hashes as one Merkle root. A record and its latest
+    history version share a hash, which is anchored once. Rows are locked
+    with SKIP LOCKED, so concurrent flushers take disjoint batches and a
+    record amended while its batch is flushed waits for the flush rather
+    than racing it.
+
+    Returns:
+        Number of rows anchored (0 when nothing is pending)
+    """
+    from blockchain import get_cardano_client, get_hash_manager
+
+    batch_size = batch_size or settings.FHIR_ANCHOR_BATCH_SIZE
+
+    with transaction.atomic():
+        pending = []
+        for model, order_field in _pending_sources():
+            rows = (
+                model.objects.select_for_update(skip_locked=True)
+                .filter(blockchain_tx_id__isnull=True, blockchain_hash__isnull=False)
+                .order_by(order_field)
+                .only('id', order_field, 'blockchain_hash')[:batch_size]
+            )
+            pending.extend((getattr(row, order_field), row) for row in rows)
+        if not pending:
+            return 0
+
+        pending.sort(key=lambda item: item[0])
+        pending = [row for _, row in pending[:batch_size]]
+        positions = {}
+        for row in pending:
+            positions.setdefault(row.blockchain_hash, len(positions))
+        tx_id = get_cardano_client().submit_record_batch(
+            submitter_did=settings.ANCHOR_SUBMITTER_DID,
+            merkle_root=get_hash_manager().merkle_root(list(positions)),
+            count=len(positions),
+            record_types=dict(Counter(type(row).__name__ for row in pending)),
+        )
+
+        by_model = {}
+        for row in pending:
+            row.blockchain_tx_id = f"{tx_id}#{positions[row.blockchain_hash]}"
+            by_model.setdefault(type(row), []).append(row)
+        for model, rows in by_model.items():
+            model.objects.bulk_update(rows, ['blockchain_tx_id'])
+
+    logger.info(f"Anchored {len(positions)} pending hashes ({len(pending)} rows) in {tx_id}")
+    return len(pending)
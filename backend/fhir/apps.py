@@ -8,3 +8,6 @@ class FhirConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'fhir'
     verbose_name = 'FHIR Resources'
+    
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,368 @@
+"""
+FHIR Bundles
+Processes transaction and batch Bundles with bulk inserts and one anchoring event
+"""
+import logging
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from django.conf import settings
+from django.db import transaction
+
+from .anchoring import anchor_on_commit
+from .consent_scope import RESOURCE_DATE_FIELDS
+from .mapping import RESOURCE_MAPPERS, MappedResource, ReferenceResolver, group_references, map_resource
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_TYPES = ('transaction', 'batch')
+
+# Entry error for a match to a stored record the submitter may not see (answered 409)
+CONFLICT_MESSAGE = "Conflicts with an existing record"
+
+
+class BundleError(ValueError):
+    """A transaction Bundle was rejected; issues are (entry index, message) pairs"""
+
+    def __init__(self, issues: List[Tuple[int, str]]):
+        self.issues = issues
+        super().__init__(f"Bundle rejected: {len(issues)} invalid entries")
+
+
+class BundleResult(NamedTuple):
+    """Response Bundle and the anchor transaction id (None if nothing was stored)"""
+    bundle: dict
+    tx_id: Optional[str]
+
+
+def _entry_resource(entry) -> dict:
+    if not isinstance(entry, dict) or not isinstance(entry.get('resource'), dict):
+        raise ValueError("Entry has no resource")
+    request = entry.get('request') or {}
+    resource_type = entry['resource'].get('resourceType')
+    if request.get('method') != 'POST':
+        raise ValueError("Only POST entries are supported")
+    if request.get('url', '').rstrip('/') != resource_type:
+        raise ValueError(f"Entry request.url must be {resource_type}")
+    return entry['resource']
+
+
+def _outcome(message: str, code: str = 'invalid') -> dict:
+    return {
+        'resourceType': 'OperationOutcome',
+        'issue': [{'severity': 'error', 'code': code, 'diagnostics': message}],
+    }
+
+
+def missing_references(mapped: Dict[int, MappedResource]) -> Dict[int, str]:
+    """Entries pointing at stored resources that do not exist (one query per resource type)"""
+    from .models import Observation, Patient, Practitioner
+
+    models = {'Patient': Patient, 'Practitioner': Practitioner, 'Observation': Observation}
+    existing = set()
+    for resource_type, ids in group_references(mapped).items():
+        if resource_type in models:
+            found = models[resource_type].objects.filter(id__in=ids).values_list('id', flat=True)
+            existing.update((resource_type, resource_id) for resource_id in found)
+
+    errors = {}
+    for index, resource in mapped.items():
+        missing = sorted(f"{t}/{i}" for t, i in resource.references - existing)
+        if missing:
+            errors[index] = f"Referenced resources not found: {', '.join(missing)}"
+    return errors
+
+
+def _duplicate_hashes(mapped: Dict[int, MappedResource],
+                      hashes: Dict[int, str]) -> Tuple[Dict[int, str], Dict[int, object]]:
+    """
+    Entries identical to another entry or to a stored record (one query per resource type)
+
+    Returns:
+        ({index: error} for duplicates within the bundle,
+         {index: stored record (id, hash, tx id, patient and date loaded)} for stored ones)
+    """
+    counts = Counter(hashes[index] for index in mapped)
+    by_model = defaultdict(set)
+    for index, resource in mapped.items():
+        by_model[type(resource.instance)].add(hashes[index])
+
+    rows = {}
+    for model, model_hashes in by_model.items():
+        fields = ['id', 'blockchain_hash', 'blockchain_tx_id', 'patient_id']
+        if model.__name__ in RESOURCE_DATE_FIELDS:
+            fields.append(RESOURCE_DATE_FIELDS[model.__name__])
+        for row in model.objects.filter(blockchain_hash__in=model_hashes).only(*fields):
+            rows[(model, row.blockchain_hash)] = row
+
+    errors = {}
+    stored = {}
+    for index, resource in mapped.items():
+        row = rows.get((type(resource.instance), hashes[index]))
+        if row is not None:
+            stored[index] = row
+        elif counts[hashes[index]] > 1:
+            errors[index] = "Duplicate entry in bundle"
+    return errors, stored
+
+
+def disclosable(records: list, did: str) -> set:
+    """
+    Ids of stored records a caller may learn about: the patient's own, or covered by their consent
+
+    A content-hash match reveals that an exact clinical fact is on file,
+    so it is only answered with the record to these callers.
+    """
+    from .consent_decisions import get_consent_service
+    from .models import Patient
+
+    patient_ids = {record.patient_id for record in records}
+    own = set(Patient.objects.filter(id__in=patient_ids, did=did).values_list('id', flat=True))
+    decisions = {
+        patient_id: get_consent_service().check(patient_id, did)
+        for patient_id in patient_ids - own
+    }
+    return {
+        record.id for record in records
+        if record.patient_id in own or decisions[record.patient_id].allows(record)
+    }
+
+
+class _InsertConflict(Exception):
+    """A concurrent request stored one of the bundle's records first"""
+
+
+def process_bundle(bundle: dict, submitter_did: str, defer_anchoring: Optional[bool] = None) -> BundleResult:
+    """
+    Store the resources in a transaction or batch Bundle
+
+    Entries are POSTs of supported resource types (see RESOURCE_MAPPERS)
+    and may reference each other by fullUrl (e.g. 'urn:uuid:...'). All
+    entries are validated and hashed up front, rows are written with
+    bulk_create in a single database transaction, and once it commits
+    the hashes are anchored as one Merkle root. Each record's
+    blockchain_tx_id is '<tx id>#<index in batch>' (NULL until
+    flush_anchors when deferred, or if anchoring fails).
+
+    Entries are upserted on their content hash: one identical to a stored
+    record is answered '200 OK' with that record, and is neither stored
+    nor anchored again, so a resent bundle costs no writes or chain fees.
+    Entries referencing it by fullUrl point at the stored record instead.
+    The match is only disclosed to the patient or a provider whose
+    consent covers the record (see disclosable); for anyone else the
+    entry fails as a '409 Conflict' without naming the record.
+    Rows are inserted with ON CONFLICT DO NOTHING; if a concurrent request
+    stored one of them first, the attempt rolls back before anything is
+    anchored, and the bundle is processed once more and answers with
+    that request's record.
+
+    A transaction Bundle is all-or-nothing. In a batch Bundle invalid
+    entries, and entries that reference them, are reported and skipped.
+
+    Args:
+        bundle: FHIR Bundle resource
+        submitter_did: DID of the submitting provider
+        defer_anchoring: Override FHIR_DEFER_ANCHORING (leave the hashes
+            for flush_anchors instead of anchoring the bundle now)
+
+    Returns:
+        BundleResult with a transaction-response or batch-response Bundle
+
+    Raises:
+        BundleError: If a transaction Bundle has invalid entries
+        ValueError: If the Bundle itself is malformed
+    """
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+        raise ValueError("Expected a Bundle resource")
+    bundle_type = bundle.get('type')
+    if bundle_type not in BUNDLE_TYPES:
+        raise ValueError(f"Unsupported Bundle type: {bundle_type}")
+    entries = bundle.get('entry') or []
+    if not entries:
+        raise ValueError("Bundle has no entries")
+    if len(entries) > settings.FHIR_BUNDLE_MAX_ENTRIES:
+        raise ValueError(f"At most {settings.FHIR_BUNDLE_MAX_ENTRIES} entries per Bundle")
+
+    try:
+        return _store_bundle(bundle_type, entries, submitter_did, defer_anchoring)
+    except _InsertConflict:
+        logger.info("Bundle entries were stored concurrently; matching them to the stored records")
+        try:
+            return _store_bundle(bundle_type, entries, submitter_did, defer_anchoring)
+        except _InsertConflict:
+            raise ValueError("Bundle entries conflict with concurrent writes; retry the request")
+
+
+def _store_bundle(bundle_type: str, entries: list, submitter_did: str,
+                  defer_anchoring: Optional[bool]) -> BundleResult:
+    """Validate, hash, match and store the entries of a Bundle (see process_bundle)"""
+    from blockchain import get_hash_manager
+    from .signals import records_created
+
+    errors: Dict[int, str] = {}
+
+    # Assign ids first so entries can reference later entries by fullUrl
+    full_urls = {}
+    resources = {}
+    for index, entry in enumerate(entries):
+        try:
+            resource = _entry_resource(entry)
+            resource_id = uuid.uuid4()
+            full_url = entry.get('fullUrl')
+            if full_url:
+                if full_url in full_urls:
+                    raise ValueError(f"Duplicate fullUrl: {full_url}")
+                full_urls[full_url] = (resource.get('resourceType'), resource_id)
+            resources[index] = (resource, resource_id)
+        except ValueError as e:
+            errors[index] = str(e)
+
+    resolver = ReferenceResolver(full_urls)
+    mapped: Dict[int, MappedResource] = {}
+    for index, (resource, resource_id) in resources.items():
+        try:
+            mapped[index] = map_resource(resource, resource_id, resolver)
+        except ValueError as e:
+            errors[index] = str(e)
+
+    for index, message in missing_references(mapped).items():
+        errors[index] = message
+        del mapped[index]
+
+    hash_manager = get_hash_manager()
+    hashes: Dict[int, str] = {}
+    stored: Dict[int, object] = {}
+    duplicates: Dict[int, str] = {}
+    stale = list(mapped)
+    while stale:
+        hashes.update(zip(stale, hash_manager.generate_record_hashes(
+            [(mapped[index].instance, mapped[index].related) for index in stale]
+        )))
+        duplicates, matched = _duplicate_hashes(mapped, hashes)
+        visible = disclosable(list(matched.values()), submitter_did) if matched else set()
+        moved = set()
+        for index, row in matched.items():
+            del mapped[index]
+            if row.id not in visible:
+                errors[index] = CONFLICT_MESSAGE
+                continue
+            stored[index] = row
+            full_url = entries[index].get('fullUrl')
+            if full_url:
+                full_urls[full_url] = (type(row).__name__, row.id)
+                moved.add(full_url)
+
+        # Entries pointing at a matched entry now point at the stored record,
+        # which changes their hash (and may match them to stored records too)
+        stale = [index for index, resource in mapped.items() if resource.full_urls & moved]
+        for index in stale:
+            mapped[index] = map_resource(*resources[index], resolver)
+
+    for index, message in duplicates.items():
+        errors[index] = message
+    for index in errors:
+        mapped.pop(index, None)
+
+    # Entries referencing a failed entry fail with it
+    failed_urls = {entries[i].get('fullUrl') for i in errors if isinstance(entries[i], dict)} - {None}
+    while failed_urls:
+        dependents = [index for index, resource in mapped.items() if resource.full_urls & failed_urls]
+        failed_urls = set()
+        for index in dependents:
+            errors[index] = "References an entry that failed"
+            failed_urls.add(entries[index].get('fullUrl'))
+            del mapped[index]
+        failed_urls.discard(None)
+
+    if errors and bundle_type == 'transaction':
+        raise BundleError(sorted(errors.items()))
+
+    tx_id = None
+    if mapped:
+        ordered = list(mapped)
+
+        with transaction.atomic():
+            # Inserted pending, and anchored only once the insert has committed
+            for index in ordered:
+                mapped[index].instance.blockchain_hash = hashes[index]
+                mapped[index].instance.blockchain_tx_id = None
+
+            through_rows = defaultdict(list)
+            for resource_type in RESOURCE_MAPPERS:
+                instances = [mapped[i].instance for i in ordered
+                             if type(mapped[i].instance).__name__ == resource_type]
+                if not instances:
+                    continue
+                model = type(instances[0])
+                model.objects.bulk_create(instances, ignore_conflicts=True)
+                # ON CONFLICT DO NOTHING: a row missing afterwards lost a race on its hash
+                if model.objects.filter(id__in=[i.id for i in instances]).count() != len(instances):
+                    raise _InsertConflict()
+
+                for index in ordered:
+                    resource = mapped[index]
+                    if type(resource.instance) is not model:
+                        continue
+                    for name, ids in resource.related.items():
+                        field = model._meta.get_field(name)
+                        through = field.remote_field.through
+                        through_rows[through].extend(
+                            through(**{f'{field.m2m_field_name()}_id': resource.instance.id,
+                                       f'{field.m2m_reverse_field_name()}_id': related_id})
+                            for related_id in ids
+                        )
+
+            for through, rows in through_rows.items():
+                through.objects.bulk_create(rows)
+
+            records = [
+                (type(mapped[i].instance).__name__, mapped[i].instance.id, mapped[i].instance.patient_id)
+                for i in ordered
+            ]
+            transaction.on_commit(lambda: records_created.send(sender=None, records=records))
+            anchor_on_commit([mapped[index].instance for index in ordered], submitter_did, defer=defer_anchoring)
+
+        first_tx_id = mapped[ordered[0]].instance.blockchain_tx_id
+        tx_id = first_tx_id.partition('#')[0] if first_tx_id else None
+        logger.info(f"Stored {len(mapped)} of {len(entries)} bundle entries in {tx_id or 'a deferred anchor'}")
+    if stored:
+        logger.info(f"Matched {len(stored)} bundle entries to stored records")
+
+    response_entries = []
+    for index, entry in enumerate(entries):
+        if index in mapped:
+            instance = mapped[index].instance
+            response_entries.append({
+                'fullUrl': entry.get('fullUrl'),
+                'response': {
+                    'status': '201 Created',
+                    'location': f"{type(instance).__name__}/{instance.id}",
+                    'blockchain_hash': instance.blockchain_hash,
+                    'blockchain_tx_id': instance.blockchain_tx_id,
+                },
+            })
+        elif index in stored:
+            row = stored[index]
+            response_entries.append({
+                'fullUrl': entry.get('fullUrl'),
+                'response': {
+                    'status': '200 OK',
+                    'location': f"{type(row).__name__}/{row.id}",
+                    'blockchain_hash': row.blockchain_hash,
+                    'blockchain_tx_id': row.blockchain_tx_id,
+                },
+            })
+        elif errors[index] == CONFLICT_MESSAGE:
+            response_entries.append({
+                'response': {'status': '409 Conflict', 'outcome': _outcome(errors[index], 'duplicate')},
+            })
+        else:
+            response_entries.append({
+                'response': {'status': '400 Bad Request', 'outcome': _outcome(errors[index])},
+            })
+
+    return BundleResult({
+        'resourceType': 'Bundle',
+        'type': f'{bundle_type}-response',
+        'entry': response_entries,
+    }, tx_id)
@@ -0,0 +1,342 @@
+"""
+Consent Decisions
+Caches whether a practitioner DID holds active consent for a patient's records
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, NamedTuple, Optional
+from django.conf import settings
+from .consent_scope import CompiledScope, compile_scope
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'consent:invalidate'
+
+
+class ConsentDecision(NamedTuple):
+    """Outcome of a consent check, valid until valid_until (Unix time)"""
+    consent_id: Optional[uuid.UUID]
+    valid_until: float
+    scope: Optional[CompiledScope] = None
+
+    @property
+    def allowed(self) -> bool:
+        return self.consent_id is not None
+
+    def allows(self, instance) -> bool:
+        """Check consent and scope for a single record"""
+        return self.allowed and self.scope.allows_instance(instance)
+
+    def filter(self, queryset):
+        """Restrict a queryset to records covered by the consent"""
+        if not self.allowed:
+            return queryset.none()
+        return self.scope.filter(queryset)
+
+
+def decision_from_grants(grants, now: float, ttl: float, negative_ttl: float) -> ConsentDecision:
+    """
+    Build a decision from active consent rows
+
+    Args:
+        grants: (consent id, expires_at, scope) rows, latest expiry first
+        now: Current Unix time
+        ttl: Maximum lifetime of a positive decision
+        negative_ttl: Lifetime of a denial
+
+    Returns:
+        ConsentDecision
+    """
+    if not grants:
+        return ConsentDecision(None, now + negative_ttl)
+
+    # Several active consents grant the union of their scopes, which
+    # shrinks as soon as the first of them expires
+    scope = compile_scope(grants[0][2])
+    for _, _, other_scope in grants[1:]:
+        scope = scope.union(compile_scope(other_scope))
+
+    valid_until = min(grants[-1][1].timestamp(), now + ttl)
+    return ConsentDecision(grants[0][0], valid_until, scope)
+
+
+class ConsentDecisionService:
+    """
+    Answers (patient, practitioner DID) consent checks from cache
+
+    Each decision carries the compiled scope of the practitioner's active
+    consents, so record-level checks need no further queries.
+
+    Decisions are kept in a bounded in-process cache and, with the 'redis'
+    backend, in one Redis hash per patient shared by all workers. A positive
+    decision never outlives the consent's expires_at. ConsentRecord saves
+    and deletes invalidate the patient's decisions through signals; with
+    Redis the invalidation is published so every worker drops its local copy.
+
+    A per-patient generation counter guards against a reader that queried
+    the database before a revoke committed writing its stale decision back.
+    """
+
+    NEGATIVE_TTL = 5  # seconds
+
+    def __init__(self, backend: str = 'redis'):
+        if backend not in ('redis', 'memory'):
+            raise ValueError(f"Unknown consent decision backend: {backend}")
+
+        self.backend = backend
+        self.ttl = settings.CONSENT_DECISION_CACHE_TTL
+        self.local_ttl = settings.CONSENT_DECISION_LOCAL_TTL if backend == 'redis' else self.ttl
+        self.max_size = settings.CONSENT_DECISION_CACHE_SIZE
+
+        # patient id -> {practitioner DID -> ConsentDecision}, LRU by patient
+        self._local: "OrderedDict[str, Dict[str, ConsentDecision]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self._client = None
+        self._subscriber = None
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def check(self, patient_id, practitioner_did: str) -> ConsentDecision:
+        """
+        Decide whether a practitioner may read a patient's records
+
+        Args:
+            patient_id: Patient primary key
+            practitioner_did: DID of the accessing practitioner
+
+        Returns:
+            ConsentDecision; allowed when an active, unexpired consent exists
+        """
+        patient_key = str(patient_id)
+        now = time.time()
+
+        with self._lock:
+            decision = self._local.get(patient_key, {}).get(practitioner_did)
+            if decision is not None and decision.valid_until > now:
+                self._local.move_to_end(patient_key)
+                self.local_hits += 1
+                return decision
+            local_generation = self._generations.get(patient_key, 0)
+
+        shared_generation = None
+        if self.backend == 'redis':
+            self._ensure_subscriber()
+            decision, shared_generation = self._shared_get(patient_key, practitioner_did)
+            if decision is not None and decision.valid_until > now:
+                self.shared_hits += 1
+                self._remember(patient_key, practitioner_did, decision, local_generation, now)
+                return decision
+
+        self.misses += 1
+        decision = self._query(patient_id, practitioner_did, now)
+
+        if self.backend == 'redis':
+            self._shared_set(patient_key, practitioner_did, decision, shared_generation)
+        self._remember(patient_key, practitioner_did, decision, local_generation, now)
+
+        return decision
+
+    def invalidate_patient(self, patient_id, publish: bool = True):
+        """
+        Drop cached decisions for a patient in this and (optionally) all workers
+        """
+        self.invalidate_patients([patient_id], publish=publish)
+
+    def invalidate_patients(self, patient_ids: Iterable, publish: bool = True):
+        """Drop cached decisions for several patients, e.g. after a bulk update"""
+        patient_keys = {str(patient_id) for patient_id in patient_ids}
+        if not patient_keys:
+            return
+
+        for patient_key in patient_keys:
+            self._drop_local(patient_key)
+        self.invalidations += len(patient_keys)
+
+        if self.backend == 'redis' and publish:
+            import redis
+
+            try:
+                pipe = self._redis().pipeline(transaction=False)
+                for patient_key in patient_keys:
+                    pipe.incr(self._generation_key(patient_key))
+                    pipe.expire(self._generation_key(patient_key), self.ttl * 2)
+                    pipe.delete(self._decisions_key(patient_key))
+                    pipe.publish(INVALIDATION_CHANNEL, patient_key)
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.error(f"Failed to publish consent invalidation: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Report cache hit/miss counters"""
+        lookups = self.local_hits + self.shared_hits + self.misses
+        with self._lock:
+            local_entries = sum(len(decisions) for decisions in self._local.values())
+
+        return {
+            'backend': self.backend,
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': (self.local_hits + self.shared_hits) / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+            'local_patients': len(self._local),
+            'local_entries': local_entries,
+        }
+
+    def _query(self, patient_id, practitioner_did: str, now: float) -> ConsentDecision:
+        from .models import ConsentRecord
+
+        # Direct grants plus grants to the practitioner's care teams and organizations
+        rows = list(
+            ConsentRecord.objects.active()
+            .filter(patient_id=patient_id)
+            .granted_to(practitioner_did=practitioner_did)
+            .order_by('-expires_at')
+            .values_list('id', 'expires_at', 'scope')
+        )
+
+        return decision_from_grants(rows, now, self.ttl, self.NEGATIVE_TTL)
+
+    def _remember(self, patient_key: str, practitioner_did: str, decision: ConsentDecision,
+                  generation: int, now: float):
+        local = decision._replace(valid_until=min(decision.valid_until, now + self.local_ttl))
+        with self._lock:
+            # Invalidated while we were reading: the decision may be stale
+            if self._generations.get(patient_key, 0) != generation:
+                return
+            self._local.setdefault(patient_key, {})[practitioner_did] = local
+            self._local.move_to_end(patient_key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _drop_local(self, patient_key: str):
+        with self._lock:
+            self._local.pop(patient_key, None)
+            self._generations[patient_key] = self._generations.get(patient_key, 0) + 1
+
+    def _clear_local(self):
+        with self._lock:
+            for patient_key in self._local:
+                self._generations[patient_key] = self._generations.get(patient_key, 0) + 1
+            self._local.clear()
+
+    # Redis tier
+
+    def _redis(self):
+        if self._client is None:
+            from core.redis_client import get_redis_client
+            self._client = get_redis_client()
+        return self._client
+
+    @staticmethod
+    def _decisions_key(patient_key: str) -> str:
+        return f"consent:decisions:{patient_key}"
+
+    @staticmethod
+    def _generation_key(patient_key: str) -> str:
+        return f"consent:decisions:{patient_key}:gen"
+
+    def _shared_get(self, patient_key: str, practitioner_did: str):
+        import redis
+
+        try:
+            pipe = self._redis().pipeline(transaction=False)
+            pipe.hget(self._decisions_key(patient_key), practitioner_did)
+            pipe.get(self._generation_key(patient_key))
+            value, generation = pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Consent decision cache unavailable: {e}")
+            return None, False
+
+        if value is None:
+            return None, generation
+
+        parts = value.decode().split('|', 2)
+        if len(parts) != 3:
+            return None, generation
+
+        consent_id, valid_until, scope = parts
+        decision = ConsentDecision(
+            uuid.UUID(consent_id) if consent_id else None,
+            float(valid_until),
+            CompiledScope.from_json(scope) if scope else None,
+        )
+        return decision, generation
+
+    def _shared_set(self, patient_key: str, practitioner_did: str, decision: ConsentDecision,
+                    generation):
+        import redis
+
+        # False means the read failed; don't write without a generation to compare
+        if generation is False:
+            return
+
+        consent_id = str(decision.consent_id) if decision.consent_id else ''
+        scope = decision.scope.to_json() if decision.scope else ''
+        generation_key = self._generation_key(patient_key)
+
+        try:
+            with self._redis().pipeline() as pipe:
+                pipe.watch(generation_key)
+                if pipe.get(generation_key) != generation:
+                    return
+                pipe.multi()
+                pipe.hset(self._decisions_key(patient_key), practitioner_did,
+                          f"{consent_id}|{decision.valid_until}|{scope}")
+                pipe.expire(self._decisions_key(patient_key), self.ttl)
+                pipe.execute()
+        except redis.WatchError:
+            logger.debug(f"Consent decisions for patient {patient_key} changed during lookup")
+        except redis.RedisError as e:
+            logger.warning(f"Failed to cache consent decision: {e}")
+
+    def _ensure_subscriber(self):
+        if self._subscriber is not None:
+            return
+        with self._lock:
+            if self._subscriber is None:
+                self._subscriber = threading.Thread(
+                    target=self._listen, name='consent-invalidation', daemon=True
+                )
+                self._subscriber.start()
+
+    def _listen(self):
+        import redis
+
+        connected_before = False
+        while True:
+            try:
+                pubsub = self._redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Messages may have been missed while disconnected
+                if connected_before:
+                    self._clear_local()
+                connected_before = True
+
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message['type'] == 'message':
+                        self._drop_local(message['data'].decode())
+            except redis.RedisError as e:
+                logger.warning(f"Consent invalidation subscriber disconnected: {e}")
+                self._clear_local()
+                time.sleep(1)
+
+
+# Singleton instance
+_consent_service = None
+
+def get_consent_service() -> ConsentDecisionService:
+    """Get singleton consent decision service configured from settings"""
+    global _consent_service
+    if _consent_service is None:
+        _consent_service = ConsentDecisionService(backend=settings.CONSENT_DECISION_BACKEND)
+    return _consent_service
@@ -0,0 +1,64 @@
+"""
+Consent Expiry
+Moves lapsed consents from 'active' to 'expired' in bounded batches
+"""
+import logging
+from typing import Optional
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def sweep_expired_consents(batch_size: int = 1000, now=None, max_batches: Optional[int] = None) -> int:
+    """
+    Mark lapsed consents as expired
+
+    Each batch walks the expires_at index in order, locks at most batch_size
+    rows (skipping rows held by concurrent sweepers or revokes) and updates
+    them in one statement, so no transaction holds many locks. After each
+    batch commits, consent_expired is sent with the affected consents.
+
+    Args:
+        batch_size: Rows per transaction
+        now: Cut-off time (defaults to the current time)
+        max_batches: Stop after this many batches (None for no limit)
+
+    Returns:
+        Number of consents expired
+    """
+    from .models import ConsentRecord
+    from .signals import consent_expired
+
+    now = now or timezone.now()
+    total = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            rows = list(
+                ConsentRecord.objects.lapsed(now)
+                .order_by('expires_at')
+                .select_for_update(skip_locked=True)
+                .values_list('id', 'patient_id', 'practitioner_id')[:batch_size]
+            )
+            if not rows:
+                break
+
+            ConsentRecord.objects.filter(
+                id__in=[row[0] for row in rows], status='active'
+            ).update(status='expired', updated_at=timezone.now())
+
+        consent_expired.send(sender=ConsentRecord, consents=rows, expired_at=now)
+
+        total += len(rows)
+        batches += 1
+        logger.debug(f"Expired batch of {len(rows)} consents")
+
+        if len(rows) < batch_size:
+            break
+
+    if total:
+        logger.info(f"Expired {total} consents lapsed before {now.isoformat()}")
+
+    return total
@@ -0,0 +1,183 @@
+"""
+Consent Grants
+Creates and revokes consents in batches anchored by a single Cardano transaction
+"""
+import logging
+import uuid
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+from django.db import transaction
+from django.utils import timezone
+from .consent_scope import compile_scope
+
+logger = logging.getLogger(__name__)
+
+# Grantee type -> ConsentRecord foreign key
+GRANTEE_FIELDS = {
+    'practitioner': 'practitioner_id',
+    'care_team': 'care_team_id',
+    'organization': 'organization_id',
+}
+
+
+class ConsentGrant(NamedTuple):
+    """One consent to create"""
+    grantee_type: str  # 'practitioner', 'care_team' or 'organization'
+    grantee_id: uuid.UUID
+    scope: list
+    expires_at: datetime
+
+
+def _notify(consents: List[tuple]):
+    from .signals import consents_changed
+
+    # After commit, so caches never repopulate from uncommitted state
+    transaction.on_commit(lambda: consents_changed.send(sender=None, consents=consents))
+
+
+def _anchor_on_commit(patient_did: str, action: str, hashes: List[str], on_anchored):
+    """
+    Anchor a batch of consent changes once the transaction writing them commits
+
+    on_anchored is called with the anchor transaction id; anchoring errors
+    are logged, as the committed change stands either way.
+    """
+    from blockchain import get_cardano_client, get_hash_manager
+
+    def anchor():
+        try:
+            tx_id = get_cardano_client().submit_consent_batch(
+                patient_did=patient_did,
+                action=action,
+                merkle_root=get_hash_manager().merkle_root(hashes),
+                count=len(hashes),
+            )
+            on_anchored(tx_id)
+        except Exception:
+            logger.exception(f"Error anchoring {len(hashes)} consent {action} events")
+
+    transaction.on_commit(anchor)
+
+
+def grant_consents(patient_id, patient_did: str, grants: Iterable[ConsentGrant]):
+    """
+    Create consents for one patient in a single transaction
+
+    Every consent is hashed, the hashes are combined into a Merkle root and,
+    once the rows are committed, the root is anchored in one transaction.
+    Each row's consent_tx_id is then '<tx id>#<index in batch>'; until
+    then, or if anchoring fails, it is 'pending:<consent id>'. A rolled
+    back write never reaches the chain.
+
+    Args:
+        patient_id: Granting patient's id
+        patient_did: Granting patient's DID
+        grants: Consents to create
+
+    Returns:
+        (created ConsentRecords, anchor transaction id or None if not anchored yet)
+
+    Raises:
+        ValueError: If a grant is invalid
+    """
+    from blockchain import get_hash_manager
+    from .models import ConsentRecord
+
+    hash_manager = get_hash_manager()
+    consents = []
+    hashes = []
+
+    for grant in grants:
+        if grant.grantee_type not in GRANTEE_FIELDS:
+            raise ValueError(f"Unknown grantee type: {grant.grantee_type}")
+        compile_scope(grant.scope)  # Raises ValueError for unsupported entries
+
+        consent = ConsentRecord(
+            id=uuid.uuid4(),
+            patient_id=patient_id,
+            status='active',
+            scope=grant.scope,
+            expires_at=grant.expires_at,
+            # TODO: Deploy Plutus consent smart contract
+            smart_contract_address=f"addr_test1_consent_{patient_id}_{grant.grantee_id}",
+            **{GRANTEE_FIELDS[grant.grantee_type]: grant.grantee_id},
+        )
+        consents.append(consent)
+        hashes.append(hash_manager.generate_hash({
+            'id': str(consent.id),
+            'patient': str(patient_id),
+            'grantee_type': grant.grantee_type,
+            'grantee': str(grant.grantee_id),
+            'scope': grant.scope,
+            'expires_at': grant.expires_at.isoformat(),
+        }))
+
+    if not consents:
+        raise ValueError("No consents to grant")
+
+    anchored = []
+
+    def store_tx_id(tx_id):
+        for index, consent in enumerate(consents):
+            consent.consent_tx_id = f"{tx_id}#{index}"
+        ConsentRecord.objects.bulk_update(consents, ['consent_tx_id'])
+        anchored.append(tx_id)
+
+    with transaction.atomic():
+        for consent in consents:
+            consent.consent_tx_id = f"pending:{consent.id}"
+        ConsentRecord.objects.bulk_create(consents)
+        _notify([(c.id, c.patient_id, c.practitioner_id) for c in consents])
+        _anchor_on_commit(patient_did, 'grant', hashes, store_tx_id)
+
+    tx_id = anchored[0] if anchored else None
+    logger.info(f"Granted {len(consents)} consents for patient {patient_id} in {tx_id or 'a pending anchor'}")
+
+    return consents, tx_id
+
+
+def revoke_consents(patient_id, patient_did: str, consent_ids: Iterable) -> Tuple[List[uuid.UUID], Optional[str]]:
+    """
+    Revoke a patient's consents in a single transaction
+
+    Only the patient's own active or pending consents are revoked; other
+    ids are ignored. Once the revocation is committed it is anchored as
+    one Merkle root; a failed anchor is logged and does not undo it.
+
+    Returns:
+        (revoked consent ids, anchor transaction id or None if nothing was
+        revoked or it is not anchored yet)
+    """
+    from blockchain import get_hash_manager
+    from .models import ConsentRecord
+
+    hash_manager = get_hash_manager()
+    now = timezone.now()
+
+    with transaction.atomic():
+        rows = list(
+            ConsentRecord.objects.select_for_update()
+            .filter(patient_id=patient_id, id__in=list(consent_ids), status__in=('active', 'pending'))
+            .order_by('id')
+            .values_list('id', 'patient_id', 'practitioner_id')
+        )
+        if not rows:
+            return [], None
+
+        hashes = [
+            hash_manager.generate_hash({'id': str(row[0]), 'action': 'revoke', 'revoked_at': now.isoformat()})
+            for row in rows
+        ]
+
+        revoked_ids = [row[0] for row in rows]
+        ConsentRecord.objects.filter(id__in=revoked_ids).update(
+            status='revoked', revoked_at=now, updated_at=now
+        )
+        _notify(rows)
+        anchored = []
+        _anchor_on_commit(patient_did, 'revoke', hashes, anchored.append)
+
+    tx_id = anchored[0] if anchored else None
+    logger.info(f"Revoked {len(rows)} consents for patient {patient_id} in {tx_id or 'a pending anchor'}")
+
+    return revoked_ids, tx_id
@@ -0,0 +1,268 @@
+"""
+Consent Scope
+Compiles ConsentRecord.scope into a compact form for O(1) access checks and SQL filters
+"""
+import json
+import logging
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+logger = logging.getLogger(__name__)
+
+# Resource types a consent can cover, with the field used for date ranges.
+# Bit positions are part of the cached format: append new types only.
+RESOURCE_DATE_FIELDS = {
+    'Observation': 'effective_datetime',
+    'DiagnosticReport': 'effective_datetime',
+    'MedicationRequest': 'authored_on',
+    'Encounter': 'period_start',
+}
+RESOURCE_BITS = {resource_type: 1 << i for i, resource_type in enumerate(RESOURCE_DATE_FIELDS)}
+ALL_RESOURCES = (1 << len(RESOURCE_BITS)) - 1
+
+_TYPE_NAMES = {resource_type.lower(): resource_type for resource_type in RESOURCE_BITS}
+
+Period = Tuple[Optional[datetime], Optional[datetime]]
+
+
+class CompiledScope:
+    """
+    Compiled consent scope
+
+    A record is in scope if its resource type bit is set in type_mask, its
+    id is in the per-type id set, or its date falls in one of the per-type
+    half-open [start, end) periods.
+    """
+
+    __slots__ = ('type_mask', 'ids', 'periods')
+
+    def __init__(self, type_mask: int = 0, ids: Optional[Dict[str, FrozenSet[str]]] = None,
+                 periods: Optional[Dict[str, Tuple[Period, ...]]] = None):
+        self.type_mask = type_mask
+        self.ids = ids or {}
+        self.periods = periods or {}
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, CompiledScope)
+            and (self.type_mask, self.ids, self.periods) == (other.type_mask, other.ids, other.periods)
+        )
+
+    def __repr__(self):
+        return f"CompiledScope(type_mask={self.type_mask:#x}, ids={self.ids}, periods={self.periods})"
+
+    @property
+    def is_all(self) -> bool:
+        return self.type_mask == ALL_RESOURCES
+
+    def allows(self, resource_type: str, resource_id=None, resource_date: Optional[datetime] = None) -> bool:
+        """
+        Check whether a single record is in scope
+
+        Args:
+            resource_type: FHIR resource type name, e.g. 'Observation'
+            resource_id: Record primary key
+            resource_date: Value of the type's date field (see RESOURCE_DATE_FIELDS)
+
+        Returns:
+            True if the consent covers the record
+        """
+        if self.type_mask & RESOURCE_BITS.get(resource_type, 0):
+            return True
+
+        ids = self.ids.get(resource_type)
+        if ids and resource_id is not None and str(resource_id) in ids:
+            return True
+
+        if resource_date is not None:
+            for start, end in self.periods.get(resource_type, ()):
+                if (start is None or resource_date >= start) and (end is None or resource_date < end):
+                    return True
+
+        return False
+
+    def allows_instance(self, instance) -> bool:
+        """Check whether a model instance is in scope"""
+        resource_type = type(instance).__name__
+        date_field = RESOURCE_DATE_FIELDS.get(resource_type)
+        return self.allows(
+            resource_type,
+            instance.pk,
+            getattr(instance, date_field) if date_field else None,
+        )
+
+    def as_q(self, resource_type: str) -> Optional[Q]:
+        """
+        Build a filter selecting in-scope records of a type
+
+        Returns:
+            Q object (empty Q for the whole type), or None if nothing is in scope
+        """
+        if self.type_mask & RESOURCE_BITS.get(resource_type, 0):
+            return Q()
+
+        q = None
+        ids = self.ids.get(resource_type)
+        if ids:
+            q = Q(pk__in=sorted(ids))
+
+        date_field = RESOURCE_DATE_FIELDS.get(resource_type)
+        for start, end in self.periods.get(resource_type, ()):
+            period_q = Q()
+            if start is not None:
+                period_q &= Q(**{f'{date_field}__gte': start})
+            if end is not None:
+                period_q &= Q(**{f'{date_field}__lt': end})
+            q = period_q if q is None else q | period_q
+
+        return q
+
+    def filter(self, queryset):
+        """Restrict a queryset of a FHIR resource model to in-scope records"""
+        q = self.as_q(queryset.model.__name__)
+        if q is None:
+            return queryset.none()
+        return queryset.filter(q)
+
+    def union(self, other: 'CompiledScope') -> 'CompiledScope':
+        """Combine the scopes of several consents held by the same practitioner"""
+        ids = dict(self.ids)
+        for resource_type, other_ids in other.ids.items():
+            ids[resource_type] = ids.get(resource_type, frozenset()) | other_ids
+        periods = dict(self.periods)
+        for resource_type, other_periods in other.periods.items():
+            periods[resource_type] = periods.get(resource_type, ()) + other_periods
+        return CompiledScope(self.type_mask | other.type_mask, ids, periods)
+
+    def to_json(self) -> str:
+        """Serialise for the shared decision cache"""
+        return json.dumps({
+            'm': self.type_mask,
+            'i': {t: sorted(ids) for t, ids in self.ids.items()},
+            'd': {
+                t: [[s.isoformat() if s else None, e.isoformat() if e else None] for s, e in periods]
+                for t, periods in self.periods.items()
+            },
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, value: str) -> 'CompiledScope':
+        data = json.loads(value)
+        return cls(
+            data['m'],
+            {t: frozenset(ids) for t, ids in data['i'].items()},
+            {
+                t: tuple(
+                    (parse_datetime(s) if s else None, parse_datetime(e) if e else None)
+                    for s, e in periods
+                )
+                for t, periods in data['d'].items()
+            },
+        )
+
+
+def _resource_type(name: str) -> str:
+    resource_type = _TYPE_NAMES.get(str(name).lower())
+    if resource_type is None:
+        raise ValueError(f"Unknown resource type in consent scope: {name}")
+    return resource_type
+
+
+def _parse_bound(value, is_end: bool) -> Optional[datetime]:
+    if value in (None, ''):
+        return None
+
+    try:
+        day = parse_date(value)
+        parsed = None if day else parse_datetime(value)
+    except ValueError:
+        day = parsed = None
+
+    if day is not None:
+        # Date-only end bounds are inclusive of the whole day
+        if is_end:
+            day += timedelta(days=1)
+        parsed = datetime.combine(day, dt_time.min)
+    elif parsed is None:
+        raise ValueError(f"Invalid date in consent scope: {value}")
+
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def _compile(entries) -> CompiledScope:
+    type_mask = 0
+    ids: Dict[str, set] = {}
+    periods: Dict[str, list] = {}
+
+    for entry in entries:
+        if isinstance(entry, str):
+            if entry in ('all', '*'):
+                type_mask = ALL_RESOURCES
+            elif '/' in entry:
+                name, resource_id = entry.split('/', 1)
+                ids.setdefault(_resource_type(name), set()).add(resource_id)
+            else:
+                type_mask |= RESOURCE_BITS[_resource_type(entry)]
+
+        elif isinstance(entry, dict):
+            resource_type = _resource_type(entry.get('resource_type', ''))
+            has_ids = bool(entry.get('ids'))
+            has_period = bool(entry.get('start') or entry.get('end'))
+
+            if has_ids and has_period:
+                raise ValueError("A consent scope entry may restrict by ids or by date, not both")
+            if has_ids:
+                ids.setdefault(resource_type, set()).update(str(i) for i in entry['ids'])
+            elif has_period:
+                start = _parse_bound(entry.get('start'), is_end=False)
+                end = _parse_bound(entry.get('end'), is_end=True)
+                if start and end and start >= end:
+                    raise ValueError("Consent scope period must end after it starts")
+                periods.setdefault(resource_type, []).append((start, end))
+            else:
+                type_mask |= RESOURCE_BITS[resource_type]
+
+        else:
+            raise ValueError(f"Invalid consent scope entry: {entry!r}")
+
+    # Whole-type grants make narrower grants for that type redundant
+    return CompiledScope(
+        type_mask,
+        {t: frozenset(v) for t, v in ids.items() if not type_mask & RESOURCE_BITS[t]},
+        {t: tuple(v) for t, v in periods.items() if not type_mask & RESOURCE_BITS[t]},
+    )
+
+
+@lru_cache(maxsize=4096)
+def _compile_cached(canonical: str) -> CompiledScope:
+    return _compile(json.loads(canonical))
+
+
+def compile_scope(scope: Optional[Iterable]) -> CompiledScope:
+    """
+    Compile a ConsentRecord.scope value
+
+    Supported entries:
+        'all' or '*'                          every resource type
+        'Observation'                         one resource type
+        'Observation/<id>'                    one record
+        {'resource_type': 'Observation', 'ids': [...]}
+        {'resource_type': 'Observation', 'start': '2024-01-01', 'end': '2024-12-31'}
+
+    An empty scope grants everything, matching consents created before
+    scopes were enforced.
+
+    Raises:
+        ValueError: If an entry cannot be parsed
+    """
+    if not scope:
+        return CompiledScope(ALL_RESOURCES)
+    if isinstance(scope, (str, dict)):
+        scope = [scope]
+    return _compile_cached(json.dumps(list(scope), sort_keys=True, default=str))
@@ -0,0 +1,281 @@
+"""
+FHIR Bulk Data Export
+Runs asynchronous $export jobs into gzip-compressed NDJSON files
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+
+from .consent_scope import CompiledScope, compile_scope
+from .mapping import RESOURCE_SERIALIZERS
+
+logger = logging.getLogger(__name__)
+
+# Resource types an export can include, in output order
+EXPORT_TYPES = tuple(RESOURCE_SERIALIZERS)
+
+# Patient ids per IN (...) list when exporting a cohort
+PATIENT_CHUNK_SIZE = 1000
+
+
+class ExportCancelled(Exception):
+    """The job was cancelled while it was running"""
+
+
+def export_dir(job_id) -> str:
+    """Directory holding a job's output files"""
+    return os.path.join(settings.FHIR_EXPORT_DIR, str(job_id))
+
+
+def delete_export_files(job_id) -> None:
+    shutil.rmtree(export_dir(job_id), ignore_errors=True)
+
+
+def create_export_job(requester_did: str, level: str, request_url: str,
+                      resource_types: Optional[List[str]] = None, since=None,
+                      group_id=None, redact: Optional[List[str]] = None):
+    """
+    Queue an export for the process_exports worker
+
+    Args:
+        requester_did: DID of the caller; only they can poll and download
+        level: 'system', 'patient' or 'group'
+        request_url: Kick-off URL
+        resource_types: Types to export (default: all of EXPORT_TYPES)
+        since: Only resources updated at or after this time
+        group_id: CareTeam or Organization id for group exports
+        redact: Elements to strip, as 'element' or 'ResourceType.element'
+
+    Returns:
+        Queued ExportJob
+
+    Raises:
+        ValueError: If a resource type is not exportable
+    """
+    from .models import ExportJob
+
+    unknown = set(resource_types or ()) - set(EXPORT_TYPES)
+    if unknown:
+        raise ValueError(f"Unsupported _type: {', '.join(sorted(unknown))}")
+
+    return ExportJob.objects.create(
+        requester_did=requester_did,
+        request_url=request_url,
+        level=level,
+        group_id=group_id,
+        resource_types=list(resource_types or ()),
+        since=since,
+        redact=list(redact or ()) + list(settings.FHIR_EXPORT_REDACT_ELEMENTS),
+    )
+
+
+def _cohort(job) -> Optional[Dict[str, Tuple[CompiledScope, List]]]:
+    """
+    Patients in a patient or group export, grouped by consent scope
+
+    Returns None for system exports. Otherwise maps each distinct scope
+    (by its JSON form) to the scope and its patients, so patients with the same
+    scope are exported with the same query.
+    """
+    from .models import ConsentRecord, Patient
+
+    if job.level == 'system':
+        return None
+
+    if job.level == 'patient':
+        patient = Patient.objects.filter(did=job.requester_did).only('id').first()
+        if patient is not None:
+            # A patient exporting their own record
+            return {'all': (compile_scope(['all']), [patient.id])}
+
+    consents = ConsentRecord.objects.active(job.transaction_time)
+    if job.level == 'group':
+        consents = consents.filter(Q(care_team_id=job.group_id) | Q(organization_id=job.group_id))
+    else:
+        consents = consents.granted_to(practitioner_did=job.requester_did)
+
+    scopes = {}
+    for patient_id, scope in consents.values_list('patient_id', 'scope').iterator():
+        compiled = compile_scope(scope)
+        scopes[patient_id] = scopes[patient_id].union(compiled) if patient_id in scopes else compiled
+
+    cohort = {}
+    for patient_id, scope in scopes.items():
+        cohort.setdefault(scope.to_json(), (scope, []))[1].append(patient_id)
+    return cohort
+
+
+def _querysets(job, resource_type: str, cohort) -> Iterable:
+    """Querysets that together select a type's resources for the job"""
+    from .models import Observation
+
+    model = RESOURCE_SERIALIZERS[resource_type][0]
+    base = model.objects.filter(updated_at__lte=job.transaction_time)
+    if job.since:
+        base = base.filter(updated_at__gte=job.since)
+    if resource_type == 'DiagnosticReport':
+        base = base.prefetch_related(Prefetch('result', queryset=Observation.objects.only('id')))
+
+    if cohort is None:
+        yield base
+        return
+
+    patient_field = 'id' if resource_type == 'Patient' else 'patient_id'
+    for scope, patient_ids in cohort.values():
+        # The Patient resource comes with any consent; other types follow its scope
+        q = Q() if resource_type == 'Patient' else scope.as_q(resource_type)
+        if q is None:
+            continue
+        for start in range(0, len(patient_ids), PATIENT_CHUNK_SIZE):
+            yield base.filter(q, **{f'{patient_field}__in': patient_ids[start:start + PATIENT_CHUNK_SIZE]})
+
+
+def _elements_for(resource_type: str, elements: Iterable[str]) -> set:
+    """Elements from 'element' / 'ResourceType.element' specs that apply to a type"""
+    applicable = set()
+    for element in elements:
+        prefix, _, name = element.rpartition('.')
+        if not prefix or prefix == resource_type:
+            applicable.add(name)
+    return applicable
+
+
+def _transform(resource: dict, decrypt: set, redact: set) -> dict:
+    """Decrypt encrypted elements, then strip redacted ones"""
+    if decrypt:
+        from core.encryption import get_encryption_service
+
+        encryption_service = get_encryption_service()
+        for element in decrypt & resource.keys():
+            value = resource[element]
+            if isinstance(value, str):
+                resource[element] = encryption_service.decrypt(value)
+            elif isinstance(value, dict):
+                resource[element] = encryption_service.decrypt_dict(value)
+    for element in redact:
+        resource.pop(element, None)
+    return resource
+
+
+def _check_cancelled(job) -> None:
+    from .models import ExportJob
+
+    if ExportJob.objects.filter(id=job.id, status='cancelled').exists():
+        raise ExportCancelled()
+
+
+def run_export_job(job) -> None:
+    """
+    Write a claimed job's NDJSON files
+
+    Rows are read from server-side cursors in API_STREAM_CHUNK_SIZE
+    batches and written straight into one gzip file per resource type, so
+    worker memory does not grow with the size of the export. Resources
+    updated after the job's transaction_time are left for the next
+    incremental (_since) export.
+    """
+    from .models import ExportJob
+
+    job.transaction_time = timezone.now()
+    ExportJob.objects.filter(id=job.id).update(transaction_time=job.transaction_time)
+
+    directory = export_dir(job.id)
+    os.makedirs(directory, exist_ok=True)
+    output = []
+
+    try:
+        cohort = _cohort(job)
+
+        for resource_type in job.resource_types or EXPORT_TYPES:
+            _check_cancelled(job)
+            serialize = RESOURCE_SERIALIZERS[resource_type][1]
+            decrypt = _elements_for(resource_type, settings.FHIR_ENCRYPTED_ELEMENTS)
+            redact = _elements_for(resource_type, job.redact)
+
+            file_name = f"{resource_type}.ndjson.gz"
+            path = os.path.join(directory, file_name)
+            count = 0
+            with gzip.open(path, 'wt', encoding='utf-8') as out:
+                for queryset in _querysets(job, resource_type, cohort):
+                    for instance in queryset.iterator(chunk_size=settings.API_STREAM_CHUNK_SIZE):
+                        resource = _transform(serialize(instance), decrypt, redact)
+                        out.write(json.dumps(resource, cls=DjangoJSONEncoder, separators=(',', ':')) + '\n')
+                        count += 1
+                    _check_cancelled(job)
+
+            if count:
+                output.append({'type': resource_type, 'file': file_name, 'count': count})
+            else:
+                os.remove(path)
+            ExportJob.objects.filter(id=job.id).update(progress=f"Exported {resource_type} ({count})")
+
+    except ExportCancelled:
+        delete_export_files(job.id)
+        logger.info(f"Export {job.id} cancelled")
+        return
+    except Exception as e:
+        logger.error(f"Export {job.id} failed: {e}")
+        delete_export_files(job.id)
+        ExportJob.objects.filter(id=job.id, status='in-progress').update(
+            status='failed', error=str(e), completed_at=timezone.now()
+        )
+        return
+
+    # Conditional, so a cancellation that lands now is not overwritten
+    completed = ExportJob.objects.filter(id=job.id, status='in-progress').update(
+        status='completed', output=output, progress='', completed_at=timezone.now()
+    )
+    if not completed:
+        delete_export_files(job.id)
+        return
+
+    logger.info(f"Export {job.id} completed: {sum(o['count'] for o in output)} resources in {len(output)} files")
+
+
+def claim_export_job():
+    """
+    Claim the oldest queued job
+
+    Returns:
+        The claimed ExportJob, or None if the queue is empty
+    """
+    from .models import ExportJob
+
+    with transaction.atomic():
+        job = (
+            ExportJob.objects.select_for_update(skip_locked=True)
+            .filter(status='queued')
+            .order_by('created_at')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = 'in-progress'
+        job.started_at = timezone.now()
+        job.save(update_fields=['status', 'started_at'])
+    return job
+
+
+def process_export_jobs(max_jobs: Optional[int] = None) -> int:
+    """
+    Run queued jobs until the queue is empty or max_jobs have run
+
+    Returns:
+        Number of jobs run
+    """
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        job = claim_export_job()
+        if job is None:
+            break
+        run_export_job(job)
+        count += 1
+    return count
@@ -0,0 +1,218 @@
+"""
+FHIR Version History
+Records updates as JSON Patch deltas and rebuilds past versions for _history and vread
+"""
+import copy
+import logging
+from typing import List, Optional, Tuple
+from django.conf import settings
+from django.db.models import Max, Subquery
+
+from .mapping import UPDATE_MAPPERS, ReferenceResolver, to_fhir, version_id
+from .models import ResourceVersion
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(key: str) -> str:
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token: str) -> str:
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def json_diff(old, new, path: str = '') -> List[dict]:
+    """
+    JSON Patch (RFC 6902) turning old into new
+
+    Objects are compared key by key, so a changed value costs one
+    operation however large the resource is. Arrays and scalars that
+    differ are replaced whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{'op': 'remove', 'path': f'{path}/{_escape(key)}'} for key in old if key not in new]
+        for key, value in new.items():
+            child = f'{path}/{_escape(key)}'
+            if key not in old:
+                ops.append({'op': 'add', 'path': child, 'value': value})
+            elif old[key] != value:
+                ops.extend(json_diff(old[key], value, child))
+        return ops
+    if old != new:
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    return []
+
+
+def apply_patch(document, patch: List[dict]):
+    """
+    Apply a patch from json_diff to a copy of document
+
+    Supports the add, remove and replace operations on object members
+    that json_diff emits.
+    """
+    document = copy.deepcopy(document)
+    for op in patch:
+        keys = [_unescape(token) for token in op['path'].split('/')[1:]]
+        if not keys:
+            document = copy.deepcopy(op.get('value'))
+            continue
+        parent = document
+        for key in keys[:-1]:
+            parent = parent[key]
+        if op['op'] == 'remove':
+            del parent[keys[-1]]
+        else:
+            parent[keys[-1]] = copy.deepcopy(op['value'])
+    return document
+
+
+def _content(instance) -> dict:
+    """Versioned content of a record: its FHIR resource without meta"""
+    resource = to_fhir(instance)
+    resource.pop('meta', None)
+    return resource
+
+
+def _version(instance, number: int, content: dict, previous: Optional[dict], **fields) -> ResourceVersion:
+    interval = settings.FHIR_HISTORY_SNAPSHOT_INTERVAL
+    snapshot = previous is None or (number - 1) % interval == 0
+    return ResourceVersion(
+        resource_type=type(instance).__name__,
+        resource_id=instance.id,
+        version=number,
+        version_id=version_id(instance),
+        snapshot=content if snapshot else None,
+        delta=None if snapshot else json_diff(previous, content),
+        blockchain_hash=getattr(instance, 'blockchain_hash', None),
+        blockchain_tx_id=getattr(instance, 'blockchain_tx_id', None),
+        **fields,
+    )
+
+
+def current_version(instance) -> Tuple[ResourceVersion, dict]:
+    """The only version of a record that was never updated (not saved)"""
+    content = _content(instance)
+    return _version(instance, 1, content, None, recorded_at=instance.updated_at), content
+
+
+def record_update(before, after, recorded_by: str) -> ResourceVersion:
+    """
+    Add the version written by an update to the resource's history
+
+    Call in the transaction that updated the row, after the write, so the
+    row lock orders concurrent updates. The first update of a resource
+    also stores the version it replaced, as version 1.
+
+    Args:
+        before: The record as read before the update
+        after: The record as stored by the update
+        recorded_by: DID of the caller
+
+    Returns:
+        The new ResourceVersion
+    """
+    resource_type = type(before).__name__
+    latest = (
+        ResourceVersion.objects.filter(resource_type=resource_type, resource_id=before.id)
+        .aggregate(version=Max('version'))['version']
+    )
+    old = _content(before)
+    versions = []
+    if latest is None:
+        versions.append(_version(before, 1, old, None, recorded_at=before.updated_at))
+        latest = 1
+
+    version = _version(after, latest + 1, _content(after), old, recorded_by=recorded_by, recorded_at=after.updated_at)
+    versions.append(version)
+    ResourceVersion.objects.bulk_create(versions)
+
+    logger.info(f"Recorded {resource_type}/{before.id} version {version.version}")
+    return version
+
+
+def _rebuild(chain: List[ResourceVersion]) -> List[Tuple[ResourceVersion, dict]]:
+    """Content of each version in a chain that starts at a snapshot"""
+    versions = []
+    content = None
+    for row in chain:
+        content = row.snapshot if row.snapshot is not None else apply_patch(content, row.delta)
+        versions.append((row, content))
+    return versions
+
+
+def _chain(resource_type: str, resource_id, lowest: int, highest: int) -> List[ResourceVersion]:
+    """Versions lowest..highest, preceded by what is needed to rebuild them, in one query"""
+    rows = ResourceVersion.objects.filter(resource_type=resource_type, resource_id=resource_id)
+    base = rows.filter(version__lte=lowest, snapshot__isnull=False).order_by('-version').values('version')[:1]
+    return list(rows.filter(version__gte=Subquery(base), version__lte=highest).order_by('version'))
+
+
+def load_history(resource_type: str, resource_id, count: int,
+                 before: Optional[int] = None) -> List[Tuple[ResourceVersion, dict]]:
+    """
+    Newest versions of a resource, newest first
+
+    At most one snapshot interval of extra rows is read to rebuild the
+    oldest version returned.
+
+    Args:
+        resource_type: FHIR resource type
+        resource_id: Resource id
+        count: Versions to return
+        before: Only versions older than this version number (paging)
+
+    Returns:
+        (ResourceVersion, content) pairs; empty if never updated
+    """
+    if before is None:
+        latest = (
+            ResourceVersion.objects.filter(resource_type=resource_type, resource_id=resource_id)
+            .aggregate(version=Max('version'))['version']
+        )
+        if latest is None:
+            return []
+        before = latest + 1
+    highest = before - 1
+    lowest = max(1, highest - count + 1)
+    if highest < 1:
+        return []
+
+    versions = _rebuild(_chain(resource_type, resource_id, lowest, highest))
+    return [(row, content) for row, content in reversed(versions) if row.version >= lowest]
+
+
+def load_version(resource_type: str, resource_id, vid: str) -> Optional[Tuple[ResourceVersion, dict]]:
+    """
+    One past version by its version id (meta.versionId), or None
+
+    If content was later restored to an earlier version, the latest
+    version with that id is returned.
+    """
+    target = (
+        ResourceVersion.objects.filter(resource_type=resource_type, resource_id=resource_id, version_id=vid)
+        .order_by('-version').values_list('version', flat=True).first()
+    )
+    if target is None:
+        return None
+    return _rebuild(_chain(resource_type, resource_id, target, target))[-1]
+
+
+def verify_version(resource_type: str, resource_id, row: ResourceVersion, content: dict) -> Optional[bool]:
+    """
+    Re-hash a version from its stored content
+
+    The content is mapped back onto a record the way an update maps a
+    resource, so the hash comes out of the same fields that were hashed
+    when the version was anchored.
+
+    Returns:
+        Whether the content still hashes to the version's blockchain_hash,
+        or None if the version was never hashed
+    """
+    from blockchain import get_hash_manager
+
+    if not row.blockchain_hash:
+        return None
+    mapped = UPDATE_MAPPERS[resource_type](content, resource_id, ReferenceResolver({}))
+    return get_hash_manager().generate_record_hash(mapped.instance, related=mapped.related) == row.blockchain_hash
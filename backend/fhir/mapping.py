@@ -0,0 +1,522 @@
+"""
+FHIR Resource Mapping
+Converts between FHIR JSON resources and model instances
+"""
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, NamedTuple, Optional, Set, Tuple
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import DiagnosticReport, Encounter, MedicationRequest, Observation, Patient, Practitioner
+
+
+class MappedResource(NamedTuple):
+    """A FHIR resource mapped onto a model instance"""
+    instance: object
+    related: Dict[str, list]  # Many-to-many ids, e.g. {'result': [observation ids]}
+    references: Set[Tuple[str, uuid.UUID]]  # (resource type, id) of stored resources it points to
+    full_urls: Set[str]  # Bundle entries it points to
+
+
+def parse_instant(value) -> Optional[datetime]:
+    """
+    Parse a FHIR dateTime/instant into an aware datetime
+
+    Naive values are taken to be in the default time zone.
+
+    Raises:
+        ValueError: If the value is not an ISO 8601 date-time
+    """
+    if value in (None, ''):
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = parse_datetime(str(value))
+        if parsed is None:
+            raise ValueError(f"Invalid dateTime: {value}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class ReferenceResolver:
+    """
+    Resolves FHIR references to ids
+
+    Accepts 'Type/<uuid>' for stored resources and bundle fullUrls
+    (typically 'urn:uuid:...') for resources created in the same bundle.
+    """
+
+    def __init__(self, full_urls: Dict[str, Tuple[str, uuid.UUID]]):
+        self.full_urls = full_urls
+
+    def resolve(self, reference, expected_type: str, mapped: MappedResource) -> uuid.UUID:
+        """
+        Resolve one reference, recording it on the mapped resource
+
+        Raises:
+            ValueError: If the reference is malformed or of the wrong type
+        """
+        value = reference.get('reference') if isinstance(reference, dict) else None
+        if not value:
+            raise ValueError(f"Expected a reference to {expected_type}")
+
+        if value in self.full_urls:
+            resource_type, resource_id = self.full_urls[value]
+            mapped.full_urls.add(value)
+        elif value.startswith('urn:'):
+            raise ValueError(f"Reference {value} does not match any entry fullUrl")
+        else:
+            resource_type, _, raw_id = value.rpartition('/')
+            try:
+                resource_id = uuid.UUID(raw_id)
+            except ValueError:
+                raise ValueError(f"Invalid reference: {value}")
+            mapped.references.add((resource_type, resource_id))
+
+        if resource_type != expected_type:
+            raise ValueError(f"Reference {value} is not a {expected_type}")
+        return resource_id
+
+
+def _choice(resource: dict, key: str, model) -> str:
+    value = resource.get(key)
+    choices = {choice for choice, _ in model._meta.get_field(key).choices}
+    if value not in choices:
+        raise ValueError(f"Invalid {key}: {value}")
+    return value
+
+
+def _performer(resource: dict, resolver: ReferenceResolver, mapped: MappedResource) -> Optional[uuid.UUID]:
+    """First performer that is a Practitioner (organizations and teams are not stored)"""
+    for performer in resource.get('performer') or []:
+        value = performer.get('reference', '') if isinstance(performer, dict) else ''
+        if value in resolver.full_urls:
+            target_type = resolver.full_urls[value][0]
+        else:
+            target_type = value.rpartition('/')[0]
+        if target_type == 'Practitioner':
+            return resolver.resolve(performer, 'Practitioner', mapped)
+    return None
+
+
+def _new(model, resource_id: uuid.UUID) -> MappedResource:
+    return MappedResource(model(id=resource_id), {}, set(), set())
+
+
+def observation_from_fhir(resource: dict, resource_id: uuid.UUID, resolver: ReferenceResolver) -> MappedResource:
+    """Map a FHIR Observation"""
+    mapped = _new(Observation, resource_id)
+    obs = mapped.instance
+
+    if not resource.get('code'):
+        raise ValueError("Observation.code is required")
+
+    obs.patient_id = resolver.resolve(resource.get('subject'), 'Patient', mapped)
+    obs.practitioner_id = _performer(resource, resolver, mapped)
+    obs.status = _choice(resource, 'status', Observation)
+    obs.category = resource.get('category', [])
+    obs.code = resource['code']
+    obs.effective_datetime = parse_instant(resource.get('effectiveDateTime'))
+    obs.effective_period = resource.get('effectivePeriod')
+    obs.value_quantity = resource.get('valueQuantity')
+    obs.value_codeable_concept = resource.get('valueCodeableConcept')
+    obs.value_string = resource.get('valueString')
+    obs.value_boolean = resource.get('valueBoolean')
+    obs.value_integer = resource.get('valueInteger')
+    obs.value_range = resource.get('valueRange')
+    obs.interpretation = resource.get('interpretation', [])
+    obs.note = resource.get('note', [])
+    obs.reference_range = resource.get('referenceRange', [])
+    obs.derive_values()
+
+    return mapped
+
+
+def diagnostic_report_from_fhir(resource: dict, resource_id: uuid.UUID, resolver: ReferenceResolver) -> MappedResource:
+    """Map a FHIR DiagnosticReport; results may point at Observations in the same bundle"""
+    mapped = _new(DiagnosticReport, resource_id)
+    report = mapped.instance
+
+    if not resource.get('code'):
+        raise ValueError("DiagnosticReport.code is required")
+
+    report.patient_id = resolver.resolve(resource.get('subject'), 'Patient', mapped)
+    report.practitioner_id = _performer(resource, resolver, mapped)
+    report.status = _choice(resource, 'status', DiagnosticReport)
+    report.category = resource.get('category', [])
+    report.code = resource['code']
+    report.effective_datetime = parse_instant(resource.get('effectiveDateTime'))
+    report.effective_period = resource.get('effectivePeriod')
+    report.conclusion = resource.get('conclusion')
+    report.conclusion_code = resource.get('conclusionCode', [])
+    mapped.related['result'] = [
+        resolver.resolve(result, 'Observation', mapped) for result in resource.get('result') or []
+    ]
+
+    return mapped
+
+
+def medication_request_from_fhir(resource: dict, resource_id: uuid.UUID, resolver: ReferenceResolver) -> MappedResource:
+    """Map a FHIR MedicationRequest (authoredOn is set by the server)"""
+    mapped = _new(MedicationRequest, resource_id)
+    request = mapped.instance
+
+    if not resource.get('medicationCodeableConcept'):
+        raise ValueError("MedicationRequest.medicationCodeableConcept is required")
+
+    request.patient_id = resolver.resolve(resource.get('subject'), 'Patient', mapped)
+    request.practitioner_id = (
+        resolver.resolve(resource['requester'], 'Practitioner', mapped) if resource.get('requester') else None
+    )
+    request.status = _choice(resource, 'status', MedicationRequest)
+    request.intent = _choice(resource, 'intent', MedicationRequest)
+    request.medication_codeable_concept = resource['medicationCodeableConcept']
+    request.dosage_instruction = resource.get('dosageInstruction', [])
+    request.dispense_request = resource.get('dispenseRequest')
+    request.note = resource.get('note', [])
+
+    return mapped
+
+
+def encounter_from_fhir(resource: dict, resource_id: uuid.UUID, resolver: ReferenceResolver) -> MappedResource:
+    """Map a FHIR Encounter; the first participant is the practitioner"""
+    mapped = _new(Encounter, resource_id)
+    encounter = mapped.instance
+
+    if not resource.get('class'):
+        raise ValueError("Encounter.class is required")
+    period = resource.get('period') or {}
+    if not period.get('start'):
+        raise ValueError("Encounter.period.start is required")
+
+    encounter.patient_id = resolver.resolve(resource.get('subject'), 'Patient', mapped)
+    participants = [p for p in resource.get('participant') or [] if isinstance(p, dict) and p.get('individual')]
+    encounter.practitioner_id = (
+        resolver.resolve(participants[0]['individual'], 'Practitioner', mapped) if participants else None
+    )
+    encounter.status = _choice(resource, 'status', Encounter)
+    encounter.encounter_class = resource['class']
+    encounter.encounter_type = resource.get('type', [])
+    encounter.period_start = parse_instant(period['start'])
+    encounter.period_end = parse_instant(period.get('end'))
+    if encounter.period_end and encounter.period_end < encounter.period_start:
+        raise ValueError("Encounter.period.end is before its start")
+    encounter.reason_code = resource.get('reasonCode', [])
+    encounter.derive_values()
+
+    return mapped
+
+
+def patient_from_fhir(resource: dict, resource_id: uuid.UUID, resolver: ReferenceResolver) -> MappedResource:
+    """Map a FHIR Patient's demographics (the DID is not part of the resource)"""
+    mapped = _new(Patient, resource_id)
+    patient = mapped.instance
+
+    patient.identifier = resource.get('identifier', [])
+    patient.active = resource.get('active', True)
+    patient.name = resource.get('name', [])
+    patient.telecom = resource.get('telecom', [])
+    patient.gender = _choice(resource, 'gender', Patient)
+    patient.birth_date = resource.get('birthDate')
+    patient.deceased_datetime = parse_instant(resource.get('deceasedDateTime'))
+    patient.deceased = bool(resource.get('deceasedBoolean')) or patient.deceased_datetime is not None
+    patient.address = resource.get('address', [])
+    patient.marital_status = resource.get('maritalStatus')
+
+    return mapped
+
+
+def practitioner_from_fhir(resource: dict, resource_id: uuid.UUID, resolver: ReferenceResolver) -> MappedResource:
+    """Map a FHIR Practitioner (the DID is not part of the resource)"""
+    mapped = _new(Practitioner, resource_id)
+    practitioner = mapped.instance
+
+    practitioner.identifier = resource.get('identifier', [])
+    practitioner.active = resource.get('active', True)
+    practitioner.name = resource.get('name', [])
+    practitioner.telecom = resource.get('telecom', [])
+    practitioner.address = resource.get('address', [])
+    practitioner.gender = resource.get('gender')
+    practitioner.birth_date = resource.get('birthDate')
+    practitioner.qualification = resource.get('qualification', [])
+
+    return mapped
+
+
+# Resource type -> mapper, in insert order (results before the reports that cite them)
+RESOURCE_MAPPERS: Dict[str, Callable[[dict, uuid.UUID, ReferenceResolver], MappedResource]] = {
+    'Observation': observation_from_fhir,
+    'DiagnosticReport': diagnostic_report_from_fhir,
+    'MedicationRequest': medication_request_from_fhir,
+    'Encounter': encounter_from_fhir,
+}
+
+# Patients and practitioners are created with their DIDs (identity
+# endpoints), so their mappers are only used to update them
+UPDATE_MAPPERS = {
+    **RESOURCE_MAPPERS,
+    'Patient': patient_from_fhir,
+    'Practitioner': practitioner_from_fhir,
+}
+
+
+def map_resource(resource: dict, resource_id: uuid.UUID, resolver: ReferenceResolver) -> MappedResource:
+    """
+    Map a FHIR resource onto an unsaved model instance with the given id
+
+    Raises:
+        ValueError: If the resource type is unsupported or the resource is invalid
+    """
+    resource_type = resource.get('resourceType')
+    if resource_type not in RESOURCE_MAPPERS:
+        raise ValueError(f"Unsupported resource type: {resource_type}")
+    return RESOURCE_MAPPERS[resource_type](resource, resource_id, resolver)
+
+
+def group_references(mapped: Dict[int, MappedResource]) -> Dict[str, Set[uuid.UUID]]:
+    """Stored resource ids referenced by a set of mapped resources, per type"""
+    grouped = defaultdict(set)
+    for resource in mapped.values():
+        for resource_type, resource_id in resource.references:
+            grouped[resource_type].add(resource_id)
+    return grouped
+
+
+def _compact(resource: dict) -> dict:
+    """Drop empty elements, as FHIR JSON omits them"""
+    return {key: value for key, value in resource.items() if value not in (None, '', [], {})}
+
+
+def _reference(resource_type: str, resource_id) -> Optional[dict]:
+    return {'reference': f"{resource_type}/{resource_id}"} if resource_id else None
+
+
+def _instant(value) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def version_id(instance) -> str:
+    """
+    Version of a stored resource, as sent in meta.versionId and the ETag
+
+    The content hash for hashed records, which changes exactly when the
+    content does; otherwise the last update time in microseconds.
+    """
+    record_hash = getattr(instance, 'blockchain_hash', None)
+    if record_hash:
+        return record_hash
+    return str(int(instance.updated_at.timestamp() * 1_000_000))
+
+
+def _meta(instance) -> dict:
+    return {'versionId': version_id(instance), 'lastUpdated': _instant(instance.updated_at)}
+
+
+class Element(NamedTuple):
+    """A FHIR element: the columns it is read from and how to render it"""
+    columns: Tuple[str, ...]
+    render: Callable
+    summary: bool = False  # Part of the _summary=true view
+
+
+# Columns every resource needs: id and meta (versionId, lastUpdated)
+BASE_COLUMNS = ('id', 'updated_at', 'blockchain_hash')
+
+# Tag on resources that leave out elements (_summary / _elements)
+SUBSETTED = {'system': 'http://terminology.hl7.org/CodeSystem/v3-ObservationValue', 'code': 'SUBSETTED'}
+
+
+PATIENT_ELEMENTS = {
+    'identifier': Element(('identifier',), lambda p: p.identifier, True),
+    'active': Element(('active',), lambda p: p.active, True),
+    'name': Element(('name',), lambda p: p.name, True),
+    'telecom': Element(('telecom',), lambda p: p.telecom, True),
+    'gender': Element(('gender',), lambda p: p.gender, True),
+    'birthDate': Element(('birth_date',), lambda p: _instant(p.birth_date), True),
+    'deceasedDateTime': Element(('deceased_datetime',), lambda p: _instant(p.deceased_datetime), True),
+    'deceasedBoolean': Element(('deceased', 'deceased_datetime'),
+                               lambda p: p.deceased if not p.deceased_datetime else None, True),
+    'address': Element(('address',), lambda p: p.address, True),
+    'maritalStatus': Element(('marital_status',), lambda p: p.marital_status),
+}
+
+OBSERVATION_ELEMENTS = {
+    'status': Element(('status',), lambda o: o.status, True),
+    'category': Element(('category',), lambda o: o.category, True),
+    'code': Element(('code',), lambda o: o.code, True),
+    'subject': Element(('patient',), lambda o: _reference('Patient', o.patient_id), True),
+    'performer': Element(('practitioner',), lambda o: [_reference('Practitioner', o.practitioner_id)]
+                         if o.practitioner_id else None, True),
+    'effectiveDateTime': Element(('effective_datetime',), lambda o: _instant(o.effective_datetime), True),
+    'effectivePeriod': Element(('effective_period',), lambda o: o.effective_period, True),
+    'issued': Element(('issued',), lambda o: _instant(o.issued), True),
+    'valueQuantity': Element(('value_quantity',), lambda o: o.value_quantity, True),
+    'valueCodeableConcept': Element(('value_codeable_concept',), lambda o: o.value_codeable_concept, True),
+    'valueString': Element(('value_string',), lambda o: o.value_string, True),
+    'valueBoolean': Element(('value_boolean',), lambda o: o.value_boolean, True),
+    'valueInteger': Element(('value_integer',), lambda o: o.value_integer, True),
+    'valueRange': Element(('value_range',), lambda o: o.value_range, True),
+    'interpretation': Element(('interpretation',), lambda o: o.interpretation),
+    'note': Element(('note',), lambda o: o.note),
+    'referenceRange': Element(('reference_range',), lambda o: o.reference_range),
+}
+
+DIAGNOSTIC_REPORT_ELEMENTS = {
+    'status': Element(('status',), lambda r: r.status, True),
+    'category': Element(('category',), lambda r: r.category, True),
+    'code': Element(('code',), lambda r: r.code, True),
+    'subject': Element(('patient',), lambda r: _reference('Patient', r.patient_id), True),
+    'performer': Element(('practitioner',), lambda r: [_reference('Practitioner', r.practitioner_id)]
+                         if r.practitioner_id else None, True),
+    'effectiveDateTime': Element(('effective_datetime',), lambda r: _instant(r.effective_datetime), True),
+    'effectivePeriod': Element(('effective_period',), lambda r: r.effective_period, True),
+    'issued': Element(('issued',), lambda r: _instant(r.issued), True),
+    # Many-to-many: no column, prefetch 'result' when serializing many
+    'result': Element((), lambda r: [_reference('Observation', obs.id) for obs in r.result.all()]),
+    'conclusion': Element(('conclusion',), lambda r: r.conclusion),
+    'conclusionCode': Element(('conclusion_code',), lambda r: r.conclusion_code),
+}
+
+MEDICATION_REQUEST_ELEMENTS = {
+    'status': Element(('status',), lambda m: m.status, True),
+    'intent': Element(('intent',), lambda m: m.intent, True),
+    'medicationCodeableConcept': Element(('medication_codeable_concept',),
+                                         lambda m: m.medication_codeable_concept, True),
+    'subject': Element(('patient',), lambda m: _reference('Patient', m.patient_id), True),
+    'requester': Element(('practitioner',), lambda m: _reference('Practitioner', m.practitioner_id), True),
+    'authoredOn': Element(('authored_on',), lambda m: _instant(m.authored_on), True),
+    'dosageInstruction': Element(('dosage_instruction',), lambda m: m.dosage_instruction),
+    'dispenseRequest': Element(('dispense_request',), lambda m: m.dispense_request),
+    'note': Element(('note',), lambda m: m.note),
+}
+
+PRACTITIONER_ELEMENTS = {
+    'identifier': Element(('identifier',), lambda p: p.identifier, True),
+    'active': Element(('active',), lambda p: p.active, True),
+    'name': Element(('name',), lambda p: p.name, True),
+    'telecom': Element(('telecom',), lambda p: p.telecom, True),
+    'address': Element(('address',), lambda p: p.address, True),
+    'gender': Element(('gender',), lambda p: p.gender, True),
+    'birthDate': Element(('birth_date',), lambda p: _instant(p.birth_date), True),
+    'qualification': Element(('qualification',), lambda p: p.qualification),
+}
+
+ENCOUNTER_ELEMENTS = {
+    'status': Element(('status',), lambda e: e.status, True),
+    'class': Element(('encounter_class',), lambda e: e.encounter_class, True),
+    'type': Element(('encounter_type',), lambda e: e.encounter_type, True),
+    'subject': Element(('patient',), lambda e: _reference('Patient', e.patient_id), True),
+    'participant': Element(('practitioner',), lambda e: [
+        {'individual': _reference('Practitioner', e.practitioner_id)}
+    ] if e.practitioner_id else None, True),
+    'period': Element(('period_start', 'period_end'), lambda e: _compact({
+        'start': _instant(e.period_start), 'end': _instant(e.period_end),
+    }), True),
+    'reasonCode': Element(('reason_code',), lambda e: e.reason_code, True),
+}
+
+
+def _serialize(resource_type: str, table: Dict[str, Element], instance, elements=None) -> dict:
+    """
+    Render a resource from its element table
+
+    With elements, only those elements are rendered (and only their
+    columns need to be loaded); the resource is tagged SUBSETTED.
+    """
+    meta = _meta(instance)
+    if elements is not None:
+        meta['tag'] = [SUBSETTED]
+    resource = {'resourceType': resource_type, 'id': str(instance.id), 'meta': meta}
+    for name, element in table.items():
+        if elements is None or name in elements:
+            resource[name] = element.render(instance)
+    return _compact(resource)
+
+
+def patient_to_fhir(patient, elements=None) -> dict:
+    """Serialize a Patient"""
+    return _serialize('Patient', PATIENT_ELEMENTS, patient, elements)
+
+
+def practitioner_to_fhir(practitioner, elements=None) -> dict:
+    """Serialize a Practitioner"""
+    return _serialize('Practitioner', PRACTITIONER_ELEMENTS, practitioner, elements)
+
+
+def observation_to_fhir(obs, elements=None) -> dict:
+    """Serialize an Observation"""
+    return _serialize('Observation', OBSERVATION_ELEMENTS, obs, elements)
+
+
+def diagnostic_report_to_fhir(report, elements=None) -> dict:
+    """Serialize a DiagnosticReport (prefetch 'result' when serializing many)"""
+    return _serialize('DiagnosticReport', DIAGNOSTIC_REPORT_ELEMENTS, report, elements)
+
+
+def medication_request_to_fhir(request, elements=None) -> dict:
+    """Serialize a MedicationRequest"""
+    return _serialize('MedicationRequest', MEDICATION_REQUEST_ELEMENTS, request, elements)
+
+
+def encounter_to_fhir(encounter, elements=None) -> dict:
+    """Serialize an Encounter"""
+    return _serialize('Encounter', ENCOUNTER_ELEMENTS, encounter, elements)
+
+
+def consent_to_fhir(consent) -> dict:
+    """Serialize a ConsentRecord as a FHIR Consent"""
+    grantee_types = {'practitioner': 'Practitioner', 'care_team': 'CareTeam', 'organization': 'Organization'}
+    return _compact({
+        'resourceType': 'Consent',
+        'id': str(consent.id),
+        'meta': _meta(consent),
+        'status': {'active': 'active', 'pending': 'proposed'}.get(consent.status, 'inactive'),
+        'scope': {'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/consentscope', 'code': 'patient-privacy'}]},
+        'patient': _reference('Patient', consent.patient_id),
+        'dateTime': _instant(consent.granted_at),
+        'provision': _compact({
+            'type': 'permit',
+            'period': _compact({'start': _instant(consent.granted_at), 'end': _instant(consent.expires_at)}),
+            'actor': [{'reference': _reference(grantee_types[consent.grantee_type], consent.grantee_id)}],
+            'class': [
+                {'system': 'http://hl7.org/fhir/resource-types', 'code': entry}
+                for entry in consent.scope if isinstance(entry, str) and entry[:1].isupper() and '/' not in entry
+            ],
+        }),
+    })
+
+
+# Resource type -> (model, serializer) for the types in a patient's record
+RESOURCE_SERIALIZERS = {
+    'Patient': (Patient, patient_to_fhir),
+    'Observation': (Observation, observation_to_fhir),
+    'DiagnosticReport': (DiagnosticReport, diagnostic_report_to_fhir),
+    'MedicationRequest': (MedicationRequest, medication_request_to_fhir),
+    'Encounter': (Encounter, encounter_to_fhir),
+}
+
+
+# Every FHIR resource type stored in fhir.models -> (model, serializer)
+SERIALIZERS = {
+    **RESOURCE_SERIALIZERS,
+    'Practitioner': (Practitioner, practitioner_to_fhir),
+}
+
+# Resource type -> element table
+RESOURCE_ELEMENTS = {
+    'Patient': PATIENT_ELEMENTS,
+    'Practitioner': PRACTITIONER_ELEMENTS,
+    'Observation': OBSERVATION_ELEMENTS,
+    'DiagnosticReport': DIAGNOSTIC_REPORT_ELEMENTS,
+    'MedicationRequest': MEDICATION_REQUEST_ELEMENTS,
+    'Encounter': ENCOUNTER_ELEMENTS,
+}
+
+
+def to_fhir(instance, elements=None) -> dict:
+    """Serialize a model instance as a FHIR resource, optionally only some elements"""
+    return SERIALIZERS[type(instance).__name__][1](instance, elements)
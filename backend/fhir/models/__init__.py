@@ -9,7 +9,11 @@ from .resources import (
     MedicationRequest,
     Encounter,
 )
+from .groups import Organization, PractitionerRole, CareTeam, CareTeamMember
 from .consent import ConsentRecord, AccessLog
+from .exports import ExportJob
+from .history import ResourceVersion
+from .streams import ObservationChunk
 
 __all__ = [
     'Patient',
@@ -18,6 +22,13 @@ __all__ = [
     'DiagnosticReport',
     'MedicationRequest',
     'Encounter',
+    'Organization',
+    'PractitionerRole',
+    'CareTeam',
+    'CareTeamMember',
     'ConsentRecord',
     'AccessLog',
+    'ExportJob',
+    'ResourceVersion',
+    'ObservationChunk',
 ]
@@ -3,10 +3,53 @@ Consent and Access Control Models
 Tracks blockchain-based consent and access permissions
 """
 from django.db import models
+from django.utils import timezone
 from fhir.models.resources import Patient, Practitioner
+from fhir.models.groups import CareTeam, CareTeamMember, Organization, PractitionerRole
 import uuid
 
 
+class ConsentRecordQuerySet(models.QuerySet):
+    """Query helpers for consent status"""
+    
+    def active(self, now=None):
+        """
+        Consents that currently grant access
+        
+        The expiry filter covers consents that lapsed since the last
+        expiry sweep; both conditions match the partial active indexes.
+        """
+        return self.filter(status='active', expires_at__gt=now or timezone.now())
+    
+    def lapsed(self, now=None):
+        """Consents still marked active whose expiry has passed"""
+        return self.filter(status='active', expires_at__lte=now or timezone.now())
+    
+    def granted_to(self, practitioner_id=None, practitioner_did=None):
+        """
+        Consents reaching a practitioner directly or through an active
+        care team or organization membership
+        
+        Memberships are resolved with indexed subqueries at query time,
+        so consent rows scale with patients rather than staff.
+        """
+        if practitioner_did is not None:
+            member = {'practitioner__did': practitioner_did}
+        else:
+            member = {'practitioner_id': practitioner_id}
+        
+        teams = CareTeamMember.objects.filter(
+            active=True, care_team__status='active', **member
+        ).values('care_team_id')
+        organizations = PractitionerRole.objects.filter(
+            active=True, organization__active=True, **member
+        ).values('organization_id')
+        
+        return self.filter(
+            models.Q(**member) | models.Q(care_team__in=teams) | models.Q(organization__in=organizations)
+        )
+
+
 class ConsentRecord(models.Model):
     """
     Tracks patient consent for data access
@@ -14,9 +57,14 @@ class ConsentRecord(models.Model):
     """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     
-    # Parties
+    # Parties: the patient grants access to exactly one grantee
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='consents')
-    practitioner = models.ForeignKey(Practitioner, on_delete=models.CASCADE, related_name='consents_received')
+    practitioner = models.ForeignKey(Practitioner, on_delete=models.CASCADE, null=True, blank=True,
+                                     related_name='consents_received')
+    care_team = models.ForeignKey(CareTeam, on_delete=models.CASCADE, null=True, blank=True,
+                                  related_name='consents_received')
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, null=True, blank=True,
+                                     related_name='consents_received')
     
     # Consent details
     status = models.CharField(max_length=20, choices=[
@@ -44,16 +92,66 @@ class ConsentRecord(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = ConsentRecordQuerySet.as_manager()
+    
     class Meta:
         db_table = 'consent_record'
         indexes = [
             models.Index(fields=['patient', 'status']),
             models.Index(fields=['practitioner', 'status']),
             models.Index(fields=['expires_at']),
+            # Partial indexes over consents that are still active; they stay
+            # small once expired consents are swept
+            models.Index(
+                fields=['patient', 'practitioner', 'expires_at'],
+                include=['id'],
+                condition=models.Q(status='active'),
+                name='consent_active_patient_idx',
+            ),
+            models.Index(
+                fields=['practitioner', 'expires_at'],
+                include=['id', 'patient'],
+                condition=models.Q(status='active'),
+                name='consent_active_provider_idx',
+            ),
+            models.Index(
+                fields=['care_team', 'expires_at'],
+                include=['id', 'patient'],
+                condition=models.Q(status='active', care_team__isnull=False),
+                name='consent_active_team_idx',
+            ),
+            models.Index(
+                fields=['organization', 'expires_at'],
+                include=['id', 'patient'],
+                condition=models.Q(status='active', organization__isnull=False),
+                name='consent_active_org_idx',
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=(
+                    models.Q(practitioner__isnull=False, care_team__isnull=True, organization__isnull=True)
+                    | models.Q(practitioner__isnull=True, care_team__isnull=False, organization__isnull=True)
+                    | models.Q(practitioner__isnull=True, care_team__isnull=True, organization__isnull=False)
+                ),
+                name='consent_single_grantee',
+            ),
         ]
     
     def __str__(self):
-        return f"Consent {self.id} - Patient: {self.patient.did} -> Provider: {self.practitioner.did}"
+        return f"Consent {self.id} - Patient: {self.patient.did} -> {self.grantee_type}: {self.grantee_id}"
+    
+    @property
+    def grantee_type(self) -> str:
+        if self.care_team_id:
+            return 'care_team'
+        if self.organization_id:
+            return 'organization'
+        return 'practitioner'
+    
+    @property
+    def grantee_id(self):
+        return self.care_team_id or self.organization_id or self.practitioner_id
     
     def is_active(self):
         """Check if consent is currently valid"""
@@ -91,8 +189,8 @@ class AccessLog(models.Model):
     # Consent reference
     consent = models.ForeignKey(ConsentRecord, on_delete=models.SET_NULL, null=True, blank=True)
     
-    # Timestamp
-    accessed_at = models.DateTimeField(auto_now_add=True)
+    # Timestamp (set when the access happens; buffered rows are written later)
+    accessed_at = models.DateTimeField(default=timezone.now)
     
     # Blockchain proof
     blockchain_tx_id = models.CharField(max_length=255, unique=True)
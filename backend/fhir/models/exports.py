@@ -0,0 +1,54 @@
+"""
+FHIR Bulk Data Export Models
+Tracks asynchronous $export requests and their output files
+"""
+from django.db import models
+import uuid
+
+
+class ExportJob(models.Model):
+    """An asynchronous FHIR Bulk Data $export request"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    
+    # Requester
+    requester_did = models.CharField(max_length=255, db_index=True)
+    request_url = models.TextField()  # Kick-off URL, echoed in the manifest
+    
+    # What to export
+    level = models.CharField(max_length=10, choices=[
+        ('system', 'System'),
+        ('patient', 'Patient'),
+        ('group', 'Group'),
+    ])
+    group_id = models.UUIDField(null=True, blank=True)  # CareTeam or Organization for Group exports
+    resource_types = models.JSONField(default=list)  # _type
+    since = models.DateTimeField(null=True, blank=True)  # _since
+    redact = models.JSONField(default=list)  # Elements removed from every resource
+    
+    # Progress
+    status = models.CharField(max_length=20, choices=[
+        ('queued', 'Queued'),
+        ('in-progress', 'In Progress'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ], default='queued')
+    progress = models.CharField(max_length=255, blank=True, default='')
+    transaction_time = models.DateTimeField(null=True, blank=True)  # Snapshot time of the export
+    output = models.JSONField(default=list)  # [{'type', 'file', 'count'}]
+    error = models.TextField(null=True, blank=True)
+    
+    # Metadata
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'fhir_export_job'
+        indexes = [
+            # Workers claim the oldest queued job
+            models.Index(fields=['status', 'created_at']),
+        ]
+    
+    def __str__(self):
+        return f"ExportJob {self.id} - {self.level} ({self.status})"
@@ -0,0 +1,128 @@
+"""
+FHIR Organization and CareTeam Models
+Groups of practitioners that can receive consent as a unit
+"""
+from django.db import models
+from fhir.models.resources import Patient, Practitioner
+import uuid
+
+
+class Organization(models.Model):
+    """FHIR Organization Resource (hospital, clinic, department)"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    # FHIR identifiers
+    identifier = models.JSONField(default=list)
+
+    active = models.BooleanField(default=True)
+    name = models.CharField(max_length=255)
+    type = models.JSONField(default=list)  # CodeableConcept
+    telecom = models.JSONField(default=list)  # ContactPoint
+    address = models.JSONField(default=list)  # Address
+    part_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='departments')
+
+    # Metadata
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'fhir_organization'
+
+    def __str__(self):
+        return f"Organization {self.id} - {self.name}"
+
+
+class PractitionerRole(models.Model):
+    """
+    FHIR PractitionerRole Resource
+    Membership of a practitioner in an organization
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    practitioner = models.ForeignKey(Practitioner, on_delete=models.CASCADE, related_name='roles')
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='practitioner_roles')
+
+    active = models.BooleanField(default=True)
+    code = models.JSONField(default=list)  # CodeableConcept (role)
+    specialty = models.JSONField(default=list)  # CodeableConcept
+
+    # Metadata
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'fhir_practitioner_role'
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'practitioner'], name='practitioner_role_unique'),
+        ]
+        indexes = [
+            # Consent checks resolve a practitioner's organizations
+            models.Index(fields=['practitioner', 'active']),
+        ]
+
+    def __str__(self):
+        return f"PractitionerRole {self.practitioner_id} @ {self.organization_id}"
+
+
+class CareTeam(models.Model):
+    """FHIR CareTeam Resource (e.g. a ward team)"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    # FHIR identifiers
+    identifier = models.JSONField(default=list)
+
+    status = models.CharField(max_length=20, choices=[
+        ('proposed', 'Proposed'),
+        ('active', 'Active'),
+        ('suspended', 'Suspended'),
+        ('inactive', 'Inactive'),
+        ('entered-in-error', 'Entered in Error'),
+    ], default='active')
+    name = models.CharField(max_length=255)
+    category = models.JSONField(default=list)  # CodeableConcept
+
+    # Optional: a team dedicated to one patient
+    subject = models.ForeignKey(Patient, on_delete=models.CASCADE, null=True, blank=True,
+                                related_name='care_teams')
+    managing_organization = models.ForeignKey(Organization, on_delete=models.SET_NULL, null=True, blank=True,
+                                              related_name='care_teams')
+    members = models.ManyToManyField(Practitioner, through='CareTeamMember', related_name='care_teams')
+
+    # Metadata
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'fhir_care_team'
+
+    def __str__(self):
+        return f"CareTeam {self.id} - {self.name}"
+
+
+class CareTeamMember(models.Model):
+    """CareTeam.participant entry for a practitioner"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    care_team = models.ForeignKey(CareTeam, on_delete=models.CASCADE, related_name='memberships')
+    practitioner = models.ForeignKey(Practitioner, on_delete=models.CASCADE, related_name='care_team_memberships')
+
+    active = models.BooleanField(default=True)
+    role = models.JSONField(default=list)  # CodeableConcept
+
+    # Metadata
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'fhir_care_team_member'
+        constraints = [
+            models.UniqueConstraint(fields=['care_team', 'practitioner'], name='care_team_member_unique'),
+        ]
+        indexes = [
+            # Consent checks resolve a practitioner's teams
+            models.Index(fields=['practitioner', 'active']),
+        ]
+
+    def __str__(self):
+        return f"CareTeamMember {self.practitioner_id} in {self.care_team_id}"
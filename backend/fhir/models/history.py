@@ -0,0 +1,52 @@
+"""
+FHIR Version History Models
+Past versions of updated resources, as JSON Patch deltas with periodic snapshots
+"""
+from django.db import models
+from django.utils import timezone
+import uuid
+
+
+class ResourceVersion(models.Model):
+    """
+    One version of a FHIR resource
+
+    Version 1 and every FHIR_HISTORY_SNAPSHOT_INTERVAL-th version after it
+    store the whole resource in snapshot; the others store the JSON Patch
+    (RFC 6902) from the previous version in delta. Each version keeps the
+    content hash and anchor tx it had, so superseded versions stay
+    verifiable. Resources that were never updated have no rows.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    resource_type = models.CharField(max_length=50)
+    resource_id = models.UUIDField()
+    version = models.PositiveIntegerField()  # 1, 2, ... in update order
+    version_id = models.CharField(max_length=64)  # meta.versionId / ETag of this version
+
+    # Content (exactly one is set)
+    snapshot = models.JSONField(null=True, blank=True)
+    delta = models.JSONField(null=True, blank=True)
+
+    # Blockchain anchoring (hash is NULL for unhashed resources)
+    blockchain_hash = models.CharField(max_length=64, null=True, blank=True)
+    blockchain_tx_id = models.CharField(max_length=255, null=True, blank=True)
+
+    # Who wrote this version, and when
+    recorded_by = models.CharField(max_length=255, null=True, blank=True)
+    recorded_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'fhir_resource_version'
+        constraints = [
+            models.UniqueConstraint(fields=['resource_type', 'resource_id', 'version'],
+                                    name='resource_version_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['resource_type', 'resource_id', 'version_id']),
+            models.Index(fields=['recorded_at'], name='resource_version_unanchored',
+                         condition=models.Q(blockchain_tx_id__isnull=True, blockchain_hash__isnull=False)),
+        ]
+
+    def __str__(self):
+        return f"{self.resource_type}/{self.resource_id}/_history/{self.version}"
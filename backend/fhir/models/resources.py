@@ -3,9 +3,13 @@ FHIR R4 Data Models for MEDBLOCK
 Implements core FHIR resources with Django ORM
 """
 from django.db import models
-from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import DateTimeRangeField, JSONField
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.db.backends.postgresql.psycopg_any import DateTimeTZRange
 import uuid
 
+from fhir import ucum
+
 
 class Patient(models.Model):
     """FHIR Patient Resource"""
@@ -48,6 +52,8 @@ class Patient(models.Model):
         indexes = [
             models.Index(fields=['did']),
             models.Index(fields=['birth_date']),
+            # identifier search (system|value containment)
+            GinIndex(fields=['identifier'], opclasses=['jsonb_path_ops'], name='patient_identifier_gin'),
         ]
     
     def __str__(self):
@@ -125,6 +131,13 @@ class Observation(models.Model):
     value_integer = models.IntegerField(null=True, blank=True)
     value_range = models.JSONField(null=True, blank=True)
     
+    # Derived from code and value_quantity for range queries (see derive_values).
+    # Not editable, so not part of the hashed content.
+    code_system = models.CharField(max_length=255, null=True, blank=True, editable=False)
+    code_value = models.CharField(max_length=100, null=True, blank=True, editable=False)
+    value_numeric = models.FloatField(null=True, blank=True, editable=False)  # In value_unit
+    value_unit = models.CharField(max_length=50, null=True, blank=True, editable=False)  # Canonical UCUM code
+    
     # Interpretation and notes
     interpretation = models.JSONField(default=list)  # CodeableConcept
     note = models.JSONField(default=list)  # Annotation
@@ -140,15 +153,55 @@ class Observation(models.Model):
     blockchain_hash = models.CharField(max_length=64, unique=True, db_index=True)
     blockchain_tx_id = models.CharField(max_length=255, null=True, blank=True)
     
+    # Columns derive_values maintains, and the columns it reads
+    DERIVED_FIELDS = ('code_system', 'code_value', 'value_numeric', 'value_unit')
+    DERIVED_FROM = ('code', 'value_quantity')
+    
     class Meta:
         db_table = 'fhir_observation'
         indexes = [
             models.Index(fields=['patient', 'effective_datetime']),
             models.Index(fields=['blockchain_hash']),
+            # Records waiting for flush_anchors
+            models.Index(fields=['updated_at'], name='observation_unanchored',
+                         condition=models.Q(blockchain_tx_id__isnull=True)),
+            # code and category token search (containment)
+            GinIndex(fields=['code'], opclasses=['jsonb_path_ops'], name='observation_code_gin'),
+            GinIndex(fields=['category'], opclasses=['jsonb_path_ops'], name='observation_category_gin'),
+            # Threshold queries (code-value-quantity) and per-patient series of one code
+            models.Index(fields=['code_value', 'value_numeric'], name='observation_code_value'),
+            models.Index(fields=['patient', 'code_value', 'effective_datetime'], name='observation_patient_code'),
         ]
     
     def __str__(self):
         return f"Observation {self.id} - Patient: {self.patient.id}"
+    
+    def derive_values(self):
+        """
+        Set the derived columns from code and value_quantity
+        
+        code_system/code_value hold the first coding with a code. Numeric
+        values are converted to the canonical unit of their dimension
+        (see fhir.ucum), so 150 [lb_av] is stored as 68.04 kg.
+        
+        Called on save and by every path that writes observations without
+        it (bulk_create in Bundles, queryset updates, the backfill).
+        """
+        codings = self.code.get('coding') if isinstance(self.code, dict) else None
+        coding = next((c for c in codings or [] if isinstance(c, dict) and c.get('code')), {})
+        self.code_system = coding.get('system')
+        self.code_value = coding.get('code')
+        
+        quantity = self.value_quantity if isinstance(self.value_quantity, dict) else {}
+        value = quantity.get('value')
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.value_numeric, self.value_unit = ucum.normalize(float(value), ucum.unit_code(quantity))
+        else:
+            self.value_numeric, self.value_unit = None, None
+    
+    def save(self, *args, **kwargs):
+        self.derive_values()
+        super().save(*args, **kwargs)
 
 
 class DiagnosticReport(models.Model):
@@ -200,6 +253,9 @@ class DiagnosticReport(models.Model):
         indexes = [
             models.Index(fields=['patient', 'effective_datetime']),
             models.Index(fields=['blockchain_hash']),
+            # Records waiting for flush_anchors
+            models.Index(fields=['updated_at'], name='diagnostic_report_unanchored',
+                         condition=models.Q(blockchain_tx_id__isnull=True)),
         ]
     
     def __str__(self):
@@ -264,6 +320,9 @@ class MedicationRequest(models.Model):
         indexes = [
             models.Index(fields=['patient', 'authored_on']),
             models.Index(fields=['blockchain_hash']),
+            # Records waiting for flush_anchors
+            models.Index(fields=['updated_at'], name='medication_request_unanchored',
+                         condition=models.Q(blockchain_tx_id__isnull=True)),
         ]
     
     def __str__(self):
@@ -300,6 +359,10 @@ class Encounter(models.Model):
     period_start = models.DateTimeField()
     period_end = models.DateTimeField(null=True, blank=True)
     
+    # tstzrange of the period for overlap queries (see derive_values); an
+    # encounter without an end is open-ended. Not editable, so not hashed.
+    period = DateTimeRangeField(null=True, blank=True, editable=False)
+    
     # Reason
     reason_code = models.JSONField(default=list)  # CodeableConcept
     
@@ -311,12 +374,39 @@ class Encounter(models.Model):
     blockchain_hash = models.CharField(max_length=64, unique=True, db_index=True)
     blockchain_tx_id = models.CharField(max_length=255, null=True, blank=True)
     
+    # Columns derive_values maintains, and the columns it reads
+    DERIVED_FIELDS = ('period',)
+    DERIVED_FROM = ('period_start', 'period_end')
+    
     class Meta:
         db_table = 'fhir_encounter'
         indexes = [
             models.Index(fields=['patient', 'period_start']),
             models.Index(fields=['blockchain_hash']),
+            # Records waiting for flush_anchors
+            models.Index(fields=['updated_at'], name='encounter_unanchored',
+                         condition=models.Q(blockchain_tx_id__isnull=True)),
+            # Overlap and containment (&&, @>, <@) searches on the period
+            GistIndex(fields=['period'], name='encounter_period_gist'),
         ]
     
     def __str__(self):
         return f"Encounter {self.id} - Patient: {self.patient.id}"
+    
+    def derive_values(self):
+        """
+        Set period from period_start and period_end
+        
+        Called on save and by every path that writes encounters without
+        it (bulk_create in Bundles, queryset updates, the backfill). An
+        end before the start leaves period empty (NULL).
+        """
+        start, end = self.period_start, self.period_end
+        if start is None or (end is not None and end < start):
+            self.period = None
+        else:
+            self.period = DateTimeTZRange(start, end, '[]' if end == start else '[)')
+    
+    def save(self, *args, **kwargs):
+        self.derive_values()
+        super().save(*args, **kwargs)
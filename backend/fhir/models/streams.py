@@ -0,0 +1,67 @@
+"""
+FHIR Device Stream Models
+High-frequency device readings stored as hourly compressed chunks
+"""
+from django.db import models
+import uuid
+
+from .resources import Patient
+
+
+class ObservationChunk(models.Model):
+    """
+    One hour of readings from one device for a patient, code and unit
+
+    Readings (time, value) are packed into data by fhir.streams and
+    summarised in count/min/max/sum/last, so aggregates over hours or
+    longer never decode them. The chunk is hashed and anchored as a unit:
+    a blood pressure cuff or CGM adds one row and one anchor per hour,
+    not per reading. data_hash covers the packed readings in the record
+    hash.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    # Stream
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='observation_chunks')
+    device = models.CharField(max_length=255)  # Device identifier as sent by the device or its gateway
+    code = models.JSONField()  # CodeableConcept of the readings
+    code_system = models.CharField(max_length=255, blank=True, default='')
+    code_value = models.CharField(max_length=100)
+    unit = models.CharField(max_length=50, blank=True, default='')  # Canonical UCUM code of the values
+    start = models.DateTimeField()  # Start of the (UTC) hour
+
+    # Readings
+    data = models.BinaryField()
+    data_hash = models.CharField(max_length=64)
+
+    # Summary of the readings
+    count = models.PositiveIntegerField()
+    value_min = models.FloatField()
+    value_max = models.FloatField()
+    value_sum = models.FloatField()
+    last_time = models.DateTimeField()
+    last_value = models.FloatField()
+
+    # Metadata
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Blockchain proof
+    blockchain_hash = models.CharField(max_length=64, unique=True, db_index=True)
+    blockchain_tx_id = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        db_table = 'fhir_observation_chunk'
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'device', 'code_system', 'code_value', 'unit', 'start'],
+                                    name='observation_chunk_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['patient', 'code_value', 'start'], name='observation_chunk_series'),
+            # Records waiting for flush_anchors
+            models.Index(fields=['updated_at'], name='observation_chunk_unanchored',
+                         condition=models.Q(blockchain_tx_id__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f"ObservationChunk {self.code_value} {self.start:%Y-%m-%dT%H} - Patient: {self.patient_id}"
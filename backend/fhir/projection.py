@@ -0,0 +1,92 @@
+"""
+FHIR Projections
+Maps _summary and _elements to the elements rendered and the columns loaded
+"""
+from typing import FrozenSet, NamedTuple, Optional, Sequence, Tuple
+
+from .mapping import BASE_COLUMNS, RESOURCE_ELEMENTS, SERIALIZERS
+
+SUMMARY_MODES = ('true', 'false', 'text', 'data', 'count')
+
+# Elements with cardinality 1..1, returned even when not requested
+MANDATORY_ELEMENTS = {
+    'Patient': (),
+    'Practitioner': (),
+    'Observation': ('status', 'code'),
+    'DiagnosticReport': ('status', 'code'),
+    'MedicationRequest': ('status', 'intent', 'subject', 'medicationCodeableConcept'),
+    'Encounter': ('status', 'class'),
+}
+
+
+class Projection(NamedTuple):
+    """
+    The part of a resource type a request asks for
+
+    elements is None for the full resource. count is set for
+    _summary=count, where searches return only the total.
+    """
+    resource_type: str
+    elements: Optional[FrozenSet[str]]
+    count: bool = False
+
+    def columns(self, extra: Sequence[str] = ()) -> Optional[Tuple[str, ...]]:
+        """
+        Columns for .only(), or None to load whole rows
+
+        Args:
+            extra: Further columns the caller needs, e.g. its ordering
+                and the foreign key a Prefetch joins on
+        """
+        if self.elements is None:
+            return None
+        table = RESOURCE_ELEMENTS[self.resource_type]
+        fields = {field.name for field in SERIALIZERS[self.resource_type][0]._meta.concrete_fields}
+        columns = dict.fromkeys(column for column in BASE_COLUMNS if column in fields)
+        for name in sorted(self.elements):
+            columns.update(dict.fromkeys(table[name].columns))
+        columns.update(dict.fromkeys(field.lstrip('-') for field in extra))
+        return tuple(columns)
+
+    def apply(self, queryset, extra: Sequence[str] = ()):
+        """Defer the columns no requested element is read from"""
+        columns = self.columns(extra)
+        return queryset if columns is None else queryset.only(*columns)
+
+
+def parse_projection(resource_type: str, params) -> Projection:
+    """
+    Read _summary and _elements from query parameters
+
+    _summary=true keeps the summary elements, _summary=text and =count
+    only id, meta and mandatory elements (there is no narrative), and
+    _summary=false/data the whole resource. _elements lists top-level
+    elements to return; mandatory elements are always added.
+
+    Raises:
+        ValueError: For unknown modes or elements, or both parameters at once
+    """
+    table = RESOURCE_ELEMENTS[resource_type]
+    mandatory = frozenset(MANDATORY_ELEMENTS[resource_type])
+    summary = params.get('_summary')
+    requested = [name for value in params.getlist('_elements') for name in value.split(',') if name]
+
+    if summary and requested:
+        raise ValueError('_summary and _elements cannot be combined')
+
+    if summary:
+        if summary not in SUMMARY_MODES:
+            raise ValueError(f"Invalid _summary: {summary}")
+        if summary in ('false', 'data'):
+            return Projection(resource_type, None)
+        if summary == 'true':
+            return Projection(resource_type, frozenset(n for n, e in table.items() if e.summary) | mandatory)
+        return Projection(resource_type, mandatory, count=summary == 'count')
+
+    if requested:
+        unknown = sorted(set(requested) - set(table) - {'id', 'meta', 'resourceType'})
+        if unknown:
+            raise ValueError(f"Unknown elements for {resource_type}: {', '.join(unknown)}")
+        return Projection(resource_type, frozenset(n for n in requested if n in table) | mandatory)
+
+    return Projection(resource_type, None)
@@ -0,0 +1,509 @@
+"""
+FHIR Search
+Token, date, quantity and reference search parameters with a selectivity-ordered query plan
+"""
+import hashlib
+import logging
+import re
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import List, NamedTuple, Optional, Tuple
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.backends.postgresql.psycopg_any import DateTimeTZRange
+from django.db.models import Q
+from django.utils import timezone
+
+from . import ucum
+from .models import DiagnosticReport, Encounter, MedicationRequest, Observation, Patient, Practitioner
+
+logger = logging.getLogger(__name__)
+
+DATE_PREFIXES = ('eq', 'ne', 'gt', 'lt', 'ge', 'le', 'sa', 'eb', 'ap')
+QUANTITY_PREFIXES = DATE_PREFIXES
+
+# YYYY, YYYY-MM, YYYY-MM-DD or a full dateTime
+_DATE_RE = re.compile(
+    r'^(?P<year>\d{4})(?:-(?P<month>\d{2})(?:-(?P<day>\d{2})'
+    r'(?:T(?P<hour>\d{2}):(?P<minute>\d{2})(?::(?P<second>\d{2})(?P<fraction>\.\d+)?)?'
+    r'(?P<tz>Z|[+-]\d{2}:\d{2})?)?)?)?$'
+)
+
+
+def _split(value: str) -> List[str]:
+    """Split a comma-separated OR list, honouring '\\,' escapes"""
+    return [part.replace('\\,', ',') for part in re.split(r'(?<!\\),', value)]
+
+
+def parse_date_range(value: str) -> Tuple[datetime, datetime]:
+    """
+    Parse a FHIR date search value into the [start, end) range it denotes
+
+    '2024' covers the whole year, '2024-03-05' the whole day and
+    '2024-03-05T10:00' the whole minute. Values without a time zone are
+    in the default time zone.
+
+    Raises:
+        ValueError: If the value is not a FHIR date or dateTime
+    """
+    match = _DATE_RE.match(value)
+    if not match:
+        raise ValueError(f"Invalid date: {value}")
+    parts = match.groupdict()
+
+    start = datetime(
+        int(parts['year']), int(parts['month'] or 1), int(parts['day'] or 1),
+        int(parts['hour'] or 0), int(parts['minute'] or 0), int(parts['second'] or 0),
+        int(float(parts['fraction']) * 1_000_000) if parts['fraction'] else 0,
+    )
+    if parts['tz']:
+        start = datetime.fromisoformat(start.isoformat() + parts['tz'].replace('Z', '+00:00'))
+    else:
+        start = timezone.make_aware(start)
+
+    if parts['fraction']:
+        end = start + timedelta(microseconds=1)
+    elif parts['second']:
+        end = start + timedelta(seconds=1)
+    elif parts['minute']:
+        end = start + timedelta(minutes=1)
+    elif parts['day']:
+        end = start + timedelta(days=1)
+    elif parts['month']:
+        end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    else:
+        end = start.replace(year=start.year + 1)
+    return start, end
+
+
+class TokenParam:
+    """
+    Token search on a plain field or a JSON CodeableConcept / Identifier
+
+    shape is 'code' for a plain column, 'coding' for one Coding, 'concept'
+    for one CodeableConcept, 'concepts' for a list of them and
+    'identifiers' for a list of Identifiers. JSON shapes are matched by
+    containment (@>), which the GIN jsonb_path_ops indexes serve.
+    """
+
+    def __init__(self, field: str, shape: str):
+        self.field = field
+        self.shape = shape
+
+    def _one(self, value: str) -> Q:
+        if self.shape == 'code':
+            return Q(**{self.field: value})
+
+        system, bar, code = value.rpartition('|')
+        if bar and not system:
+            raise ValueError("Tokens without a system ('|code') are not supported")
+        element = {}
+        if system:
+            element['system'] = system
+        if code:
+            element['value' if self.shape == 'identifiers' else 'code'] = code
+
+        if self.shape == 'identifiers':
+            target = [element]
+        elif self.shape == 'coding':
+            target = element
+        elif self.shape == 'concepts':
+            target = [{'coding': [element]}]
+        else:
+            target = {'coding': [element]}
+        return Q(**{f'{self.field}__contains': target})
+
+    def to_q(self, value: str) -> Q:
+        q = Q()
+        for part in _split(value):
+            if not part:
+                raise ValueError("Empty token")
+            q |= self._one(part)
+        return q
+
+
+class DateParam:
+    """Date search with FHIR prefixes (eq, ne, gt, lt, ge, le, sa, eb, ap)"""
+
+    def __init__(self, field: str):
+        self.field = field
+
+    def _ranges(self, value: str) -> List[Tuple[Optional[datetime], Optional[datetime]]]:
+        prefix = value[:2] if value[:2] in DATE_PREFIXES else 'eq'
+        start, end = parse_date_range(value[2:] if value[:2] in DATE_PREFIXES else value)
+
+        if prefix == 'eq':
+            return [(start, end)]
+        if prefix == 'ne':
+            return [(None, start), (end, None)]
+        if prefix in ('gt', 'sa'):
+            return [(end, None)]
+        if prefix in ('lt', 'eb'):
+            return [(None, start)]
+        if prefix == 'ge':
+            return [(start, None)]
+        if prefix == 'le':
+            return [(None, end)]
+
+        # ap: within 10% of the distance from now, and at least a day
+        margin = max(abs(timezone.now() - start) / 10, timedelta(days=1))
+        return [(start - margin, end + margin)]
+
+    def ranges(self, value: str) -> List[Tuple[Optional[datetime], Optional[datetime]]]:
+        """The [start, end) ranges a value matches (None where unbounded), ORed"""
+        return [bounds for part in _split(value) for bounds in self._ranges(part)]
+
+    def to_q(self, value: str) -> Q:
+        q = Q()
+        for start, end in self.ranges(value):
+            bounds = {}
+            if start is not None:
+                bounds[f'{self.field}__gte'] = start
+            if end is not None:
+                bounds[f'{self.field}__lt'] = end
+            q |= Q(**bounds)
+        return q
+
+
+class PeriodParam:
+    """
+    Date search on a tstzrange period, with FHIR's prefix semantics for periods
+
+    eq matches periods within the range the value denotes, ne the others;
+    gt/ge and lt/le periods reaching past its end/start or before its
+    start/end; sa and eb periods wholly after or before it. Each is a
+    range operator (<@, &&, >>, <<) that a GiST index serves.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+
+    def _one(self, value: str) -> Q:
+        prefix = value[:2] if value[:2] in DATE_PREFIXES else 'eq'
+        start, end = parse_date_range(value[2:] if value[:2] in DATE_PREFIXES else value)
+        f = self.field
+
+        if prefix == 'eq':
+            return Q(**{f'{f}__contained_by': DateTimeTZRange(start, end, '[)')})
+        if prefix == 'ne':
+            return ~Q(**{f'{f}__contained_by': DateTimeTZRange(start, end, '[)')})
+        if prefix == 'gt':
+            return Q(**{f'{f}__overlap': DateTimeTZRange(end, None, '[)')})
+        if prefix == 'ge':
+            return Q(**{f'{f}__overlap': DateTimeTZRange(start, None, '[)')})
+        if prefix == 'lt':
+            return Q(**{f'{f}__overlap': DateTimeTZRange(None, start, '[)')})
+        if prefix == 'le':
+            return Q(**{f'{f}__overlap': DateTimeTZRange(None, end, '[)')})
+        if prefix == 'sa':
+            return Q(**{f'{f}__fully_gt': DateTimeTZRange(start, end, '[)')})
+        if prefix == 'eb':
+            return Q(**{f'{f}__fully_lt': DateTimeTZRange(start, end, '[)')})
+
+        margin = max(abs(timezone.now() - start) / 10, timedelta(days=1))
+        return Q(**{f'{f}__overlap': DateTimeTZRange(start - margin, end + margin, '[)')})
+
+    def to_q(self, value: str) -> Q:
+        q = Q()
+        for part in _split(value):
+            q |= self._one(part)
+        return q
+
+
+class RangeParam:
+    """
+    Period search with one range operator against the range a date denotes
+
+    lookup 'overlap' finds periods sharing any time with it (census: who
+    was in on 2024-03-01), 'contains' periods covering all of it.
+    """
+
+    def __init__(self, field: str, lookup: str):
+        self.field = field
+        self.lookup = lookup
+
+    def to_q(self, value: str) -> Q:
+        q = Q()
+        for part in _split(value):
+            start, end = parse_date_range(part)
+            q |= Q(**{f'{self.field}__{self.lookup}': DateTimeTZRange(start, end, '[)')})
+        return q
+
+
+class QuantityParam:
+    """
+    Quantity search ([prefix]number|system|code) on the derived value columns
+
+    Values are compared in the canonical unit of their dimension, so
+    gt150|http://unitsofmeasure.org|[lb_av] finds 70 kg. Without a unit
+    the number is taken as canonical and matches any unit. eq and ne use
+    the precision of the number (6.5 is [6.45, 6.55)), ap is within 10%.
+    """
+
+    def __init__(self, field: str, unit_field: str):
+        self.field = field
+        self.unit_field = unit_field
+
+    def _one(self, value: str) -> Q:
+        prefix = value[:2] if value[:2] in QUANTITY_PREFIXES else 'eq'
+        number, _, unit = (value[2:] if value[:2] in QUANTITY_PREFIXES else value).partition('|')
+        system, _, code = unit.partition('|')
+        try:
+            exact = Decimal(number)
+        except InvalidOperation:
+            raise ValueError(f"Invalid quantity: {value}")
+        half = Decimal(5).scaleb(exact.as_tuple().exponent - 1)
+
+        given = ucum.unit_code({'system': system or None, 'code': code}) if code else None
+        target, unit = ucum.normalize(float(exact), given)
+        low, _ = ucum.normalize(float(exact - half), given)
+        high, _ = ucum.normalize(float(exact + half), given)
+        f = self.field
+
+        if prefix == 'eq':
+            q = Q(**{f'{f}__gte': low, f'{f}__lt': high})
+        elif prefix == 'ne':
+            q = Q(**{f'{f}__lt': low}) | Q(**{f'{f}__gte': high})
+        elif prefix in ('gt', 'sa'):
+            q = Q(**{f'{f}__gt': target})
+        elif prefix in ('lt', 'eb'):
+            q = Q(**{f'{f}__lt': target})
+        elif prefix == 'ge':
+            q = Q(**{f'{f}__gte': target})
+        elif prefix == 'le':
+            q = Q(**{f'{f}__lte': target})
+        else:
+            margin = max(abs(target) / 10, (high - low) / 2)
+            q = Q(**{f'{f}__gte': target - margin, f'{f}__lte': target + margin})
+
+        if unit:
+            q &= Q(**{self.unit_field: unit})
+        return q
+
+    def to_q(self, value: str) -> Q:
+        q = Q()
+        for part in _split(value):
+            q |= self._one(part)
+        return q
+
+
+class CodeQuantityParam:
+    """
+    Composite code and quantity search (system|code$[prefix]number|system|code)
+
+    The code matches the primary coding columns (code_system/code_value)
+    rather than the whole CodeableConcept, so together with the quantity
+    it is a range scan on the (code_value, value_numeric) index.
+    """
+
+    def __init__(self, system_field: str, code_field: str, quantity: QuantityParam):
+        self.system_field = system_field
+        self.code_field = code_field
+        self.quantity = quantity
+
+    def _one(self, value: str) -> Q:
+        token, dollar, quantity = value.partition('$')
+        system, _, code = token.rpartition('|')
+        if not dollar or not code or not quantity:
+            raise ValueError(f"Expected code$quantity: {value}")
+        q = Q(**{self.code_field: code})
+        if system:
+            q &= Q(**{self.system_field: system})
+        return q & self.quantity._one(quantity)
+
+    def to_q(self, value: str) -> Q:
+        q = Q()
+        for part in _split(value):
+            q |= self._one(part)
+        return q
+
+
+class ReferenceParam:
+    """Reference search by 'Type/<id>' or bare id"""
+
+    def __init__(self, field: str, target: str):
+        self.field = field
+        self.target = target
+
+    def to_q(self, value: str) -> Q:
+        ids = []
+        for part in _split(value):
+            resource_type, _, raw_id = part.rpartition('/')
+            if resource_type and resource_type != self.target:
+                raise ValueError(f"Expected a {self.target} reference: {part}")
+            ids.append(uuid.UUID(raw_id))
+        return Q(**{f'{self.field}__in': ids})
+
+
+# Supported search parameters per resource type
+SEARCH_PARAMETERS = {
+    'Observation': {
+        'code': TokenParam('code', 'concept'),
+        'category': TokenParam('category', 'concepts'),
+        'status': TokenParam('status', 'code'),
+        'date': DateParam('effective_datetime'),
+        'value-quantity': QuantityParam('value_numeric', 'value_unit'),
+        'code-value-quantity': CodeQuantityParam('code_system', 'code_value',
+                                                 QuantityParam('value_numeric', 'value_unit')),
+        'patient': ReferenceParam('patient_id', 'Patient'),
+        'subject': ReferenceParam('patient_id', 'Patient'),
+        '_lastUpdated': DateParam('updated_at'),
+    },
+    'DiagnosticReport': {
+        'code': TokenParam('code', 'concept'),
+        'category': TokenParam('category', 'concepts'),
+        'status': TokenParam('status', 'code'),
+        'date': DateParam('effective_datetime'),
+        'patient': ReferenceParam('patient_id', 'Patient'),
+        'subject': ReferenceParam('patient_id', 'Patient'),
+        '_lastUpdated': DateParam('updated_at'),
+    },
+    'MedicationRequest': {
+        'code': TokenParam('medication_codeable_concept', 'concept'),
+        'status': TokenParam('status', 'code'),
+        'intent': TokenParam('intent', 'code'),
+        'authoredon': DateParam('authored_on'),
+        'patient': ReferenceParam('patient_id', 'Patient'),
+        'subject': ReferenceParam('patient_id', 'Patient'),
+        '_lastUpdated': DateParam('updated_at'),
+    },
+    'Encounter': {
+        'status': TokenParam('status', 'code'),
+        'class': TokenParam('encounter_class', 'coding'),
+        'date': PeriodParam('period'),
+        'period-overlaps': RangeParam('period', 'overlap'),
+        'period-contains': RangeParam('period', 'contains'),
+        'patient': ReferenceParam('patient_id', 'Patient'),
+        'subject': ReferenceParam('patient_id', 'Patient'),
+        '_lastUpdated': DateParam('updated_at'),
+    },
+    'Patient': {
+        'identifier': TokenParam('identifier', 'identifiers'),
+        'gender': TokenParam('gender', 'code'),
+        '_lastUpdated': DateParam('updated_at'),
+    },
+    'Practitioner': {
+        'identifier': TokenParam('identifier', 'identifiers'),
+        '_lastUpdated': DateParam('updated_at'),
+    },
+}
+
+SEARCH_MODELS = {
+    'Observation': Observation,
+    'DiagnosticReport': DiagnosticReport,
+    'MedicationRequest': MedicationRequest,
+    'Encounter': Encounter,
+    'Patient': Patient,
+    'Practitioner': Practitioner,
+}
+
+# Keyset ordering of search results per type, newest first where there is a clinical date
+SEARCH_ORDERING = {
+    'Observation': ('-effective_datetime', '-id'),
+    'DiagnosticReport': ('-effective_datetime', '-id'),
+    'MedicationRequest': ('-authored_on', '-id'),
+    'Encounter': ('-period_start', '-id'),
+    'Patient': ('id',),
+    'Practitioner': ('id',),
+}
+
+# Result (paging and control) parameters, not search criteria
+RESULT_PARAMETERS = {'_count', 'cursor', '_format', '_summary', '_elements'}
+
+
+class SearchClause(NamedTuple):
+    """One parameter occurrence compiled to a filter, with its estimated row count"""
+    name: str
+    q: Q
+    estimate: float
+
+
+def parse_search(resource_type: str, params) -> List[Tuple[str, Q]]:
+    """
+    Compile query parameters to filters
+
+    Repeated parameters are ANDed (date=ge2024&date=lt2025); comma
+    separated values within one parameter are ORed.
+
+    Raises:
+        ValueError: For unknown parameters, modifiers or malformed values
+    """
+    definitions = SEARCH_PARAMETERS[resource_type]
+    clauses = []
+    for name in params:
+        if name in RESULT_PARAMETERS:
+            continue
+        if ':' in name:
+            raise ValueError(f"Search modifiers are not supported: {name}")
+        if name not in definitions:
+            raise ValueError(f"Unknown search parameter for {resource_type}: {name}")
+        for value in params.getlist(name):
+            clauses.append((name, definitions[name].to_q(value)))
+    return clauses
+
+
+def estimate_rows(model, name: str, q: Q) -> float:
+    """
+    Planner row estimate for a single filter
+
+    Runs EXPLAIN (no execution) and caches the result for
+    FHIR_SEARCH_ESTIMATE_TTL seconds, keyed by the parameter name and the
+    shape of its SQL (operators and number of values), not the values
+    themselves. Every code=... search shares one estimate, taken from the
+    first values seen; that is enough to rank a code against a date.
+    """
+    sql, params = model.objects.filter(q).query.sql_with_params()
+    shape = hashlib.sha1(sql.encode('utf-8')).hexdigest()
+    key = f'search:estimate:{model._meta.label_lower}:{name}:{shape}'
+
+    estimate = cache.get(key)
+    if estimate is None:
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        estimate = plan[0]['Plan']['Plan Rows']
+        cache.set(key, estimate, settings.FHIR_SEARCH_ESTIMATE_TTL)
+    return estimate
+
+
+def plan_search(resource_type: str, clauses: List[Tuple[str, Q]]) -> List[SearchClause]:
+    """
+    Order clauses from most to least selective
+
+    PostgreSQL keeps the written order for conditions that are not index
+    conditions, so putting the narrowest filter first means the costlier
+    JSON containment checks only run on rows that survive it.
+    """
+    model = SEARCH_MODELS[resource_type]
+    planned = [SearchClause(name, q, estimate_rows(model, name, q)) for name, q in clauses]
+    planned.sort(key=lambda clause: clause.estimate)
+    if planned:
+        logger.debug(f"{resource_type} search plan: " + ", ".join(f"{c.name}~{c.estimate:g}" for c in planned))
+    return planned
+
+
+def search(resource_type: str, params, queryset=None):
+    """
+    Build a queryset for a FHIR search
+
+    Args:
+        resource_type: A type in SEARCH_PARAMETERS
+        params: Query parameters (a QueryDict)
+        queryset: Base queryset, e.g. already restricted by consent
+
+    Returns:
+        Filtered queryset
+
+    Raises:
+        ValueError: If the search is not supported or malformed
+    """
+    if resource_type not in SEARCH_PARAMETERS:
+        raise ValueError(f"Search is not supported for {resource_type}")
+    if queryset is None:
+        queryset = SEARCH_MODELS[resource_type].objects.all()
+
+    for clause in plan_search(resource_type, parse_search(resource_type, params)):
+        queryset = queryset.filter(clause.q)
+    return queryset
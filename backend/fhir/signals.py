@@ -0,0 +1,86 @@
+"""
+FHIR Signals
+Invalidates cached consent decisions when consent records change
+"""
+import logging
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from .consent_decisions import get_consent_service
+
+logger = logging.getLogger(__name__)
+
+# Sent after a sweep commits (consent_expired) or after bulk grants and
+# revocations commit (consents_changed); consents is a list of
+# (consent_id, patient_id, practitioner_id) tuples. Bulk writes bypass
+# post_save, so these are the hooks for caches and notifications.
+consent_expired = Signal()
+consents_changed = Signal()
+
+# Sent after a Bundle's records commit; records is a list of
+# (resource_type, record_id, patient_id) tuples
+records_created = Signal()
+
+
+@receiver(post_save, sender='fhir.ConsentRecord')
+@receiver(post_delete, sender='fhir.ConsentRecord')
+def invalidate_consent_decisions(sender, instance, **kwargs):
+    """Drop cached decisions for the consent's patient"""
+    consent_service = get_consent_service()
+    patient_id = instance.patient_id
+
+    # Invalidate now for this request, and again after commit so readers
+    # that saw the pre-commit row cannot leave a stale decision behind
+    consent_service.invalidate_patient(patient_id)
+    transaction.on_commit(lambda: consent_service.invalidate_patient(patient_id))
+
+
+@receiver(consent_expired)
+@receiver(consents_changed)
+def invalidate_bulk_consent_decisions(sender, consents, **kwargs):
+    """Drop cached decisions for patients whose consents changed in bulk"""
+    patient_ids = {patient_id for _, patient_id, _ in consents}
+    get_consent_service().invalidate_patients(patient_ids)
+    logger.debug(f"Invalidated consent decisions for {len(patient_ids)} patients")
+
+
+def _invalidate_group_consents(**grantee):
+    from .models import ConsentRecord
+
+    consent_service = get_consent_service()
+
+    def invalidate():
+        patient_ids = ConsentRecord.objects.active().filter(**grantee).values_list('patient_id', flat=True)
+        consent_service.invalidate_patients(set(patient_ids))
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender='fhir.CareTeamMember')
+@receiver(post_delete, sender='fhir.CareTeamMember')
+def invalidate_care_team_member_decisions(sender, instance, raw=False, **kwargs):
+    """Membership changes alter who is covered by the team's consents"""
+    if not raw:
+        _invalidate_group_consents(care_team_id=instance.care_team_id)
+
+
+@receiver(post_save, sender='fhir.PractitionerRole')
+@receiver(post_delete, sender='fhir.PractitionerRole')
+def invalidate_practitioner_role_decisions(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _invalidate_group_consents(organization_id=instance.organization_id)
+
+
+@receiver(post_save, sender='fhir.CareTeam')
+def invalidate_care_team_decisions(sender, instance, created=False, raw=False, **kwargs):
+    """A suspended or inactive team stops granting access"""
+    if not (raw or created):
+        _invalidate_group_consents(care_team_id=instance.id)
+
+
+@receiver(post_save, sender='fhir.Organization')
+def invalidate_organization_decisions(sender, instance, created=False, raw=False, **kwargs):
+    if not (raw or created):
+        _invalidate_group_consents(organization_id=instance.id)
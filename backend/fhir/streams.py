@@ -0,0 +1,312 @@
+"""
+Device Streams
+Ingests batched device readings into hourly compressed chunks and reads them back
+"""
+import hashlib
+import logging
+import struct
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import ucum
+from .anchoring import anchor_on_commit
+from .models import ObservationChunk
+from .search import DateParam, ReferenceParam, TokenParam
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SPAN = timedelta(hours=1)
+VALUE_DECIMALS = 3  # Values are stored as integers in thousandths
+
+Reading = Tuple[datetime, float]
+Range = Tuple[Optional[datetime], Optional[datetime]]
+
+
+def _zigzag(number: int) -> int:
+    return number * 2 if number >= 0 else -number * 2 - 1
+
+
+def _unzigzag(number: int) -> int:
+    return number // 2 if number % 2 == 0 else -(number + 1) // 2
+
+
+def _write_varint(out: bytearray, number: int):
+    while number > 0x7F:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varints(data: bytes) -> List[int]:
+    numbers, number, shift = [], 0, 0
+    for byte in data:
+        number |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            numbers.append(number)
+            number, shift = 0, 0
+    return numbers
+
+
+def encode_readings(start: datetime, readings: Sequence[Reading]) -> bytes:
+    """
+    Pack readings of one chunk
+
+    Times become milliseconds after start and values integers in
+    thousandths; both are delta encoded, zigzag mapped and written as
+    varints, then zlib compressed. A minute of one-second heart rates
+    takes a few bytes per reading.
+
+    Args:
+        start: Chunk start
+        readings: (time, value) pairs sorted by time
+
+    Returns:
+        Packed readings (decode_readings reverses it)
+    """
+    scale = 10 ** VALUE_DECIMALS
+    out = bytearray()
+    _write_varint(out, VALUE_DECIMALS)
+    _write_varint(out, len(readings))
+    previous = 0
+    for moment, _ in readings:
+        offset = round((moment - start) / timedelta(milliseconds=1))
+        _write_varint(out, _zigzag(offset - previous))
+        previous = offset
+    previous = 0
+    for _, value in readings:
+        scaled = round(value * scale)
+        _write_varint(out, _zigzag(scaled - previous))
+        previous = scaled
+    return zlib.compress(bytes(out))
+
+
+def decode_readings(start: datetime, data: bytes) -> List[Reading]:
+    """Unpack readings written by encode_readings, in time order"""
+    numbers = _read_varints(zlib.decompress(bytes(data)))
+    decimals, count = numbers[0], numbers[1]
+    readings = []
+    offset = scaled = 0
+    for i in range(count):
+        offset += _unzigzag(numbers[2 + i])
+        scaled += _unzigzag(numbers[2 + count + i])
+        readings.append((start + timedelta(milliseconds=offset), round(scaled / 10 ** decimals, decimals)))
+    return readings
+
+
+def _chunk_start(moment: datetime) -> datetime:
+    return moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _fill_chunk(chunk: ObservationChunk, readings: List[Reading]):
+    """Set the packed data and summary of a chunk from its (sorted) readings"""
+    values = [value for _, value in readings]
+    chunk.data = encode_readings(chunk.start, readings)
+    chunk.data_hash = hashlib.sha256(chunk.data).hexdigest()
+    chunk.count = len(readings)
+    chunk.value_min = min(values)
+    chunk.value_max = max(values)
+    chunk.value_sum = sum(values)
+    chunk.last_time, chunk.last_value = readings[-1]
+
+
+def ingest_readings(patient, device: str, code: dict, unit: Optional[str], readings: Iterable[Reading],
+                    submitter_did: str, defer_anchoring: Optional[bool] = None) -> List[ObservationChunk]:
+    """
+    Store a batch of device readings in hourly chunks
+
+    Values are converted to the canonical unit (fhir.ucum) and rounded to
+    VALUE_DECIMALS. Readings for an hour that already has a chunk are
+    merged into it; a reading at the same millisecond as a stored one
+    replaces it, so a device resending a batch changes nothing. Each
+    new or changed chunk gets a new hash and is anchored (or left for
+    flush_anchors) as one record once the ingest commits, so the chain
+    call holds neither the rows nor the stream lock. Ingests of the same
+    stream are serialised with an advisory lock.
+
+    Args:
+        patient: Patient the readings belong to
+        device: Device identifier
+        code: CodeableConcept with at least one coding with a code
+        unit: Unit of the values (UCUM code or common alias)
+        readings: (aware datetime, number) pairs, in any order
+        submitter_did: DID anchoring the chunks
+        defer_anchoring: Override FHIR_DEFER_ANCHORING
+
+    Returns:
+        The chunks created or changed, oldest first
+
+    Raises:
+        ValueError: For a code without a coding, or invalid readings
+    """
+    from blockchain import get_hash_manager
+
+    codings = code.get('coding') if isinstance(code, dict) else None
+    coding = next((c for c in codings or [] if isinstance(c, dict) and c.get('code')), None)
+    if coding is None:
+        raise ValueError("code needs a coding with a code")
+    unit_code = ucum.unit_code({'code': unit}) if unit else None
+
+    by_hour: Dict[datetime, Dict[datetime, float]] = defaultdict(dict)
+    for moment, value in readings:
+        if timezone.is_naive(moment):
+            raise ValueError("Reading times need a time zone")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"Reading values must be numbers: {value!r}")
+        moment = moment.astimezone(dt_timezone.utc)
+        moment = moment.replace(microsecond=moment.microsecond // 1000 * 1000)
+        by_hour[_chunk_start(moment)][moment] = ucum.normalize(float(value), unit_code)[0]
+    if not by_hour:
+        return []
+
+    stream = {
+        'patient_id': patient.id,
+        'device': device,
+        'code_system': coding.get('system') or '',
+        'code_value': coding['code'],
+        'unit': ucum.canonical_unit(unit_code) or '',
+    }
+    lock_key = struct.unpack('>q', hashlib.sha256(repr(sorted(stream.items())).encode('utf-8')).digest()[:8])[0]
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [lock_key])
+        existing = {
+            chunk.start: chunk
+            for chunk in ObservationChunk.objects.filter(start__in=list(by_hour), **stream)
+        }
+
+        created, changed = [], []
+        for start in sorted(by_hour):
+            chunk = existing.get(start)
+            merged = dict(decode_readings(start, chunk.data)) if chunk else {}
+            before = dict(merged)
+            merged.update((moment, round(value, VALUE_DECIMALS)) for moment, value in by_hour[start].items())
+            if chunk is not None and merged == before:
+                continue
+            if chunk is None:
+                chunk = ObservationChunk(start=start, code=code, **stream)
+                created.append(chunk)
+            else:
+                changed.append(chunk)
+            _fill_chunk(chunk, sorted(merged.items()))
+
+        chunks = sorted(created + changed, key=lambda c: c.start)
+        if not chunks:
+            return []
+        hash_manager = get_hash_manager()
+        for chunk in chunks:
+            # Written pending; anchored once the ingest commits
+            chunk.blockchain_hash = hash_manager.generate_record_hash(chunk)
+            chunk.blockchain_tx_id = None
+        ObservationChunk.objects.bulk_create(created)
+        for chunk in changed:
+            chunk.updated_at = timezone.now()
+        ObservationChunk.objects.bulk_update(changed, [
+            'data', 'data_hash', 'count', 'value_min', 'value_max', 'value_sum', 'last_time', 'last_value',
+            'blockchain_hash', 'blockchain_tx_id', 'updated_at',
+        ])
+        anchor_on_commit(chunks, submitter_did, defer=defer_anchoring)
+
+    logger.info(f"Ingested {sum(len(r) for r in by_hour.values())} readings into {len(chunks)} chunks "
+                f"for patient {patient.id}")
+    return chunks
+
+
+# Observation search parameters that apply to device readings
+_CHUNK_CODE = TokenParam('code', 'concept')
+_CHUNK_PATIENT = ReferenceParam('patient_id', 'Patient')
+_CHUNK_DATE = DateParam('start')
+
+
+class ChunkSearch:
+    """
+    Chunks matching Observation search parameters, and the date ranges
+    their readings must fall in
+
+    code, patient/subject and status are matched per chunk (device
+    readings are final). date selects the chunks overlapping its ranges;
+    readings are then checked against the ranges themselves, except in
+    chunks covered whole (see covers).
+    """
+
+    def __init__(self, queryset, params):
+        self.ranges: List[List[Range]] = []
+        for name in params:
+            for value in params.getlist(name):
+                if name == 'code':
+                    queryset = queryset.filter(_CHUNK_CODE.to_q(value))
+                elif name in ('patient', 'subject'):
+                    queryset = queryset.filter(_CHUNK_PATIENT.to_q(value))
+                elif name == 'status':
+                    if 'final' not in value.split(','):
+                        queryset = queryset.none()
+                elif name == 'date':
+                    ranges = _CHUNK_DATE.ranges(value)
+                    overlap = Q()
+                    for start, end in ranges:
+                        bounds = {}
+                        if start is not None:
+                            bounds['start__gt'] = start - CHUNK_SPAN
+                        if end is not None:
+                            bounds['start__lt'] = end
+                        overlap |= Q(**bounds)
+                    queryset = queryset.filter(overlap)
+                    self.ranges.append(ranges)
+                else:
+                    raise ValueError(f"Unsupported parameter for device readings: {name}")
+        self.queryset = queryset
+
+    def matches(self, moment: datetime) -> bool:
+        """Check a reading time against every date parameter"""
+        return all(
+            any((start is None or moment >= start) and (end is None or moment < end) for start, end in ranges)
+            for ranges in self.ranges
+        )
+
+    def covers(self, chunk: ObservationChunk) -> bool:
+        """Check that every reading a chunk can hold matches the date parameters"""
+        end = chunk.start + CHUNK_SPAN
+        return all(
+            any((low is None or chunk.start >= low) and (high is None or end <= high) for low, high in ranges)
+            for ranges in self.ranges
+        )
+
+    def readings(self, limit: Optional[int] = None) -> List[dict]:
+        """
+        Matching readings in time order, across devices
+
+        Raises:
+            ValueError: If more than limit (default FHIR_STREAM_MAX_READINGS) readings match
+        """
+        limit = limit or settings.FHIR_STREAM_MAX_READINGS
+        chunks = self.queryset.order_by('start').only('start', 'device', 'unit', 'count', 'data')
+        readings = []
+        for chunk in chunks.iterator():
+            for moment, value in decode_readings(chunk.start, chunk.data):
+                if self.matches(moment):
+                    readings.append({'time': moment, 'value': value, 'unit': chunk.unit, 'device': chunk.device})
+            if len(readings) > limit:
+                raise ValueError(f"More than {limit} readings match; narrow the date range")
+        readings.sort(key=lambda reading: reading['time'])
+        return readings
+
+
+def visible_chunks(compartment):
+    """
+    Chunks of a patient that an api.authorization.CompartmentSearch may see
+
+    Device readings are Observations without ids or dates of their own,
+    so a consent covers them when it covers the Observation type whole.
+    """
+    queryset = ObservationChunk.objects.filter(patient_id=compartment.patient_id)
+    if compartment.decision is None:
+        return queryset
+    q = compartment.decision.scope.as_q('Observation')
+    return queryset if q is not None and not q else queryset.none()
@@ -0,0 +1,229 @@
+"""
+Observation Time Series
+Buckets numeric observation values in SQL and downsamples them for charts
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+from django.db.models import Avg, Count, F, FloatField, Func, Max, Min, Window
+from django.db.models.functions import FirstValue, RowNumber, Trunc
+from django.utils import timezone
+
+RESOLUTIONS = ('minute', 'hour', 'day', 'week', 'month')
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _epoch(expression):
+    return Func(expression, template='EXTRACT(EPOCH FROM %(expressions)s)', output_field=FloatField())
+
+
+def bucket_values(queryset, resolution: str) -> List[dict]:
+    """
+    Per-bucket statistics of value_numeric, oldest bucket first
+
+    Buckets are effective_datetime truncated with date_trunc (in the
+    current time zone), one per canonical unit (value_unit): values in
+    units without a conversion between them, such as mg/dL and mmol/L,
+    are never averaged together. Window functions partitioned by bucket
+    and unit compute count, min, max and avg and the latest value; one
+    row per partition is kept, so the database does the aggregation and
+    returns as many rows as there are buckets. Bucket starts come back as epoch seconds of
+    the local wall time rather than datetimes, which are costly to
+    convert for every row; see bucket_time.
+
+    Args:
+        queryset: Observations of one code (and patient)
+        resolution: One of RESOLUTIONS
+
+    Returns:
+        Dicts with bucket (epoch seconds), unit, count, min, max, avg,
+        last and last_time (epoch seconds of the last value)
+
+    Raises:
+        ValueError: For an unknown resolution
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Invalid resolution: {resolution} (expected one of {', '.join(RESOLUTIONS)})")
+
+    partition = [F('bucket'), F('value_unit')]
+    latest_first = [F('effective_datetime').desc(), F('id').desc()]
+    rows = (
+        queryset.filter(value_numeric__isnull=False, effective_datetime__isnull=False)
+        .annotate(bucket=Trunc('effective_datetime', resolution))
+        .annotate(
+            bucket_start=_epoch(F('bucket')),
+            bucket_count=Window(Count('id'), partition_by=partition),
+            bucket_min=Window(Min('value_numeric'), partition_by=partition),
+            bucket_max=Window(Max('value_numeric'), partition_by=partition),
+            bucket_avg=Window(Avg('value_numeric'), partition_by=partition),
+            bucket_last=Window(FirstValue('value_numeric'), partition_by=partition, order_by=latest_first),
+            bucket_last_time=Window(FirstValue(_epoch(F('effective_datetime'))), partition_by=partition,
+                                    order_by=latest_first),
+            position=Window(RowNumber(), partition_by=partition, order_by=latest_first),
+        )
+        .filter(position=1)
+        .order_by('bucket', 'value_unit')
+        .values('bucket_start', 'value_unit', 'bucket_count', 'bucket_min', 'bucket_max', 'bucket_avg', 'bucket_last',
+                'bucket_last_time')
+    )
+    return [
+        {
+            'bucket': row['bucket_start'],
+            'unit': row['value_unit'],
+            'count': row['bucket_count'],
+            'min': row['bucket_min'],
+            'max': row['bucket_max'],
+            'avg': row['bucket_avg'],
+            'last': row['bucket_last'],
+            'last_time': row['bucket_last_time'],
+        }
+        for row in rows
+    ]
+
+
+def bucket_start(moment: datetime, resolution: str) -> float:
+    """The bucket (as from bucket_values) a moment falls in"""
+    local = timezone.localtime(moment).replace(tzinfo=None)
+    if resolution == 'minute':
+        local = local.replace(second=0, microsecond=0)
+    elif resolution == 'hour':
+        local = local.replace(minute=0, second=0, microsecond=0)
+    else:
+        local = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        if resolution == 'week':
+            local -= timedelta(days=local.weekday())
+        elif resolution == 'month':
+            local = local.replace(day=1)
+    return (local - _EPOCH).total_seconds()
+
+
+def chunk_buckets(chunks, resolution: str) -> List[dict]:
+    """
+    Per-bucket statistics of device readings, as from bucket_values
+
+    Buckets are per chunk unit, as bucket_values is per value_unit. A chunk that falls in one bucket and that the date parameters cover
+    whole contributes its stored summary, so hourly and coarser series
+    never unpack readings; other chunks are decoded and their readings
+    bucketed one by one.
+
+    Args:
+        chunks: A fhir.streams.ChunkSearch
+        resolution: One of RESOLUTIONS
+
+    Returns:
+        Dicts with bucket, unit, count, min, max, avg, last and last_time, oldest bucket first
+    """
+    from .streams import CHUNK_SPAN, decode_readings
+
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Invalid resolution: {resolution} (expected one of {', '.join(RESOLUTIONS)})")
+
+    buckets: Dict[Tuple[float, Optional[str]], dict] = {}
+
+    def add(bucket, unit, count, low, high, total, last_time, last):
+        row = buckets.get((bucket, unit))
+        if row is None:
+            buckets[(bucket, unit)] = {'bucket': bucket, 'unit': unit, 'count': count, 'min': low, 'max': high,
+                                       'sum': total, 'last': last, 'last_time': last_time}
+            return
+        row['count'] += count
+        row['min'] = min(row['min'], low)
+        row['max'] = max(row['max'], high)
+        row['sum'] += total
+        if last_time >= row['last_time']:
+            row['last'], row['last_time'] = last, last_time
+
+    queryset = chunks.queryset if resolution == 'minute' else chunks.queryset.defer('data')
+    for chunk in queryset.iterator():
+        unit = chunk.unit or None  # Chunks store '' where observations have no unit
+        first = bucket_start(chunk.start, resolution)
+        if first == bucket_start(chunk.start + CHUNK_SPAN - timedelta(microseconds=1), resolution) \
+                and chunks.covers(chunk):
+            add(first, unit, chunk.count, chunk.value_min, chunk.value_max, chunk.value_sum,
+                chunk.last_time.timestamp(), chunk.last_value)
+            continue
+        for moment, value in decode_readings(chunk.start, chunk.data):
+            if chunks.matches(moment):
+                add(bucket_start(moment, resolution), unit, 1, value, value, value, moment.timestamp(), value)
+
+    rows = [buckets[key] for key in sorted(buckets, key=_bucket_order)]
+    for row in rows:
+        row['avg'] = row.pop('sum') / row['count']
+    return rows
+
+
+def _bucket_order(key: Tuple[float, Optional[str]]):
+    bucket, unit = key
+    return bucket, unit or ''
+
+
+def merge_buckets(*series: List[dict]) -> List[dict]:
+    """Combine bucket lists of the same resolution, per bucket and unit, oldest bucket first"""
+    merged: Dict[Tuple[float, Optional[str]], dict] = {}
+    for rows in series:
+        for row in rows:
+            key = (row['bucket'], row['unit'])
+            current = merged.get(key)
+            if current is None:
+                merged[key] = dict(row)
+                continue
+            count = current['count'] + row['count']
+            current['avg'] = (current['avg'] * current['count'] + row['avg'] * row['count']) / count
+            current['count'] = count
+            current['min'] = min(current['min'], row['min'])
+            current['max'] = max(current['max'], row['max'])
+            if row['last_time'] >= current['last_time']:
+                current['last'], current['last_time'] = row['last'], row['last_time']
+    return [merged[key] for key in sorted(merged, key=_bucket_order)]
+
+
+def bucket_time(bucket: float) -> datetime:
+    """Start of a bucket from bucket_values as an aware datetime"""
+    return timezone.make_aware(datetime.utcfromtimestamp(bucket))
+
+
+def lttb(points: Sequence[Tuple[float, float]], threshold: int) -> List[int]:
+    """
+    Largest-Triangle-Three-Buckets downsampling
+
+    Keeps the first and last points and, from each of threshold - 2
+    equal slices in between, the point forming the largest triangle with
+    the point kept before it and the average of the next slice. Peaks
+    and troughs survive, unlike averaging or taking every nth point.
+
+    Args:
+        points: (x, y) pairs sorted by x
+        threshold: Number of points to keep (at least 3)
+
+    Returns:
+        Indexes of the points kept, ascending
+    """
+    count = len(points)
+    if threshold >= count:
+        return list(range(count))
+    if threshold < 3:
+        raise ValueError("LTTB needs a threshold of at least 3")
+
+    every = (count - 2) / (threshold - 2)
+    kept = [0]
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, count)
+        following = points[end:next_end]
+        avg_x = sum(x for x, _ in following) / len(following)
+        avg_y = sum(y for _, y in following) / len(following)
+
+        ax, ay = points[previous]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        kept.append(best)
+        previous = best
+
+    kept.append(count - 1)
+    return kept
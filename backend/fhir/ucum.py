@@ -0,0 +1,95 @@
+"""
+UCUM Units
+Normalizes common clinical units so quantities in different units compare
+"""
+import re
+from typing import Optional, Tuple
+
+UCUM_SYSTEM = 'http://unitsofmeasure.org'
+
+# UCUM code -> (canonical code, factor, offset): canonical = value * factor + offset
+UNITS = {
+    # Mass
+    'kg': ('kg', 1.0, 0.0),
+    'g': ('kg', 1e-3, 0.0),
+    'mg': ('kg', 1e-6, 0.0),
+    'ug': ('kg', 1e-9, 0.0),
+    '[lb_av]': ('kg', 0.45359237, 0.0),
+    '[oz_av]': ('kg', 0.028349523125, 0.0),
+    # Length
+    'cm': ('cm', 1.0, 0.0),
+    'm': ('cm', 100.0, 0.0),
+    'mm': ('cm', 0.1, 0.0),
+    '[in_i]': ('cm', 2.54, 0.0),
+    '[ft_i]': ('cm', 30.48, 0.0),
+    # Temperature
+    'Cel': ('Cel', 1.0, 0.0),
+    '[degF]': ('Cel', 5 / 9, -32 * 5 / 9),
+    'K': ('Cel', 1.0, -273.15),
+    # Pressure
+    'mm[Hg]': ('mm[Hg]', 1.0, 0.0),
+    'kPa': ('mm[Hg]', 7.500615758, 0.0),
+    # Mass concentration
+    'mg/dL': ('mg/dL', 1.0, 0.0),
+    'g/dL': ('mg/dL', 1000.0, 0.0),
+    'g/L': ('mg/dL', 100.0, 0.0),
+    'mg/L': ('mg/dL', 0.1, 0.0),
+    # Substance concentration
+    'mmol/L': ('mmol/L', 1.0, 0.0),
+    'umol/L': ('mmol/L', 1e-3, 0.0),
+    'mol/L': ('mmol/L', 1000.0, 0.0),
+    # Rates and fractions
+    '/min': ('/min', 1.0, 0.0),
+    '/h': ('/min', 1 / 60, 0.0),
+    '%': ('%', 1.0, 0.0),
+}
+
+# Unit strings seen in practice that are not UCUM codes
+ALIASES = {
+    'lb': '[lb_av]', 'lbs': '[lb_av]', 'oz': '[oz_av]', 'in': '[in_i]', 'ft': '[ft_i]',
+    'mmHg': 'mm[Hg]', 'degC': 'Cel', '°C': 'Cel', 'C': 'Cel', 'degF': '[degF]', '°F': '[degF]', 'F': '[degF]',
+    'bpm': '/min', 'beats/min': '/min', 'breaths/min': '/min', '1/min': '/min', 'µg': 'ug', 'mcg': 'ug',
+    'µmol/L': 'umol/L',
+}
+
+_ANNOTATION_RE = re.compile(r'\{[^}]*\}')
+
+
+def unit_code(quantity: dict) -> Optional[str]:
+    """
+    UCUM code of a FHIR Quantity, or its unit as written
+
+    Annotations ('{beats}/min') carry no meaning in UCUM and are dropped.
+    Codes from other systems are returned unchanged.
+    """
+    system = quantity.get('system')
+    code = quantity.get('code') or quantity.get('unit')
+    if not code:
+        return None
+    if system and system != UCUM_SYSTEM:
+        return code
+    code = _ANNOTATION_RE.sub('', code) or '1'
+    if code.startswith('1/'):
+        code = code[1:]
+    return ALIASES.get(code, code)
+
+
+def canonical_unit(code: Optional[str]) -> Optional[str]:
+    """Canonical code for a unit (the unit itself when outside the table)"""
+    return UNITS[code][0] if code in UNITS else code
+
+
+def normalize(value: float, code: Optional[str]) -> Tuple[float, Optional[str]]:
+    """
+    A value in the canonical unit of its dimension (kg, cm, Cel, mg/dL, ...)
+
+    Values in units outside the table are returned unchanged, so they
+    still compare with values in the same unit.
+
+    Returns:
+        (value, canonical unit code)
+    """
+    if code not in UNITS:
+        return value, code
+    canonical, factor, offset = UNITS[code]
+    return float(f"{value * factor + offset:.12g}"), canonical
@@ -3,13 +3,26 @@ Identity Module
 Handles Atala PRISM DID management and authentication
 """
 from .did_manager import DIDManager, get_did_manager
-from .authentication import DIDAuthentication, DIDUser
+from .directory import DIDDirectory, DirectoryEntry, get_did_directory
+from .authentication import (
+    DIDAuthentication,
+    DIDCredentials,
+    DIDUser,
+    aget_did_principal,
+    get_did_principal,
+)
 from .auth_middleware import DIDAuthenticationMiddleware
 
 __all__ = [
     'DIDManager',
     'get_did_manager',
+    'DIDDirectory',
+    'DirectoryEntry',
+    'get_did_directory',
     'DIDAuthentication',
     'DIDUser',
+    'DIDCredentials',
+    'get_did_principal',
+    'aget_did_principal',
     'DIDAuthenticationMiddleware',
 ]
@@ -8,3 +8,6 @@ class IdentityConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'identity'
     verbose_name = 'Atala PRISM Identity'
+    
+    def ready(self):
+        from . import signals  # noqa: F401
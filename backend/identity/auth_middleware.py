@@ -1,41 +1,86 @@
 """
 DID Authentication Middleware
-Processes DID-based authentication for all requests
+Attaches DID information to each request without doing any I/O up front
 """
 import logging
-from django.utils.deprecation import MiddlewareMixin
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.functional import SimpleLazyObject
+from rest_framework import exceptions
+from .authentication import get_did_principal, parse_did_credentials
 from .did_manager import get_did_manager
 
 logger = logging.getLogger(__name__)
 
 
-class DIDAuthenticationMiddleware(MiddlewareMixin):
+def _principal_or_anonymous(request):
+    try:
+        user = get_did_principal(request)
+    except exceptions.AuthenticationFailed as e:
+        logger.debug(f"DID authentication failed in middleware: {e.detail}")
+        user = None
+
+    if user is None:
+        from django.contrib.auth.models import AnonymousUser
+        return AnonymousUser()
+    return user
+
+
+def _did_document(request, did):
+    # Reuse the document verified during authentication when there was one
+    user = request.__dict__.get('_did_auth_result')
+    if user is not None and getattr(user, 'did', None) == did:
+        return user.did_document
+    return get_did_manager().resolve_did(did)
+
+
+class DIDAuthenticationMiddleware:
     """
     Middleware to process DID authentication
     Attaches DID information to request object
+
+    The Authorization header is parsed once here. Signature verification and
+    DID resolution are deferred until a view reads request.user or
+    request.did_document, and the result is shared with DIDAuthentication,
+    so each request is authenticated at most once. Supports both WSGI and
+    ASGI (async) request handling.
     """
-    
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # process_request only parses headers, so it is safe on the event loop
+        self.process_request(request)
+        return await self.get_response(request)
+
     def process_request(self, request):
         """
         Process incoming request for DID authentication
         """
-        # Extract DID from authorization header if present
-        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
-        
-        if auth_header.startswith('DID '):
-            try:
-                parts = auth_header[4:].split(' ')
-                if len(parts) >= 1:
-                    did = parts[0]
-                    request.did = did
-                    
-                    # Resolve DID and attach to request
-                    did_manager = get_did_manager()
-                    did_document = did_manager.resolve_did(did)
-                    request.did_document = did_document
-                    
-                    logger.debug(f"DID attached to request: {did}")
-            except Exception as e:
-                logger.warning(f"Error processing DID in middleware: {e}")
-        
-        return None
+        try:
+            credentials = parse_did_credentials(request)
+        except exceptions.AuthenticationFailed as e:
+            # DRF reports the error when the view authenticates
+            logger.warning(f"Error processing DID in middleware: {e.detail}")
+            return
+
+        if credentials is None:
+            return
+
+        did = credentials.did
+        request.did = did
+        request.did_document = SimpleLazyObject(lambda: _did_document(request, did))
+        request.user = SimpleLazyObject(lambda: _principal_or_anonymous(request))
+
+        logger.debug(f"DID attached to request: {did}")
@@ -1,34 +1,224 @@
 """
 DID-Based Authentication
-Custom authentication backend for Django REST Framework
+Single authentication pipeline shared by Django middleware and Django REST Framework
 """
 import logging
-from typing import Optional, Tuple
+import uuid
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+from asgiref.sync import sync_to_async
 from rest_framework import authentication, exceptions
-from django.contrib.auth.models import AnonymousUser
-from .did_manager import get_did_manager
+from django.conf import settings
+from .did_manager import DEMO_DID, get_did_manager
+from .directory import get_did_directory
+from .replay import get_replay_guard
 
 logger = logging.getLogger(__name__)
 
+# Per-request state attribute names on the underlying HttpRequest
+_CREDENTIALS_ATTR = '_did_credentials'
+_AUTH_RESULT_ATTR = '_did_auth_result'
+
 
 class DIDUser:
     """
     Represents an authenticated user via DID
     Compatible with Django's authentication system
+
+    This is the typed principal attached to both request.user (Django views)
+    and DRF's request.user. The DID document is resolved on first access.
     """
-    
-    def __init__(self, did: str, did_document: dict):
+
+    def __init__(
+        self,
+        did: str,
+        did_document: Optional[dict] = None,
+        role: Optional[str] = None,
+        entity_id: Optional[uuid.UUID] = None,
+        status: Optional[str] = None,
+    ):
         self.did = did
-        self.did_document = did_document
+        self._did_document = did_document
+        # From the DID directory: 'patient' or 'provider' and the matching
+        # Patient/Practitioner id, or None for unregistered DIDs
+        self.role = role
+        self.entity_id = entity_id
+        self.status = status
         self.is_authenticated = True
         self.is_anonymous = False
-    
+
     def __str__(self):
         return f"DIDUser({self.did})"
-    
+
+    @property
+    def did_document(self) -> Optional[Dict[str, Any]]:
+        if self._did_document is None:
+            self._did_document = get_did_manager().resolve_did(self.did)
+        return self._did_document
+
     @property
     def is_active(self):
-        return True
+        return self.status != 'inactive'
+
+    @property
+    def is_patient(self) -> bool:
+        return self.role == 'patient'
+
+    @property
+    def is_provider(self) -> bool:
+        return self.role == 'provider'
+
+
+class DIDCredentials(NamedTuple):
+    """Parsed DID Authorization and X-DID-Message headers"""
+    did: str
+    signature: str
+    message: str
+
+
+def parse_did_credentials(request) -> Optional[DIDCredentials]:
+    """
+    Parse DID credentials from a Django HttpRequest, once per request
+
+    Expected header format:
+    Authorization: DID did:prism:abc123 signature:xyz789
+    X-DID-Message: 1760868000:9f2c41d0
+
+    Returns:
+        DIDCredentials, or None if the request does not use DID auth
+
+    Raises:
+        AuthenticationFailed: If a DID Authorization header is malformed
+    """
+    cached = request.__dict__.get(_CREDENTIALS_ATTR)
+    if cached is not None:
+        if isinstance(cached, exceptions.AuthenticationFailed):
+            raise cached
+        return cached or None
+
+    auth_header = request.META.get('HTTP_AUTHORIZATION', '')
+
+    if not auth_header.startswith('DID '):
+        setattr(request, _CREDENTIALS_ATTR, False)
+        return None
+
+    try:
+        parts = auth_header[4:].split(' ')
+        if len(parts) != 2:
+            raise exceptions.AuthenticationFailed('Invalid DID authorization format')
+
+        did, signature_part = parts
+
+        if not signature_part.startswith('signature:'):
+            raise exceptions.AuthenticationFailed('Missing signature')
+
+        # Get message to verify: '<unix timestamp>[:<nonce>]'
+        message = request.META.get('HTTP_X_DID_MESSAGE', '')
+        if not message:
+            raise exceptions.AuthenticationFailed('Missing X-DID-Message header')
+
+    except exceptions.AuthenticationFailed as e:
+        setattr(request, _CREDENTIALS_ATTR, e)
+        raise
+
+    credentials = DIDCredentials(did=did, signature=signature_part[10:], message=message)
+    setattr(request, _CREDENTIALS_ATTR, credentials)
+    return credentials
+
+
+def authenticate_credentials(credentials: DIDCredentials) -> DIDUser:
+    """
+    Verify DID credentials and build the principal
+
+    The signature covers the X-DID-Message value, whose leading Unix
+    timestamp must be within DID_AUTH_MESSAGE_MAX_AGE seconds of now and
+    whose nonce may only be used once per DID.
+
+    Raises:
+        AuthenticationFailed: If verification fails or the account is inactive
+    """
+    did = credentials.did
+    did_manager = get_did_manager()
+
+    # Reject stale challenges before doing any signature work
+    challenge = None
+    if did != DEMO_DID:
+        try:
+            challenge = did_manager.parse_challenge(credentials.message)
+        except ValueError:
+            raise exceptions.AuthenticationFailed('Malformed X-DID-Message header')
+
+        if not did_manager.is_challenge_fresh(challenge):
+            raise exceptions.AuthenticationFailed('Expired X-DID-Message challenge')
+
+        if settings.DID_AUTH_REQUIRE_NONCE and not challenge.nonce:
+            raise exceptions.AuthenticationFailed('X-DID-Message must include a nonce')
+
+    # Verify signature; the document used for verification is kept
+    did_document = did_manager.verify_and_resolve(did, credentials.message, credentials.signature)
+    if did_document is None:
+        raise exceptions.AuthenticationFailed('Invalid DID signature')
+
+    # Only signed challenges are recorded, so unsigned traffic cannot
+    # fill the replay filters
+    if challenge and challenge.nonce:
+        if not get_replay_guard().check_and_record(did, challenge.nonce, challenge.timestamp):
+            raise exceptions.AuthenticationFailed('Replayed X-DID-Message challenge')
+
+    # Attach role and entity id so views never look identity up again
+    entry = get_did_directory().lookup(did)
+    if entry and entry.status == 'inactive':
+        raise exceptions.AuthenticationFailed('Account is inactive')
+
+    logger.info(f"Authenticated user with DID: {did}")
+
+    return DIDUser(
+        did=did,
+        did_document=did_document,
+        role=entry.role if entry else None,
+        entity_id=entry.entity_id if entry else None,
+        status=entry.status if entry else None,
+    )
+
+
+def get_did_principal(request) -> Optional[DIDUser]:
+    """
+    Authenticate a Django HttpRequest at most once
+
+    The outcome (principal or failure) is memoised on the request, so the
+    middleware's lazy request.user and DRF's DIDAuthentication share one
+    verification pass.
+
+    Returns:
+        DIDUser, or None if the request does not use DID auth
+
+    Raises:
+        AuthenticationFailed: If DID credentials are present but invalid
+    """
+    if _AUTH_RESULT_ATTR in request.__dict__:
+        result = request.__dict__[_AUTH_RESULT_ATTR]
+        if isinstance(result, exceptions.AuthenticationFailed):
+            raise result
+        return result
+
+    try:
+        credentials = parse_did_credentials(request)
+        result = authenticate_credentials(credentials) if credentials else None
+    except exceptions.AuthenticationFailed as e:
+        result = e
+    except Exception as e:
+        logger.error(f"Authentication error: {e}")
+        result = exceptions.AuthenticationFailed('Authentication failed')
+
+    setattr(request, _AUTH_RESULT_ATTR, result)
+
+    if isinstance(result, exceptions.AuthenticationFailed):
+        raise result
+    return result
+
+
+async def aget_did_principal(request) -> Optional[DIDUser]:
+    """Async variant of get_did_principal for async views under ASGI"""
+    return await sync_to_async(get_did_principal)(request)
 
 
 class DIDAuthentication(authentication.BaseAuthentication):
@@ -36,64 +226,22 @@ class DIDAuthentication(authentication.BaseAuthentication):
     DID-based authentication for REST API
     Expects Authorization header with DID signature
     """
-    
+
     def authenticate(self, request) -> Optional[Tuple[DIDUser, None]]:
         """
         Authenticate request using DID signature
-        
-        Expected header format:
-        Authorization: DID did:prism:abc123 signature:xyz789
-        
+
+        Reuses the result of DIDAuthenticationMiddleware when it already
+        ran for this request.
+
         Returns:
             (DIDUser, None) if authenticated, None otherwise
         """
-        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
-        
-        if not auth_header.startswith('DID '):
+        user = get_did_principal(request._request)
+        if user is None:
             return None
-        
-        try:
-            # Parse authorization header
-            parts = auth_header[4:].split(' ')
-            if len(parts) != 2:
-                raise exceptions.AuthenticationFailed('Invalid DID authorization format')
-            
-            did = parts[0]
-            signature_part = parts[1]
-            
-            if not signature_part.startswith('signature:'):
-                raise exceptions.AuthenticationFailed('Missing signature')
-            
-            signature = signature_part[10:]
-            
-            # Get message to verify (could be timestamp or challenge)
-            message = request.META.get('HTTP_X_DID_MESSAGE', '')
-            if not message:
-                raise exceptions.AuthenticationFailed('Missing X-DID-Message header')
-            
-            # Verify signature
-            did_manager = get_did_manager()
-            if not did_manager.verify_did_signature(did, message, signature):
-                raise exceptions.AuthenticationFailed('Invalid DID signature')
-            
-            # Resolve DID to get document
-            did_document = did_manager.resolve_did(did)
-            if not did_document:
-                raise exceptions.AuthenticationFailed('Could not resolve DID')
-            
-            # Create DID user
-            user = DIDUser(did=did, did_document=did_document)
-            
-            logger.info(f"Authenticated user with DID: {did}")
-            
-            return (user, None)
-            
-        except exceptions.AuthenticationFailed:
-            raise
-        except Exception as e:
-            logger.error(f"Authentication error: {e}")
-            raise exceptions.AuthenticationFailed('Authentication failed')
-    
+        return (user, None)
+
     def authenticate_header(self, request):
         """
         Return authentication header for 401 responses
@@ -3,12 +3,30 @@ Atala PRISM DID Management
 Handles decentralized identity creation and verification
 """
 import logging
-from typing import Optional, Dict, Any
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple
 from django.conf import settings
 from django.core.cache import cache
 
+from . import keys
+
 logger = logging.getLogger(__name__)
 
+DEMO_DID = 'did:prism:mock_demo_did'
+DEMO_SIGNATURE = 'mock_signature_for_demo_purposes_only'
+
+DID_PATTERN = re.compile(r'^did:[a-z0-9]+:[A-Za-z0-9._:%-]+$')
+
+
+class DIDChallenge(NamedTuple):
+    """Parsed X-DID-Message challenge: '<unix timestamp>[:<nonce>]'"""
+    timestamp: float
+    nonce: Optional[str]
+
 
 class DIDManager:
     """
@@ -21,46 +39,57 @@ class DIDManager:
         self.prism_node_url = settings.PRISM_NODE_URL
         self.prism_api_key = settings.PRISM_API_KEY
         self.did_method = settings.PRISM_DID_METHOD
+        self.key_type = settings.DID_KEY_TYPE
+        self.message_max_age = settings.DID_AUTH_MESSAGE_MAX_AGE
+        
+        # Decoded public key objects keyed by (did, key_version), LRU-bounded
+        self._key_cache: "OrderedDict[Tuple[str, int], Any]" = OrderedDict()
+        self._key_cache_size = settings.DID_KEY_CACHE_SIZE
+        self._key_cache_lock = threading.Lock()
     
-    def create_did(self, entity_type: str = 'patient') -> Dict[str, Any]:
+    def create_did(self, entity_type: str = 'patient', key_type: Optional[str] = None) -> Dict[str, Any]:
         """
         Create a new DID for a patient or provider
         
         Args:
             entity_type: Type of entity ('patient' or 'provider')
+            key_type: 'Ed25519' or 'secp256k1' (default from settings)
             
         Returns:
             Dictionary containing DID and key material
             {
                 'did': 'did:prism:...',
-                'public_key': '...',
-                'private_key': '...' (should be securely stored by user)
+                'public_key': '...' (hex),
+                'private_key': '...' (hex, should be securely stored by user),
+                'key_type': 'Ed25519',
             }
         """
         try:
-            # TODO: Implement actual Atala PRISM DID creation
-            # This is a placeholder for the PRISM SDK integration
+            # TODO: Anchor the DID on Atala PRISM once the SDK is available
             
             logger.info(f"Creating new DID for {entity_type}")
             
-            # Mock DID creation
+            key_type = key_type or self.key_type
+            public_key, private_key = keys.generate_key_pair(key_type)
+            
             import uuid
             did_suffix = str(uuid.uuid4()).replace('-', '')[:32]
-            mock_did = f"did:{self.did_method}:{did_suffix}"
-            
-            result = {
-                'did': mock_did,
-                'public_key': f"pub_key_{did_suffix[:16]}",
-                'private_key': f"priv_key_{did_suffix[:16]}",  # User must store securely
-                'created_at': self._get_current_timestamp(),
-            }
+            did = f"did:{self.did_method}:{did_suffix}"
             
-            # Cache DID document
-            cache.set(f"did_{mock_did}", result, timeout=86400)  # 24 hours
+            # Until PRISM resolution lands the database is the DID registry;
+            # the public key is stored, never the private key
+            from .models import DIDKey
+            did_document = DIDKey.objects.create(
+                did=did, public_key=public_key, key_type=key_type, key_version=1,
+            ).to_document()
+            cache.set(f"did_{did}", did_document, timeout=3600)
             
-            logger.info(f"Created DID: {mock_did}")
+            logger.info(f"Created DID: {did}")
             
-            return result
+            return {
+                **did_document,
+                'private_key': private_key,  # User must store securely
+            }
             
         except Exception as e:
             logger.error(f"Error creating DID: {e}")
@@ -82,35 +111,118 @@ class DIDManager:
             if cached_doc:
                 return cached_doc
             
-            # TODO: Implement actual DID resolution via PRISM
-            logger.info(f"Resolving DID: {did}")
-            
-            # Mock resolution
-            if did.startswith(f"did:{self.did_method}:"):
-                doc = {
-                    'did': did,
-                    'public_key': f"pub_key_{did[-16:]}",
-                    'created_at': self._get_current_timestamp(),
-                }
+            doc = self._stored_documents([did]).get(did) or self._fetch_did_document(did)
+            if doc:
                 cache.set(f"did_{did}", doc, timeout=3600)
-                return doc
-            
-            # Support demo mock DID created by frontend hook
-            if did == 'did:prism:mock_demo_did':
-                doc = {
-                    'did': did,
-                    'public_key': 'pub_key_mock_demo',
-                    'created_at': self._get_current_timestamp(),
-                }
-                cache.set(f"did_{did}", doc, timeout=3600)
-                return doc
-
-            return None
+            return doc
             
         except Exception as e:
             logger.error(f"Error resolving DID: {e}")
             return None
     
+    def resolve_dids(self, dids: List[str]) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, str]]:
+        """
+        Resolve many DIDs at once
+        
+        Cached documents are read with a single get_many (one Redis MGET);
+        misses are read from the key registry in one query, the rest are
+        fetched upstream in parallel, and all are written back with one
+        set_many.
+        
+        Args:
+            dids: Decentralized identifiers (duplicates are ignored)
+            
+        Returns:
+            (documents, errors): documents keyed by DID, and an error message
+            keyed by DID for every DID that could not be resolved
+        """
+        documents: Dict[str, Dict[str, Any]] = {}
+        errors: Dict[str, str] = {}
+        
+        unique_dids = []
+        for did in dict.fromkeys(dids):
+            if DID_PATTERN.match(did or ''):
+                unique_dids.append(did)
+            else:
+                errors[did] = 'Invalid DID syntax'
+        
+        if not unique_dids:
+            return documents, errors
+        
+        try:
+            cached = cache.get_many([f"did_{did}" for did in unique_dids])
+        except Exception as e:
+            logger.error(f"Error reading DID cache: {e}")
+            cached = {}
+        
+        misses = []
+        for did in unique_dids:
+            doc = cached.get(f"did_{did}")
+            if doc:
+                documents[did] = doc
+            else:
+                misses.append(did)
+        
+        fetched = self._stored_documents(misses) if misses else {}
+        misses = [did for did in misses if did not in fetched]
+        
+        if misses:
+            logger.info(f"Resolving {len(misses)} unregistered DIDs")
+            
+            workers = min(settings.DID_RESOLVE_MAX_WORKERS, len(misses))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self._fetch_did_document, did): did for did in misses}
+                for future in as_completed(futures):
+                    did = futures[future]
+                    try:
+                        doc = future.result()
+                    except Exception as e:
+                        logger.error(f"Error resolving DID {did}: {e}")
+                        errors[did] = 'Resolution failed'
+                        continue
+                    if doc:
+                        fetched[did] = doc
+                    else:
+                        errors[did] = 'DID not found'
+        
+        if fetched:
+            documents.update(fetched)
+            try:
+                cache.set_many({f"did_{did}": doc for did, doc in fetched.items()}, timeout=3600)
+            except Exception as e:
+                logger.error(f"Error caching resolved DIDs: {e}")
+        
+        return documents, errors
+    
+    def _stored_documents(self, dids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """DID documents of registered keys, keyed by DID (bypasses the cache)"""
+        from .models import DIDKey
+        
+        return {key.did: key.to_document() for key in DIDKey.objects.filter(did__in=dids)}
+    
+    def _fetch_did_document(self, did: str) -> Optional[Dict[str, Any]]:
+        """
+        Fetch a DID document from the upstream registry (bypasses the cache)
+        
+        Returns:
+            DID document or None if the DID does not exist
+        """
+        # TODO: Implement actual DID resolution via PRISM
+        logger.info(f"Resolving DID: {did}")
+        
+        # Mock resolution: the DID is well-formed but has no registered
+        # verification key, so signatures against it never verify
+        if did.startswith(f"did:{self.did_method}:"):
+            return {
+                'did': did,
+                'public_key': None,
+                'key_type': None,
+                'key_version': 0,
+                'created_at': self._get_current_timestamp(),
+            }
+        
+        return None
+    
     def verify_did_signature(
         self,
         did: str,
@@ -123,35 +235,123 @@ class DIDManager:
         Args:
             did: Decentralized identifier
             message: Original message that was signed
-            signature: Signature to verify
+            signature: Signature to verify (hex or base64url)
             
         Returns:
             True if signature is valid, False otherwise
         """
+        return self.verify_and_resolve(did, message, signature) is not None
+    
+    def verify_and_resolve(
+        self,
+        did: str,
+        message: str,
+        signature: str
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Verify a signature and return the DID document it was checked against
+        
+        Lets authentication verify and obtain the document with a single
+        resolution.
+        
+        Returns:
+            DID document if the signature is valid, None otherwise
+        """
         try:
+            # Frontend demo identity, only honoured in demo mode
+            if did == DEMO_DID:
+                if settings.DID_DEMO_MODE and signature == DEMO_SIGNATURE:
+                    return {'did': did, 'public_key': None, 'key_type': None, 'key_version': 0}
+                return None
+            
             # Resolve DID to get public key
             did_doc = self.resolve_did(did)
             if not did_doc:
                 logger.warning(f"Could not resolve DID: {did}")
-                return False
+                return None
             
-            # TODO: Implement actual signature verification
-            logger.info(f"Verifying signature for DID: {did}")
+            public_key = self._get_public_key(did, did_doc)
+            if public_key is None:
+                logger.warning(f"DID has no verification key: {did}")
+                return None
             
-            # Mock verification: accept mock_demo signature and any signature for cached DIDs
-            if did == 'did:prism:mock_demo_did' and signature == 'mock_signature_for_demo_purposes_only':
-                return True
-
-            # If DID doc is cached (created by backend), accept any signature for demo/test
-            cached = cache.get(f"did_{did}")
-            if cached:
-                return True
-
-            return False
+            valid = keys.verify_signature(
+                did_doc['key_type'],
+                public_key,
+                message.encode('utf-8'),
+                keys.decode_signature(signature),
+            )
+            return did_doc if valid else None
         
         except Exception as e:
             logger.error(f"Error verifying DID signature: {e}")
-            return False
+            return None
+    
+    def verify_did_signatures(
+        self,
+        items: List[Tuple[str, str, str]]
+    ) -> List[bool]:
+        """
+        Verify a batch of (did, message, signature) triples
+        
+        Each distinct DID is resolved and its key decoded once for the whole
+        batch, which is what dominates cost for bulk-signed submissions.
+        
+        Args:
+            items: List of (did, message, signature) tuples
+            
+        Returns:
+            List of booleans in the same order as items
+        """
+        documents = {}
+        results = []
+        
+        for did, message, signature in items:
+            try:
+                if did == DEMO_DID:
+                    results.append(settings.DID_DEMO_MODE and signature == DEMO_SIGNATURE)
+                    continue
+                
+                if did not in documents:
+                    documents[did] = self.resolve_did(did)
+                did_doc = documents[did]
+                
+                public_key = self._get_public_key(did, did_doc) if did_doc else None
+                if public_key is None:
+                    results.append(False)
+                    continue
+                
+                results.append(keys.verify_signature(
+                    did_doc['key_type'],
+                    public_key,
+                    message.encode('utf-8'),
+                    keys.decode_signature(signature),
+                ))
+            except Exception as e:
+                logger.error(f"Error verifying DID signature in batch: {e}")
+                results.append(False)
+        
+        return results
+    
+    def parse_challenge(self, message: str) -> DIDChallenge:
+        """
+        Parse an X-DID-Message challenge
+        
+        Format: '<unix timestamp>[:<nonce>]', e.g. '1760868000:9f2c41d0'
+        
+        Raises:
+            ValueError: If the message is malformed
+        """
+        timestamp_part, _, nonce = message.partition(':')
+        timestamp = float(timestamp_part)
+        return DIDChallenge(timestamp=timestamp, nonce=nonce or None)
+    
+    def is_challenge_fresh(self, challenge: DIDChallenge, now: Optional[float] = None) -> bool:
+        """
+        Check that a challenge timestamp lies within the allowed clock window
+        """
+        now = time.time() if now is None else now
+        return abs(now - challenge.timestamp) <= self.message_max_age
     
     def update_did_document(
         self,
@@ -172,8 +372,18 @@ class DIDManager:
             # TODO: Implement actual DID document update via PRISM
             logger.info(f"Updating DID document: {did}")
             
+            if updates.get('public_key'):
+                from django.db.models import F
+                from .models import DIDKey
+                DIDKey.objects.filter(did=did).update(
+                    public_key=updates['public_key'],
+                    key_type=updates.get('key_type') or F('key_type'),
+                    key_version=F('key_version') + 1,
+                )
+            
             # Invalidate cache
             cache.delete(f"did_{did}")
+            self._evict_public_keys(did)
             
             return True
             
@@ -181,6 +391,39 @@ class DIDManager:
             logger.error(f"Error updating DID document: {e}")
             return False
     
+    def _get_public_key(self, did: str, did_doc: Dict[str, Any]) -> Any:
+        """
+        Get the decoded public key object for a DID document
+        
+        Key objects are cached per (DID, key version) so hex decoding and
+        curve point validation happen once per key rather than per request.
+        """
+        if not did_doc.get('public_key') or did_doc.get('key_type') not in keys.SUPPORTED_KEY_TYPES:
+            return None
+        
+        cache_key = (did, did_doc.get('key_version', 1))
+        
+        with self._key_cache_lock:
+            public_key = self._key_cache.get(cache_key)
+            if public_key is not None:
+                self._key_cache.move_to_end(cache_key)
+                return public_key
+        
+        public_key = keys.load_public_key(did_doc['key_type'], did_doc['public_key'])
+        
+        with self._key_cache_lock:
+            self._key_cache[cache_key] = public_key
+            while len(self._key_cache) > self._key_cache_size:
+                self._key_cache.popitem(last=False)
+        
+        return public_key
+    
+    def _evict_public_keys(self, did: str):
+        """Drop all cached key versions for a DID (e.g. after rotation)"""
+        with self._key_cache_lock:
+            for cache_key in [k for k in self._key_cache if k[0] == did]:
+                del self._key_cache[cache_key]
+    
     def _get_current_timestamp(self) -> str:
         """Get current timestamp in ISO 8601 format"""
         from datetime import datetime
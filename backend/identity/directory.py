@@ -0,0 +1,260 @@
+"""
+DID Directory
+Resolves a DID to (role, entity id, status) with an in-process cache invalidated across workers
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, NamedTuple, Tuple
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'did:directory:invalidate'
+INVALIDATE_ALL = '*'
+
+
+class DirectoryEntry(NamedTuple):
+    """Resolved identity for an authenticated DID"""
+    did: str
+    role: str  # 'patient' or 'provider'
+    entity_id: uuid.UUID
+    status: str  # 'active' or 'inactive'
+
+
+class DIDDirectory:
+    """
+    Looks up DID directory entries
+    
+    Hits are served from a bounded in-process cache, so authenticated
+    requests resolve identity without touching the database. Saves and
+    deletes invalidate through signals: locally at once and again when
+    the write commits, and with the 'redis' backend the commit is
+    published so every worker drops its copy, a deactivation included.
+    A subscriber that loses its connection clears its cache, and
+    DID_DIRECTORY_CACHE_TTL bounds anything still missed. Unknown DIDs are
+    cached briefly so registration becomes visible quickly everywhere.
+    
+    A per-DID generation counter keeps a lookup that read the database
+    before an invalidation from caching what it read.
+    """
+    
+    NEGATIVE_TTL = 5  # seconds
+    
+    def __init__(self, backend: str = 'redis'):
+        if backend not in ('redis', 'memory'):
+            raise ValueError(f"Unknown DID directory backend: {backend}")
+        
+        self.backend = backend
+        self.ttl = settings.DID_DIRECTORY_CACHE_TTL
+        self.max_size = settings.DID_DIRECTORY_CACHE_SIZE
+        self._cache: "OrderedDict[str, Tuple[Optional[DirectoryEntry], float]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        
+        self._client = None
+        self._subscriber = None
+    
+    def lookup(self, did: str) -> Optional[DirectoryEntry]:
+        """
+        Resolve a DID to its directory entry
+        
+        Args:
+            did: Decentralized identifier
+            
+        Returns:
+            DirectoryEntry or None if the DID is not registered
+        """
+        now = time.monotonic()
+        if self.backend == 'redis':
+            self._ensure_subscriber()
+        
+        with self._lock:
+            cached = self._cache.get(did)
+            if cached is not None and cached[1] > now:
+                self._cache.move_to_end(did)
+                return cached[0]
+            generation = self._generations.get(did, 0)
+        
+        from .models import DIDDirectoryEntry
+        
+        row = DIDDirectoryEntry.objects.filter(did=did).values_list(
+            'role', 'entity_id', 'status'
+        ).first()
+        entry = DirectoryEntry(did, *row) if row else None
+        
+        self._remember(did, entry, generation, now)
+        return entry
+    
+    def register(self, did: str, role: str, entity_id, active: bool = True):
+        """
+        Create or update the directory entry for a DID
+        
+        A DID already registered to a different entity keeps its existing
+        mapping; patients take precedence, matching the historical lookup order.
+        """
+        from .models import DIDDirectoryEntry
+        
+        status = 'active' if active else 'inactive'
+        existing = DIDDirectoryEntry.objects.filter(did=did).first()
+        
+        if existing and (existing.role, existing.entity_id) != (role, entity_id):
+            if existing.role == 'patient' and role != 'patient':
+                logger.warning(f"DID {did} already registered as patient; ignoring {role} {entity_id}")
+                return
+        
+        DIDDirectoryEntry.objects.update_or_create(
+            did=did,
+            defaults={'role': role, 'entity_id': entity_id, 'status': status},
+        )
+        
+        # An entity whose DID changed leaves a stale mapping behind
+        DIDDirectoryEntry.objects.filter(role=role, entity_id=entity_id).exclude(did=did).delete()
+        
+        self.invalidate(did)
+    
+    def remove(self, did: str, role: str, entity_id):
+        """Remove the directory entry for a deleted entity"""
+        from .models import DIDDirectoryEntry
+        
+        DIDDirectoryEntry.objects.filter(did=did, role=role, entity_id=entity_id).delete()
+        self.invalidate(did)
+    
+    def invalidate(self, did: str, publish: bool = True):
+        """
+        Drop a DID from this and (optionally) every worker's cache
+
+        Dropped now and again once the current transaction commits, when
+        the invalidation is also published; a worker that read the row
+        before the commit would otherwise cache the old status.
+        """
+        self._drop_local(did)
+        
+        def commit():
+            self._drop_local(did)
+            if publish:
+                self._publish(did)
+        
+        transaction.on_commit(commit)
+    
+    def rebuild(self) -> int:
+        """
+        Rebuild the directory from Patient and Practitioner tables
+        
+        Returns:
+            Number of entries written
+        """
+        from fhir.models import Patient, Practitioner
+        from .models import DIDDirectoryEntry
+        
+        entries = {}
+        for did, entity_id, active in Practitioner.objects.values_list('did', 'id', 'active').iterator():
+            entries[did] = DIDDirectoryEntry(did=did, role='provider', entity_id=entity_id,
+                                             status='active' if active else 'inactive')
+        # Patients overwrite providers sharing a DID
+        for did, entity_id, active in Patient.objects.values_list('did', 'id', 'active').iterator():
+            entries[did] = DIDDirectoryEntry(did=did, role='patient', entity_id=entity_id,
+                                             status='active' if active else 'inactive')
+        
+        with transaction.atomic():
+            DIDDirectoryEntry.objects.all().delete()
+            DIDDirectoryEntry.objects.bulk_create(entries.values(), batch_size=1000)
+        
+        self._clear_local()
+        self._publish(INVALIDATE_ALL)
+        
+        logger.info(f"Rebuilt DID directory with {len(entries)} entries")
+        
+        return len(entries)
+    
+    def _remember(self, did: str, entry: Optional[DirectoryEntry], generation: int, now: float):
+        ttl = self.ttl if entry else self.NEGATIVE_TTL
+        with self._lock:
+            # Invalidated while we were reading: the row may be stale
+            if self._generations.get(did, 0) != generation:
+                return
+            self._cache[did] = (entry, now + ttl)
+            self._cache.move_to_end(did)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+    
+    def _drop_local(self, did: str):
+        with self._lock:
+            self._cache.pop(did, None)
+            self._generations[did] = self._generations.get(did, 0) + 1
+    
+    def _clear_local(self):
+        with self._lock:
+            for did in self._cache:
+                self._generations[did] = self._generations.get(did, 0) + 1
+            self._cache.clear()
+    
+    # Redis tier
+    
+    def _redis(self):
+        if self._client is None:
+            from core.redis_client import get_redis_client
+            self._client = get_redis_client()
+        return self._client
+    
+    def _publish(self, did: str):
+        if self.backend != 'redis':
+            return
+        import redis
+        
+        try:
+            self._redis().publish(INVALIDATION_CHANNEL, did)
+        except redis.RedisError as e:
+            logger.error(f"Failed to publish DID directory invalidation: {e}")
+    
+    def _on_message(self, did: str):
+        if did == INVALIDATE_ALL:
+            self._clear_local()
+        else:
+            self._drop_local(did)
+    
+    def _ensure_subscriber(self):
+        if self._subscriber is not None:
+            return
+        with self._lock:
+            if self._subscriber is None:
+                self._subscriber = threading.Thread(
+                    target=self._listen, name='did-directory-invalidation', daemon=True
+                )
+                self._subscriber.start()
+    
+    def _listen(self):
+        import redis
+        
+        connected_before = False
+        while True:
+            try:
+                pubsub = self._redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Messages may have been missed while disconnected
+                if connected_before:
+                    self._clear_local()
+                connected_before = True
+                
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message['type'] == 'message':
+                        self._on_message(message['data'].decode())
+            except redis.RedisError as e:
+                logger.warning(f"DID directory invalidation subscriber disconnected: {e}")
+                self._clear_local()
+                time.sleep(1)
+
+
+# Singleton instance
+_did_directory = None
+
+def get_did_directory() -> DIDDirectory:
+    """Get singleton DID directory instance"""
+    global _did_directory
+    if _did_directory is None:
+        _did_directory = DIDDirectory(backend=settings.DID_DIRECTORY_BACKEND)
+    return _did_directory
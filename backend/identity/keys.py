@@ -0,0 +1,155 @@
+"""
+DID Key Material
+Ed25519 and secp256k1 key generation, encoding and signature verification
+"""
+import base64
+import binascii
+from typing import Any, Tuple
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    decode_dss_signature,
+    encode_dss_signature,
+)
+
+KEY_TYPE_ED25519 = 'Ed25519'
+KEY_TYPE_SECP256K1 = 'secp256k1'
+SUPPORTED_KEY_TYPES = (KEY_TYPE_ED25519, KEY_TYPE_SECP256K1)
+
+# Raw r||s signature length for secp256k1 (32-byte r and s)
+_SECP256K1_RAW_SIGNATURE_LENGTH = 64
+
+
+def generate_key_pair(key_type: str = KEY_TYPE_ED25519) -> Tuple[str, str]:
+    """
+    Generate a new key pair
+
+    Args:
+        key_type: 'Ed25519' or 'secp256k1'
+
+    Returns:
+        (public_key_hex, private_key_hex)
+        Ed25519 keys are raw 32-byte values, secp256k1 public keys are
+        compressed SEC1 points and private keys are 32-byte scalars
+    """
+    if key_type == KEY_TYPE_ED25519:
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        private_bytes = private_key.private_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PrivateFormat.Raw,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+        public_bytes = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw,
+        )
+    elif key_type == KEY_TYPE_SECP256K1:
+        private_key = ec.generate_private_key(ec.SECP256K1())
+        private_bytes = private_key.private_numbers().private_value.to_bytes(32, 'big')
+        public_bytes = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.X962,
+            format=serialization.PublicFormat.CompressedPoint,
+        )
+    else:
+        raise ValueError(f"Unsupported key type: {key_type}")
+
+    return public_bytes.hex(), private_bytes.hex()
+
+
+def load_public_key(key_type: str, public_key_hex: str) -> Any:
+    """
+    Decode a hex-encoded public key into a cryptography key object
+
+    Args:
+        key_type: 'Ed25519' or 'secp256k1'
+        public_key_hex: Hex-encoded public key
+
+    Returns:
+        Public key object usable with verify_signature
+    """
+    public_bytes = bytes.fromhex(public_key_hex)
+
+    if key_type == KEY_TYPE_ED25519:
+        return ed25519.Ed25519PublicKey.from_public_bytes(public_bytes)
+    if key_type == KEY_TYPE_SECP256K1:
+        return ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256K1(), public_bytes)
+
+    raise ValueError(f"Unsupported key type: {key_type}")
+
+
+def sign_message(key_type: str, private_key_hex: str, message: str) -> str:
+    """
+    Sign a message with a hex-encoded private key
+
+    Used by tests, benchmarks and reference clients; the backend itself
+    never holds patient private keys.
+
+    Returns:
+        Hex-encoded signature (raw r||s for secp256k1)
+    """
+    private_bytes = bytes.fromhex(private_key_hex)
+    data = message.encode('utf-8')
+
+    if key_type == KEY_TYPE_ED25519:
+        private_key = ed25519.Ed25519PrivateKey.from_private_bytes(private_bytes)
+        return private_key.sign(data).hex()
+
+    if key_type == KEY_TYPE_SECP256K1:
+        private_key = ec.derive_private_key(int.from_bytes(private_bytes, 'big'), ec.SECP256K1())
+        r, s = decode_dss_signature(private_key.sign(data, ec.ECDSA(hashes.SHA256())))
+        return (r.to_bytes(32, 'big') + s.to_bytes(32, 'big')).hex()
+
+    raise ValueError(f"Unsupported key type: {key_type}")
+
+
+def decode_signature(signature: str) -> bytes:
+    """
+    Decode a signature from the Authorization header
+
+    Accepts hex or base64url (padding optional).
+    """
+    try:
+        return bytes.fromhex(signature)
+    except ValueError:
+        pass
+
+    try:
+        padded = signature + '=' * (-len(signature) % 4)
+        return base64.urlsafe_b64decode(padded.encode('ascii'))
+    except (binascii.Error, UnicodeEncodeError) as e:
+        raise ValueError(f"Signature is neither hex nor base64url: {e}")
+
+
+def verify_signature(key_type: str, public_key: Any, message: bytes, signature: bytes) -> bool:
+    """
+    Verify a signature with an already-decoded public key object
+
+    Args:
+        key_type: 'Ed25519' or 'secp256k1'
+        public_key: Key object returned by load_public_key
+        message: Signed message bytes
+        signature: Raw signature bytes (DER or r||s for secp256k1)
+
+    Returns:
+        True if the signature is valid, False otherwise
+    """
+    try:
+        if key_type == KEY_TYPE_ED25519:
+            public_key.verify(signature, message)
+            return True
+
+        if key_type == KEY_TYPE_SECP256K1:
+            if len(signature) == _SECP256K1_RAW_SIGNATURE_LENGTH:
+                signature = encode_dss_signature(
+                    int.from_bytes(signature[:32], 'big'),
+                    int.from_bytes(signature[32:], 'big'),
+                )
+            public_key.verify(signature, message, ec.ECDSA(hashes.SHA256()))
+            return True
+
+    except (InvalidSignature, ValueError):
+        return False
+
+    raise ValueError(f"Unsupported key type: {key_type}")
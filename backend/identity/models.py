@@ -0,0 +1,66 @@
+"""
+Identity Models
+Materialized DID directory for single-lookup identity resolution, and registered DID keys
+"""
+from django.db import models
+
+
+class DIDDirectoryEntry(models.Model):
+    """
+    Maps a DID to the FHIR entity it authenticates as
+    Kept in sync with Patient and Practitioner by signals
+    """
+    did = models.CharField(max_length=255, primary_key=True)
+    
+    role = models.CharField(max_length=20, choices=[
+        ('patient', 'Patient'),
+        ('provider', 'Provider'),
+    ])
+    entity_id = models.UUIDField()
+    
+    status = models.CharField(max_length=20, choices=[
+        ('active', 'Active'),
+        ('inactive', 'Inactive'),
+    ], default='active')
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'did_directory'
+        indexes = [
+            models.Index(fields=['role', 'entity_id']),
+        ]
+    
+    def __str__(self):
+        return f"{self.did} -> {self.role} {self.entity_id}"
+
+
+class DIDKey(models.Model):
+    """
+    Registered verification key of a DID created by this service
+    The registry of record until PRISM resolution lands; the cache only fronts it
+    """
+    did = models.CharField(max_length=255, primary_key=True)
+    
+    public_key = models.TextField()  # hex
+    key_type = models.CharField(max_length=20)  # Ed25519 or secp256k1
+    key_version = models.PositiveIntegerField(default=1)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'did_keys'
+    
+    def __str__(self):
+        return f"{self.did} {self.key_type} key v{self.key_version}"
+    
+    def to_document(self) -> dict:
+        """DID document for the key, as cached by DIDManager"""
+        return {
+            'did': self.did,
+            'public_key': self.public_key,
+            'key_type': self.key_type,
+            'key_version': self.key_version,
+            'created_at': self.created_at.isoformat(),
+        }
@@ -0,0 +1,290 @@
+"""
+Replay Protection for DID Challenges
+Remembers seen (DID, nonce) pairs in time-bucketed Bloom filters of fixed size
+"""
+import contextlib
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Buckets that can hold an acceptable challenge at any moment are those whose
+# timestamps fall in [now - window, now + window]: at most three consecutive
+# windows. One spare slot lets the oldest bucket be recycled lazily.
+BUCKET_SLOTS = 4
+
+
+class BloomParameters:
+    """
+    Bloom filter sizing for a target capacity and false-positive rate
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        if capacity <= 0:
+            raise ValueError("Bloom filter capacity must be positive")
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("False-positive rate must be between 0 and 1")
+
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+
+        # Standard optimum: m = -n ln p / (ln 2)^2, k = (m / n) ln 2
+        bits = math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))
+        self.num_bits = (bits + 7) // 8 * 8
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+
+    @property
+    def num_bytes(self) -> int:
+        return self.num_bits // 8
+
+    def positions(self, item: bytes) -> List[int]:
+        """Bit positions for an item using Kirsch-Mitzenmacher double hashing"""
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def estimate_false_positive_rate(self, bits_set: int) -> float:
+        """Current false-positive probability given the number of set bits"""
+        return (bits_set / self.num_bits) ** self.num_hashes
+
+
+class RedisBloomBackend:
+    """
+    Bloom buckets stored as Redis bitmaps shared by every worker
+
+    A check is one pipelined round trip: k SETBITs (whose return values tell
+    whether the bits were already set) plus an EXPIREAT on the bucket key.
+    """
+
+    def __init__(self, params: BloomParameters, window: int, key_prefix: str = 'did_replay'):
+        from core.redis_client import get_redis_client
+
+        self.params = params
+        self.window = window
+        self.key_prefix = key_prefix
+        self.client = get_redis_client()
+
+    def _key(self, bucket: int) -> str:
+        return f"{self.key_prefix}:{self.params.num_bits}:{self.params.num_hashes}:{bucket}"
+
+    def test_and_set(self, bucket: int, positions: List[int]) -> bool:
+        key = self._key(bucket)
+        pipe = self.client.pipeline(transaction=False)
+        for position in positions:
+            pipe.setbit(key, position, 1)
+        pipe.expireat(key, (bucket + BUCKET_SLOTS - 1) * self.window)
+        previous = pipe.execute()[:-1]
+        return all(previous)
+
+    def bits_set(self, bucket: int) -> int:
+        return int(self.client.bitcount(self._key(bucket)))
+
+
+class SharedMemoryBloomBackend:
+    """
+    Bloom buckets in a fixed ring of memory slots
+
+    With a name, the ring lives in a POSIX shared memory segment so all
+    workers on a host share it; without one it is private to the process.
+    Layout: BUCKET_SLOTS 8-byte bucket epochs followed by BUCKET_SLOTS
+    bit arrays. A slot is cleared when a newer bucket claims it.
+
+    Every test-and-set, including claiming and clearing a slot, holds an
+    exclusive flock on a lock file next to the segment name, so two
+    workers can neither both accept one replayed challenge nor clear a
+    slot while the other is setting bits in it.
+    """
+
+    HEADER_BYTES = 8 * BUCKET_SLOTS
+
+    def __init__(self, params: BloomParameters, window: int, name: Optional[str] = None):
+        self.params = params
+        self.window = window
+        self._lock = threading.Lock()
+        self._shm = None
+        self._lock_file = None
+
+        size = self.HEADER_BYTES + BUCKET_SLOTS * params.num_bytes
+
+        if name:
+            segment = f"{name}_{params.num_bits}_{params.num_hashes}"
+            self.lock_path = os.path.join(tempfile.gettempdir(), f"{segment}.lock")
+            self._lock_file = open(self.lock_path, 'a')
+            self._shm = self._attach_shared_memory(segment, size)
+            self.buffer = self._shm.buf
+        else:
+            self.buffer = memoryview(bytearray(size))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Exclusive access across threads and, for a shared ring, across processes"""
+        with self._lock:
+            if self._lock_file is None:
+                yield
+                return
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _attach_shared_memory(self, name: str, size: int):
+        from multiprocessing import resource_tracker, shared_memory
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            shm = shared_memory.SharedMemory(name=name)
+
+        # The segment outlives individual workers; stop the resource tracker
+        # from unlinking it when this process exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+    def _read_epoch(self, slot: int) -> int:
+        return int.from_bytes(self.buffer[slot * 8:(slot + 1) * 8], 'little', signed=True)
+
+    def _write_epoch(self, slot: int, bucket: int):
+        self.buffer[slot * 8:(slot + 1) * 8] = bucket.to_bytes(8, 'little', signed=True)
+
+    def _slot_offset(self, slot: int) -> int:
+        return self.HEADER_BYTES + slot * self.params.num_bytes
+
+    def _claim_slot(self, bucket: int) -> int:
+        slot = bucket % BUCKET_SLOTS
+        if self._read_epoch(slot) != bucket:
+            offset = self._slot_offset(slot)
+            self.buffer[offset:offset + self.params.num_bytes] = bytes(self.params.num_bytes)
+            self._write_epoch(slot, bucket)
+        return slot
+
+    def test_and_set(self, bucket: int, positions: List[int]) -> bool:
+        with self._locked():
+            offset = self._slot_offset(self._claim_slot(bucket))
+            seen = True
+            for position in positions:
+                index = offset + (position >> 3)
+                mask = 1 << (position & 7)
+                byte = self.buffer[index]
+                if not byte & mask:
+                    seen = False
+                    self.buffer[index] = byte | mask
+            return seen
+
+    def bits_set(self, bucket: int) -> int:
+        slot = bucket % BUCKET_SLOTS
+        if self._read_epoch(slot) != bucket:
+            return 0
+        offset = self._slot_offset(slot)
+        return int.from_bytes(self.buffer[offset:offset + self.params.num_bytes], 'little').bit_count()
+
+
+class ReplayGuard:
+    """
+    Detects replayed X-DID-Message challenges
+
+    Each (DID, nonce) pair is recorded in the Bloom bucket for the window
+    containing the challenge timestamp. A replay carries the same signed
+    timestamp, so it always lands in the same bucket, and only one bucket is
+    touched per check. Memory is fixed at BUCKET_SLOTS filters regardless of
+    request rate; false positives (fresh nonces rejected) occur at the
+    configured rate while a bucket stays within capacity.
+    """
+
+    def __init__(
+        self,
+        backend: str = 'redis',
+        window: Optional[int] = None,
+        capacity: Optional[int] = None,
+        false_positive_rate: Optional[float] = None,
+        shared_memory_name: Optional[str] = None,
+    ):
+        self.window = window or settings.DID_AUTH_MESSAGE_MAX_AGE
+        self.params = BloomParameters(
+            capacity or settings.DID_REPLAY_CAPACITY,
+            false_positive_rate or settings.DID_REPLAY_FALSE_POSITIVE_RATE,
+        )
+        self.backend_name = backend
+
+        if backend == 'redis':
+            self.backend = RedisBloomBackend(self.params, self.window)
+        elif backend == 'shared_memory':
+            self.backend = SharedMemoryBloomBackend(
+                self.params, self.window, name=shared_memory_name or 'medblock_did_replay'
+            )
+        elif backend == 'memory':
+            self.backend = SharedMemoryBloomBackend(self.params, self.window)
+        else:
+            raise ValueError(f"Unknown replay guard backend: {backend}")
+
+        self.checks = 0
+        self.replays = 0
+
+    def _bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.window)
+
+    def check_and_record(self, did: str, nonce: str, timestamp: float) -> bool:
+        """
+        Record a challenge and report whether it is new
+
+        Args:
+            did: Authenticated DID
+            nonce: Challenge nonce
+            timestamp: Challenge timestamp (already checked for freshness)
+
+        Returns:
+            True if the (DID, nonce) pair has not been seen, False on replay
+        """
+        positions = self.params.positions(f"{did}\x00{nonce}".encode('utf-8'))
+        seen = self.backend.test_and_set(self._bucket(timestamp), positions)
+
+        self.checks += 1
+        if seen:
+            self.replays += 1
+            logger.warning(f"Replayed DID challenge rejected for {did}")
+
+        return not seen
+
+    def stats(self, now: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Report sizing, configured and estimated false-positive rates
+
+        The estimate is computed from the fill of the current bucket, so it
+        shows when traffic exceeds DID_REPLAY_CAPACITY.
+        """
+        bucket = self._bucket(time.time() if now is None else now)
+        bits_set = self.backend.bits_set(bucket)
+
+        return {
+            'backend': self.backend_name,
+            'window_seconds': self.window,
+            'capacity_per_bucket': self.params.capacity,
+            'bits_per_bucket': self.params.num_bits,
+            'hash_functions': self.params.num_hashes,
+            'memory_bytes': self.params.num_bytes * BUCKET_SLOTS,
+            'configured_false_positive_rate': self.params.false_positive_rate,
+            'current_bucket_fill': bits_set / self.params.num_bits,
+            'estimated_false_positive_rate': self.params.estimate_false_positive_rate(bits_set),
+            'checks': self.checks,
+            'replays_rejected': self.replays,
+        }
+
+
+# Singleton instance
+_replay_guard = None
+
+def get_replay_guard() -> ReplayGuard:
+    """Get singleton replay guard configured from settings"""
+    global _replay_guard
+    if _replay_guard is None:
+        _replay_guard = ReplayGuard(backend=settings.DID_REPLAY_BACKEND)
+    return _replay_guard
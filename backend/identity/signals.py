@@ -0,0 +1,34 @@
+"""
+Identity Signals
+Keeps the DID directory in sync with Patient and Practitioner records
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .directory import get_did_directory
+
+
+@receiver(post_save, sender='fhir.Patient')
+def register_patient_did(sender, instance, raw=False, **kwargs):
+    """Register or refresh a patient's DID"""
+    if raw:
+        return
+    get_did_directory().register(instance.did, 'patient', instance.id, active=instance.active)
+
+
+@receiver(post_save, sender='fhir.Practitioner')
+def register_practitioner_did(sender, instance, raw=False, **kwargs):
+    """Register or refresh a practitioner's DID"""
+    if raw:
+        return
+    get_did_directory().register(instance.did, 'provider', instance.id, active=instance.active)
+
+
+@receiver(post_delete, sender='fhir.Patient')
+def remove_patient_did(sender, instance, **kwargs):
+    get_did_directory().remove(instance.did, 'patient', instance.id)
+
+
+@receiver(post_delete, sender='fhir.Practitioner')
+def remove_practitioner_did(sender, instance, **kwargs):
+    get_did_directory().remove(instance.did, 'provider', instance.id)
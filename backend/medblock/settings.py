@@ -29,6 +29,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     
     # Third-party apps
     'rest_framework',
@@ -128,6 +129,44 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 50,
 }
 
+# Keyset-paginated listings
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', '500'))
+API_COUNT_CACHE_TTL = int(os.getenv('API_COUNT_CACHE_TTL', '60'))  # seconds
+API_STREAM_CHUNK_SIZE = int(os.getenv('API_STREAM_CHUNK_SIZE', '2000'))  # rows per server-side cursor fetch
+
+# FHIR Bundle processing
+FHIR_BUNDLE_MAX_ENTRIES = int(os.getenv('FHIR_BUNDLE_MAX_ENTRIES', '1000'))
+
+# Record anchoring: deferred records are anchored in batches by flush_anchors
+FHIR_DEFER_ANCHORING = os.getenv('FHIR_DEFER_ANCHORING', 'True') == 'True'
+FHIR_ANCHOR_BATCH_SIZE = int(os.getenv('FHIR_ANCHOR_BATCH_SIZE', '1000'))
+ANCHOR_SUBMITTER_DID = os.getenv('ANCHOR_SUBMITTER_DID', 'did:medblock:system')  # Submitter of deferred batches
+
+# Version history: every Nth version is stored whole, the rest as deltas
+FHIR_HISTORY_SNAPSHOT_INTERVAL = int(os.getenv('FHIR_HISTORY_SNAPSHOT_INTERVAL', '10'))
+
+# Device streams: readings are stored in hourly compressed chunks
+FHIR_STREAM_MAX_READINGS = int(os.getenv('FHIR_STREAM_MAX_READINGS', '10000'))  # per ingest request and per $readings response
+
+# Idempotency-Key on create endpoints: responses are replayed to retries for IDEMPOTENCY_KEY_TTL seconds
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', '86400'))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '60'))  # seconds a running request holds its key
+
+# Access audit buffering (1 writes the events after every request)
+AUDIT_BUFFER_SIZE = int(os.getenv('AUDIT_BUFFER_SIZE', '100'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '5'))  # seconds an event may wait
+AUDIT_BUFFER_MAX = int(os.getenv('AUDIT_BUFFER_MAX', '10000'))  # events held in memory while anchoring fails
+AUDIT_SPILL_DIR = os.getenv('AUDIT_SPILL_DIR', os.path.join(BASE_DIR, 'audit-spill'))  # where the rest go
+
+# FHIR search
+FHIR_SEARCH_ESTIMATE_TTL = int(os.getenv('FHIR_SEARCH_ESTIMATE_TTL', '300'))  # seconds planner row estimates are cached
+
+# FHIR Bulk Data $export
+FHIR_EXPORT_DIR = os.getenv('FHIR_EXPORT_DIR', os.path.join(BASE_DIR, 'exports'))
+FHIR_EXPORT_SYSTEM_DIDS = [did for did in os.getenv('FHIR_EXPORT_SYSTEM_DIDS', '').split(',') if did]  # May run system-level exports
+FHIR_EXPORT_REDACT_ELEMENTS = [e for e in os.getenv('FHIR_EXPORT_REDACT_ELEMENTS', '').split(',') if e]  # e.g. Patient.telecom,note
+FHIR_ENCRYPTED_ELEMENTS = [e for e in os.getenv('FHIR_ENCRYPTED_ELEMENTS', '').split(',') if e]  # Stored encrypted, decrypted on export
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = os.getenv('CORS_ALLOWED_ORIGINS', 'http://localhost:3000').split(',')
 CORS_ALLOW_CREDENTIALS = True
@@ -143,6 +182,30 @@ PRISM_NODE_URL = os.getenv('PRISM_NODE_URL', 'https://prism-node-preprod.atalapr
 PRISM_API_KEY = os.getenv('PRISM_API_KEY', '')
 PRISM_DID_METHOD = os.getenv('PRISM_DID_METHOD', 'prism')
 
+# DID authentication configuration
+DID_KEY_TYPE = os.getenv('DID_KEY_TYPE', 'Ed25519')  # Ed25519 or secp256k1
+DID_AUTH_MESSAGE_MAX_AGE = int(os.getenv('DID_AUTH_MESSAGE_MAX_AGE', '300'))  # seconds
+DID_KEY_CACHE_SIZE = int(os.getenv('DID_KEY_CACHE_SIZE', '10000'))
+DID_DEMO_MODE = os.getenv('DID_DEMO_MODE', str(DEBUG)) == 'True'
+DID_AUTH_REQUIRE_NONCE = os.getenv('DID_AUTH_REQUIRE_NONCE', 'True') == 'True'
+DID_RESOLVE_BATCH_MAX = int(os.getenv('DID_RESOLVE_BATCH_MAX', '100'))
+DID_RESOLVE_MAX_WORKERS = int(os.getenv('DID_RESOLVE_MAX_WORKERS', '8'))
+DID_DIRECTORY_BACKEND = os.getenv('DID_DIRECTORY_BACKEND', 'redis')  # redis (invalidations published) or memory
+DID_DIRECTORY_CACHE_TTL = int(os.getenv('DID_DIRECTORY_CACHE_TTL', '300'))  # seconds
+DID_DIRECTORY_CACHE_SIZE = int(os.getenv('DID_DIRECTORY_CACHE_SIZE', '50000'))
+
+# Replay protection for X-DID-Message challenges (Bloom filters per time window)
+DID_REPLAY_BACKEND = os.getenv('DID_REPLAY_BACKEND', 'redis')  # redis, shared_memory or memory
+DID_REPLAY_CAPACITY = int(os.getenv('DID_REPLAY_CAPACITY', '500000'))  # challenges per window
+DID_REPLAY_FALSE_POSITIVE_RATE = float(os.getenv('DID_REPLAY_FALSE_POSITIVE_RATE', '1e-6'))
+
+# Consent decision cache (redis: shared across workers with pub/sub invalidation, memory: per process)
+CONSENT_DECISION_BACKEND = os.getenv('CONSENT_DECISION_BACKEND', 'redis')
+CONSENT_DECISION_CACHE_TTL = int(os.getenv('CONSENT_DECISION_CACHE_TTL', '300'))  # seconds
+CONSENT_DECISION_LOCAL_TTL = int(os.getenv('CONSENT_DECISION_LOCAL_TTL', '30'))  # seconds, redis backend
+CONSENT_DECISION_CACHE_SIZE = int(os.getenv('CONSENT_DECISION_CACHE_SIZE', '50000'))  # patients
+CONSENT_BULK_MAX = int(os.getenv('CONSENT_BULK_MAX', '500'))  # grants or revocations per request
+
 # Encryption configuration
 DB_ENCRYPTION_KEY = os.getenv('DB_ENCRYPTION_KEY', '')
 HASH_ALGORITHM = os.getenv('HASH_ALGORITHM', 'SHA256')
@@ -112,3 +112,101 @@ class ObservationModelTests(TestCase):
         assert observation.id is not None
         assert observation.patient == patient
         assert observation.blockchain_hash is not None
+    
+    def test_keyset_pages_newest_first_with_undated_rows(self):
+        """Test that descending keyset pages cover every row, NULL dates included"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from api.pagination import paginate_keyset
+        
+        patient = Patient.objects.create(did='did:prism:pages', gender='female')
+        now = timezone.now()
+        for i in range(5):
+            Observation.objects.create(
+                patient=patient,
+                status='final',
+                code={'text': 'Heart rate'},
+                effective_datetime=None if i == 2 else now - timedelta(hours=i % 2),
+                blockchain_hash=f'page{i}',
+            )
+        
+        seen, cursor = [], None
+        while True:
+            page = paginate_keyset(Observation.objects.filter(patient=patient),
+                                   ordering=('-effective_datetime', '-id'), cursor=cursor, limit=2)
+            seen += [obs.id for obs in page.results]
+            cursor = page.next_cursor
+            if not cursor:
+                break
+        
+        assert len(seen) == len(set(seen)) == 5
+        assert Observation.objects.get(id=seen[0]).effective_datetime is None
+
+
+class ConditionalRequestTests(TestCase):
+    """Test ETag matching for conditional reads and updates"""
+    
+    def test_if_none_match_and_if_match(self):
+        """Test weak and strong forms, lists and '*'"""
+        from django.test import RequestFactory
+        from api.conditional import PreconditionFailed, check_if_match, etag, not_modified
+        
+        version = 'a' * 64
+        factory = RequestFactory()
+        
+        assert not_modified(factory.get('/', HTTP_IF_NONE_MATCH=etag(version)), version)
+        assert not_modified(factory.get('/', HTTP_IF_NONE_MATCH=f'"b", "{version}"'), version)
+        assert not_modified(factory.get('/', HTTP_IF_NONE_MATCH='*'), version)
+        assert not not_modified(factory.get('/', HTTP_IF_NONE_MATCH='W/"b"'), version)
+        assert not not_modified(factory.get('/'), version)
+        
+        check_if_match(factory.put('/'), version)
+        check_if_match(factory.put('/', HTTP_IF_MATCH=etag(version)), version)
+        with pytest.raises(PreconditionFailed):
+            check_if_match(factory.put('/', HTTP_IF_MATCH='W/"b"'), version)
+    
+    def test_update_anchors_only_stored_versions(self):
+        """Test that an amendment reaches the chain only after its compare-and-set is stored"""
+        from datetime import timedelta
+        from unittest import mock
+        from django.test import override_settings
+        from django.utils import timezone
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from api.conditional import etag
+        from api.endpoints.records import ObservationViewSet
+        from fhir.models import ConsentRecord, Practitioner, ResourceVersion
+        from identity import DIDUser
+        
+        patient = Patient.objects.create(did='did:prism:amend-patient', gender='female')
+        doctor = Practitioner.objects.create(did='did:prism:amend-doctor')
+        ConsentRecord.objects.create(patient=patient, practitioner=doctor, status='active',
+                                     expires_at=timezone.now() + timedelta(days=30), consent_tx_id='amend-consent')
+        observation = Observation(patient=patient, status='final', code={'text': 'HR'}, value_quantity={'value': 70})
+        observation.blockchain_hash = get_hash_manager().generate_record_hash(observation)
+        observation.save()
+        original = observation.blockchain_hash
+        
+        def amend(value, version):
+            request = APIRequestFactory().patch(f'/api/observations/{observation.id}/', {
+                'value_quantity': {'value': value},
+            }, format='json', HTTP_IF_MATCH=etag(version))
+            force_authenticate(request, user=DIDUser(doctor.did, role='provider', entity_id=doctor.id))
+            return ObservationViewSet.as_view({'patch': 'partial_update'})(request, pk=str(observation.id))
+        
+        with override_settings(FHIR_DEFER_ANCHORING=False), \
+                mock.patch('blockchain.cardano_client.CardanoClient.submit_record_batch',
+                           return_value='tx-amend') as submit, \
+                mock.patch('api.endpoints.records.get_audit_buffer'):
+            with self.captureOnCommitCallbacks(execute=True):
+                assert amend(72, 'stale').status_code == 412
+            assert not submit.called
+            
+            with self.captureOnCommitCallbacks(execute=True):
+                response = amend(72, original)
+            assert response.status_code == 200
+            assert submit.call_count == 1
+        
+        stored = Observation.objects.get(id=observation.id)
+        assert stored.blockchain_tx_id == 'tx-amend#0' and stored.blockchain_hash != original
+        latest = ResourceVersion.objects.filter(resource_id=observation.id).order_by('-version').first()
+        assert latest.blockchain_tx_id == 'tx-amend#0'
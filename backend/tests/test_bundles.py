@@ -0,0 +1,101 @@
+"""
+Tests for FHIR Bundle processing
+"""
+from django.test import TestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
+from api.endpoints.bundles import process_bundle as bundle_view
+from fhir.bundles import BundleError, process_bundle
+from fhir.models import Patient, Practitioner, Observation, DiagnosticReport
+from blockchain import get_hash_manager
+from identity import DIDUser
+
+
+class BundleTransactionTests(TestCase):
+    """Test transaction and batch Bundles"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:bundle-patient', gender='female')
+        self.lab = Practitioner.objects.create(did='did:prism:bundle-lab')
+
+    def _observation(self, full_url, text, **resource):
+        return {
+            'fullUrl': full_url,
+            'request': {'method': 'POST', 'url': 'Observation'},
+            'resource': {
+                'resourceType': 'Observation',
+                'status': 'final',
+                'code': {'text': text},
+                'subject': {'reference': f'Patient/{self.patient.id}'},
+                'performer': [{'reference': f'Practitioner/{self.lab.id}'}],
+                'effectiveDateTime': '2024-03-01T10:00:00+02:00',
+                **resource,
+            },
+        }
+
+    def test_panel_is_stored_and_anchored_once(self):
+        """Test that a panel with fullUrl references is one anchored batch"""
+        entries = [self._observation(f'urn:uuid:obs-{i}', f'Analyte {i}') for i in range(3)]
+        entries.append({
+            'request': {'method': 'POST', 'url': 'DiagnosticReport'},
+            'resource': {
+                'resourceType': 'DiagnosticReport',
+                'status': 'final',
+                'code': {'text': 'Panel'},
+                'subject': {'reference': f'Patient/{self.patient.id}'},
+                'result': [{'reference': entry['fullUrl']} for entry in entries],
+            },
+        })
+
+        # Anchored once the insert commits
+        with self.captureOnCommitCallbacks(execute=True):
+            result = process_bundle({'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries},
+                                    self.lab.did, defer_anchoring=False)
+            assert not Observation.objects.filter(blockchain_tx_id__isnull=False).exists()
+
+        assert result.bundle['type'] == 'transaction-response'
+        tx_ids = {e['response']['location']: None for e in result.bundle['entry']}
+        for model in (Observation, DiagnosticReport):
+            for row in model.objects.all():
+                tx_ids[f'{model.__name__}/{row.id}'] = row.blockchain_tx_id
+        tx_id = tx_ids[result.bundle['entry'][0]['response']['location']].partition('#')[0]
+        assert [tx_ids[e['response']['location']] for e in result.bundle['entry']] == [
+            f'{tx_id}#{i}' for i in range(4)
+        ]
+        report = DiagnosticReport.objects.get()
+        assert report.result.count() == 3
+
+        # Hashes computed before insert match the stored rows
+        hash_manager = get_hash_manager()
+        assert hash_manager.generate_record_hash(report) == report.blockchain_hash
+        for obs in Observation.objects.all():
+            assert hash_manager.generate_record_hash(obs) == obs.blockchain_hash
+
+    def test_transaction_is_all_or_nothing(self):
+        """Test that one invalid entry rejects a transaction but not a batch"""
+        entries = [
+            self._observation('urn:uuid:good', 'Glucose'),
+            self._observation('urn:uuid:bad', 'Sodium', status='unknown-status'),
+        ]
+
+        with self.assertRaises(BundleError) as raised:
+            process_bundle({'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries}, self.lab.did)
+        assert raised.exception.issues == [(1, 'Invalid status: unknown-status')]
+        assert not Observation.objects.exists()
+
+        result = process_bundle({'resourceType': 'Bundle', 'type': 'batch', 'entry': entries}, self.lab.did)
+        assert [e['response']['status'] for e in result.bundle['entry']] == ['201 Created', '400 Bad Request']
+        assert Observation.objects.count() == 1
+
+    def test_only_providers_submit_bundles(self):
+        """Test that a patient cannot write clinical records through a Bundle"""
+        bundle = {'resourceType': 'Bundle', 'type': 'transaction', 'entry': [self._observation('urn:uuid:a', 'K')]}
+
+        request = APIRequestFactory().post('/api/bundle/', bundle, format='json')
+        force_authenticate(request, user=DIDUser(self.patient.did, role='patient', entity_id=self.patient.id))
+        assert bundle_view(request).status_code == 403
+        assert not Observation.objects.exists()
+
+        request = APIRequestFactory().post('/api/bundle/', bundle, format='json')
+        force_authenticate(request, user=DIDUser(self.lab.did, role='provider', entity_id=self.lab.id))
+        assert bundle_view(request).status_code == 200
+        assert Observation.objects.count() == 1
@@ -0,0 +1,280 @@
+"""
+Consent tests for MEDBLOCK backend
+"""
+from datetime import datetime, timedelta
+from unittest import mock
+from django.test import TestCase
+from django.utils import timezone
+from api.pagination import paginate_keyset
+from fhir.models import Patient, Practitioner, Observation, ConsentRecord, CareTeam, CareTeamMember
+from fhir.consent_grants import ConsentGrant, grant_consents, revoke_consents
+from fhir.consent_decisions import ConsentDecisionService
+from fhir.consent_expiry import sweep_expired_consents
+from fhir.consent_scope import CompiledScope, compile_scope
+from fhir.signals import consent_expired
+
+
+class ConsentDecisionTests(TestCase):
+    """Test cached consent decisions"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:consent-patient', gender='female')
+        self.practitioner = Practitioner.objects.create(did='did:prism:consent-provider')
+        self.service = ConsentDecisionService(backend='memory')
+
+    def _grant(self, expires_in=timedelta(days=30)):
+        return ConsentRecord.objects.create(
+            patient=self.patient,
+            practitioner=self.practitioner,
+            status='active',
+            expires_at=timezone.now() + expires_in,
+            smart_contract_address='addr_test',
+            consent_tx_id=f'consent_tx_{timezone.now().timestamp()}',
+        )
+
+    def test_repeated_checks_skip_the_database(self):
+        """Test that a cached decision needs no consent query"""
+        consent = self._grant()
+
+        assert self.service.check(self.patient.id, self.practitioner.did).consent_id == consent.id
+
+        with self.assertNumQueries(0):
+            assert self.service.check(self.patient.id, self.practitioner.did).allowed
+
+        stats = self.service.stats()
+        assert stats['misses'] == 1
+        assert stats['local_hits'] == 1
+
+    def test_revoke_invalidates_decision(self):
+        """Test that saving a consent drops cached decisions for the patient"""
+        from fhir import consent_decisions
+
+        consent_decisions._consent_service = self.service
+        try:
+            consent = self._grant()
+            assert self.service.check(self.patient.id, self.practitioner.did).allowed
+
+            consent.status = 'revoked'
+            consent.save()
+
+            assert not self.service.check(self.patient.id, self.practitioner.did).allowed
+        finally:
+            consent_decisions._consent_service = None
+
+    def test_decision_ttl_is_capped_at_expiry(self):
+        """Test that a positive decision never outlives the consent"""
+        consent = self._grant(expires_in=timedelta(seconds=10))
+
+        decision = self.service.check(self.patient.id, self.practitioner.did)
+
+        assert decision.valid_until <= consent.expires_at.timestamp()
+
+
+class ConsentScopeTests(TestCase):
+    """Test compiled consent scopes"""
+
+    def test_scope_entries_compile_to_mask_ids_and_periods(self):
+        """Test resource-type, id and date-range grants"""
+        scope = compile_scope([
+            'DiagnosticReport',
+            'MedicationRequest/abc',
+            {'resource_type': 'Observation', 'start': '2024-01-01', 'end': '2024-01-31'},
+        ])
+        in_range = timezone.make_aware(datetime(2024, 1, 31, 23, 0))
+        out_of_range = timezone.make_aware(datetime(2024, 2, 1, 1, 0))
+
+        assert scope.allows('DiagnosticReport', 'any-id')
+        assert scope.allows('MedicationRequest', 'abc')
+        assert not scope.allows('MedicationRequest', 'other')
+        assert scope.allows('Observation', 'x', in_range)
+        assert not scope.allows('Observation', 'x', out_of_range)
+        assert not scope.allows('Encounter', 'x')
+        assert compile_scope([]).is_all
+
+        with self.assertRaises(ValueError):
+            compile_scope(['Unknown'])
+
+    def test_scope_filters_querysets(self):
+        """Test that the compiled scope restricts a queryset in SQL"""
+        patient = Patient.objects.create(did='did:prism:scope-patient', gender='male')
+        january = Observation.objects.create(
+            patient=patient, code={'text': 'a'}, blockchain_hash='a' * 64,
+            effective_datetime=timezone.make_aware(datetime(2024, 1, 15))
+        )
+        Observation.objects.create(
+            patient=patient, code={'text': 'b'}, blockchain_hash='b' * 64,
+            effective_datetime=timezone.make_aware(datetime(2024, 3, 15))
+        )
+        scope = compile_scope([{'resource_type': 'Observation', 'start': '2024-01-01', 'end': '2024-01-31'}])
+
+        assert list(scope.filter(Observation.objects.all())) == [january]
+        assert not compile_scope(['Encounter']).filter(Observation.objects.all()).exists()
+        assert CompiledScope.from_json(scope.to_json()) == scope
+
+
+class ConsentExpiryTests(TestCase):
+    """Test the consent expiry sweeper"""
+
+    def test_sweep_expires_lapsed_consents_in_batches(self):
+        """Test that only lapsed active consents change and events are sent"""
+        patient = Patient.objects.create(did='did:prism:expiry-patient', gender='female')
+        practitioner = Practitioner.objects.create(did='did:prism:expiry-provider')
+        now = timezone.now()
+        for i, offset in enumerate([-3, -2, -1, 1]):
+            ConsentRecord.objects.create(
+                patient=patient, practitioner=practitioner, status='active',
+                expires_at=now + timedelta(hours=offset),
+                smart_contract_address='addr_test', consent_tx_id=f'expiry_tx_{i}',
+            )
+        received = []
+
+        def on_expired(sender, consents, **kwargs):
+            received.extend(consents)
+
+        consent_expired.connect(on_expired)
+        self.addCleanup(consent_expired.disconnect, on_expired)
+
+        assert sweep_expired_consents(batch_size=2, now=now) == 3
+
+        assert len(received) == 3
+        assert ConsentRecord.objects.filter(status='expired').count() == 3
+        assert ConsentRecord.objects.active(now).count() == 1
+        assert sweep_expired_consents(batch_size=2, now=now) == 0
+
+
+class ConsentListingTests(TestCase):
+    """Test keyset pagination of consents"""
+
+    def test_pages_follow_expiry_order_with_joined_dids(self):
+        """Test that each page is one query and pages do not overlap"""
+        patient = Patient.objects.create(did='did:prism:listing-patient', gender='female')
+        practitioner = Practitioner.objects.create(did='did:prism:listing-provider')
+        expires_at = timezone.now() + timedelta(days=1)
+        for i in range(5):
+            # Shared expiry forces the id tie-breaker
+            ConsentRecord.objects.create(
+                patient=patient, practitioner=practitioner, status='active',
+                expires_at=expires_at if i < 3 else expires_at + timedelta(hours=i),
+                smart_contract_address='addr_test', consent_tx_id=f'listing_tx_{i}',
+            )
+        consents = ConsentRecord.objects.active().filter(patient=patient)
+
+        seen = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page = paginate_keyset(consents, ('expires_at', 'id'), cursor, limit=2,
+                                       values=('id', 'patient__did', 'practitioner__did'))
+            seen.extend(page.results)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+
+        expected = list(consents.order_by('expires_at', 'id').values_list('id', flat=True))
+        assert [row['id'] for row in seen] == expected
+        assert seen[0]['practitioner__did'] == practitioner.did
+
+
+class GroupConsentTests(TestCase):
+    """Test consents granted to care teams and organizations"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:group-patient', gender='female')
+        self.nurse = Practitioner.objects.create(did='did:prism:group-nurse')
+        self.outsider = Practitioner.objects.create(did='did:prism:group-outsider')
+        self.ward = CareTeam.objects.create(name='Ward 7')
+        self.membership = CareTeamMember.objects.create(care_team=self.ward, practitioner=self.nurse)
+        self.service = ConsentDecisionService(backend='memory')
+
+    def test_bulk_grant_is_anchored_once(self):
+        """Test that a batch shares one anchor tx with unique per-row ids"""
+        expires_at = timezone.now() + timedelta(days=1)
+        grants = [
+            ConsentGrant('care_team', self.ward.id, ['all'], expires_at),
+            ConsentGrant('practitioner', self.outsider.id, ['Observation'], expires_at),
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            consents, tx_id = grant_consents(self.patient.id, self.patient.did, grants)
+            # Anchored only once the rows are committed
+            assert tx_id is None and consents[0].consent_tx_id == f'pending:{consents[0].id}'
+
+        stored = ConsentRecord.objects.filter(patient=self.patient).order_by('consent_tx_id')
+        tx_id = stored[0].consent_tx_id.partition('#')[0]
+        assert [c.consent_tx_id for c in stored] == [f'{tx_id}#0', f'{tx_id}#1']
+
+    def test_team_membership_is_resolved_at_check_time(self):
+        """Test that team consents follow membership changes"""
+        from fhir import consent_decisions
+
+        consent_decisions._consent_service = self.service
+        self.addCleanup(setattr, consent_decisions, '_consent_service', None)
+        grant_consents(self.patient.id, self.patient.did, [
+            ConsentGrant('care_team', self.ward.id, ['all'], timezone.now() + timedelta(days=1)),
+        ])
+
+        assert self.service.check(self.patient.id, self.nurse.did).allowed
+        assert not self.service.check(self.patient.id, self.outsider.did).allowed
+
+        self.membership.active = False
+        self.membership.save()
+
+        assert not self.service.check(self.patient.id, self.nurse.did).allowed
+
+    def test_bulk_revoke_only_touches_own_consents(self):
+        """Test that bulk revoke ignores other patients' consents"""
+        other = Patient.objects.create(did='did:prism:group-other', gender='male')
+        expires_at = timezone.now() + timedelta(days=1)
+        mine, _ = grant_consents(self.patient.id, self.patient.did, [
+            ConsentGrant('care_team', self.ward.id, ['all'], expires_at),
+        ])
+        theirs, _ = grant_consents(other.id, other.did, [
+            ConsentGrant('care_team', self.ward.id, ['all'], expires_at),
+        ])
+
+        with mock.patch('blockchain.cardano_client.CardanoClient.submit_consent_batch') as submit, \
+                self.captureOnCommitCallbacks(execute=True):
+            revoked, _ = revoke_consents(self.patient.id, self.patient.did, [mine[0].id, theirs[0].id])
+            assert not submit.called
+
+        assert revoked == [mine[0].id]
+        assert submit.call_count == 1 and submit.call_args.kwargs['count'] == 1
+        assert ConsentRecord.objects.get(id=theirs[0].id).status == 'active'
+
+
+class AuthorizedRecordTests(TestCase):
+    """Test the single-query authorized record fetch"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:authz-patient', gender='female')
+        self.doctor = Practitioner.objects.create(did='did:prism:authz-doctor')
+        self.observation = Observation.objects.create(
+            patient=self.patient, status='final', code={'text': 'Heart rate'},
+            effective_datetime=timezone.now(), blockchain_hash='authz-0',
+        )
+
+    def _fetch(self, did):
+        from api.authorization import with_consent_grants, consent_decision
+
+        observation = with_consent_grants(Observation.objects.all(), did).get(id=self.observation.id)
+        return observation, consent_decision(observation.consent_grants)
+
+    def test_record_patient_and_consent_in_one_query(self):
+        """Test that the record, patient DID and consent come back together"""
+        consents, _ = grant_consents(self.patient.id, self.patient.did, [
+            ConsentGrant('practitioner', self.doctor.id, ['Observation'], timezone.now() + timedelta(days=1)),
+        ])
+
+        with self.assertNumQueries(1):
+            observation, decision = self._fetch(self.doctor.did)
+            assert observation.patient.did == self.patient.did
+
+        assert decision.allowed
+        assert decision.consent_id == consents[0].id
+        assert decision.allows(observation)
+
+    def test_no_consent_is_denied(self):
+        """Test that a caller without consent gets an empty grant list"""
+        observation, decision = self._fetch('did:prism:authz-stranger')
+
+        assert observation.consent_grants is None
+        assert not decision.allowed
@@ -0,0 +1,70 @@
+"""
+Tests for Patient $everything
+"""
+from datetime import datetime, timedelta, timezone
+from django.test import TestCase
+from django.utils import timezone as django_timezone
+from api.endpoints.everything import EVERYTHING_TYPES, load_everything
+from fhir.models import Patient, Practitioner, Observation, DiagnosticReport
+from fhir.consent_grants import ConsentGrant, grant_consents
+from fhir.consent_scope import compile_scope
+
+
+class PatientEverythingTests(TestCase):
+    """Test prefetched, per-type paging of a patient's chart"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:everything', gender='female')
+        self.doctor = Practitioner.objects.create(did='did:prism:everything-doctor')
+        self.observations = [
+            Observation.objects.create(
+                patient=self.patient, status='final', code={'text': 'Heart rate'},
+                effective_datetime=datetime(2024, 3, 1 + i, tzinfo=timezone.utc), blockchain_hash=f'everything{i}',
+            )
+            for i in range(5)
+        ]
+        report = DiagnosticReport.objects.create(
+            patient=self.patient, status='final', code={'text': 'Panel'},
+            effective_datetime=datetime(2024, 3, 6, tzinfo=timezone.utc), blockchain_hash='everything-report',
+        )
+        report.result.set(self.observations[:2])
+
+    def test_query_count_does_not_grow_with_the_chart(self):
+        """Test one query per type, plus the patient and report results"""
+        with self.assertNumQueries(7):
+            patient, pages = load_everything(self.patient.id, list(EVERYTHING_TYPES), limit=50)
+            assert len(pages['DiagnosticReport'].results[0].result.all()) == 2
+
+        assert patient.id == self.patient.id
+        assert len(pages['Observation'].results) == 5
+
+    def test_types_page_independently(self):
+        """Test that each type carries its own cursor"""
+        _, pages = load_everything(self.patient.id, ['Observation', 'DiagnosticReport'], limit=2)
+        assert pages['Observation'].next_cursor is not None
+        assert pages['DiagnosticReport'].next_cursor is None
+
+        _, pages = load_everything(self.patient.id, ['Observation'], limit=2,
+                                   cursors={'Observation': pages['Observation'].next_cursor})
+        assert [o.id for o in pages['Observation'].results] == [o.id for o in self.observations[2:0:-1]]
+
+    def test_provider_sees_consented_types_and_own_consents(self):
+        """Test that scope filters clinical types and consents are the caller's"""
+        grant_consents(self.patient.id, self.patient.did, [
+            ConsentGrant('practitioner', self.doctor.id, ['DiagnosticReport'],
+                         django_timezone.now() + timedelta(days=1)),
+        ])
+
+        _, pages = load_everything(
+            self.patient.id, list(EVERYTHING_TYPES), limit=50,
+            scope=compile_scope(['DiagnosticReport']), accessor_did=self.doctor.did,
+        )
+        assert pages['Observation'].results == []
+        assert len(pages['DiagnosticReport'].results) == 1
+        assert len(pages['Consent'].results) == 1
+
+        _, pages = load_everything(
+            self.patient.id, ['Consent'], limit=50,
+            scope=compile_scope(['all']), accessor_did='did:prism:someone-else',
+        )
+        assert pages['Consent'].results == []
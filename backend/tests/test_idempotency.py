@@ -0,0 +1,158 @@
+"""
+Tests for Idempotency-Key replay and hash upserts on create endpoints
+"""
+from types import SimpleNamespace
+from unittest import mock
+from datetime import timedelta
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from api.endpoints.bundles import process_bundle as bundle_view
+from api.endpoints.records import ObservationViewSet
+from api.idempotency import get_idempotency_store, request_fingerprint
+from fhir import bundles
+from fhir.bundles import process_bundle
+from fhir.models import ConsentRecord, DiagnosticReport, Observation, Patient, Practitioner
+from identity import DIDUser
+
+
+class IdempotencyKeyTests(TestCase):
+    """Test replayed, conflicting and in-flight retries"""
+
+    def setUp(self):
+        cache.clear()
+        self.patient = Patient.objects.create(did='did:prism:retry-patient', gender='female')
+        self.doctor = Practitioner.objects.create(did='did:prism:retry-doctor')
+        self.user = DIDUser(self.doctor.did, role='provider', entity_id=self.doctor.id)
+        self.create = ObservationViewSet.as_view({'post': 'create'})
+
+    def _post(self, body, key=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        request = APIRequestFactory().post('/api/observations/', body, format='json', **headers)
+        force_authenticate(request, user=self.user)
+        return self.create(request)
+
+    def _body(self, value):
+        # No effective_datetime: each request gets the current time, so only the key dedupes
+        return {'patient_id': str(self.patient.id), 'code': {'text': 'Glucose'}, 'value_quantity': {'value': value}}
+
+    def test_retry_replays_without_creating(self):
+        """Test that a retry gets the original response and stores nothing"""
+        first = self._post(self._body(5.4), key='retry-1')
+        retry = self._post(self._body(5.4), key='retry-1')
+
+        assert first.status_code == retry.status_code == 201
+        assert retry.data == first.data and retry['Idempotent-Replayed'] == 'true'
+        assert Observation.objects.count() == 1
+
+        assert self._post(self._body(6.1), key='retry-1').status_code == 422
+        assert self._post(self._body(5.4)).status_code == 201
+        assert Observation.objects.count() == 2
+
+    def test_in_flight_key_is_a_conflict(self):
+        """Test that a retry racing the first request gets 409 instead of running"""
+        store = get_idempotency_store()
+        fingerprint = request_fingerprint(SimpleNamespace(data=self._body(7.0)))
+        assert store.claim(store.cache_key(self.doctor.did, 'POST', '/api/observations/', 'slow'),
+                           fingerprint) is None
+
+        response = self._post(self._body(7.0), key='slow')
+        assert response.status_code == 409 and response['Retry-After']
+        assert not Observation.objects.exists()
+
+    def test_bundle_view_replays_response(self):
+        """Test that the bundle endpoint replays too"""
+        bundle = {'resourceType': 'Bundle', 'type': 'batch', 'entry': [{
+            'request': {'method': 'POST', 'url': 'Observation'},
+            'resource': {'resourceType': 'Observation', 'status': 'final', 'code': {'text': 'K'},
+                         'subject': {'reference': f'Patient/{self.patient.id}'}},
+        }]}
+        responses = []
+        for _ in range(2):
+            request = APIRequestFactory().post('/api/bundle/', bundle, format='json', HTTP_IDEMPOTENCY_KEY='b-1')
+            force_authenticate(request, user=self.user)
+            responses.append(bundle_view(request))
+        assert responses[0].data == responses[1].data and responses[1]['Idempotent-Replayed'] == 'true'
+        assert Observation.objects.count() == 1
+
+
+class HashUpsertTests(TestCase):
+    """Test that resent records match stored ones instead of failing or anchoring again"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:upsert-patient', gender='male')
+        self.lab = Practitioner.objects.create(did='did:prism:upsert-lab')
+        ConsentRecord.objects.create(
+            patient=self.patient, practitioner=self.lab, status='active',
+            expires_at=timezone.now() + timedelta(days=30), consent_tx_id='upsert-consent',
+        )
+
+    def _panel(self):
+        subject = {'reference': f'Patient/{self.patient.id}'}
+        entries = [{
+            'fullUrl': f'urn:uuid:analyte-{i}',
+            'request': {'method': 'POST', 'url': 'Observation'},
+            'resource': {'resourceType': 'Observation', 'status': 'final', 'code': {'text': f'Analyte {i}'},
+                         'subject': subject, 'effectiveDateTime': '2024-03-01T10:00:00Z'},
+        } for i in range(2)]
+        entries.append({
+            'request': {'method': 'POST', 'url': 'DiagnosticReport'},
+            'resource': {'resourceType': 'DiagnosticReport', 'status': 'final', 'code': {'text': 'Panel'},
+                         'subject': subject, 'result': [{'reference': e['fullUrl']} for e in entries]},
+        })
+        return {'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries}
+
+    def test_resent_bundle_matches_stored_records(self):
+        """Test that a resent panel, references included, is answered from the stored rows"""
+        first = process_bundle(self._panel(), self.lab.did)
+        resent = process_bundle(self._panel(), self.lab.did, defer_anchoring=False)
+
+        assert resent.tx_id is None
+        assert [e['response']['status'] for e in resent.bundle['entry']] == ['200 OK'] * 3
+        assert [e['response']['location'] for e in resent.bundle['entry']] == [
+            e['response']['location'] for e in first.bundle['entry']
+        ]
+        assert Observation.objects.count() == 2 and DiagnosticReport.objects.count() == 1
+
+        # A new report over the stored analytes points at them
+        panel = self._panel()
+        panel['entry'][2]['resource']['code'] = {'text': 'Panel, repeated'}
+        result = process_bundle(panel, self.lab.did)
+        assert [e['response']['status'] for e in result.bundle['entry']] == ['200 OK', '200 OK', '201 Created']
+        assert DiagnosticReport.objects.get(code={'text': 'Panel, repeated'}).result.count() == 2
+        assert Observation.objects.count() == 2
+
+    def test_match_is_hidden_without_consent(self):
+        """Test that a provider without consent cannot learn that a record exists"""
+        process_bundle(self._panel(), self.lab.did)
+        other = Practitioner.objects.create(did='did:prism:upsert-other')
+
+        panel = self._panel()
+        panel['type'] = 'batch'
+        result = process_bundle(panel, other.did)
+        responses = [e['response'] for e in result.bundle['entry']]
+        assert [r['status'] for r in responses] == ['409 Conflict', '409 Conflict', '400 Bad Request']
+        assert not any('location' in r for r in responses)
+        assert Observation.objects.count() == 2
+
+    def test_insert_conflict_anchors_nothing(self):
+        """Test that a row stored concurrently rolls the attempt back before anything is anchored"""
+        process_bundle(self._panel(), self.lab.did, defer_anchoring=True)
+
+        # As if the concurrent request committed just after the hash lookup
+        lookup = bundles._duplicate_hashes
+        calls = []
+
+        def late_lookup(mapped, hashes):
+            calls.append(1)
+            return ({}, {}) if len(calls) == 1 else lookup(mapped, hashes)
+
+        with mock.patch.object(bundles, '_duplicate_hashes', late_lookup), \
+                mock.patch('blockchain.cardano_client.CardanoClient.submit_record_batch') as submit, \
+                self.captureOnCommitCallbacks(execute=True):
+            result = process_bundle(self._panel(), self.lab.did, defer_anchoring=False)
+
+        assert [e['response']['status'] for e in result.bundle['entry']] == ['200 OK'] * 3
+        assert not submit.called
+        assert Observation.objects.count() == 2
@@ -0,0 +1,290 @@
+"""
+Identity tests for MEDBLOCK backend
+"""
+import fcntl
+import os
+import threading
+import time
+from unittest import mock
+from django.test import RequestFactory, TestCase
+from rest_framework import exceptions
+from identity import keys
+from identity.auth_middleware import DIDAuthenticationMiddleware
+from identity.authentication import DIDAuthentication
+from identity.did_manager import DIDManager
+from identity.replay import ReplayGuard
+from identity import get_did_directory, get_did_manager
+from fhir.models import Patient, Practitioner
+
+
+class DIDSignatureTests(TestCase):
+    """Test DID key generation and signature verification"""
+
+    def _signed(self, did_info, message):
+        return keys.sign_message(did_info['key_type'], did_info['private_key'], message)
+
+    def test_valid_signature_verifies_for_each_key_type(self):
+        """Test Ed25519 and secp256k1 signatures round-trip"""
+        did_manager = DIDManager()
+
+        for key_type in keys.SUPPORTED_KEY_TYPES:
+            did_info = did_manager.create_did(entity_type='patient', key_type=key_type)
+            message = f"{int(time.time())}:abc123"
+
+            assert did_manager.verify_did_signature(did_info['did'], message, self._signed(did_info, message))
+
+    def test_wrong_message_or_key_is_rejected(self):
+        """Test that signatures do not verify against other messages or DIDs"""
+        did_manager = DIDManager()
+        alice = did_manager.create_did(entity_type='patient')
+        bob = did_manager.create_did(entity_type='patient')
+        signature = self._signed(alice, '1700000000:n1')
+
+        assert not did_manager.verify_did_signature(alice['did'], '1700000000:n2', signature)
+        assert not did_manager.verify_did_signature(bob['did'], '1700000000:n1', signature)
+        assert not did_manager.verify_did_signature(alice['did'], '1700000000:n1', 'not-a-signature')
+
+    def test_unregistered_did_has_no_key(self):
+        """Test that mock-resolved DIDs never verify"""
+        did_manager = DIDManager()
+
+        assert not did_manager.verify_did_signature('did:prism:unknown', '1700000000', 'ab' * 64)
+
+    def test_keys_survive_a_cache_flush(self):
+        """Test that registered keys are read back from the database once the cache is emptied"""
+        from django.core.cache import cache
+
+        did_manager = DIDManager()
+        did_info = did_manager.create_did(entity_type='patient')
+        signature = self._signed(did_info, '1700000000:flush')
+        cache.clear()
+
+        assert did_manager.verify_did_signature(did_info['did'], '1700000000:flush', signature)
+        cache.clear()
+        documents, errors = did_manager.resolve_dids([did_info['did']])
+        assert documents[did_info['did']]['public_key'] == did_info['public_key'] and not errors
+
+    def test_batch_verification(self):
+        """Test batch verification preserves order"""
+        did_manager = DIDManager()
+        did_info = did_manager.create_did(entity_type='provider')
+        good = self._signed(did_info, '1:a')
+
+        results = did_manager.verify_did_signatures([
+            (did_info['did'], '1:a', good),
+            (did_info['did'], '1:b', good),
+            ('did:prism:unknown', '1:a', good),
+        ])
+
+        assert results == [True, False, False]
+
+    def test_challenge_freshness(self):
+        """Test X-DID-Message parsing and timestamp window"""
+        did_manager = DIDManager()
+        now = time.time()
+
+        challenge = did_manager.parse_challenge(f"{int(now)}:nonce-1")
+        assert challenge.nonce == 'nonce-1'
+        assert did_manager.is_challenge_fresh(challenge, now=now)
+
+        stale = did_manager.parse_challenge(str(int(now - did_manager.message_max_age - 1)))
+        assert stale.nonce is None
+        assert not did_manager.is_challenge_fresh(stale, now=now)
+
+        with self.assertRaises(ValueError):
+            did_manager.parse_challenge('not-a-timestamp')
+
+
+class ReplayGuardTests(TestCase):
+    """Test Bloom-filter replay protection"""
+
+    def test_replay_is_rejected(self):
+        """Test that a (DID, nonce) pair is accepted once per window"""
+        replay_guard = ReplayGuard(backend='memory', window=300, capacity=1000, false_positive_rate=1e-6)
+        now = time.time()
+
+        assert replay_guard.check_and_record('did:prism:a', 'n1', now)
+        assert not replay_guard.check_and_record('did:prism:a', 'n1', now)
+        assert replay_guard.check_and_record('did:prism:b', 'n1', now)
+        assert replay_guard.check_and_record('did:prism:a', 'n2', now)
+
+    def test_bucket_slots_are_recycled(self):
+        """Test that old buckets are cleared instead of growing memory"""
+        replay_guard = ReplayGuard(backend='memory', window=10, capacity=100, false_positive_rate=1e-3)
+
+        assert replay_guard.check_and_record('did:prism:a', 'n1', 1000)
+        # Four windows later the slot is reused for a new bucket
+        assert replay_guard.check_and_record('did:prism:a', 'n1', 1040)
+
+    def test_stats_report_false_positive_rates(self):
+        """Test that configured and estimated FP rates are reported"""
+        replay_guard = ReplayGuard(backend='memory', window=300, capacity=1000, false_positive_rate=1e-4)
+        now = time.time()
+        for i in range(500):
+            replay_guard.check_and_record('did:prism:a', f'n{i}', now)
+
+        stats = replay_guard.stats(now=now)
+
+        assert stats['configured_false_positive_rate'] == 1e-4
+        assert 0 < stats['estimated_false_positive_rate'] < 1e-4
+        assert stats['checks'] == 500
+
+    def test_shared_ring_is_locked_across_workers(self):
+        """Test that workers sharing a ring wait for each other's lock and see each other's entries"""
+        options = dict(backend='shared_memory', window=300, capacity=1000, false_positive_rate=1e-6,
+                       shared_memory_name=f'medblock_test_replay_{os.getpid()}')
+        guard, other_worker = ReplayGuard(**options), ReplayGuard(**options)
+        self.addCleanup(os.remove, guard.backend.lock_path)
+        self.addCleanup(guard.backend._shm.unlink)
+        now = time.time()
+
+        results = []
+        with open(guard.backend.lock_path) as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            worker = threading.Thread(target=lambda: results.append(
+                other_worker.check_and_record('did:prism:a', 'n1', now)))
+            worker.start()
+            worker.join(0.2)
+            assert worker.is_alive() and not results
+            fcntl.flock(held, fcntl.LOCK_UN)
+        worker.join()
+
+        assert results == [True]
+        assert not guard.check_and_record('did:prism:a', 'n1', now)
+
+
+class DIDDirectoryTests(TestCase):
+    """Test DID directory synchronisation"""
+
+    def test_directory_tracks_patients_and_practitioners(self):
+        """Test that saves and deletes keep the directory in sync"""
+        directory = get_did_directory()
+        patient = Patient.objects.create(did='did:prism:dir-patient', gender='female')
+        practitioner = Practitioner.objects.create(did='did:prism:dir-provider')
+
+        entry = directory.lookup(patient.did)
+        assert entry.role == 'patient'
+        assert entry.entity_id == patient.id
+        assert directory.lookup(practitioner.did).role == 'provider'
+
+        patient.active = False
+        patient.save()
+        assert directory.lookup(patient.did).status == 'inactive'
+
+        practitioner.delete()
+        assert directory.lookup('did:prism:dir-provider') is None
+
+    def test_cached_lookup_needs_no_queries(self):
+        """Test that repeated lookups are served from process memory"""
+        directory = get_did_directory()
+        patient = Patient.objects.create(did='did:prism:dir-cached', gender='male')
+        directory.lookup(patient.did)
+
+        with self.assertNumQueries(0):
+            assert directory.lookup(patient.did).entity_id == patient.id
+
+
+    def test_deactivation_reaches_other_workers(self):
+        """Test that a committed status change is published and drops other workers' copies"""
+        from identity.directory import DIDDirectory, INVALIDATION_CHANNEL
+
+        patient = Patient.objects.create(did='did:prism:dir-broadcast', gender='female')
+        writer, reader = DIDDirectory(backend='redis'), DIDDirectory(backend='redis')
+        for directory in (writer, reader):
+            directory._client = mock.Mock()
+            directory._subscriber = True  # No listener thread; messages are delivered below
+        assert reader.lookup(patient.did).status == 'active'
+
+        with self.captureOnCommitCallbacks(execute=True):
+            writer.invalidate(patient.did)
+            assert not writer._client.publish.called  # Not before the write commits
+        writer._client.publish.assert_called_once_with(INVALIDATION_CHANNEL, patient.did)
+
+        patient.active = False
+        patient.save()
+        assert reader.lookup(patient.did).status == 'active'  # Cached until the message arrives
+        reader._on_message(patient.did)
+        with self.assertNumQueries(1):
+            assert reader.lookup(patient.did).status == 'inactive'
+
+
+class DIDBatchResolutionTests(TestCase):
+    """Test batch DID resolution"""
+
+    def test_resolve_dids_returns_documents_and_errors(self):
+        """Test that cached, uncached and invalid DIDs are keyed separately"""
+        did_manager = DIDManager()
+        created = did_manager.create_did(entity_type='patient')
+
+        documents, errors = did_manager.resolve_dids([
+            created['did'],
+            created['did'],
+            'did:prism:uncached123',
+            'did:other:unknown',
+            'not-a-did',
+        ])
+
+        assert documents[created['did']]['public_key'] == created['public_key']
+        assert documents['did:prism:uncached123']['public_key'] is None
+        assert errors == {'did:other:unknown': 'DID not found', 'not-a-did': 'Invalid DID syntax'}
+
+
+class DIDAuthenticationPipelineTests(TestCase):
+    """Test that middleware and DRF share one authentication pass"""
+
+    def test_request_is_verified_once(self):
+        """Test that the middleware defers work and DRF reuses its result"""
+        did_info = get_did_manager().create_did(entity_type='patient')
+        message = f"{int(time.time())}:pipeline-1"
+        signature = keys.sign_message(did_info['key_type'], did_info['private_key'], message)
+        request = RequestFactory().get(
+            '/api/identity/profile/',
+            HTTP_AUTHORIZATION=f"DID {did_info['did']} signature:{signature}",
+            HTTP_X_DID_MESSAGE=message,
+        )
+        drf_request = mock.Mock(_request=request)
+
+        with mock.patch.object(
+            get_did_manager(), 'verify_and_resolve', wraps=get_did_manager().verify_and_resolve
+        ) as verify:
+            DIDAuthenticationMiddleware(lambda r: None)(request)
+            assert request.did == did_info['did']
+            assert verify.call_count == 0
+
+            user, _ = DIDAuthentication().authenticate(drf_request)
+            assert request.user.did == user.did
+            assert request.did_document['public_key'] == did_info['public_key']
+            assert verify.call_count == 1
+
+    def test_invalid_signature_is_anonymous_in_django(self):
+        """Test that a bad signature leaves Django views with AnonymousUser"""
+        request = RequestFactory().get(
+            '/', HTTP_AUTHORIZATION='DID did:prism:nobody signature:abcd',
+            HTTP_X_DID_MESSAGE=f"{int(time.time())}:pipeline-2",
+        )
+        DIDAuthenticationMiddleware(lambda r: None)(request)
+
+        assert not request.user.is_authenticated
+
+    def test_inactive_account_is_rejected(self):
+        """Test that a valid signature from a deactivated account does not authenticate"""
+        did_info = get_did_manager().create_did(entity_type='patient')
+        patient = Patient.objects.create(did=did_info['did'], gender='female')
+
+        def authenticate(nonce):
+            message = f"{int(time.time())}:{nonce}"
+            signature = keys.sign_message(did_info['key_type'], did_info['private_key'], message)
+            request = RequestFactory().get(
+                '/api/identity/profile/',
+                HTTP_AUTHORIZATION=f"DID {did_info['did']} signature:{signature}",
+                HTTP_X_DID_MESSAGE=message,
+            )
+            return DIDAuthentication().authenticate(mock.Mock(_request=request))
+
+        user, _ = authenticate('inactive-1')
+        assert user.is_active and user.entity_id == patient.id
+
+        patient.active = False
+        patient.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            authenticate('inactive-2')
@@ -0,0 +1,251 @@
+"""
+Tests for the generic FHIR resource pipeline
+"""
+import os
+import tempfile
+from unittest import mock
+from django.test import TestCase
+from fhir.anchoring import flush_anchors
+from fhir.bundles import process_bundle
+from fhir.mapping import ReferenceResolver, UPDATE_MAPPERS, to_fhir
+from fhir.models import AccessLog, Encounter, MedicationRequest, Observation, Patient, Practitioner
+from api.audit import AuditBuffer
+
+
+class ResourcePipelineTests(TestCase):
+    """Test mapping, deferred anchoring and buffered audit logging"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:pipeline-patient', gender='female')
+        self.doctor = Practitioner.objects.create(did='did:prism:pipeline-doctor')
+
+    def _entry(self, resource):
+        return {'request': {'method': 'POST', 'url': resource['resourceType']}, 'resource': resource}
+
+    def _resources(self):
+        subject = {'reference': f'Patient/{self.patient.id}'}
+        return [
+            {'resourceType': 'Encounter', 'status': 'finished', 'class': {'code': 'AMB'}, 'subject': subject,
+             'period': {'start': '2024-03-01T10:00:00Z'},
+             'participant': [{'individual': {'reference': f'Practitioner/{self.doctor.id}'}}]},
+            {'resourceType': 'MedicationRequest', 'status': 'active', 'intent': 'order', 'subject': subject,
+             'medicationCodeableConcept': {'text': 'Amoxicillin'}},
+        ]
+
+    def test_new_resource_types_round_trip(self):
+        """Test that Encounter and MedicationRequest map to rows and back"""
+        encounter, medication = self._resources()
+        process_bundle({'resourceType': 'Bundle', 'type': 'transaction',
+                        'entry': [self._entry(encounter), self._entry(medication)]}, self.doctor.did)
+
+        stored = to_fhir(Encounter.objects.get())
+        assert stored['class'] == {'code': 'AMB'}
+        assert stored['participant'][0]['individual']['reference'] == f'Practitioner/{self.doctor.id}'
+        assert to_fhir(MedicationRequest.objects.get())['medicationCodeableConcept'] == {'text': 'Amoxicillin'}
+
+        mapped = UPDATE_MAPPERS['Patient']({'resourceType': 'Patient', 'gender': 'male'}, self.patient.id,
+                                           ReferenceResolver({}))
+        assert mapped.instance.gender == 'male' and not mapped.instance.did
+
+    def test_deferred_records_are_anchored_in_one_batch(self):
+        """Test that deferred records wait for flush_anchors, which anchors them together"""
+        result = process_bundle({'resourceType': 'Bundle', 'type': 'transaction',
+                                 'entry': [self._entry(r) for r in self._resources()]},
+                                self.doctor.did, defer_anchoring=True)
+        assert result.tx_id is None
+        assert not Encounter.objects.filter(blockchain_tx_id__isnull=False).exists()
+
+        assert flush_anchors() == 2
+        assert flush_anchors() == 0
+        tx_ids = sorted(
+            list(Encounter.objects.values_list('blockchain_tx_id', flat=True))
+            + list(MedicationRequest.objects.values_list('blockchain_tx_id', flat=True))
+        )
+        assert len({tx_id.partition('#')[0] for tx_id in tx_ids}) == 1
+        assert sorted(tx_id.partition('#')[2] for tx_id in tx_ids) == ['0', '1']
+        assert not Observation.objects.exists()
+
+    def test_losing_update_anchors_nothing(self):
+        """Test that only an update whose compare-and-set is stored reaches the chain"""
+        from datetime import timedelta
+        from django.test import override_settings
+        from django.utils import timezone
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from api.conditional import etag
+        from api.endpoints.resources import viewset_for
+        from fhir.models import ConsentRecord
+        from identity import DIDUser
+
+        ConsentRecord.objects.create(patient=self.patient, practitioner=self.doctor, status='active',
+                                     expires_at=timezone.now() + timedelta(days=30), consent_tx_id='pipeline')
+        medication = self._resources()[1]
+        process_bundle({'resourceType': 'Bundle', 'type': 'transaction', 'entry': [self._entry(medication)]},
+                       self.doctor.did)
+        stored = MedicationRequest.objects.get()
+
+        def put(text, version):
+            request = APIRequestFactory().put(f'/api/MedicationRequest/{stored.id}', {
+                **medication, 'medicationCodeableConcept': {'text': text},
+            }, format='json', HTTP_IF_MATCH=etag(version))
+            force_authenticate(request, user=DIDUser(self.doctor.did, role='provider', entity_id=self.doctor.id))
+            return viewset_for('MedicationRequest').as_view({'put': 'update'})(request, pk=str(stored.id))
+
+        with override_settings(FHIR_DEFER_ANCHORING=False), \
+                mock.patch('blockchain.cardano_client.CardanoClient.submit_record_batch',
+                           return_value='tx-put') as submit, \
+                mock.patch('api.endpoints.resources.get_audit_buffer'):
+            with self.captureOnCommitCallbacks(execute=True):
+                assert put('Penicillin', 'stale').status_code == 412
+            assert not submit.called
+
+            with self.captureOnCommitCallbacks(execute=True):
+                assert put('Penicillin', stored.blockchain_hash).status_code == 200
+            assert submit.call_count == 1
+
+        amended = MedicationRequest.objects.get()
+        assert amended.blockchain_tx_id == 'tx-put#0' and amended.blockchain_hash != stored.blockchain_hash
+
+    def test_audit_buffer_writes_in_batches(self):
+        """Test that access events are held until the buffer fills, then anchored together"""
+        buffer = AuditBuffer(size=3, interval=3600)
+        for _ in range(2):
+            buffer.record(self.doctor.did, self.patient.id, 'Patient', self.patient.id, 'read')
+        assert len(buffer) == 2 and not AccessLog.objects.exists()
+
+        buffer.record(self.doctor.did, self.patient.id, 'Patient', self.patient.id, 'update')
+        assert len(buffer) == 3 and not AccessLog.objects.exists()
+        assert buffer.flush_if_due() == 3 and len(buffer) == 0
+        tx_ids = sorted(AccessLog.objects.values_list('blockchain_tx_id', flat=True))
+        assert [tx_id.partition('#')[2] for tx_id in tx_ids] == ['0', '1', '2']
+        assert buffer.flush() == 0
+
+    def test_audit_buffer_survives_anchoring_outage(self):
+        """Test that recording never raises and overflow is spilled to disk, then written"""
+        buffer = AuditBuffer(size=1, interval=3600, max_events=2, spill_dir=tempfile.mkdtemp())
+        with mock.patch('blockchain.cardano_client.CardanoClient.submit_access_batch',
+                        side_effect=ConnectionError('node unreachable')):
+            for _ in range(5):
+                buffer.record(self.doctor.did, self.patient.id, 'Patient', self.patient.id, 'read')
+            with self.assertRaises(ConnectionError):
+                buffer.flush()
+        assert len(buffer) == 2 and os.listdir(buffer.spill_dir)
+
+        assert buffer.flush() == 5
+        assert AccessLog.objects.count() == 5 and not os.listdir(buffer.spill_dir)
+
+    def test_anchored_audit_events_survive_a_failed_insert(self):
+        """Test that events anchored but not inserted are spilled and written without anchoring again"""
+        from django.db import OperationalError
+
+        buffer = AuditBuffer(size=10, interval=3600, spill_dir=tempfile.mkdtemp())
+        for _ in range(3):
+            buffer.record(self.doctor.did, self.patient.id, 'Patient', self.patient.id, 'read')
+        outage = OperationalError('database unavailable')
+        with mock.patch.object(AccessLog.objects, 'bulk_create', side_effect=outage), \
+                mock.patch.object(AccessLog, 'save', side_effect=outage):
+            assert buffer.flush() == 0
+        assert len(buffer) == 0 and os.listdir(buffer.spill_dir)
+
+        with mock.patch('blockchain.cardano_client.CardanoClient.submit_access_batch') as submit:
+            assert buffer.flush() == 3
+        assert not submit.called
+        tx_ids = sorted(AccessLog.objects.values_list('blockchain_tx_id', flat=True))
+        assert [tx_id.partition('#')[2] for tx_id in tx_ids] == ['0', '1', '2']
+
+
+class VersionHistoryTests(TestCase):
+    """Test delta storage and reconstruction of past versions"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:history-patient', gender='female')
+
+    def test_diff_round_trips(self):
+        """Test that json_diff records only what changed and apply_patch replays it"""
+        from fhir.history import apply_patch, json_diff
+
+        old = {'status': 'final', 'valueQuantity': {'value': 70, 'unit': 'bpm'}, 'note': [{'text': 'a/b'}]}
+        new = {'status': 'amended', 'valueQuantity': {'value': 72, 'unit': 'bpm'}, 'a/b': 1}
+        patch = json_diff(old, new)
+
+        assert {'op': 'replace', 'path': '/valueQuantity/value', 'value': 72} in patch
+        assert {'op': 'add', 'path': '/a~1b', 'value': 1} in patch
+        assert apply_patch(old, patch) == new
+        assert old['valueQuantity']['value'] == 70
+
+    def test_versions_rebuild_from_snapshots(self):
+        """Test that every version is rebuilt from the nearest snapshot and its deltas"""
+        from django.test import override_settings
+        from fhir.history import load_history, load_version, record_update
+        from fhir.models import ResourceVersion
+
+        observation = Observation.objects.create(
+            patient=self.patient, status='final', code={'text': 'HR'},
+            value_quantity={'value': 70}, blockchain_hash='v70',
+        )
+        with override_settings(FHIR_HISTORY_SNAPSHOT_INTERVAL=3):
+            for value in range(71, 76):
+                before = Observation.objects.get(id=observation.id)
+                Observation.objects.filter(id=observation.id).update(
+                    value_quantity={'value': value}, blockchain_hash=f'v{value}',
+                )
+                record_update(before, Observation.objects.get(id=observation.id), 'did:prism:doctor')
+
+        rows = ResourceVersion.objects.filter(resource_id=observation.id).order_by('version')
+        assert [row.snapshot is not None for row in rows] == [True, False, False, True, False, False]
+
+        with self.assertNumQueries(2):
+            history = load_history('Observation', observation.id, count=3)
+        assert [content['valueQuantity']['value'] for _, content in history] == [75, 74, 73]
+        older = load_history('Observation', observation.id, count=3, before=history[-1][0].version)
+        assert [content['valueQuantity']['value'] for _, content in older] == [72, 71, 70]
+
+        row, content = load_version('Observation', observation.id, 'v72')
+        assert row.version == 3 and content['valueQuantity'] == {'value': 72}
+        assert load_version('Observation', observation.id, 'missing') is None
+
+    def test_vread_re_hashes_past_versions(self):
+        """Test that a stored version is checked against the hash it was anchored with"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from api.endpoints.resources import viewset_for
+        from fhir.models import ConsentRecord, ResourceVersion
+        from identity import DIDUser
+
+        doctor = Practitioner.objects.create(did='did:prism:history-doctor')
+        ConsentRecord.objects.create(
+            patient=self.patient, practitioner=doctor, status='active',
+            expires_at=timezone.now() + timedelta(days=30), consent_tx_id='history-consent',
+        )
+        user = DIDUser(doctor.did, role='provider', entity_id=doctor.id)
+        audit = mock.patch('api.endpoints.resources.get_audit_buffer')
+        audit.start()
+        self.addCleanup(audit.stop)
+        resource = {'resourceType': 'Observation', 'status': 'final', 'code': {'text': 'HR'},
+                    'subject': {'reference': f'Patient/{self.patient.id}'},
+                    'effectiveDateTime': '2024-03-01T10:00:00Z', 'valueQuantity': {'value': 70}}
+        process_bundle({'resourceType': 'Bundle', 'type': 'transaction', 'entry': [
+            {'request': {'method': 'POST', 'url': 'Observation'}, 'resource': resource},
+        ]}, doctor.did, defer_anchoring=False)
+        observation = Observation.objects.get()
+        first = observation.blockchain_hash
+
+        request = APIRequestFactory().put(f'/api/Observation/{observation.id}', {
+            **resource, 'id': str(observation.id), 'valueQuantity': {'value': 72},
+        }, format='json')
+        force_authenticate(request, user=user)
+        assert viewset_for('Observation').as_view({'put': 'update'})(request, pk=str(observation.id)).status_code == 200
+
+        def vread():
+            request = APIRequestFactory().get(f'/api/Observation/{observation.id}/_history/{first}')
+            force_authenticate(request, user=user)
+            return viewset_for('Observation').as_view({'get': 'vread'})(request, pk=str(observation.id), vid=first)
+
+        response = vread()
+        assert response.status_code == 200 and response.data['valueQuantity'] == {'value': 70}
+
+        # Edit the superseded version behind the chain's back
+        row = ResourceVersion.objects.get(resource_id=observation.id, version=1)
+        row.snapshot['valueQuantity'] = {'value': 60}
+        row.save()
+        assert vread().status_code == 500
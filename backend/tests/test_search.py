@@ -0,0 +1,124 @@
+"""
+Tests for FHIR search parameters
+"""
+import pytest
+from datetime import datetime, timezone
+from django.http import QueryDict
+from django.test import TestCase
+from fhir.models import Patient, Observation
+from fhir.search import parse_date_range, parse_search, plan_search, search
+
+LOINC = 'http://loinc.org'
+
+
+class SearchParameterTests(TestCase):
+    """Test token and date search semantics"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(
+            did='did:prism:search', gender='female',
+            identifier=[{'system': 'urn:nhis', 'value': 'NH-1'}],
+        )
+        for i, (code, category) in enumerate([('8867-4', 'vital-signs'), ('8867-4', 'laboratory'),
+                                              ('789-8', 'laboratory')]):
+            Observation.objects.create(
+                patient=self.patient, status='final',
+                code={'coding': [{'system': LOINC, 'code': code}]},
+                category=[{'coding': [{'code': category}]}],
+                effective_datetime=datetime(2024, 3, 1 + i, 10, tzinfo=timezone.utc),
+                blockchain_hash=f'search{i}',
+            )
+
+    def test_date_precision_defines_the_range(self):
+        """Test that partial dates cover their whole period"""
+        start, end = parse_date_range('2024-02')
+        assert (start.day, end.month, end.day) == (1, 3, 1)
+        start, end = parse_date_range('2024-03-05T10:00+02:00')
+        assert start.utcoffset().total_seconds() == 7200
+        assert (end - start).total_seconds() == 60
+
+    def test_tokens_and_dates_combine(self):
+        """Test system|code tokens, OR lists and ANDed date bounds"""
+        def count(query, resource_type='Observation'):
+            return search(resource_type, QueryDict(query)).count()
+
+        assert count(f'code={LOINC}|8867-4') == 2
+        assert count('code=8867-4,789-8&category=laboratory') == 2
+        assert count('date=ge2024-03-02&date=lt2024-03-03') == 1
+        assert count('identifier=urn:nhis|NH-1', 'Patient') == 1
+        assert count('identifier=urn:nhis|NH-2', 'Patient') == 0
+
+    def test_plan_orders_by_estimate(self):
+        """Test that clauses come back most selective first"""
+        clauses = plan_search('Observation', parse_search('Observation', QueryDict('status=final&date=2024-03-02')))
+
+        assert sorted(c.name for c in clauses) == ['date', 'status']
+        assert [c.estimate for c in clauses] == sorted(c.estimate for c in clauses)
+
+        # Other values of the same shape reuse the estimate without an EXPLAIN
+        with self.assertNumQueries(0):
+            plan_search('Observation', parse_search('Observation', QueryDict('status=amended&date=2023-01-09')))
+
+    def test_elements_limit_columns_and_output(self):
+        """Test that _elements loads and renders only what was asked for"""
+        from fhir.mapping import to_fhir
+        from fhir.projection import parse_projection
+
+        projection = parse_projection('Observation', QueryDict('_elements=valueQuantity'))
+        assert projection.elements == {'valueQuantity', 'status', 'code'}
+        assert 'note' not in projection.columns()
+
+        observation = projection.apply(Observation.objects.filter(patient=self.patient)).first()
+        assert observation.get_deferred_fields() >= {'note', 'reference_range', 'category'}
+        with self.assertNumQueries(0):
+            resource = to_fhir(observation, projection.elements)
+        assert set(resource) == {'resourceType', 'id', 'meta', 'status', 'code'}
+        assert resource['meta']['tag'][0]['code'] == 'SUBSETTED'
+
+        summary = parse_projection('Patient', QueryDict('_summary=true'))
+        assert 'maritalStatus' not in summary.elements and 'identifier' in summary.elements
+        assert parse_projection('Patient', QueryDict('')).columns() is None
+        with pytest.raises(ValueError):
+            parse_projection('Observation', QueryDict('_summary=true&_elements=code'))
+
+
+class QuantitySearchTests(TestCase):
+    """Test derived code and value columns and value-quantity comparators"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:quantity', gender='male')
+        for i, (code, value, unit) in enumerate([('4548-4', 6.2, '%'), ('4548-4', 7.1, '%'),
+                                                 ('29463-7', 150, '[lb_av]'), ('29463-7', 72, 'kg'),
+                                                 ('8310-5', 100.4, '[degF]')]):
+            Observation.objects.create(
+                patient=self.patient, status='final',
+                code={'coding': [{'system': 'urn:local', 'code': ''}, {'system': LOINC, 'code': code}]},
+                value_quantity={'value': value, 'system': 'http://unitsofmeasure.org', 'code': unit},
+                blockchain_hash=f'quantity{i}',
+            )
+
+    def test_values_are_stored_in_canonical_units(self):
+        """Test that the primary coding and a canonical value and unit are derived"""
+        weight = Observation.objects.get(blockchain_hash='quantity2')
+        assert (weight.code_system, weight.code_value) == (LOINC, '29463-7')
+        assert weight.value_unit == 'kg' and round(weight.value_numeric, 2) == 68.04
+        temperature = Observation.objects.get(blockchain_hash='quantity4')
+        assert temperature.value_unit == 'Cel' and round(temperature.value_numeric, 1) == 38.0
+
+    def test_quantity_comparators(self):
+        """Test prefixes, implied precision, unit conversion and the composite parameter"""
+        def hashes(query):
+            return sorted(search('Observation', QueryDict(query)).values_list('blockchain_hash', flat=True))
+
+        assert hashes(f'code-value-quantity={LOINC}|4548-4$gt6.5') == ['quantity1']
+        assert hashes('code-value-quantity=4548-4$le6.2,4548-4$ge7.1') == ['quantity0', 'quantity1']
+        assert hashes('value-quantity=7.1||%') == ['quantity1']
+        assert hashes('value-quantity=7||%') == ['quantity1']
+        assert hashes('value-quantity=gt155|http://unitsofmeasure.org|[lb_av]') == ['quantity3']
+        assert hashes('value-quantity=ge100|http://unitsofmeasure.org|[degF]') == ['quantity4']
+        assert hashes('value-quantity=ap70||kg') == ['quantity2', 'quantity3']
+
+        with pytest.raises(ValueError):
+            parse_search('Observation', QueryDict('code-value-quantity=gt6.5'))
+        with pytest.raises(ValueError):
+            parse_search('Observation', QueryDict('value-quantity=high'))
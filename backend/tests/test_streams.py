@@ -0,0 +1,96 @@
+"""
+Tests for device stream ingestion
+"""
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from django.db import DatabaseError
+from django.http import QueryDict
+from django.test import TestCase
+from fhir.anchoring import flush_anchors
+from fhir.models import Observation, ObservationChunk, Patient
+from fhir.streams import ChunkSearch, decode_readings, encode_readings, ingest_readings
+from fhir.timeseries import bucket_start, bucket_time, bucket_values, chunk_buckets, merge_buckets
+
+HEART_RATE = {'coding': [{'system': 'http://loinc.org', 'code': '8867-4'}]}
+
+
+class DeviceStreamTests(TestCase):
+    """Test chunk encoding, merging ingests and reads over chunks"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:stream', gender='female')
+        self.start = datetime(2024, 3, 1, 8, tzinfo=timezone.utc)
+
+    def _readings(self, seconds, first=0):
+        return [(self.start + timedelta(seconds=first + s), 60 + (s % 7) * 0.5) for s in range(seconds)]
+
+    def test_encoding_round_trips_compactly(self):
+        """Test that delta/varint packing restores times and values"""
+        readings = self._readings(3600)
+        data = encode_readings(self.start, readings)
+
+        assert decode_readings(self.start, data) == readings
+        assert len(data) < 3600
+        negative = [(self.start + timedelta(milliseconds=1500), -3.25), (self.start + timedelta(minutes=59), 1e4)]
+        assert decode_readings(self.start, encode_readings(self.start, negative)) == negative
+
+    def test_ingest_chunks_by_hour_and_merges_retries(self):
+        """Test one chunk per hour, idempotent resends and anchoring per chunk"""
+        chunks = ingest_readings(self.patient, 'cuff-1', HEART_RATE, 'bpm', self._readings(5400),
+                                 'did:prism:device', defer_anchoring=True)
+        assert [(c.start.hour, c.count) for c in chunks] == [(8, 3600), (9, 1800)]
+        assert chunks[0].unit == '/min' and chunks[0].last_time == self.start + timedelta(seconds=3599)
+        assert ingest_readings(self.patient, 'cuff-1', HEART_RATE, '/min', self._readings(60),
+                               'did:prism:device', defer_anchoring=True) == []
+
+        assert flush_anchors() == 2
+        first_hash = ObservationChunk.objects.get(start__hour=9).blockchain_hash
+        added = ingest_readings(self.patient, 'cuff-1', HEART_RATE, 'bpm', self._readings(10, first=5400),
+                                'did:prism:device', defer_anchoring=True)
+        assert [c.count for c in added] == [1810]
+        stored = ObservationChunk.objects.get(start__hour=9)
+        assert stored.blockchain_hash != first_hash and stored.blockchain_tx_id is None
+        assert ObservationChunk.objects.count() == 2 and not Observation.objects.exists()
+
+    def test_chunks_are_anchored_after_the_ingest_commits(self):
+        """Test that a failed ingest anchors nothing and a stored one anchors its chunks once"""
+        with mock.patch('blockchain.cardano_client.CardanoClient.submit_record_batch',
+                        return_value='tx-stream') as submit:
+            with self.captureOnCommitCallbacks(execute=True), \
+                    mock.patch.object(ObservationChunk.objects, 'bulk_update', side_effect=DatabaseError('lost')):
+                with self.assertRaises(DatabaseError):
+                    ingest_readings(self.patient, 'cuff-1', HEART_RATE, 'bpm', self._readings(60),
+                                    'did:prism:device', defer_anchoring=False)
+            assert not submit.called and not ObservationChunk.objects.exists()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                ingest_readings(self.patient, 'cuff-1', HEART_RATE, 'bpm', self._readings(5400),
+                                'did:prism:device', defer_anchoring=False)
+            assert submit.call_count == 1
+        assert sorted(ObservationChunk.objects.values_list('blockchain_tx_id', flat=True)) == [
+            'tx-stream#0', 'tx-stream#1',
+        ]
+
+    def test_reads_combine_chunks_and_rows(self):
+        """Test that date filters apply per reading and buckets merge with observation rows"""
+        ingest_readings(self.patient, 'cuff-1', HEART_RATE, 'bpm', self._readings(7200), 'did:prism:device',
+                        defer_anchoring=True)
+        Observation.objects.create(
+            patient=self.patient, status='final', code=HEART_RATE, effective_datetime=self.start,
+            value_quantity={'value': 100, 'code': '/min'}, blockchain_hash='stream-row',
+        )
+        params = QueryDict(mutable=True)
+        params.setlist('code', ['http://loinc.org|8867-4'])
+        params.setlist('date', ['ge2024-03-01T08:30:00Z', 'lt2024-03-01T09:30:00Z'])
+        chunks = ChunkSearch(ObservationChunk.objects.filter(patient=self.patient), params)
+
+        readings = [(t, v) for t, v in self._readings(7200) if chunks.matches(t)]
+        assert [(r['time'], r['value']) for r in chunks.readings()] == readings
+        assert len(readings) == 3600
+
+        whole = ChunkSearch(ObservationChunk.objects.filter(patient=self.patient), QueryDict('code=8867-4'))
+        buckets = merge_buckets(bucket_values(Observation.objects.all(), 'hour'), chunk_buckets(whole, 'hour'))
+        assert [bucket_time(b['bucket']).hour for b in buckets] == [8, 9]
+        assert buckets[0]['count'] == 3601 and buckets[0]['max'] == 100
+        assert buckets[0]['bucket'] == bucket_start(self.start, 'hour')
+        assert [b['count'] for b in chunk_buckets(chunks, 'hour')] == [1800, 1800]
@@ -0,0 +1,124 @@
+"""
+Tests for encounter period search and the patient timeline
+"""
+from datetime import datetime, timedelta, timezone
+from django.core.management import call_command
+from django.http import QueryDict
+from django.test import TestCase
+from fhir.models import ConsentRecord, Encounter, MedicationRequest, Observation, Patient, Practitioner
+from fhir.search import search
+from identity import DIDUser
+from api.authorization import restrict_to_patient
+from api.endpoints.timeline import load_timeline
+
+INPATIENT = {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'IMP'}
+
+
+class EncounterPeriodTests(TestCase):
+    """Test the derived period range and range search parameters"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:periods', gender='male')
+        day = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        for i, (start, end, kind) in enumerate([
+            (day - timedelta(days=3), day + timedelta(hours=12), INPATIENT),   # spans the day
+            (day + timedelta(hours=9), day + timedelta(hours=10), {'code': 'AMB'}),
+            (day + timedelta(days=2), None, INPATIENT),                        # still admitted
+        ]):
+            Encounter.objects.create(patient=self.patient, status='in-progress', encounter_class=kind,
+                                     period_start=start, period_end=end, blockchain_hash=f'period{i}')
+
+    def _hashes(self, query):
+        return sorted(search('Encounter', QueryDict(query)).values_list('blockchain_hash', flat=True))
+
+    def test_range_parameters(self):
+        """Test overlap, containment and FHIR period prefixes"""
+        assert self._hashes('period-overlaps=2024-03-01') == ['period0', 'period1']
+        assert self._hashes(f"period-overlaps=2024-03-01&class={INPATIENT['system']}|IMP") == ['period0']
+        assert self._hashes('period-contains=2024-03-01T09:30:00Z') == ['period0', 'period1']
+        assert self._hashes('date=2024-03-01') == ['period1']
+        assert self._hashes('date=ge2024-03-02&date=le2024-03-31') == ['period2']
+        assert self._hashes('date=sa2024-03-01') == ['period2']
+        assert self._hashes('date=eb2024-03-01') == []
+
+    def test_census_covers_consenting_patients(self):
+        """Test that a provider's census spans the patients whose consent covers encounters"""
+        doctor = Practitioner.objects.create(did='did:prism:census-doctor')
+        user = DIDUser(doctor.did, role='provider', entity_id=doctor.id)
+        expires = datetime.now(timezone.utc) + timedelta(days=30)
+        ConsentRecord.objects.create(patient=self.patient, practitioner=doctor, status='active',
+                                     expires_at=expires, scope=['Encounter'], consent_tx_id='census-all')
+
+        day = datetime(2024, 3, 1, 10, tzinfo=timezone.utc)
+        for name, scope in [('dated', [{'resource_type': 'Encounter', 'end': '2024-02-29'}]),
+                            ('labs', ['Observation']), ('none', None)]:
+            patient = Patient.objects.create(did=f'did:prism:census-{name}', gender='female')
+            for i, start in enumerate([day - timedelta(days=2), day]):
+                Encounter.objects.create(patient=patient, status='in-progress', encounter_class=INPATIENT,
+                                         period_start=start, blockchain_hash=f'{name}{i}')
+            if scope is not None:
+                ConsentRecord.objects.create(patient=patient, practitioner=doctor, status='active',
+                                             expires_at=expires, scope=scope, consent_tx_id=f'census-{name}')
+
+        params = QueryDict('period-overlaps=2024-03-01')
+        census = restrict_to_patient(search('Encounter', params), user, params)
+        assert census.patient_id is None
+        assert sorted(census.queryset.values_list('blockchain_hash', flat=True)) == [
+            'dated0', 'period0', 'period1',
+        ]
+        with self.assertRaises(ValueError):
+            restrict_to_patient(search('Observation', params), user, params)
+
+    def test_backfill_derives_missing_periods(self):
+        """Test that rows written without a period get one from the backfill"""
+        Encounter.objects.update(period=None)
+        call_command('backfill_derived_values', model=['Encounter'], batch_size=2, stdout=open('/dev/null', 'w'))
+
+        encounter = Encounter.objects.get(blockchain_hash='period2')
+        assert encounter.period.lower == encounter.period_start and encounter.period.upper is None
+        assert not Encounter.objects.filter(period__isnull=True).exists()
+
+
+class TimelineTests(TestCase):
+    """Test merged, paged timelines"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:timeline', gender='female')
+        self.start = datetime(2024, 3, 1, 8, tzinfo=timezone.utc)
+        self.encounter = Encounter.objects.create(
+            patient=self.patient, status='finished', encounter_class=INPATIENT, period_start=self.start,
+            period_end=self.start + timedelta(hours=6), blockchain_hash='timeline-encounter',
+        )
+        for i in range(5):
+            Observation.objects.create(
+                patient=self.patient, status='final', code={'text': 'HR'}, value_quantity={'value': 70 + i},
+                effective_datetime=self.start + timedelta(hours=2 * i), blockchain_hash=f'timeline-obs{i}',
+            )
+        MedicationRequest.objects.create(
+            patient=self.patient, status='active', intent='order', medication_codeable_concept={'text': 'Aspirin'},
+            blockchain_hash='timeline-med',
+        )
+
+    def test_entries_merge_newest_first_across_pages(self):
+        """Test time order across types, per-type cursors and encounter context"""
+        seen = []
+        cursors = None
+        types = ['Encounter', 'Observation', 'MedicationRequest']
+        while True:
+            with self.assertNumQueries(len(types) + 1):
+                page = load_timeline(self.patient.id, types, 3, cursors=cursors)
+            seen.extend(page.entries)
+            if not page.cursors:
+                break
+            cursors = page.cursors
+            types = list(cursors)
+
+        times = [time for time, _, _ in seen]
+        assert times == sorted(times, reverse=True)
+        assert len(seen) == 7 and seen[0][1] == 'MedicationRequest'
+        assert len({instance.id for _, _, instance in seen}) == 7
+
+        page = load_timeline(self.patient.id, ['Observation'], 5)
+        linked = [page.encounters.get(instance.id) for _, _, instance in page.entries]
+        assert [e.id if e else None for e in linked] == [None, None, self.encounter.id,
+                                                         self.encounter.id, self.encounter.id]
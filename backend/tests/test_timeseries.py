@@ -0,0 +1,74 @@
+"""
+Tests for observation time series
+"""
+from datetime import datetime, timedelta, timezone
+from django.test import TestCase
+from fhir.models import Patient, Observation
+from fhir.timeseries import bucket_time, bucket_values, lttb, merge_buckets
+from blockchain import get_hash_manager
+
+
+class TimeSeriesTests(TestCase):
+    """Test numeric extraction, SQL bucketing and LTTB downsampling"""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(did='did:prism:series', gender='female')
+        self.start = datetime(2024, 3, 1, 8, tzinfo=timezone.utc)
+
+    def _observation(self, minutes, value, unit='mmol/L', **fields):
+        return Observation.objects.create(
+            patient=self.patient, status='final', code={'text': 'Glucose'},
+            effective_datetime=self.start + timedelta(minutes=minutes),
+            value_quantity={'value': value, 'unit': unit},
+            blockchain_hash=f'series{minutes}', **fields,
+        )
+
+    def test_numeric_value_is_derived_and_not_hashed(self):
+        """Test that value_numeric follows value_quantity without changing the record hash"""
+        observation = self._observation(0, 5)
+        assert observation.value_numeric == 5.0
+        record_hash = get_hash_manager().generate_record_hash(observation)
+
+        Observation.objects.filter(id=observation.id).update(value_numeric=None)
+        assert get_hash_manager().generate_record_hash(Observation.objects.get(id=observation.id)) == record_hash
+
+        observation.value_quantity = {'value': 'high'}
+        observation.derive_values()
+        assert observation.value_numeric is None
+
+    def test_buckets_aggregate_in_sql(self):
+        """Test per-hour min/max/avg/count and the latest value of each bucket"""
+        for minutes, value in [(0, 4.0), (20, 9.0), (40, 5.0), (70, 6.0)]:
+            self._observation(minutes, value)
+        self._observation(10, None)
+
+        with self.assertNumQueries(1):
+            buckets = bucket_values(Observation.objects.filter(patient=self.patient), 'hour')
+
+        assert [bucket_time(b['bucket']) for b in buckets] == [self.start, self.start + timedelta(hours=1)]
+        assert buckets[0] == {'bucket': buckets[0]['bucket'], 'unit': 'mmol/L', 'count': 3, 'min': 4.0,
+                              'max': 9.0, 'avg': 6.0, 'last': 5.0, 'last_time': buckets[0]['last_time']}
+        assert (buckets[1]['count'], buckets[1]['last']) == (1, 6.0)
+
+    def test_units_without_conversion_are_bucketed_apart(self):
+        """Test that mg/dL and mmol/L glucose values are never averaged together"""
+        self._observation(0, 5.0)
+        self._observation(10, 7.0)
+        self._observation(20, 90.0, unit='mg/dL')
+
+        buckets = bucket_values(Observation.objects.filter(patient=self.patient), 'hour')
+        assert [(b['unit'], b['count'], b['avg']) for b in buckets] == [('mg/dL', 1, 90.0), ('mmol/L', 2, 6.0)]
+        merged = merge_buckets(buckets, [dict(buckets[1], count=1, avg=8.0, min=8.0, max=8.0)])
+        assert [(b['unit'], b['count']) for b in merged] == [('mg/dL', 1), ('mmol/L', 3)]
+        assert merged[1]['avg'] == (5.0 + 7.0 + 8.0) / 3
+
+    def test_lttb_keeps_ends_and_peaks(self):
+        """Test that downsampling keeps the first and last points and an isolated spike"""
+        points = [(float(x), 100.0 if x == 500 else float(x % 7)) for x in range(1000)]
+        kept = lttb(points, 50)
+
+        assert len(kept) == 50
+        assert kept[0] == 0 and kept[-1] == 999
+        assert 500 in kept
+        assert kept == sorted(kept)
+        assert lttb(points[:10], 50) == list(range(10))